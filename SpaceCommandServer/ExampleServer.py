@@ -9,6 +9,7 @@ import sys
 import yaml
 
 from TinkerSpaceCommandServer.SpaceCommandServer import *
+from TinkerSpaceCommandServer import Constants
 from TinkerSpaceCommandServer.comms.MqttCommunicationProvider import *
 from TinkerSpaceCommandServer.processor.SensorProcessor import *
 from TinkerSpaceCommandServer.entities.EntityRegistry import *
@@ -40,11 +41,19 @@ entity_registry.prepare_runtime_models()
 # entity_registry.get_sensor_active_model('sensor.esp8266.FE13DE').register_value_update_observer(SensorPrintObserver())
 
 server = SpaceCommandServer(config)
-server.sensor_processor = SensorProcessor(entity_registry)
-server.addCommunicationProvider( MqttCommunicationProvider(config) )
-event_persistence = InfluxEventPersistence(config)
+server.sensor_processor = SensorProcessor(entity_registry, config.get("processor", {}).get("offlineCheckResolution", Constants.SENSOR_OFFLINE_CHECK_RESOLUTION))
+if server.runtime == Constants.SERVER_RUNTIME_ASYNCIO:
+  from TinkerSpaceCommandServer.comms.AsyncMqttCommunicationProvider import AsyncMqttCommunicationProvider
+  server.addCommunicationProvider( AsyncMqttCommunicationProvider(config) )
+else:
+  server.addCommunicationProvider( MqttCommunicationProvider(config) )
+if config["persistence"].get("backend", Constants.PERSISTENCE_BACKEND) == Constants.PERSISTENCE_BACKEND_LOCAL:
+  from TinkerSpaceCommandServer.persistence.LocalEventPersistence import LocalEventPersistence
+  event_persistence = LocalEventPersistence(config)
+else:
+  event_persistence = InfluxEventPersistence(config)
 event_persistence.attach_sensor_processor(server.sensor_processor)
-event_persistence.start()
 server.event_persistence = event_persistence
 
 server.start()
+server.wait_for_shutdown()
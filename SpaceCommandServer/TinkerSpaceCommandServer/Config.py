@@ -39,3 +39,7 @@ CONFIG_NAME_PHYSICAL_LOCATIONS = "physicalLocations"
 CONFIG_NAME_SENSOR_UPDATE_TIME_LIMIT = "sensorUpdateTimeLimit"
 
 CONFIG_NAME_SENSOR_HEARTBEAT_TIME_LIMIT = "sensorHeartbeatTimeLimit"
+
+CONFIG_NAME_HISTORY_SIZE = "historySize"
+
+CONFIG_NAME_HISTORY_WINDOW = "historyWindow"
@@ -2,19 +2,339 @@
 # This file contains constants for various functionality in TinkerSpaceCommand.
 #
 
-# How often to scan for offline sensors.
+# The resolution of offline sensor detection. A sensor is marked offline no
+# later than this long after its time limit has passed.
 #
 # The time is in seconds.
-SENSOR_OFFLINE_CHECK_DELAY = 60
+SENSOR_OFFLINE_CHECK_RESOLUTION = 1.0
+
+# The server runtimes. The threaded runtime gives each component its own
+# threads, the asyncio runtime runs every component on one event loop.
+SERVER_RUNTIME_THREADED = "threaded"
+SERVER_RUNTIME_ASYNCIO = "asyncio"
+
+# The default number of recent measurements kept in memory for each sensor
+# channel.
+CHANNEL_HISTORY_SIZE = 1024
+
+# How old the current value of a channel can be and still be in the summary
+# of the values of its location.
+#
+# The time is in seconds.
+LOCATION_VALUE_MAX_AGE = 600.0
+
+# How quickly the weight of a channel's current value in its location's
+# current value falls off. The weight halves every half life.
+#
+# The time is in seconds.
+LOCATION_VALUE_HALF_LIFE = 60.0
 
 #
 # The format for date times.
 #
 SENSOR_TIMESTAMP_DATE_TIME_FORMAT = '%H:%M:%S %b %d, %Y'
 
+# The persistence backends. influxdb writes to an InfluxDB server, local
+# writes to column files in a local directory.
+PERSISTENCE_BACKEND_INFLUXDB = "influxdb"
+PERSISTENCE_BACKEND_LOCAL = "local"
+PERSISTENCE_BACKEND = PERSISTENCE_BACKEND_INFLUXDB
+
 INFLUXDB_MEASUREMENT_NAME_SENSORS = "sensors"
 
 INFLUXDB_TAG_NAME_SENSED = "sensed"
 INFLUXDB_TAG_NAME_SENSOR = "sensor"
 INFLUXDB_TAG_NAME_CHANNEL = "channel"
+INFLUXDB_TAG_NAME_MEASUREMENT_TYPE = "measurement_type"
+
+# The measurements rollups are written to, formatted with the rollup tier
+# name.
+INFLUXDB_MEASUREMENT_NAME_SENSOR_ROLLUPS = "sensors_{}"
+INFLUXDB_MEASUREMENT_NAME_LOCATION_ROLLUPS = "locations_{}"
+
+
+# The maximum number of points written to InfluxDB in one request.
+INFLUXDB_WRITE_BATCH_SIZE = 500
+
+# The longest time a point waits in the write queue before being written.
+#
+# The time is in seconds.
+INFLUXDB_WRITE_FLUSH_INTERVAL = 1.0
+
+# The number of times a failed InfluxDB write is retried.
+INFLUXDB_WRITE_MAX_RETRIES = 3
+
+# The delay between InfluxDB write retries.
+#
+# The time is in seconds.
+INFLUXDB_WRITE_RETRY_DELAY = 1.0
+
+# InfluxDB client errors for a write that are retried. They come from the
+# server's setup, such as a missing database or bad credentials, and can be
+# fixed without changing the points. Any other 4xx means InfluxDB refused the
+# points themselves, so they are dropped rather than retried.
+INFLUXDB_WRITE_RETRIED_CLIENT_ERRORS = [401, 403, 404, 408, 429]
+
+# The maximum number of points waiting to be written to InfluxDB.
+INFLUXDB_WRITE_QUEUE_SIZE = 10000
+
+# The size a write-ahead log segment grows to before a new one is started.
+#
+# The size is in bytes.
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# The most disk the write-ahead log may use. The oldest segments are dropped,
+# shipped or not, to stay under it.
+#
+# The size is in bytes.
+WAL_MAX_SIZE = 1024 * 1024 * 1024
+
+# How often measurements are written to the write-ahead log and fsynced. A
+# crash loses at most this much.
+#
+# The time is in seconds.
+WAL_SYNC_INTERVAL = 0.2
+
+# The most points shipped from the write-ahead log to InfluxDB in one request.
+WAL_REPLAY_BATCH_SIZE = 5000
+
+# The longest wait between tries to ship the write-ahead log while InfluxDB is
+# failing. The wait starts at the InfluxDB write retry delay and doubles.
+#
+# The time is in seconds.
+WAL_MAX_RETRY_DELAY = 30.0
+
+# The directory of the local store.
+LOCAL_STORE_DIRECTORY = "data"
+
+# How often new measurements are written to the local store. A crash loses
+# at most this much.
+#
+# The time is in seconds.
+LOCAL_STORE_FLUSH_INTERVAL = 5.0
+
+# How many days of measurements the local store keeps, 0 for all of them.
+LOCAL_STORE_RETENTION_DAYS = 0
+
+# Whether minute, hour and day rollups of the measurements are kept.
+ROLLUPS_ENABLED = True
+
+# How often changed rollup buckets are persisted. A crash loses at most this
+# much of the rollups.
+#
+# The time is in seconds.
+ROLLUP_FLUSH_INTERVAL = 30.0
+
+# How long after its end a rollup bucket still takes late measurements.
+#
+# The time is in seconds.
+ROLLUP_GRACE_PERIOD = 60.0
+
+# The most rollup rows of a tier kept for writing again while the backend
+# is failing.
+ROLLUP_MAX_UNWRITTEN_ROWS = 100000
+
+# The number of worker threads that decode and process incoming sensor
+# messages.
+INGEST_WORKERS = 2
+
+# The maximum number of raw sensor messages waiting to be processed.
+INGEST_QUEUE_SIZE = 1000
+
+# What to do when a new sensor message arrives and the ingest queue is full.
+#
+# block makes the communication provider wait for space, dropOldest throws
+# away the oldest waiting message and dropNewest throws away the new message.
+INGEST_OVERFLOW_POLICY_BLOCK = "block"
+INGEST_OVERFLOW_POLICY_DROP_OLDEST = "dropOldest"
+INGEST_OVERFLOW_POLICY_DROP_NEWEST = "dropNewest"
+
+INGEST_OVERFLOW_POLICIES = [
+  INGEST_OVERFLOW_POLICY_BLOCK,
+  INGEST_OVERFLOW_POLICY_DROP_OLDEST,
+  INGEST_OVERFLOW_POLICY_DROP_NEWEST
+]
+
+# The format of the start and end date times given to history queries.
+QUERY_DATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%Z"
+
+# The aggregates history queries can be downsampled with. Each is also the
+# name of the InfluxQL function that computes it.
+QUERY_AGGREGATE_MEAN = "mean"
+QUERY_AGGREGATE_MIN = "min"
+QUERY_AGGREGATE_MAX = "max"
+QUERY_AGGREGATE_LAST = "last"
+
+QUERY_AGGREGATES = [
+  QUERY_AGGREGATE_MEAN,
+  QUERY_AGGREGATE_MIN,
+  QUERY_AGGREGATE_MAX,
+  QUERY_AGGREGATE_LAST
+]
+
+# When a query is only limited to a maximum number of points, InfluxDB first
+# averages the range into this many times more buckets than points, which are
+# then reduced to the maximum with the Largest Triangle Three Buckets
+# downsampler.
+QUERY_LTTB_OVERSAMPLING = 4
+
+# The number of aggregated points a location query gives when it is not
+# given a resolution or maximum number of points.
+QUERY_LOCATION_MAX_POINTS = 500
 
+# The maximum number of time buckets kept in the query cache. A size of 0
+# turns the cache off.
+QUERY_CACHE_SIZE = 512
+
+# The length of a query cache bucket of raw measurements.
+#
+# The time is in seconds.
+QUERY_CACHE_BUCKET_SIZE = 3600
+
+# The number of aggregated points in a query cache bucket of aggregated
+# measurements.
+QUERY_CACHE_AGGREGATED_BUCKET_ROWS = 256
+
+# The longest a measurement is expected to wait between being received and
+# being queued to be written, for example on the ingest queue. The query
+# cache allows for this before it takes a bucket as completely written.
+#
+# The time is in seconds.
+QUERY_CACHE_INGEST_LAG = 5.0
+
+# The formats of history query results. json collects the result into one
+# object of parallel arrays, ndjson and jsonArray stream every point as it is
+# read from the database.
+QUERY_FORMAT_JSON = "json"
+QUERY_FORMAT_NDJSON = "ndjson"
+QUERY_FORMAT_JSON_ARRAY = "jsonArray"
+
+QUERY_FORMATS = [
+  QUERY_FORMAT_JSON,
+  QUERY_FORMAT_NDJSON,
+  QUERY_FORMAT_JSON_ARRAY
+]
+
+# The number of points InfluxDB sends in each chunk of a streamed query.
+QUERY_STREAM_CHUNK_SIZE = 5000
+
+# The most batches of live updates sent to a web client per second. Changes
+# in between are coalesced so only the latest value of each channel is sent.
+LIVE_UPDATE_MAX_RATE = 2.0
+
+# The most web clients receiving live updates at once.
+LIVE_UPDATE_MAX_CLIENTS = 32
+
+# How long a live update stream can be idle before a keepalive is sent.
+#
+# The time is in seconds.
+LIVE_UPDATE_KEEPALIVE_INTERVAL = 15.0
+
+# How long a live update client can go without reading its updates before it
+# is dropped to make room for new clients.
+#
+# The time is in seconds.
+LIVE_UPDATE_CLIENT_TIMEOUT = 60.0
+
+# The number of ingest shard processes. With 0, sensors are processed in the
+# server process.
+SHARD_COUNT = 0
+
+# The size of each queue between the server process and an ingest shard.
+#
+# The size is in bytes.
+SHARD_QUEUE_SIZE = 4 * 1024 * 1024
+
+# How often ingest shards send the changes to their sensors to the server
+# process.
+#
+# The time is in seconds.
+SHARD_STATE_INTERVAL = 0.1
+
+# The most channels in one frame of changes from an ingest shard.
+SHARD_STATE_FRAME_CHANNELS = 1000
+
+# How long the server process waits for changes from a shard before checking
+# whether it has stopped.
+#
+# The time is in seconds.
+SHARD_STATE_READ_TIMEOUT = 0.5
+
+# How long an ingest shard has to process what is queued for it when the
+# server stops, before it is terminated.
+#
+# The time is in seconds.
+SHARD_STOP_TIMEOUT = 10.0
+
+# The port MQTT brokers listen on if a configured broker doesn't give one.
+MQTT_BROKER_PORT = 1883
+
+# The shortest and longest delays between tries to reconnect to the MQTT
+# broker on the asyncio runtime. The delay doubles after each failed try.
+#
+# The times are in seconds.
+MQTT_RECONNECT_MIN_DELAY = 1
+MQTT_RECONNECT_MAX_DELAY = 120
+
+# The topic server nodes send each other activity messages on, with the index
+# of the node the message is for added, e.g. .../activity/2
+MQTT_ACTIVITY_TOPIC = "/tinkermill/spacecommand/activity"
+
+# The topic the server node that owns a sensor sends every node its status
+# on, with the sensor ID added, e.g. .../status/sensor.esp8266.FE13DE
+MQTT_STATUS_TOPIC = "/tinkermill/spacecommand/status"
+
+# The most measurement events waiting for an asynchronous event bus handler
+# before more are dropped.
+EVENT_BUS_ASYNC_QUEUE_SIZE = 10000
+
+# The index of this server node in a cluster of nodes sharing the sensor
+# messages, and the number of nodes. A single node owns every sensor.
+CLUSTER_NODE_INDEX = 0
+CLUSTER_NODE_COUNT = 1
+
+# How often a node sends the owners of the sensors it heard from activity
+# messages. This should be well under the sensor update and heartbeat time
+# limits.
+#
+# The time is in seconds.
+CLUSTER_ACTIVITY_INTERVAL = 5.0
+
+# How the web app is served. The development mode uses the Flask development
+# server, the production mode a multithreaded waitress server. The asyncio
+# runtime always serves the web app with hypercorn.
+WEBAPP_SERVING_MODE_DEVELOPMENT = "development"
+WEBAPP_SERVING_MODE_PRODUCTION = "production"
+
+# The address and port the web app is served on.
+WEBAPP_HOST = "0.0.0.0"
+WEBAPP_PORT = 5000
+
+# The number of threads handling web requests. Every live update client holds
+# a thread for as long as it is connected, so this should be comfortably more
+# than the most live update clients.
+WEBAPP_THREADS = 40
+
+# The most connections open to the web app at once.
+WEBAPP_CONNECTION_LIMIT = 100
+
+# How long an idle connection is kept alive for another request.
+#
+# The time is in seconds.
+WEBAPP_KEEP_ALIVE_TIMEOUT = 120
+
+# Responses smaller than this are not compressed.
+#
+# The size is in bytes.
+WEBAPP_COMPRESSION_MINIMUM_SIZE = 1024
+
+# The compression levels used for web app responses. These favour speed over
+# size since responses are compressed on every request.
+WEBAPP_COMPRESSION_GZIP_LEVEL = 6
+WEBAPP_COMPRESSION_BROTLI_QUALITY = 4
+
+# How long clients can cache the files of the static web app bundle, whose
+# names change whenever their contents do.
+#
+# The time is in seconds.
+WEBAPP_STATIC_MAX_AGE = 31536000
@@ -9,11 +9,51 @@ MESSAGE_FIELD_MESSAGE_TYPE = "messageType"
 # The message type for a measurement message.
 MESSAGE_VALUE_MESSAGE_TYPE_MEASUREMENT = "measurement"
 
+# The message type for a message carrying several measurements per channel.
+MESSAGE_VALUE_MESSAGE_TYPE_MEASUREMENT_BATCH = "measurementBatch"
+
 # The message type for a heartbeat message.
 MESSAGE_VALUE_MESSAGE_TYPE_HEARTBEAT = "heartbeat"
 
+# The message type for a server node telling the node that owns a sensor when
+# it last heard from the sensor.
+MESSAGE_VALUE_MESSAGE_TYPE_ACTIVITY = "activity"
+
+# The message type for the server node that owns a sensor telling the other
+# nodes whether the sensor is offline.
+MESSAGE_VALUE_MESSAGE_TYPE_STATUS = "status"
+
 MESSAGE_FIELD_SENSOR_ID = "sensorId"
 
 MESSAGE_FIELD_DATA = "data"
 MESSAGE_FIELD_VALUE = "value"
 
+# The times in an activity or status message of the last value and heartbeat
+# from the sensor, in seconds since the epoch. Either can be null.
+MESSAGE_FIELD_VALUE_TIME = "valueTime"
+MESSAGE_FIELD_HEARTBEAT_TIME = "heartbeatTime"
+
+# Whether a status message says the sensor is offline.
+MESSAGE_FIELD_OFFLINE = "offline"
+
+class ClusterMessage(dict):
+  """A message from another server node, decoded from the activity or status
+     topics.
+
+     Activity and status messages are only acted on when they are of this
+     type, so one sent to a sensor input topic can't pass as coming from a
+     server node.
+  """
+
+
+# The suffixes of the sensor input topic that pick the encoding of messages
+# sent on them, e.g. /tinkermill/sensors/data/cbor.
+MESSAGE_TOPIC_SUFFIX_JSON = "json"
+MESSAGE_TOPIC_SUFFIX_CBOR = "cbor"
+MESSAGE_TOPIC_SUFFIX_MSGPACK = "msgpack"
+
+# The first byte of a binary encoded message sent on the plain sensor input
+# topic, giving the encoding of the rest of the message. JSON messages need no
+# content type byte.
+MESSAGE_CONTENT_TYPE_CBOR = 0x01
+MESSAGE_CONTENT_TYPE_MSGPACK = 0x02
@@ -2,8 +2,14 @@
 # Written by Keith M. Hughes
 #
 
+from threading import Event
+import asyncio
 import signal
 import sys
+from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.metrics import Metrics
+from TinkerSpaceCommandServer.processor.SensorOwnership import SensorOwnership
+from TinkerSpaceCommandServer.processor.ShardedIngest import ShardedIngest
 from TinkerSpaceCommandServer.webapp import WebAppServer
 
 class SpaceCommandServer:
@@ -20,11 +26,64 @@ class SpaceCommandServer:
     self.sensor_processor = None
     self.event_persistence = None
     self.webapp = WebAppServer.WebAppServer(__name__, self)
+
+    # Whether the server runs its components on their own threads or all on
+    # one asyncio event loop.
+    self.runtime = config.get("server", {}).get("runtime", Constants.SERVER_RUNTIME_THREADED)
+
+    # Sensors can be processed by several ingest shard processes rather than
+    # in this one.
+    sharding_config = config.get("server", {}).get("sharding", {})
+    self.sharded_ingest = None
+    shard_count = sharding_config.get("shards", Constants.SHARD_COUNT)
+    if shard_count > 0:
+      if self.runtime != Constants.SERVER_RUNTIME_THREADED:
+        raise ValueError("Sharded ingest needs the threaded runtime")
+
+      self.sharded_ingest = ShardedIngest(self, shard_count,
+                                          sharding_config.get("queueSize", Constants.SHARD_QUEUE_SIZE),
+                                          sharding_config.get("stateInterval", Constants.SHARD_STATE_INTERVAL))
+
+    # Which sensors this node tracks the offline state of, when several
+    # server nodes share the sensor messages.
+    cluster_config = config.get("server", {}).get("cluster", {})
+    self.sensor_ownership = SensorOwnership(cluster_config.get("nodeIndex", Constants.CLUSTER_NODE_INDEX),
+                                            cluster_config.get("nodeCount", Constants.CLUSTER_NODE_COUNT))
+
+    # Set once the server has stopped.
+    self.stopped = Event()
+
+    Metrics.registry.configure(config)
     
   def start(self):
+    """Start the server.
+
+       The threaded runtime returns once every component has started, the
+       asyncio runtime runs until the server is stopped.
+    """
+    if self.runtime == Constants.SERVER_RUNTIME_ASYNCIO:
+      asyncio.run(self.run_async())
+      self.stopped.set()
+      return
+
     print("Starting Tinker Space Command Server")
 
-    self.sensor_processor.start()
+    self.sensor_processor.sensor_ownership = self.sensor_ownership
+
+    # The shards are forked, so must be started before any threads are.
+    if self.sharded_ingest is not None:
+      self.sharded_ingest.start_workers()
+
+    self.webapp.attach_sensor_processor(self.sensor_processor)
+
+    # The shards watch their own sensors for going offline.
+    if self.sharded_ingest is not None:
+      self.sharded_ingest.start()
+    else:
+      self.sensor_processor.start()
+
+    if self.event_persistence is not None:
+      self.event_persistence.start()
     
     for provider in self.communicationProviders:
       provider.sensor_processor = self.sensor_processor
@@ -34,15 +93,88 @@ class SpaceCommandServer:
     
     # Set the ^C handler.
     signal.signal(signal.SIGINT, self.signal_handler)
+    signal.signal(signal.SIGTERM, self.signal_handler)
+
+  def wait_for_shutdown(self):
+    """Block until the server has stopped, for example from a ^C.
+    """
+    self.stopped.wait()
 
   def stop(self):
     print("Stopping Tinker Space Command Server")
 
+    self.webapp.stop()
+
     for provider in self.communicationProviders:
       provider.stop()
 
+    if self.sharded_ingest is not None:
+      self.sharded_ingest.stop()
+
     self.sensor_processor.stop()
 
+    if self.event_persistence is not None:
+      self.event_persistence.stop()
+
+    self.stopped.set()
+
+  async def run_async(self):
+    """Run all components of the server as tasks on the current event loop.
+
+       Runs until SIGINT or SIGTERM, then cancels the components in the order
+       data flows through them, so queued measurements are still persisted.
+    """
+    print("Starting Tinker Space Command Server on asyncio")
+
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+      loop.add_signal_handler(signal_number, main_task.cancel)
+
+    self.sensor_processor.sensor_ownership = self.sensor_ownership
+    self.webapp.attach_sensor_processor(self.sensor_processor)
+
+    tasks = []
+    for provider in self.communicationProviders:
+      provider.sensor_processor = self.sensor_processor
+      tasks.append(asyncio.ensure_future(provider.run_async()))
+
+    sensor_processor_task = asyncio.ensure_future(self.sensor_processor.run_async())
+    tasks.append(sensor_processor_task)
+
+    if self.event_persistence is not None:
+      tasks.append(asyncio.ensure_future(self.event_persistence.run_async()))
+
+    tasks.append(asyncio.ensure_future(self.webapp.run_async()))
+
+    try:
+      # Unlike gather, waiting doesn't cancel the components along with this
+      # task, so they can be stopped one at a time.
+      await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    except asyncio.CancelledError:
+      pass
+    finally:
+      print("Stopping Tinker Space Command Server")
+
+      # Each component is stopped before the next one along, so what it
+      # passes on when stopping is still handled.
+      for task in tasks:
+        task.cancel()
+        try:
+          await task
+        except asyncio.CancelledError:
+          pass
+        except:
+          print("Error while stopping component: {}".format(sys.exc_info()[1]))
+
+        # As in the threaded runtime, the event bus stops its asynchronous
+        # handlers before persistence is stopped.
+        if task is sensor_processor_task:
+          self.sensor_processor.stop()
+
+      for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        loop.remove_signal_handler(signal_number)
+
   def addCommunicationProvider(self, provider):
     """Add in a new communication provider to the server.
     """
@@ -1 +1 @@
-__all__ = ["comms", "events", "entities", "processor", "webapp", "persistence"]
+__all__ = ["comms", "events", "entities", "processor", "webapp", "persistence", "metrics"]
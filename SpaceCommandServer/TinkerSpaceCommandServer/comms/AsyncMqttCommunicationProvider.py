@@ -0,0 +1,256 @@
+#
+# An MQTT communication provider that runs on an asyncio event loop rather
+# than on its own network and ingest threads.
+#
+
+#
+# Written by Keith M. Hughes
+#
+
+from zeroconf import ServiceStateChange
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncZeroconf
+import paho.mqtt.client as mqtt
+import asyncio
+from collections import deque
+import socket
+import threading
+import time
+
+from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.comms.MqttCommunicationProvider import MqttCommunicationProvider
+
+class AsyncMqttCommunicationProvider(MqttCommunicationProvider):
+  """A communication provider for TinkerSpaceCommand that drives an MQTT
+     client from an asyncio event loop.
+
+     The paho client socket is watched by the event loop, received messages
+     are queued and then processed by a task on the same loop.
+  """
+
+  def __init__(self, config):
+    MqttCommunicationProvider.__init__(self, config)
+
+    self.loop = None
+    self.loop_thread_id = None
+    self.mqtt_client = None
+    self.mqtt_misc_task = None
+
+    # The broker found with mDNS, reconnected to if the connection is lost.
+    self.discovered_broker = None
+
+    # Raw messages waiting to be processed, along with the time they were
+    # received.
+    self.pending_messages = deque()
+    self.pending_messages_available = None
+    self.reading_paused = False
+    self.messages_dropped = 0
+
+  async def run_async(self):
+    """Find the broker, connect to it and process messages until cancelled.
+    """
+
+    print("Starting async MQTT Communication Provider")
+
+    self.loop = asyncio.get_running_loop()
+    self.loop_thread_id = threading.get_ident()
+    self.pending_messages_available = asyncio.Event()
+
+    self.create_mqtt_client()
+    self.mqtt_client.on_socket_open = self.on_mqtt_socket_open
+    self.mqtt_client.on_socket_close = self.on_mqtt_socket_close
+    self.mqtt_client.on_socket_register_write = self.on_mqtt_socket_register_write
+    self.mqtt_client.on_socket_unregister_write = self.on_mqtt_socket_unregister_write
+
+    activity_reporter_task = None
+    activity_reporter = self.create_activity_reporter()
+    if activity_reporter is not None:
+      activity_reporter_task = asyncio.ensure_future(self.report_activity(activity_reporter))
+
+    self.mqtt_misc_task = asyncio.ensure_future(self.mqtt_misc_loop())
+    try:
+      await self.process_pending_messages()
+    finally:
+      print("Stopping async MQTT Communication provider")
+
+      self.mqtt_misc_task.cancel()
+      self.mqtt_misc_task = None
+
+      if activity_reporter_task is not None:
+        activity_reporter_task.cancel()
+
+      if self.mqtt_client_connected:
+        self.mqtt_client.disconnect()
+        self.mqtt_client_connected = False
+
+  async def discover_mqtt_broker(self):
+    """Use Zeroconf to find the MQTT broker.
+
+       Returns the host and port of the first broker found.
+    """
+
+    service_found = self.loop.create_future()
+
+    def on_zeroconf_service_state_change(zeroconf, service_type, name, state_change):
+      if state_change is ServiceStateChange.Added and not service_found.done():
+        service_found.set_result((service_type, name))
+
+    async_zeroconf = AsyncZeroconf()
+    service_browser = AsyncServiceBrowser(async_zeroconf.zeroconf, self.MDNS_SERVICE_NAME_MQTT, handlers=[on_zeroconf_service_state_change])
+    try:
+      service_type, name = await service_found
+      service_info = await async_zeroconf.async_get_service_info(service_type, name)
+    finally:
+      # Don't leave zeroconf running
+      await service_browser.async_cancel()
+      await async_zeroconf.async_close()
+
+    ipv4_address = '.'.join(str(i) for i in service_info.address)
+
+    return ipv4_address, service_info.port
+
+  async def connect_mqtt_broker(self):
+    """Connect to the broker, or reconnect to the one already found.
+
+       Connecting blocks, so it is done from the loop's executor.
+    """
+
+    if self.brokers:
+      await self.loop.run_in_executor(None, self.connect_configured_mqtt_broker)
+    elif self.discovered_broker is None:
+      mqtt_host, mqtt_port = await self.discover_mqtt_broker()
+
+      print('Found MQTT broker at {0}:{1}'.format(mqtt_host, mqtt_port))
+
+      await self.loop.run_in_executor(None, self.mqtt_client.connect, mqtt_host, mqtt_port, 60)
+      self.discovered_broker = (mqtt_host, mqtt_port)
+    else:
+      await self.loop.run_in_executor(None, self.mqtt_client.reconnect)
+
+  def connect_configured_mqtt_broker(self):
+    """Connect to the first of the configured brokers that accepts the
+       connection.
+    """
+
+    for mqtt_host, mqtt_port in self.brokers:
+      try:
+        self.mqtt_client.connect(mqtt_host, mqtt_port, 60)
+        print('Connected to MQTT broker at {0}:{1}'.format(mqtt_host, mqtt_port))
+
+        return
+      except OSError as error:
+        print('Could not connect to MQTT broker at {0}:{1}: {2}'.format(mqtt_host, mqtt_port, error))
+
+    raise ConnectionError("Could not connect to any MQTT broker")
+
+  async def report_activity(self, activity_reporter):
+    while True:
+      await asyncio.sleep(self.activity_interval)
+
+      try:
+        activity_reporter.report()
+      except:
+        print("Could not report sensor activity")
+
+  def call_on_loop(self, callback, *args):
+    """Call a function on the event loop thread.
+
+       The socket callbacks come from the executor while connecting, and
+       the loop's readers and writers can only be changed from its thread.
+    """
+
+    if threading.get_ident() == self.loop_thread_id:
+      callback(*args)
+    else:
+      self.loop.call_soon_threadsafe(callback, *args)
+
+  def on_mqtt_socket_open(self, mqtt_client, userdata, sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048)
+
+    self.call_on_loop(self.loop.add_reader, sock, self.on_mqtt_socket_readable)
+
+  def on_mqtt_socket_close(self, mqtt_client, userdata, sock):
+    self.call_on_loop(self.loop.remove_reader, sock)
+    self.reading_paused = False
+
+  def on_mqtt_socket_register_write(self, mqtt_client, userdata, sock):
+    self.call_on_loop(self.loop.add_writer, sock, self.mqtt_client.loop_write)
+
+  def on_mqtt_socket_unregister_write(self, mqtt_client, userdata, sock):
+    self.call_on_loop(self.loop.remove_writer, sock)
+
+  def on_mqtt_socket_readable(self):
+    self.mqtt_client.loop_read()
+
+  async def mqtt_misc_loop(self):
+    # Connect to the broker, then do the keep alive pings and retries for
+    # the MQTT client. Whenever the connection is lost it is made again,
+    # waiting longer after each failed try.
+    reconnect_delay = Constants.MQTT_RECONNECT_MIN_DELAY
+    while True:
+      if self.mqtt_client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+        await asyncio.sleep(1)
+        continue
+
+      self.mqtt_client_connected = False
+      try:
+        await self.connect_mqtt_broker()
+        reconnect_delay = Constants.MQTT_RECONNECT_MIN_DELAY
+        continue
+      except OSError as error:
+        print('Could not connect to MQTT broker, trying again in {0} seconds: {1}'.format(reconnect_delay, error))
+
+      await asyncio.sleep(reconnect_delay)
+      reconnect_delay = min(reconnect_delay * 2, Constants.MQTT_RECONNECT_MAX_DELAY)
+
+  def on_new_mqtt_message(self, mqtt_client, userdata, msg):
+    # A new MQTT message has come in.
+    #
+    # Only queue the message so that reading the socket stays cheap.
+    dt = time.time()
+
+    if self.metrics.enabled:
+      self.messages_received += 1
+      self.bytes_received += len(msg.payload)
+
+    if len(self.pending_messages) >= self.ingest_queue_size:
+      if self.ingest_overflow_policy == Constants.INGEST_OVERFLOW_POLICY_DROP_NEWEST:
+        self.messages_dropped += 1
+        return
+      elif self.ingest_overflow_policy == Constants.INGEST_OVERFLOW_POLICY_DROP_OLDEST:
+        self.pending_messages.popleft()
+        self.messages_dropped += 1
+
+    decode, codec = self.select_decoder(msg.topic, msg.payload)
+
+    self.pending_messages.append((decode, msg.payload, dt))
+    self.pending_messages_available.set()
+
+    # When blocking, stop reading from the broker until the queue has room.
+    # TCP flow control then pushes back on the broker.
+    if self.ingest_overflow_policy == Constants.INGEST_OVERFLOW_POLICY_BLOCK and \
+       len(self.pending_messages) >= self.ingest_queue_size and not self.reading_paused:
+      self.loop.remove_reader(self.mqtt_client.socket())
+      self.reading_paused = True
+
+  async def process_pending_messages(self):
+    while True:
+      await self.pending_messages_available.wait()
+      self.pending_messages_available.clear()
+
+      while self.pending_messages:
+        decode, payload, dt = self.pending_messages.popleft()
+        self.process_raw_message(decode, payload, dt)
+
+        if self.reading_paused and len(self.pending_messages) < self.ingest_queue_size:
+          self.loop.add_reader(self.mqtt_client.socket(), self.on_mqtt_socket_readable)
+          self.reading_paused = False
+
+        # Give the socket and other tasks a chance to run during a large
+        # backlog.
+        await asyncio.sleep(0)
+
+  def ingest_queue_depth(self):
+    return len(self.pending_messages)
+
+  def ingest_messages_dropped(self):
+    return self.messages_dropped
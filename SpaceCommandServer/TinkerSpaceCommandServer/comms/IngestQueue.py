@@ -0,0 +1,188 @@
+#
+# The ingest queue decouples receiving raw sensor messages from a
+# communication channel from decoding and processing them.
+#
+# Messages are partitioned by a key, normally the sensor ID, and every
+# partition is drained by exactly one worker thread, so all messages for a
+# given sensor are processed in the order they were received.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from collections import deque
+from threading import Condition, Lock, Thread
+import traceback
+import zlib
+
+from TinkerSpaceCommandServer import Constants
+
+class IngestPartition:
+  """A bounded FIFO of raw messages drained by a single worker.
+  """
+
+  def __init__(self, capacity, overflow_policy):
+    self.capacity = capacity
+    self.overflow_policy = overflow_policy
+
+    self.messages = deque()
+
+    lock = Lock()
+    self.not_empty = Condition(lock)
+    self.not_full = Condition(lock)
+
+    self.running = True
+
+    self.enqueued_count = 0
+    self.dropped_count = 0
+    self.processed_count = 0
+
+  def put(self, message):
+    """Add a message to the partition, applying the overflow policy if the
+       partition is full.
+
+       Returns True if the message was queued.
+    """
+
+    with self.not_full:
+      if len(self.messages) >= self.capacity:
+        if self.overflow_policy == Constants.INGEST_OVERFLOW_POLICY_DROP_NEWEST:
+          self.dropped_count += 1
+          return False
+        elif self.overflow_policy == Constants.INGEST_OVERFLOW_POLICY_DROP_OLDEST:
+          self.messages.popleft()
+          self.dropped_count += 1
+        else:
+          while len(self.messages) >= self.capacity and self.running:
+            self.not_full.wait()
+
+          if not self.running:
+            self.dropped_count += 1
+            return False
+
+      self.messages.append(message)
+      self.enqueued_count += 1
+      self.not_empty.notify()
+
+      return True
+
+  def get(self):
+    """Get the next message, waiting for one if the partition is empty.
+
+       Returns None once the partition has been stopped and drained.
+    """
+
+    with self.not_empty:
+      while not self.messages and self.running:
+        self.not_empty.wait()
+
+      if not self.messages:
+        return None
+
+      message = self.messages.popleft()
+      self.not_full.notify()
+
+      return message
+
+  def depth(self):
+    return len(self.messages)
+
+  def stop(self):
+    with self.not_empty:
+      self.running = False
+      self.not_empty.notify_all()
+      self.not_full.notify_all()
+
+class IngestWorkerThread(Thread):
+  """A worker that drains one ingest partition and hands each message to the
+     message handler.
+  """
+
+  def __init__(self, partition, message_handler):
+    Thread.__init__(self)
+    self.partition = partition
+    self.message_handler = message_handler
+
+  def run(self):
+    while True:
+      message = self.partition.get()
+      if message is None:
+        break
+
+      try:
+        self.message_handler(*message)
+      except:
+        print(traceback.format_exc())
+
+      self.partition.processed_count += 1
+
+class IngestQueue:
+  """A bounded, partitioned queue of raw messages with a pool of worker
+     threads.
+
+     The message handler is called on a worker thread with the arguments
+     given to put().
+  """
+
+  def __init__(self, message_handler, workers, queue_size, overflow_policy):
+    if overflow_policy not in Constants.INGEST_OVERFLOW_POLICIES:
+      raise ValueError("Unknown ingest overflow policy {}".format(overflow_policy))
+
+    self.message_handler = message_handler
+
+    # The capacity is split evenly across the worker partitions.
+    partition_capacity = max(1, queue_size // workers)
+    self.partitions = [IngestPartition(partition_capacity, overflow_policy) for i in range(workers)]
+
+    self.workers = []
+
+  def start(self):
+    for partition in self.partitions:
+      worker = IngestWorkerThread(partition, self.message_handler)
+      worker.daemon = True
+      self.workers.append(worker)
+      worker.start()
+
+  def stop(self):
+    """Stop the workers once they have processed everything already queued.
+    """
+
+    for partition in self.partitions:
+      partition.stop()
+
+    for worker in self.workers:
+      worker.join()
+
+    self.workers = []
+
+  def put(self, partition_key, *message):
+    """Queue a message.
+
+       All messages with the same partition key are processed in order by the
+       same worker. The key must be bytes or None.
+
+       Returns True if the message was queued.
+    """
+
+    if partition_key is None or len(self.partitions) == 1:
+      partition = self.partitions[0]
+    else:
+      partition = self.partitions[zlib.crc32(partition_key) % len(self.partitions)]
+
+    return partition.put(message)
+
+  def depth(self):
+    """Get the number of messages waiting to be processed.
+    """
+
+    return sum(partition.depth() for partition in self.partitions)
+
+  def enqueued_count(self):
+    return sum(partition.enqueued_count for partition in self.partitions)
+
+  def dropped_count(self):
+    return sum(partition.dropped_count for partition in self.partitions)
+
+  def processed_count(self):
+    return sum(partition.processed_count for partition in self.partitions)
@@ -0,0 +1,228 @@
+#
+# Codecs for the wire encoding of sensor messages.
+#
+# Messages are JSON by default. Nodes may also send CBOR or MessagePack,
+# either on a topic ending in the codec's topic suffix or on the normal
+# sensor input topic with the codec's content type byte in front of the
+# encoded message. The binary codecs are only available if their packages
+# are installed.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import json
+import re
+
+from TinkerSpaceCommandServer import Messages
+
+try:
+  import orjson
+
+  json_loads = orjson.loads
+  json_dumps = orjson.dumps
+except ImportError:
+  json_loads = json.loads
+
+  def json_dumps(message):
+    return json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+# Finds the sensor ID in a raw JSON sensor message without decoding the whole
+# message.
+JSON_SENSOR_ID_PATTERN = re.compile(rb'"sensorId"\s*:\s*"([^"]*)"')
+
+def find_length_prefixed_string(payload, key, short_base, short_max, long_marker):
+  """Find the string value following a key in a binary encoded message.
+
+     Short strings have their length added to short_base in the header byte,
+     longer ones have long_marker followed by a one byte length.
+  """
+
+  index = payload.find(key)
+  if index < 0:
+    return None
+
+  index += len(key)
+  if index >= len(payload):
+    return None
+
+  header = payload[index]
+  if short_base <= header <= short_base + short_max:
+    length = header - short_base
+    index += 1
+  elif header == long_marker and index + 1 < len(payload):
+    length = payload[index + 1]
+    index += 2
+  else:
+    return None
+
+  return payload[index:index + length]
+
+class JsonMessageCodec:
+  """The JSON codec, using orjson if it is installed.
+  """
+
+  name = "json"
+  topic_suffix = Messages.MESSAGE_TOPIC_SUFFIX_JSON
+  content_type = None
+
+  def decode(self, payload):
+    return json_loads(payload)
+
+  def encode(self, message):
+    return json_dumps(message)
+
+  def partition_key(self, payload):
+    match = JSON_SENSOR_ID_PATTERN.search(payload)
+
+    return match.group(1) if match is not None else None
+
+class ClusterMessageCodec(JsonMessageCodec):
+  """The codec for the activity and status messages server nodes send each
+     other. They are JSON, on topics of their own.
+  """
+
+  name = "cluster"
+  topic_suffix = None
+
+  def decode(self, payload):
+    return Messages.ClusterMessage(json_loads(payload))
+
+class MsgpackMessageCodec:
+  """The MessagePack codec. Needs the msgpack package.
+  """
+
+  name = "msgpack"
+  topic_suffix = Messages.MESSAGE_TOPIC_SUFFIX_MSGPACK
+  content_type = Messages.MESSAGE_CONTENT_TYPE_MSGPACK
+
+  def __init__(self):
+    import msgpack
+
+    self.msgpack = msgpack
+
+  def decode(self, payload):
+    return self.msgpack.unpackb(payload, raw=False)
+
+  def decode_prefixed(self, payload):
+    return self.msgpack.unpackb(memoryview(payload)[1:], raw=False)
+
+  def encode(self, message):
+    return self.msgpack.packb(message, use_bin_type=True)
+
+  def encode_prefixed(self, message):
+    return bytes([self.content_type]) + self.encode(message)
+
+  def partition_key(self, payload):
+    # fixstr header for "sensorId", then a fixstr or str8 value.
+    return find_length_prefixed_string(payload, b'\xa8sensorId', 0xa0, 31, 0xd9)
+
+class CborMessageCodec:
+  """The CBOR codec. Needs the cbor2 package.
+  """
+
+  name = "cbor"
+  topic_suffix = Messages.MESSAGE_TOPIC_SUFFIX_CBOR
+  content_type = Messages.MESSAGE_CONTENT_TYPE_CBOR
+
+  def __init__(self):
+    import cbor2
+
+    self.cbor2 = cbor2
+
+  def decode(self, payload):
+    return self.cbor2.loads(payload)
+
+  def decode_prefixed(self, payload):
+    return self.cbor2.loads(memoryview(payload)[1:])
+
+  def encode(self, message):
+    return self.cbor2.dumps(message)
+
+  def encode_prefixed(self, message):
+    return bytes([self.content_type]) + self.encode(message)
+
+  def partition_key(self, payload):
+    # Text string header for "sensorId", then a short or one byte length
+    # text string value.
+    return find_length_prefixed_string(payload, b'\x68sensorId', 0x60, 23, 0x78)
+
+class MessageCodecs:
+  """All available codecs, and the rules for picking the one for a raw
+     message.
+  """
+
+  def __init__(self):
+    self.json_codec = JsonMessageCodec()
+
+    # Only used for the topics the server nodes send each other messages on,
+    # never picked for a sensor message.
+    self.cluster_codec = ClusterMessageCodec()
+
+    self.binary_codecs = []
+    for codec_class in [CborMessageCodec, MsgpackMessageCodec]:
+      try:
+        self.binary_codecs.append(codec_class())
+      except ImportError:
+        pass
+
+    # Map of topic suffixes to the decode function for messages on topics
+    # with that suffix.
+    self.decoders_by_topic_suffix = { self.json_codec.topic_suffix: (self.json_codec.decode, self.json_codec) }
+
+    # Map of content type bytes to the decode function for messages with
+    # that first byte.
+    self.decoders_by_content_type = {}
+
+    for codec in self.binary_codecs:
+      self.decoders_by_topic_suffix[codec.topic_suffix] = (codec.decode, codec)
+      self.decoders_by_content_type[codec.content_type] = (codec.decode_prefixed, codec)
+
+  def get_topic_suffixes(self):
+    """Get the topic suffixes of all available codecs.
+    """
+
+    return list(self.decoders_by_topic_suffix.keys())
+
+  def select_decoder(self, topic, payload):
+    """Pick the decoder for a message.
+
+       Returns a pair of the decode function to call with the payload and the
+       codec. Anything not recognized is treated as JSON.
+    """
+
+    suffix = topic[topic.rfind('/') + 1:]
+    decoder = self.decoders_by_topic_suffix.get(suffix)
+    if decoder is not None:
+      return decoder
+
+    if payload:
+      decoder = self.decoders_by_content_type.get(payload[0])
+      if decoder is not None:
+        return decoder
+
+    return self.json_codec.decode, self.json_codec
+
+  def get_decoders(self):
+    """Get every decode function select_decoder can pick, and the cluster
+       codec's, always in the same order for the same available codecs.
+    """
+
+    decoders = [decoder for decoder, codec in self.decoders_by_topic_suffix.values()]
+    decoders.extend(decoder for decoder, codec in self.decoders_by_content_type.values())
+    decoders.append(self.cluster_codec.decode)
+
+    return decoders
+
+  def get_codec(self, name):
+    """Get an available codec by its name.
+
+       Returns None if there is no such codec or its package isn't installed.
+    """
+
+    for codec in [self.json_codec] + self.binary_codecs:
+      if codec.name == name:
+        return codec
+
+    return None
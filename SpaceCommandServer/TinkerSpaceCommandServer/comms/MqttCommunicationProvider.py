@@ -4,9 +4,66 @@
 
 from zeroconf import ServiceBrowser, ServiceStateChange, Zeroconf
 import paho.mqtt.client as mqtt
+from threading import Event, Lock, Thread, local
 import time
 from datetime import datetime
-import json
+
+from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.comms.IngestQueue import IngestQueue
+from TinkerSpaceCommandServer.comms.MessageCodecs import MessageCodecs
+from TinkerSpaceCommandServer.metrics import Metrics
+from TinkerSpaceCommandServer.processor.SensorOwnership import SensorActivityReporter
+
+# The MQTT protocol versions that can be configured.
+MQTT_PROTOCOLS = {
+  "3.1.1": mqtt.MQTTv311,
+  "5": mqtt.MQTTv5
+}
+
+class MqttTopicRoute:
+  """A topic filter to subscribe to and how to decode the messages that
+     match it.
+  """
+
+  def __init__(self, topic_filter, codec=None, shared=True):
+    self.topic_filter = topic_filter
+
+    # The codec for every message on the topics, or None to pick one from
+    # the topic suffix or content type byte of each message.
+    self.codec = codec
+
+    # Whether the subscription is shared with the other server nodes, if
+    # there are any.
+    self.shared = shared
+
+class IngestWorkerCounts:
+  """The message counts kept by a single ingest worker thread.
+  """
+
+  def __init__(self):
+    self.messages_decoded = 0
+    self.bad_messages = 0
+
+class MqttActivityReporterThread(Thread):
+  """Sends the owners of sensors on other server nodes activity messages
+     for the sensors this node has heard from.
+  """
+
+  def __init__(self, activity_reporter, interval):
+    Thread.__init__(self)
+    self.activity_reporter = activity_reporter
+    self.interval = interval
+    self.stopped = Event()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        self.activity_reporter.report()
+      except:
+        print("Could not report sensor activity")
+
+  def stop(self):
+    self.stopped.set()
 
 class MqttCommunicationProvider:
   """A communication provider for TinkerSpaceCommand that sets up an 
@@ -28,19 +85,147 @@ class MqttCommunicationProvider:
     # The mDNS service name for the MQTT broker.
     self.MDNS_SERVICE_NAME_MQTT = mqttConfig["mqttMdnsServiceName"]
 
+    # Brokers to connect to, tried in order, rather than finding one with
+    # mDNS.
+    self.brokers = [(broker["host"], broker.get("port", Constants.MQTT_BROKER_PORT)) for broker in mqttConfig.get("brokers", [])]
+
+    # With a shared subscription group, the broker hands each message to
+    # just one of the server nodes subscribed in the group. Shared
+    # subscriptions are part of MQTT 5.
+    self.shared_subscription_group = mqttConfig.get("sharedSubscriptionGroup")
+    self.mqtt_protocol = MQTT_PROTOCOLS[str(mqttConfig.get("protocol", "5" if self.shared_subscription_group else "3.1.1"))]
+
+    # The other server nodes send activity messages for the sensors this
+    # node owns to the activity topic, and the owners of the other sensors
+    # send their status to the status topic. Which sensors this node owns
+    # comes from the sensor processor.
+    cluster_config = config.get("server", {}).get("cluster", {})
+    self.activity_topic = mqttConfig.get("activityTopic", Constants.MQTT_ACTIVITY_TOPIC)
+    self.status_topic = mqttConfig.get("statusTopic", Constants.MQTT_STATUS_TOPIC)
+    self.activity_interval = cluster_config.get("activityInterval", Constants.CLUSTER_ACTIVITY_INTERVAL)
+    self.activity_reporter_thread = None
+
     # Is the MQTT client connected to the broker?
     self.mqtt_client_connected = False
 
     # The server will set this field.
     self.sensor_processor = None
 
+    # The codecs for decoding messages from sensor nodes.
+    self.message_codecs = MessageCodecs()
+
+    # The topics to subscribe to. By default the sensor input topic, and the
+    # sensor input topic with each codec's suffix.
+    if "topics" in mqttConfig:
+      self.topic_routes = [MqttTopicRoute(topic["filter"], self.get_codec(topic.get("codec"))) for topic in mqttConfig["topics"]]
+    else:
+      self.topic_routes = [MqttTopicRoute(self.MQTT_SENSOR_DATA_INPUT_TOPIC)]
+      for suffix in self.message_codecs.get_topic_suffixes():
+        self.topic_routes.append(MqttTopicRoute("{}/{}".format(self.MQTT_SENSOR_DATA_INPUT_TOPIC, suffix)))
+
+    # Map of topics seen to the codec of the route they matched, or None if
+    # the codec is picked per message.
+    self.topic_codecs = {}
+
+    # Raw messages wait on the ingest queue until a worker decodes and
+    # processes them, keeping the MQTT network thread free.
+    ingest_config = mqttConfig.get("ingest", {})
+    self.ingest_queue_size = ingest_config.get("queueSize", Constants.INGEST_QUEUE_SIZE)
+    self.ingest_overflow_policy = ingest_config.get("overflowPolicy", Constants.INGEST_OVERFLOW_POLICY_DROP_OLDEST)
+    self.ingest_queue = IngestQueue(
+      self.process_raw_message,
+      ingest_config.get("workers", Constants.INGEST_WORKERS),
+      self.ingest_queue_size,
+      self.ingest_overflow_policy)
+
+    # Counts for the metrics, only kept while metrics are enabled. The
+    # received counts are only updated on the MQTT network thread. Each
+    # ingest worker keeps its own decode counts so none are lost between
+    # workers, and they are summed when the metrics are read.
+    self.messages_received = 0
+    self.bytes_received = 0
+    self.worker_counts_local = local()
+    self.worker_counts = []
+    self.worker_counts_lock = Lock()
+
+    self.metrics = Metrics.registry
+    self.metrics.counter_function("tinkerspace_mqtt_messages_received_total", "MQTT messages received from sensor nodes.", lambda: self.messages_received)
+    self.metrics.counter_function("tinkerspace_mqtt_received_bytes_total", "Bytes of MQTT message payloads received from sensor nodes.", lambda: self.bytes_received)
+    self.metrics.counter_function("tinkerspace_mqtt_messages_decoded_total", "MQTT messages decoded and processed by the ingest workers.", lambda: self.sum_worker_counts("messages_decoded"))
+    self.metrics.counter_function("tinkerspace_mqtt_bad_messages_total", "MQTT messages that could not be decoded or processed.", lambda: self.sum_worker_counts("bad_messages"))
+    self.receive_time = self.metrics.histogram("tinkerspace_mqtt_receive_seconds", "Time spent on the MQTT network thread per message.")
+    self.ingest_wait_time = self.metrics.histogram("tinkerspace_ingest_wait_seconds", "Time messages wait for an ingest worker.")
+    self.decode_time = self.metrics.histogram("tinkerspace_mqtt_decode_seconds", "Time to decode an MQTT message.")
+    self.metrics.gauge("tinkerspace_ingest_queue_depth", "Messages waiting to be processed.", self.ingest_queue_depth)
+    self.metrics.counter_function("tinkerspace_ingest_dropped_total", "Messages dropped because the ingest queue was full.", self.ingest_messages_dropped)
+
+  def get_codec(self, name):
+    if name is None:
+      return None
+
+    codec = self.message_codecs.get_codec(name)
+    if codec is None:
+      raise ValueError("MQTT topic codec {} is not available".format(name))
+
+    return codec
+
+  def create_mqtt_client(self):
+    """Create the MQTT client and add in all needed callbacks.
+    """
+
+    self.mqtt_client = mqtt.Client(client_id=self.MQTT_CLIENT_ID, protocol=self.mqtt_protocol)
+    self.mqtt_client.on_connect = self.on_mqtt_connect
+    self.mqtt_client.on_message = self.on_new_mqtt_message
+
+  def get_sensor_ownership(self):
+    """Get which sensors this node owns, or None if this is the only node.
+    """
+
+    sensor_ownership = self.sensor_processor.sensor_ownership
+    if sensor_ownership is None or sensor_ownership.node_count == 1:
+      return None
+
+    return sensor_ownership
+
+  def create_activity_reporter(self):
+    """Create the reporter of activity for sensors other nodes own, and
+       subscribe to the messages from the other nodes.
+
+       Returns None if this is the only node.
+    """
+
+    sensor_ownership = self.get_sensor_ownership()
+    if sensor_ownership is None:
+      return None
+
+    # Activity messages are for this node alone, and every node gets every
+    # status message. Only messages on these topics are decoded as coming
+    # from server nodes.
+    cluster_codec = self.message_codecs.cluster_codec
+    self.topic_routes.insert(0, MqttTopicRoute("{}/{}".format(self.activity_topic, sensor_ownership.node_index), cluster_codec, shared=False))
+    self.topic_routes.insert(1, MqttTopicRoute("{}/#".format(self.status_topic), cluster_codec, shared=False))
+
+    return SensorActivityReporter(sensor_ownership, self.sensor_processor.entity_registry,
+                                  lambda topic, payload, retain=False: self.mqtt_client.publish(topic, payload, retain=retain),
+                                  self.activity_topic, self.status_topic)
+
   def start(self):
     print("Starting MQTT Communication Provider")
+
+    self.ingest_queue.start()
     
-    # Create the MQTT client and add in all needed callbacks.
-    self.mqtt_client = mqtt.Client(client_id=self.MQTT_CLIENT_ID)
-    self.mqtt_client.on_connect = self.on_mqtt_connect
-    self.mqtt_client.on_message = self.on_new_mqtt_message
+    self.create_mqtt_client()
+
+    activity_reporter = self.create_activity_reporter()
+    if activity_reporter is not None:
+      self.activity_reporter_thread = MqttActivityReporterThread(activity_reporter, self.activity_interval)
+      self.activity_reporter_thread.daemon = True
+      self.activity_reporter_thread.start()
+
+    if self.brokers:
+      self.zeroconf = None
+      self.connect_configured_brokers()
+      return
 
     # Create the Zeroconf service browser that will look for a local
     # service _mqtt._tcp
@@ -50,12 +235,39 @@ class MqttCommunicationProvider:
   def stop(self):
     print("Stopping MQTT Communication provider")
 
+    if self.activity_reporter_thread is not None:
+      self.activity_reporter_thread.stop()
+      self.activity_reporter_thread = None
+
     # Close the MQTT client if it is connected.
     if self.mqtt_client_connected:
       self.mqtt_client.loop_stop()
       
     # Zeroconf may be closed already but make sure.
-    self.zeroconf.close()
+    if self.zeroconf is not None:
+      self.zeroconf.close()
+
+    self.ingest_queue.stop()
+
+  def connect_configured_brokers(self):
+    """Connect to the first of the configured brokers that accepts the
+       connection.
+
+       Returns True if one did.
+    """
+
+    for mqtt_host, mqtt_port in self.brokers:
+      try:
+        self.connect_mqtt(mqtt_host, mqtt_port)
+        print('Connected to MQTT broker at {0}:{1}'.format(mqtt_host, mqtt_port))
+
+        return True
+      except OSError as error:
+        print('Could not connect to MQTT broker at {0}:{1}: {2}'.format(mqtt_host, mqtt_port, error))
+
+    print('Could not connect to any MQTT broker')
+
+    return False
 
   def on_zeroconf_service_state_change(self, zeroconf, service_type, name, state_change):
     #
@@ -85,29 +297,120 @@ class MqttCommunicationProvider:
 
     self.mqtt_client.loop_start()
 
-  def on_mqtt_connect(self, mqtt_client, userdata, flags, rc):
+  def on_mqtt_connect(self, mqtt_client, userdata, flags, rc, properties=None):
     # The callback for when the MQTT client receives a connection response from the
-    # MQTT server.
+    # MQTT server. MQTT 5 connections also get the connection properties.
     print("Connected to mqtt broker with result code "+str(rc))
 
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    print("Subscribing to sensor input topic {}".format(self.MQTT_SENSOR_DATA_INPUT_TOPIC))
-    self.mqtt_client.subscribe(self.MQTT_SENSOR_DATA_INPUT_TOPIC)
+    for route in self.topic_routes:
+      subscription = self.get_subscription(route)
+      print("Subscribing to sensor input topic {}".format(subscription))
+      self.mqtt_client.subscribe(subscription)
     
     # Mark the client as connected.
     self.mqtt_client_connected = True
 
+  def get_subscription(self, route):
+    """Get the topic filter to subscribe with for a route, shared with the
+       other server nodes if there is a shared subscription group.
+    """
+
+    if self.shared_subscription_group and route.shared:
+      return "$share/{}/{}".format(self.shared_subscription_group, route.topic_filter)
+
+    return route.topic_filter
+
+  def select_decoder(self, topic, payload):
+    """Pick the decoder for a message from the route its topic matches.
+
+       Returns a pair of the decode function and the codec.
+    """
+
+    codec = self.topic_codecs.get(topic, False)
+    if codec is False:
+      codec = None
+      for route in self.topic_routes:
+        if mqtt.topic_matches_sub(route.topic_filter, topic):
+          codec = route.codec
+          break
+
+      self.topic_codecs[topic] = codec
+
+    if codec is None:
+      return self.message_codecs.select_decoder(topic, payload)
+
+    return codec.decode, codec
+
   def on_new_mqtt_message(self, mqtt_client, userdata, msg):
     # A new MQTT message has come in.
+    #
+    # This runs on the MQTT network thread, so only timestamp the message and
+    # queue it. Decoding and processing happen on an ingest worker.
+    dt = time.time()
+
+    sampled = False
+    if self.metrics.enabled:
+      self.messages_received += 1
+      self.bytes_received += len(msg.payload)
+
+      sampled = not self.messages_received % self.metrics.sample_interval
+      if sampled:
+        start = time.perf_counter()
+
+    decode, codec = self.select_decoder(msg.topic, msg.payload)
+
+    self.ingest_queue.put(codec.partition_key(msg.payload), decode, msg.payload, dt)
+
+    if sampled:
+      self.receive_time.observe(time.perf_counter() - start)
+
+  def process_raw_message(self, decode, payload, dt):
+    # Called on an ingest worker thread for each queued message.
+
+    counts = self.get_worker_counts()
+
+    sampled = False
+    if self.metrics.enabled:
+      counts.messages_decoded += 1
+      sampled = not counts.messages_decoded % self.metrics.sample_interval
 
     try:
-      dt = time.time()
-    
-      # Decode the JSON message that has come from sensor nodes.
-      # The JSON string is encoded in UTF-8 characters.
-      message = json.loads(msg.payload.decode('utf-8'))
+      # Decode the message that has come from sensor nodes.
+      if sampled:
+        self.ingest_wait_time.observe(time.time() - dt)
+
+        start = time.perf_counter()
+        message = decode(payload)
+        self.decode_time.observe(time.perf_counter() - start)
+      else:
+        message = decode(payload)
 
       self.sensor_processor.process_sensor_input(message, dt)
     except:
+      counts.bad_messages += 1
       print("Bad MQTT message received.")
+
+  def get_worker_counts(self):
+    """Get the message counts for the ingest worker running this.
+    """
+
+    counts = getattr(self.worker_counts_local, "counts", None)
+    if counts is None:
+      counts = IngestWorkerCounts()
+      self.worker_counts_local.counts = counts
+      with self.worker_counts_lock:
+        self.worker_counts.append(counts)
+
+    return counts
+
+  def sum_worker_counts(self, name):
+    with self.worker_counts_lock:
+      return sum(getattr(counts, name) for counts in self.worker_counts)
+
+  def ingest_queue_depth(self):
+    return self.ingest_queue.depth()
+
+  def ingest_messages_dropped(self):
+    return self.ingest_queue.dropped_count()
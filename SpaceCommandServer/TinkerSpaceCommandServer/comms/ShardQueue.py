@@ -0,0 +1,154 @@
+#
+# A queue of byte frames between two processes, kept in a ring buffer in
+# shared memory.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from multiprocessing.shared_memory import SharedMemory
+import struct
+import time
+
+# The head and tail of the ring. Both only ever increase, the position in the
+# ring is the count modulo the capacity.
+RING_HEADER = struct.Struct('<QQ')
+
+# The length of a frame, in front of the frame.
+FRAME_HEADER = struct.Struct('<I')
+
+class ShardQueue:
+  """A single producer, single consumer queue of byte frames in shared
+     memory.
+
+     The queue must be made before the consumer process is forked. The lock
+     is only held while copying frames in or out, and the consumer is only
+     woken when the queue goes from empty to not empty.
+  """
+
+  def __init__(self, capacity, context):
+    # The size of the ring in bytes.
+    self.capacity = capacity
+
+    self.shared_memory = SharedMemory(create=True, size=RING_HEADER.size + capacity)
+    self.buffer = self.shared_memory.buf
+    RING_HEADER.pack_into(self.buffer, 0, 0, 0)
+
+    self.lock = context.Lock()
+    self.data_available = context.Semaphore(0)
+
+    # Frames the producer dropped because the queue was full. Only counted
+    # in the producer.
+    self.dropped_count = 0
+
+  def put(self, frame, block=False):
+    """Add a frame to the queue.
+
+       If the queue is full the frame is dropped, or if block is True, the
+       producer waits for room. A frame too big for the queue to ever hold
+       is dropped, or if block is True, raises ValueError, as there would
+       never be room.
+
+       Returns True if the frame was queued.
+    """
+
+    size = FRAME_HEADER.size + len(frame)
+    if size > self.capacity:
+      if block:
+        raise ValueError("A frame of {} bytes can't fit in a queue of {} bytes".format(len(frame), self.capacity))
+
+      self.dropped_count += 1
+      return False
+
+    while True:
+      with self.lock:
+        head, tail = RING_HEADER.unpack_from(self.buffer, 0)
+        if tail - head + size <= self.capacity:
+          self.write(tail, FRAME_HEADER.pack(len(frame)))
+          self.write(tail + FRAME_HEADER.size, frame)
+          RING_HEADER.pack_into(self.buffer, 0, head, tail + size)
+
+          if head == tail:
+            self.data_available.release()
+
+          return True
+
+      if not block:
+        self.dropped_count += 1
+        return False
+
+      # The consumer takes everything at once, so room comes in big pieces.
+      time.sleep(0.001)
+
+  def max_frame_size(self):
+    """Get the size of the largest frame the queue can hold.
+    """
+
+    return self.capacity - FRAME_HEADER.size
+
+  def get_frames(self, timeout):
+    """Take every frame in the queue, waiting up to timeout seconds for
+       some.
+
+       Returns a list of frames, empty if none came in.
+    """
+
+    with self.lock:
+      head, tail = RING_HEADER.unpack_from(self.buffer, 0)
+      if head != tail:
+        data = self.read(head, tail - head)
+        RING_HEADER.pack_into(self.buffer, 0, tail, tail)
+      else:
+        data = None
+
+    if data is None:
+      self.data_available.acquire(timeout=timeout)
+      return []
+
+    frames = []
+    offset = 0
+    while offset < len(data):
+      length, = FRAME_HEADER.unpack_from(data, offset)
+      offset += FRAME_HEADER.size
+      frames.append(data[offset:offset + length])
+      offset += length
+
+    return frames
+
+  def depth(self):
+    """Get the number of bytes waiting in the queue.
+    """
+
+    head, tail = RING_HEADER.unpack_from(self.buffer, 0)
+
+    return tail - head
+
+  def write(self, count, data):
+    # Must be called with the lock held.
+    position = count % self.capacity + RING_HEADER.size
+    first = min(len(data), self.capacity + RING_HEADER.size - position)
+    self.buffer[position:position + first] = data[:first]
+    if first < len(data):
+      self.buffer[RING_HEADER.size:RING_HEADER.size + len(data) - first] = data[first:]
+
+  def read(self, count, length):
+    # Must be called with the lock held.
+    position = count % self.capacity + RING_HEADER.size
+    first = min(length, self.capacity + RING_HEADER.size - position)
+    data = bytes(self.buffer[position:position + first])
+    if first < length:
+      data += bytes(self.buffer[RING_HEADER.size:RING_HEADER.size + length - first])
+
+    return data
+
+  def close(self):
+    """Let go of the shared memory. The process that made the queue also
+       removes it.
+    """
+
+    self.buffer = None
+    self.shared_memory.close()
+
+  def unlink(self):
+    self.shared_memory.unlink()
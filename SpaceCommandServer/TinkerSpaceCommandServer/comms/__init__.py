@@ -1,2 +1,2 @@
-__all__ = [ "MqttCommunicationProvider" ]
+__all__ = [ "MqttCommunicationProvider", "AsyncMqttCommunicationProvider", "IngestQueue", "MessageCodecs" ]
 
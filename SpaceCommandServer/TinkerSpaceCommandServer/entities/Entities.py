@@ -7,20 +7,30 @@
 #
 
 from rx.subjects import Subject
+from array import array
+import itertools
 import time
 from datetime import datetime
 
 from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.entities.LocationValues import LocationValues
+from TinkerSpaceCommandServer.entities.MeasurementHistory import MeasurementHistory
 
 #
 # Subclasses of EntityDescription are static descriptions of the entities in
 # TinkerSpaceCommandServer. They describe the names and descriptions, the
 # capabilities of sensors, etc.
 #
+# There is one of most of these classes per sensor or channel, so they all
+# use __slots__ to keep a large space small.
+#
 
 class EntityDescription:
   """This is the base class for all model descriptions.
   """
+
+  __slots__ = ('external_id', 'name', 'description')
+
   def __init__(self, external_id, name, description):
     self.external_id = external_id
     self.name = name
@@ -30,6 +40,8 @@ class PhysicalLocationEntityDescription(EntityDescription):
   """The model description of a physical space.
   """
 
+  __slots__ = ()
+
   def __init__(self, external_id, name, description):
     EntityDescription.__init__(self, external_id, name, description)
 
@@ -37,6 +49,8 @@ class SensorEntityDescription(EntityDescription):
   """The model description of a sensor.
   """
 
+  __slots__ = ('sensor_details', 'sensor_update_time_limit', 'sensor_heartbeat_time_limit', 'channel_associations')
+
   def __init__(self, external_id, name, description, sensor_details, sensor_update_time_limit, sensor_heartbeat_time_limit):
     EntityDescription.__init__(self, external_id, name, description)
     self.sensor_details = sensor_details
@@ -59,7 +73,10 @@ class SensorDetailEntityDescription(EntityDescription):
      The details include the details of all the channels.
   """
 
-  def __init__(self, external_id, name, description, sensor_update_time_limit, sensor_heartbeat_time_limit, channels):
+  __slots__ = ('channels', 'sensor_update_time_limit', 'sensor_heartbeat_time_limit', 'history_size', 'history_window')
+
+  def __init__(self, external_id, name, description, sensor_update_time_limit, sensor_heartbeat_time_limit, channels,
+               history_size=Constants.CHANNEL_HISTORY_SIZE, history_window=None):
     EntityDescription.__init__(self, external_id, name, description)
 
     # channels is a map from external IDs of channels to their channel detail.
@@ -71,6 +88,11 @@ class SensorDetailEntityDescription(EntityDescription):
     
     # the time limit, in seconds, that we expect to see a sensor heartbeat.
     self.sensor_heartbeat_time_limit = sensor_heartbeat_time_limit
+
+    # The number of recent measurements kept in memory for each channel, 0
+    # for none, and the maximum age in seconds of the ones returned, if any.
+    self.history_size = history_size
+    self.history_window = history_window
     
   def get_channel_detail(self, channel_id):
     """Get the channel detail for a specific channel of the sensor.
@@ -84,6 +106,8 @@ class SensorChannelDetail(EntityDescription):
 
   """
 
+  __slots__ = ('measurement_type', 'measurement_unit')
+
   def __init__(self, external_id, name, description, measurement_type, measurement_unit):
     EntityDescription.__init__(self, external_id, name, description)
 
@@ -100,16 +124,37 @@ class ActiveModel:
   """The base class for all active models.
   """
 
+  __slots__ = ()
+
   def __init__(self):
     pass
 
+class ModelVersions:
+  """Hands out increasing version numbers for changes to active models.
+
+     The latest version handed out is kept, so a whole set of models can be
+     checked for changes with a single number. When two threads race, latest
+     can briefly go back to the other thread's version, but it still changes
+     whenever a model does.
+  """
+
+  __slots__ = ('counter', 'latest')
+
+  def __init__(self):
+    self.counter = itertools.count(1)
+    self.latest = 0
+
 class SensorActiveChannelModel:
   """Binding information about a sensor channel and the sensed entity that
      receives the information from the sensor channel.
   """
 
+  __slots__ = ('channel_id', 'channel_description', 'sensed_entity_active_model', 'sensor_entity_active_model',
+               'current_value', 'time_last_update', 'history')
+
   def __init__(self, channel_id, channel_description,
-               sensor_entity_active_model, sensed_entity_active_model):
+               sensor_entity_active_model, sensed_entity_active_model,
+               history_size=Constants.CHANNEL_HISTORY_SIZE, history_window=None):
     self.channel_id = channel_id
     self.channel_description = channel_description
     self.sensed_entity_active_model = sensed_entity_active_model
@@ -119,6 +164,13 @@ class SensorActiveChannelModel:
     self.sensed_entity_active_model.register_active_channel(self)
 
     self.current_value = None
+
+    # When the current value was received, in seconds since the epoch.
+    self.time_last_update = None
+
+    # The recent measurements for the channel, None if the channel keeps no
+    # history.
+    self.history = MeasurementHistory(history_size, history_window) if history_size > 0 else None
     
   def update_current_value(self, new_value, time_received):
     """Update the current value for the channel.
@@ -128,13 +180,77 @@ class SensorActiveChannelModel:
     """
     
     self.current_value = new_value
+    self.time_last_update = time_received
+
+    history = self.history
+    if history is not None:
+      try:
+        history.append(time_received, new_value)
+      except (TypeError, ValueError):
+        # Only numeric values are kept in the history.
+        pass
 
     self.sensor_entity_active_model.value_update_received(self, time_received)
     self.sensed_entity_active_model.value_update_received(self, time_received)
 
+  def update_current_values(self, new_values, times_received):
+    """Update the channel with a batch of values, oldest first.
+
+       All values go into the history, but the sensor and the sensed entity
+       only get a single value update for the latest value.
+    """
+
+    self.current_value = new_values[-1]
+    self.time_last_update = times_received[-1]
+
+    history = self.history
+    if history is not None:
+      try:
+        history.extend(times_received, new_values)
+      except (TypeError, ValueError):
+        # Only numeric values are kept in the history.
+        pass
+
+    self.sensor_entity_active_model.value_update_received(self, times_received[-1])
+    self.sensed_entity_active_model.value_update_received(self, times_received[-1])
+
+  def get_history(self, start_time=None, end_time=None):
+    """Get the recent measurements for the channel between the start and end
+       times, in seconds since the epoch.
+
+       Returns a pair of arrays, the timestamps in milliseconds and the
+       values.
+    """
+
+    if self.history is None:
+      return array('q'), array('d')
+
+    return self.history.get_window(start_time, end_time)
+
+class SensorChannelRoute:
+  """Everything needed to process a measurement for one channel of a sensor,
+     gathered up front so a measurement needs only a single lookup.
+  """
+
+  __slots__ = ('sensor_active_model', 'sensed_active_model', 'active_channel', 'measurement_type', 'observers')
+
+  def __init__(self, sensor_active_model, active_channel):
+    self.sensor_active_model = sensor_active_model
+    self.sensed_active_model = active_channel.sensed_entity_active_model
+    self.active_channel = active_channel
+    self.measurement_type = active_channel.channel_description.measurement_type
+
+    # The handlers of measurements on this channel, set by the event bus.
+    self.observers = ()
+
 class SensorEntityActiveModel(ActiveModel):
   """The active model for a sensor.
   """
+
+  __slots__ = ('sensor_entity_description', 'active_channels', 'sensor_value_update_subject', '_item_creation_time',
+               'value_last_time_received', 'heartbeat_last_time_received', '_online',
+               'value_update_time_limit', 'heartbeat_update_time_limit', 'offline_signaled',
+               'offline_deadline_scheduler', 'offline_deadline_scheduled', 'model_versions', 'version')
   
   def __init__(self, sensor_entity_description):
     self.sensor_entity_description = sensor_entity_description
@@ -142,7 +258,9 @@ class SensorEntityActiveModel(ActiveModel):
     # Map of a channel ID to a SensorActiveChannelModel for the channel
     self.active_channels = {}
 
-    self.sensor_value_update_subject = Subject()
+    # Only made when the first observer registers, most sensors never have
+    # one.
+    self.sensor_value_update_subject = None
 
     self._item_creation_time = time.time()
 
@@ -154,9 +272,18 @@ class SensorEntityActiveModel(ActiveModel):
 
     self.value_update_time_limit = sensor_entity_description.sensor_update_time_limit
     self.heartbeat_update_time_limit = sensor_entity_description.sensor_heartbeat_time_limit
-    self._last_update_time = None
     self.offline_signaled = False
 
+    # The scheduler that watches for this sensor going offline, and whether
+    # the sensor currently has a deadline with it.
+    self.offline_deadline_scheduler = None
+    self.offline_deadline_scheduled = False
+
+    # The version of the state of the sensor, changed whenever anything a
+    # client can see changes. The registry supplies the version numbers.
+    self.model_versions = None
+    self.version = 0
+
   def value_last_time_received_fmt(self):
     if self.value_last_time_received is not None:
       return datetime.fromtimestamp(self.value_last_time_received).strftime(Constants.SENSOR_TIMESTAMP_DATE_TIME_FORMAT)
@@ -190,6 +317,9 @@ class SensorEntityActiveModel(ActiveModel):
   def register_value_update_observer(self, observer):
     """Register an observer interested in sensor value update events.
     """
+    if self.sensor_value_update_subject is None:
+      self.sensor_value_update_subject = Subject()
+
     self.sensor_value_update_subject.subscribe(observer)
 
   def value_update_received(self, active_channel, time_received):
@@ -201,8 +331,17 @@ class SensorEntityActiveModel(ActiveModel):
     self.offline_signaled = False
     self.value_last_time_received = time_received
     self._online = True
+
+    model_versions = self.model_versions
+    if model_versions is not None:
+      model_versions.latest = self.version = next(model_versions.counter)
+
+    if self.offline_deadline_scheduler is not None:
+      self.offline_deadline_scheduler.schedule(self)
         
-    self.sensor_value_update_subject.on_next(active_channel)
+    subject = self.sensor_value_update_subject
+    if subject is not None and subject.observers:
+      subject.on_next(active_channel)
 
   def heartbeat_received(self, time_received):
     """A heartbeat message has been received.
@@ -212,27 +351,158 @@ class SensorEntityActiveModel(ActiveModel):
     self.heartbeat_last_time_received = time_received
     self._online = True
 
+    model_versions = self.model_versions
+    if model_versions is not None:
+      model_versions.latest = self.version = next(model_versions.counter)
+
+    if self.offline_deadline_scheduler is not None:
+      self.offline_deadline_scheduler.schedule(self)
+
+  def activity_reported(self, value_time_received, heartbeat_time_received):
+    """Another server node has heard from the sensor. Either time can be
+       None if that node has not had that kind of message.
+    """
+
+    changed = False
+    if value_time_received is not None and (self.value_last_time_received is None or value_time_received > self.value_last_time_received):
+      self.value_last_time_received = value_time_received
+      changed = True
+    if heartbeat_time_received is not None and (self.heartbeat_last_time_received is None or heartbeat_time_received > self.heartbeat_last_time_received):
+      self.heartbeat_last_time_received = heartbeat_time_received
+      changed = True
+
+    if not changed:
+      return
+
+    self.offline_signaled = False
+    self._online = True
+
+    model_versions = self.model_versions
+    if model_versions is not None:
+      model_versions.latest = self.version = next(model_versions.counter)
+
+    if self.offline_deadline_scheduler is not None:
+      self.offline_deadline_scheduler.schedule(self)
+
+  def status_reported(self, offline, value_time_received, heartbeat_time_received):
+    """The server node that owns the sensor has reported whether it is
+       offline. Either time can be None if the owner has not had that kind
+       of message.
+
+       A sensor this node has heard from since the times in the report stays
+       online, the owner will hear about it with the next activity message.
+    """
+
+    heard_since = ((self.value_last_time_received or 0) > (value_time_received or 0) or
+                   (self.heartbeat_last_time_received or 0) > (heartbeat_time_received or 0))
+
+    changed = False
+    if value_time_received is not None and (self.value_last_time_received is None or value_time_received > self.value_last_time_received):
+      self.value_last_time_received = value_time_received
+      changed = True
+    if heartbeat_time_received is not None and (self.heartbeat_last_time_received is None or heartbeat_time_received > self.heartbeat_last_time_received):
+      self.heartbeat_last_time_received = heartbeat_time_received
+      changed = True
+
+    offline_signaled = offline and not heard_since
+    if offline_signaled != self.offline_signaled:
+      self.offline_signaled = offline_signaled
+      changed = True
+
+    if not changed:
+      return
+
+    if not offline_signaled and (self.value_last_time_received is not None or self.heartbeat_last_time_received is not None):
+      self._online = True
+
+    model_versions = self.model_versions
+    if model_versions is not None:
+      model_versions.latest = self.version = next(model_versions.counter)
+
+  def update_status(self, online, offline_signaled, value_last_time_received, heartbeat_last_time_received):
+    """Take on the status of the sensor as tracked somewhere else, for
+       example by the ingest shard that owns the sensor.
+    """
+
+    if (self._online == online and self.offline_signaled == offline_signaled and
+        self.value_last_time_received == value_last_time_received and
+        self.heartbeat_last_time_received == heartbeat_last_time_received):
+      return
+
+    self._online = online
+    self.offline_signaled = offline_signaled
+    self.value_last_time_received = value_last_time_received
+    self.heartbeat_last_time_received = heartbeat_last_time_received
+
+    model_versions = self.model_versions
+    if model_versions is not None:
+      model_versions.latest = self.version = next(model_versions.counter)
+
+  def offline_deadline(self):
+    """Get the time at which the sensor will be considered offline if no
+       further updates come in.
+
+       Returns None if there is nothing to watch for, either because the
+       sensor has no time limits or because it has already been signaled as
+       offline.
+    """
+
+    if self._online:
+      if self.value_update_time_limit is not None:
+        # A heartbeat or a status report can put the sensor online before
+        # it has sent a value.
+        if self.value_last_time_received is not None:
+          return self.value_last_time_received + self.value_update_time_limit
+        else:
+          return self._item_creation_time + self.value_update_time_limit
+      elif self.heartbeat_update_time_limit is not None:
+        return self.heartbeat_reference_time() + self.heartbeat_update_time_limit
+    elif not self.offline_signaled:
+      if self.value_update_time_limit is not None:
+        if self.value_last_time_received is not None:
+          return self.value_last_time_received + self.value_update_time_limit
+        else:
+          return self._item_creation_time + self.value_update_time_limit
+      elif self.heartbeat_update_time_limit is not None:
+        if self.heartbeat_last_time_received is not None:
+          return self.heartbeat_last_time_received + self.heartbeat_update_time_limit
+        else:
+          return self._item_creation_time + self.heartbeat_update_time_limit
+
+    return None
+
+  def heartbeat_reference_time(self):
+    """Get the most recent of the last value and heartbeat times.
+    """
+
+    if self.value_last_time_received is not None:
+      if self.heartbeat_last_time_received is not None:
+        return max(self.value_last_time_received, self.heartbeat_last_time_received)
+      else:
+        return self.value_last_time_received
+    else:
+      return self.heartbeat_last_time_received
+
   def check_if_offline_transition(self, current_time):
 
     # Only check if the model thinks it is online and there was an update time,
     # otherwise we want the initial 
     if self._online:
       if self.value_update_time_limit is not None:
-        # The only way we would ever be considered online is if there has been a
-        # value update, so it will not be None
-        self._online = not self.is_timeout(current_time, self.value_last_time_received, self.value_update_time_limit)
+        # A heartbeat or a status report can put the sensor online before
+        # it has sent a value.
+        if self.value_last_time_received is not None:
+          update_to_use = self.value_last_time_received
+        else:
+          update_to_use = self._item_creation_time
+
+        self._online = not self.is_timeout(current_time, update_to_use, self.value_update_time_limit)
       elif self.heartbeat_update_time_limit is not None:
         # If this sensor requires a heartbeat, the heartbeat time can be
         # checked.
 
         # Calculate the update time to use in the timeout calculation.
-        if self._value_last_time_received is not Null:
-            if self._heartbeat_last_time_received is not Null:
-              update_to_use = max(self.value_last_time_received, self.heartbeat_last_time_received)
-            else:
-              update_to_use = self.value_last_time_received
-        else:
-            update_to_use = self.heartbeat_last_time_received
+        update_to_use = self.heartbeat_reference_time()
             
         self._online = not self.is_timeout(current_time, update_to_use, self.heartbeat_update_time_limit)
 
@@ -280,53 +550,122 @@ class SensorEntityActiveModel(ActiveModel):
 
   def signal_offline(self, current_time):
     self.offline_signaled = True
+
+    model_versions = self.model_versions
+    if model_versions is not None:
+      model_versions.latest = self.version = next(model_versions.counter)
+
     print("Sensor {0} offline at {1}".format(self.sensor_entity_description.name, current_time))
 
 class SensedEntityActiveModel(ActiveModel):
   """The base active model for a sensed entity.
   """
+
+  __slots__ = ('sensed_entity_description', 'active_channels', 'sensed_value_update_subject')
   
   def __init__(self, sensed_entity_description):
     self.sensed_entity_description = sensed_entity_description
 
-    # A map of measurement types to the active channel that gives that
-    # type.
+    # A map of measurement types to the active channels that give that
+    # type. A location can have several sensors of the same type.
     self.active_channels = {}
 
-    self.sensed_value_update_subject = Subject()
+    # Only made when the first observer registers.
+    self.sensed_value_update_subject = None
 
   def get_active_channels(self):
-    """Get all active channels for the sensor.
+    """Get all active channels for the sensed entity.
     """
 
-    return sorted(list(self.active_channels.values()), key=lambda channel: channel.channel_description.name)
-    
+    return sorted([channel for channels in self.active_channels.values() for channel in channels], key=lambda channel: channel.channel_description.name)
+
+  def get_measurement_type_channels(self, measurement_type):
+    """Get the active channels that give a measurement type, or an empty
+       list if there are none.
+    """
+
+    return self.active_channels.get(measurement_type, [])
+
+  def get_measurement_types(self):
+    """Get the measurement types of all the active channels.
+    """
+
+    return sorted(self.active_channels)
+
   def register_active_channel(self, active_channel):
-    self.active_channels[active_channel.channel_description.measurement_type] = active_channel
+    self.active_channels.setdefault(active_channel.channel_description.measurement_type, []).append(active_channel)
     
   def show_values(self):
-    for measurement_type, active_channel in self.active_channels.items():
-      print("Sensed entity {} has value of {} for measurement type {}".
-            format(self.sensed_entity_description.name,
-                   active_channel.current_value,
-                   measurement_type))
+    for measurement_type, active_channels in self.active_channels.items():
+      for active_channel in active_channels:
+        print("Sensed entity {} has value of {} for measurement type {} from sensor {}".
+              format(self.sensed_entity_description.name,
+                     active_channel.current_value,
+                     measurement_type,
+                     active_channel.sensor_entity_active_model.sensor_entity_description.name))
 
   def value_update_received(self, active_channel, time_received):
     """Signal to everyone who cares that there has been a value update.
     """
     
-    self.sensed_value_update_subject.on_next(active_channel)
+    subject = self.sensed_value_update_subject
+    if subject is not None and subject.observers:
+      subject.on_next(active_channel)
 
   def register_value_update_observer(self, observer):
     """Register an observer interested in sensed value update events.
     """
+    if self.sensed_value_update_subject is None:
+      self.sensed_value_update_subject = Subject()
+
     self.sensed_value_update_subject.subscribe(observer)
 
     
 class PhysicalLocationActiveModel(SensedEntityActiveModel):
   """The active model for a physical location.
+
+     The channels of each measurement type are kept together, so the
+     location can be summarized by type without visiting every channel.
   """
 
+  __slots__ = ('location_values',)
+
   def __init__(self, physical_location_description):
     SensedEntityActiveModel.__init__(self, physical_location_description)
 
+    # A map of measurement types to the channels measuring them.
+    self.location_values = {}
+
+  def register_active_channel(self, active_channel):
+    SensedEntityActiveModel.register_active_channel(self, active_channel)
+
+    measurement_type = active_channel.channel_description.measurement_type
+    location_values = self.location_values.get(measurement_type)
+    if location_values is None:
+      location_values = self.location_values[measurement_type] = LocationValues(measurement_type)
+    location_values.add_channel(active_channel)
+
+  def get_value_summary(self, measurement_type, current_time=None):
+    """Summarize the current values of a measurement type at the location.
+
+       Returns None if no channel measures the type.
+    """
+
+    location_values = self.location_values.get(measurement_type)
+    if location_values is None:
+      return None
+
+    if current_time is None:
+      current_time = time.time()
+
+    return location_values.get_summary(current_time, Constants.LOCATION_VALUE_MAX_AGE, Constants.LOCATION_VALUE_HALF_LIFE)
+
+  def get_value_summaries(self, current_time=None):
+    """Summarize the current values of every measurement type at the
+       location, in measurement type order.
+    """
+
+    if current_time is None:
+      current_time = time.time()
+
+    return [self.get_value_summary(measurement_type, current_time) for measurement_type in sorted(self.location_values)]
@@ -7,6 +7,7 @@
 
 import pdb
 from TinkerSpaceCommandServer import Config
+from TinkerSpaceCommandServer import Constants
 from . import Entities
 import yaml
 
@@ -28,6 +29,12 @@ class EntityRegistry:
     # Map of active models for sensor entities keyed by their external ID
     self.sensor_entity_active_models = {}
 
+    # Map of channel routes keyed by (sensor external ID, channel ID)
+    self.channel_routes = {}
+
+    # The versions of the state of the sensor active models.
+    self.model_versions = Entities.ModelVersions()
+
   def add_sensor_detail(self, sensor_detail_entity):
     """Add in a new sensor detail entity to the registry.
     """
@@ -69,6 +76,7 @@ class EntityRegistry:
       sensor = self.sensors[sensor_key]
 
       sensor_active_model = Entities.SensorEntityActiveModel(sensor)
+      sensor_active_model.model_versions = self.model_versions
       self.sensor_entity_active_models[sensor_key] = sensor_active_model
       
       sensor_details = sensor.sensor_details
@@ -76,7 +84,22 @@ class EntityRegistry:
       for channel_id, sensed_item in sensor.channel_associations.items():
         sensed_active_model = self.sensed_entity_active_models[sensed_item.external_id]
         channel_detail = sensor_details.get_channel_detail(channel_id)
-        channel_active_model = Entities.SensorActiveChannelModel(channel_id, channel_detail, sensor_active_model, sensed_active_model)
+        channel_active_model = Entities.SensorActiveChannelModel(channel_id, channel_detail, sensor_active_model, sensed_active_model,
+                                                                 sensor_details.history_size, sensor_details.history_window)
+
+        self.channel_routes[(sensor_key, channel_id)] = Entities.SensorChannelRoute(sensor_active_model, channel_active_model)
+
+  def restrict_to_sensors(self, sensor_ids):
+    """Drop the active models and channel routes of every sensor not in the
+       given sensor IDs.
+
+       Used by ingest shards, which each own a slice of the sensors.
+    """
+
+    sensor_ids = set(sensor_ids)
+
+    self.sensor_entity_active_models = {sensor_id: sensor_active_model for sensor_id, sensor_active_model in self.sensor_entity_active_models.items() if sensor_id in sensor_ids}
+    self.channel_routes = {key: route for key, route in self.channel_routes.items() if key[0] in sensor_ids}
 
   def get_sensor_active_model(self, sensor_id):
     """Get the sensor active model associated with a given sensor ID.
@@ -92,6 +115,20 @@ class EntityRegistry:
 
     return self.sensor_entity_active_models.values()
 
+  def get_channel_route(self, sensor_id, channel_id):
+    """Get the route for measurements on a given channel of a given sensor.
+
+       Returns None if no such sensor or channel.
+    """
+
+    return self.channel_routes.get((sensor_id, channel_id))
+
+  def get_all_channel_routes(self):
+    """Get all channel routes from the registry.
+    """
+
+    return self.channel_routes.values()
+
   def get_sensed_active_model(self, sensed_id):
     """Get the sensed entity active model associated with a given sensed entity ID.
 
@@ -128,9 +165,13 @@ class YamlEntityRegistryReader:
       sensor_update_time_limit = detail.get(Config.CONFIG_NAME_SENSOR_UPDATE_TIME_LIMIT)
       sensor_heartbeat_time_limit = detail.get(Config.CONFIG_NAME_SENSOR_HEARTBEAT_TIME_LIMIT)
 
+      history_size = detail.get(Config.CONFIG_NAME_HISTORY_SIZE, Constants.CHANNEL_HISTORY_SIZE)
+      history_window = detail.get(Config.CONFIG_NAME_HISTORY_WINDOW)
+
       channels = self.read_channel_details(detail)
 
-      entity_registry.add_sensor_detail(Entities.SensorDetailEntityDescription(external_id, name, description, sensor_update_time_limit, sensor_heartbeat_time_limit, channels))
+      entity_registry.add_sensor_detail(Entities.SensorDetailEntityDescription(external_id, name, description, sensor_update_time_limit, sensor_heartbeat_time_limit, channels,
+                                                                               history_size, history_window))
 
   def read_channel_details(self, sensor_detail):
     """Read the channel details from a sensor detail description.
@@ -0,0 +1,106 @@
+#
+# The live values of one measurement type over every sensor channel measuring
+# a physical location.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import math
+from threading import Lock
+
+class LocationValueSummary:
+  """A summary of the current values of the channels measuring one type of
+     measurement at a location.
+
+     Only channels with a numeric value no older than the maximum age are
+     counted. The current value is the mean of those values weighted by how
+     fresh they are, so a sensor that has just reported counts for more than
+     one that is about to go stale.
+  """
+
+  __slots__ = ('measurement_type', 'channel_count', 'count', 'mean', 'minimum', 'maximum', 'current_value', 'time_last_update')
+
+  def __init__(self, measurement_type, channel_count, count, mean, minimum, maximum, current_value, time_last_update):
+    self.measurement_type = measurement_type
+
+    # The number of channels measuring the type, and how many of them have a
+    # fresh value.
+    self.channel_count = channel_count
+    self.count = count
+
+    # None if no channel has a fresh value.
+    self.mean = mean
+    self.minimum = minimum
+    self.maximum = maximum
+    self.current_value = current_value
+
+    # The time of the most recent value, in seconds since the epoch, or None
+    # if there never has been one.
+    self.time_last_update = time_last_update
+
+class LocationValues:
+  """The current values of every channel measuring one type of measurement
+     at a location.
+
+     The values are read from the channel models when a summary is asked
+     for, rather than copied on every measurement, so summaries cost nothing
+     on the measurement path.
+  """
+
+  __slots__ = ('measurement_type', 'channels', 'lock')
+
+  def __init__(self, measurement_type):
+    self.measurement_type = measurement_type
+
+    # The active channels measuring the type.
+    self.channels = []
+
+    self.lock = Lock()
+
+  def add_channel(self, active_channel):
+    with self.lock:
+      self.channels.append(active_channel)
+
+  def get_summary(self, current_time, max_age, half_life):
+    """Summarize the values no more than max_age seconds old at the current
+       time, in seconds since the epoch.
+
+       The weight of a value in the current value halves every half_life
+       seconds of its age.
+    """
+
+    with self.lock:
+      channels = list(self.channels)
+
+    values = []
+    times = []
+    for active_channel in channels:
+      # The time is read first, a value newer than its time only makes the
+      # value look a little older.
+      update_time = active_channel.time_last_update
+      try:
+        value = float(active_channel.current_value)
+      except (TypeError, ValueError):
+        # Only numeric values are summarized.
+        value = math.nan
+      values.append(value)
+      times.append(math.nan if update_time is None else update_time)
+
+    # NaN compares false, so channels without a value are dropped here too.
+    oldest_time = current_time - max_age
+    fresh = [index for index, update_time in enumerate(times) if update_time >= oldest_time and values[index] == values[index]]
+
+    time_last_update = max((update_time for update_time in times if update_time == update_time), default=None)
+
+    if not fresh:
+      return LocationValueSummary(self.measurement_type, len(values), 0, None, None, None, None, time_last_update)
+
+    fresh_values = [values[index] for index in fresh]
+    weights = [0.5 ** (max(0.0, current_time - times[index]) / half_life) for index in fresh]
+
+    return LocationValueSummary(self.measurement_type, len(values), len(fresh_values),
+                                math.fsum(fresh_values) / len(fresh_values), min(fresh_values), max(fresh_values),
+                                math.fsum(map(float.__mul__, fresh_values, weights)) / math.fsum(weights),
+                                time_last_update)
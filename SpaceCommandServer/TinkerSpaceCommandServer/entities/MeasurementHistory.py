@@ -0,0 +1,133 @@
+#
+# An in-memory history of the recent measurements of a sensor channel.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+class MeasurementHistory:
+  """A fixed capacity history of measurements.
+
+     Measurements are kept in a single float64 array, each as its timestamp
+     in milliseconds since the epoch followed by its value. The array grows
+     as measurements come in, so channels that rarely report stay small.
+     Once it is a quarter past the capacity, the oldest measurements are cut
+     off in one go.
+
+     Every measurement is added to the array with one call, which can't be
+     interrupted by another thread, so adding a measurement takes no lock.
+     Reads copy the array in one call too, and work on the copy.
+
+     Measurements are expected to be added in time order.
+  """
+
+  __slots__ = ('capacity', 'window', 'trim_length', 'points', 'lock')
+
+  def __init__(self, capacity, window=None):
+    # The maximum number of measurements kept.
+    self.capacity = capacity
+
+    # If not None, the maximum age in seconds of measurements returned,
+    # relative to the most recent measurement.
+    self.window = window
+
+    # The length of the array at which the oldest measurements are cut off.
+    self.trim_length = 2 * (capacity + max(capacity // 4, 1))
+
+    # The timestamps and values, interleaved, oldest first.
+    self.points = array('d')
+
+    # Only taken while cutting off the oldest measurements.
+    self.lock = Lock()
+
+  def __len__(self):
+    return min(len(self.points) // 2, self.capacity)
+
+  def append(self, time_received, value):
+    """Add a measurement.
+
+       time_received is in seconds since the epoch.
+    """
+
+    points = self.points
+
+    # The value is converted before anything is added, so a bad one leaves
+    # no timestamp behind.
+    points.extend((time_received * 1000.0, float(value)))
+
+    if len(points) > self.trim_length:
+      self.trim()
+
+  def extend(self, times_received, values):
+    """Add a block of measurements, oldest first.
+    """
+
+    # Only the newest measurements are kept if the block is larger than the
+    # capacity.
+    count = min(len(values), self.capacity)
+    if not count:
+      return
+
+    block = array('d', bytes(16 * count))
+    block[0::2] = array('d', [time_received * 1000.0 for time_received in times_received[-count:]])
+    block[1::2] = array('d', values[-count:])
+
+    points = self.points
+    points.extend(block)
+
+    if len(points) > self.trim_length:
+      self.trim()
+
+  def trim(self):
+    # Cut off the measurements older than the newest capacity of them.
+    # Measurements added while this runs only mean fewer are cut off.
+    with self.lock:
+      excess = len(self.points) - 2 * self.capacity
+      if excess > 0:
+        del self.points[:excess]
+
+  def get_window(self, start_time=None, end_time=None):
+    """Get the measurements with start_time <= time < end_time, oldest
+       first.
+
+       The times are in seconds since the epoch and either may be None for
+       an open range. Returns a pair of arrays, the timestamps in
+       milliseconds and the values.
+    """
+
+    timestamps, values = self.copy_points()
+    if not timestamps:
+      return array('q'), array('d')
+
+    start_timestamp = None if start_time is None else int(start_time * 1000)
+    if self.window is not None:
+      window_start = int(timestamps[-1]) - int(self.window * 1000)
+      if start_timestamp is None or start_timestamp < window_start:
+        start_timestamp = window_start
+
+    low = 0 if start_timestamp is None else bisect_left(timestamps, start_timestamp)
+    high = len(timestamps) if end_time is None else bisect_left(timestamps, int(end_time * 1000))
+
+    return array('q', map(int, timestamps[low:high])), values[low:high]
+
+  def get_latest(self, count):
+    """Get the most recent count measurements, oldest first.
+    """
+
+    timestamps, values = self.copy_points()
+
+    low = max(0, len(values) - count)
+
+    return array('q', map(int, timestamps[low:])), values[low:]
+
+  def copy_points(self):
+    # Copy the newest capacity of measurements, split into a timestamp array
+    # and a value array.
+    points = self.points[-2 * self.capacity:]
+
+    return points[0::2], points[1::2]
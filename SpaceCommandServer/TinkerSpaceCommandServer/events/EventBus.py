@@ -0,0 +1,192 @@
+#
+# An in-process bus for sensor channel measurement events.
+#
+# Subscribers can filter on sensor, sensed entity (e.g. a location) and
+# measurement type. The filters are applied when something subscribes or
+# unsubscribes, not for every event: each channel route gets a prebuilt tuple
+# of the handlers whose filters match it, so publishing is a loop over that
+# tuple with no locks, copies or filter checks.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from queue import Full, Queue
+from threading import Lock, Thread
+
+from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.metrics import Metrics
+
+class EventSubscription:
+  """A handler subscribed to the event bus and the filters for the events it
+     gets.
+
+     Each filter is None for everything, or a set of the IDs or measurement
+     types to get events for.
+  """
+
+  __slots__ = ('handler', 'sensor_ids', 'sensed_ids', 'measurement_types', 'delivery', 'dispatch')
+
+  def __init__(self, handler, sensor_ids, sensed_ids, measurement_types):
+    self.handler = handler
+    self.sensor_ids = sensor_ids
+    self.sensed_ids = sensed_ids
+    self.measurement_types = measurement_types
+
+    # The thread handing events to the handler for asynchronous delivery,
+    # None if the handler is called when the event is published.
+    self.delivery = None
+
+    # Called with each event the subscription gets.
+    self.dispatch = handler
+
+  def matches(self, route):
+    """Does the subscription want events from a channel route?
+    """
+
+    if self.sensor_ids is not None and route.sensor_active_model.sensor_entity_description.external_id not in self.sensor_ids:
+      return False
+    if self.sensed_ids is not None and route.sensed_active_model.sensed_entity_description.external_id not in self.sensed_ids:
+      return False
+    if self.measurement_types is not None and route.measurement_type not in self.measurement_types:
+      return False
+
+    return True
+
+class EventDeliveryThread(Thread):
+  """Hands events to a handler on its own thread, so a slow handler does not
+     hold up measurement processing.
+
+     Events are dropped if the handler falls queue_size events behind.
+  """
+
+  def __init__(self, event_bus, handler, queue_size):
+    Thread.__init__(self)
+    self.event_bus = event_bus
+    self.handler = handler
+    self.queue = Queue(queue_size)
+    self.dropped_count = 0
+
+  def on_next(self, event):
+    try:
+      self.queue.put_nowait(event)
+    except Full:
+      self.dropped_count += 1
+      self.event_bus.events_dropped += 1
+
+  def run(self):
+    handler = self.handler
+    while True:
+      event = self.queue.get()
+      if event is None:
+        break
+
+      try:
+        handler(event)
+      except Exception as error:
+        self.event_bus.handler_failed(handler, error)
+
+  def stop(self):
+    # Events already queued are delivered first.
+    self.queue.put(None)
+
+class MeasurementEventBus:
+  """The bus that measurement events from every channel route are published
+     on.
+
+     Handlers are called with a SensorChannelMeasurementEvent or a
+     SensorChannelMeasurementBatchEvent. An exception from one handler is
+     counted and logged but doesn't stop the others getting the event.
+  """
+
+  def __init__(self, entity_registry, async_queue_size=Constants.EVENT_BUS_ASYNC_QUEUE_SIZE):
+    self.entity_registry = entity_registry
+    self.async_queue_size = async_queue_size
+
+    self.subscriptions = []
+
+    # Held while subscriptions change, never while publishing.
+    self.lock = Lock()
+
+    self.metrics = Metrics.registry
+    self.handler_errors = self.metrics.counter("tinkerspace_event_handler_errors_total", "Exceptions raised by measurement event handlers.")
+
+    # Events dropped because an asynchronous handler fell behind.
+    self.events_dropped = 0
+    self.metrics.counter_function("tinkerspace_event_bus_dropped_total", "Measurement events dropped because an asynchronous handler fell behind.", lambda: self.events_dropped)
+
+  def subscribe(self, handler, sensor_ids=None, sensed_ids=None, measurement_types=None, asynchronous=False):
+    """Subscribe a handler to measurement events.
+
+       The filters are collections of sensor IDs, sensed entity IDs and
+       measurement types, or None for all of them. Asynchronous handlers are
+       called on their own thread.
+
+       Returns the subscription, for unsubscribing.
+    """
+
+    subscription = EventSubscription(handler,
+                                     None if sensor_ids is None else frozenset(sensor_ids),
+                                     None if sensed_ids is None else frozenset(sensed_ids),
+                                     None if measurement_types is None else frozenset(measurement_types))
+    if asynchronous:
+      subscription.delivery = EventDeliveryThread(self, handler, self.async_queue_size)
+      subscription.delivery.daemon = True
+      subscription.delivery.start()
+      subscription.dispatch = subscription.delivery.on_next
+
+    with self.lock:
+      self.subscriptions.append(subscription)
+      self.rebuild_routes()
+
+    return subscription
+
+  def subscribe_observer(self, observer, **filters):
+    """Subscribe an Rx style observer, anything with an on_next function,
+       e.g. an Observer subclass.
+
+       Takes the same filters as subscribe.
+    """
+
+    return self.subscribe(observer.on_next, **filters)
+
+  def unsubscribe(self, subscription):
+    with self.lock:
+      self.subscriptions.remove(subscription)
+      self.rebuild_routes()
+
+    if subscription.delivery is not None:
+      subscription.delivery.stop()
+
+  def stop(self):
+    """Stop delivery to every asynchronous handler.
+    """
+
+    with self.lock:
+      subscriptions = list(self.subscriptions)
+
+    for subscription in subscriptions:
+      if subscription.delivery is not None:
+        subscription.delivery.stop()
+
+  def rebuild_routes(self):
+    # Give every channel route a new tuple of the handlers for it. Routes are
+    # swapped to the new tuple in one assignment, so publishers never see a
+    # half built one. Must be called with the lock held.
+    for route in self.entity_registry.get_all_channel_routes():
+      route.observers = tuple(subscription.dispatch for subscription in self.subscriptions if subscription.matches(route))
+
+  def publish(self, handlers, event):
+    """Give an event to the handlers of its channel route.
+    """
+
+    for handler in handlers:
+      try:
+        handler(event)
+      except Exception as error:
+        self.handler_failed(handler, error)
+
+  def handler_failed(self, handler, error):
+    self.handler_errors.inc()
+    print("Measurement event handler {} failed: {}".format(getattr(handler, '__qualname__', handler), error))
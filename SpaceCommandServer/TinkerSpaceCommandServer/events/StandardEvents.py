@@ -6,7 +6,13 @@ from rx import Observer
 
 class SensorChannelMeasurementEvent:
     """ A measurement event from a sensor
+
+    One of these is made for every channel value, so it is slotted to keep
+    it to a single small allocation.
     """
+
+    __slots__ = ('sensor_active_model', 'sensed_active_model', 'active_channel', 'value', 'time_received')
+
     def __init__(self, sensor_active_model, sensed_active_model, active_channel, value, time_received):
         self.sensor_active_model = sensor_active_model
         self.sensed_active_model = sensed_active_model
@@ -14,6 +20,24 @@ class SensorChannelMeasurementEvent:
         self.value = value
         self.time_received = time_received
         
+class SensorChannelMeasurementBatchEvent:
+    """ A batch of measurements from one channel of a sensor, oldest first
+    """
+
+    __slots__ = ('sensor_active_model', 'sensed_active_model', 'active_channel', 'values', 'times_received',
+                 'value', 'time_received')
+
+    def __init__(self, sensor_active_model, sensed_active_model, active_channel, values, times_received):
+        self.sensor_active_model = sensor_active_model
+        self.sensed_active_model = sensed_active_model
+        self.active_channel = active_channel
+        self.values = values
+        self.times_received = times_received
+
+        # The most recent measurement in the batch
+        self.value = values[-1]
+        self.time_received = times_received[-1]
+        
 class SensedPrintObserver(Observer):
 
     def on_next(self, value):
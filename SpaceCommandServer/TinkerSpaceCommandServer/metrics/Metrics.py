@@ -0,0 +1,181 @@
+#
+# Lightweight counters, gauges and latency histograms for the hot paths of
+# the server, rendered in the Prometheus text format.
+#
+# Updates are plain attribute arithmetic with no locking, so a rare update can
+# be lost when several threads update the same metric at once. That is the
+# price of keeping collection cheap enough to leave on in production.
+#
+# Reading the clock and updating a histogram costs about as much as a
+# fraction of processing a whole message, so the per message latency
+# histograms only time one message in every sample interval. Message counts
+# are kept exactly by the components themselves.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from bisect import bisect_left
+from threading import Lock
+
+# Time one message in this many for the per message latency histograms.
+DEFAULT_SAMPLE_INTERVAL = 16
+
+# The default histogram buckets, in seconds, for stage latencies.
+DEFAULT_LATENCY_BUCKETS = [
+  0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5
+]
+
+class Counter:
+  """A value that only goes up.
+  """
+
+  metric_type = "counter"
+
+  def __init__(self, name, help_text):
+    self.name = name
+    self.help_text = help_text
+    self.value = 0
+
+  def inc(self, amount=1):
+    self.value += amount
+
+  def render(self, lines):
+    lines.append("{} {}".format(self.name, self.value))
+
+class Gauge:
+  """A value read from a function when the metrics are rendered, so it costs
+     nothing on the hot path.
+
+     Also used for counts that a component already keeps, with a metric type
+     of counter.
+  """
+
+  def __init__(self, name, help_text, value_function, metric_type="gauge"):
+    self.name = name
+    self.help_text = help_text
+    self.value_function = value_function
+    self.metric_type = metric_type
+
+  def render(self, lines):
+    lines.append("{} {}".format(self.name, self.value_function()))
+
+class Histogram:
+  """Counts of observed values in fixed buckets, plus their sum and count.
+  """
+
+  metric_type = "histogram"
+
+  def __init__(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS):
+    self.name = name
+    self.help_text = help_text
+    self.buckets = list(buckets)
+
+    # One count per bucket plus one for values above the largest bucket.
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def render(self, lines):
+    cumulative = 0
+    for bound, count in zip(self.buckets, self.counts):
+      cumulative += count
+      lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+    cumulative += self.counts[-1]
+    lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, cumulative))
+    lines.append("{}_sum {}".format(self.name, self.sum))
+    lines.append("{}_count {}".format(self.name, self.count))
+
+class MetricsRegistry:
+  """All metrics of the server.
+
+     Components create their metrics when they are constructed and check
+     enabled before doing any timing or counting on their hot paths, so
+     turning metrics off removes almost all of their cost. Rare events, like
+     bad messages, are counted either way.
+  """
+
+  def __init__(self):
+    self.enabled = True
+    self.sample_interval = DEFAULT_SAMPLE_INTERVAL
+
+    # Map of metric names to metrics, in registration order.
+    self.metrics = {}
+    self.lock = Lock()
+
+  def configure(self, config):
+    """Configure the metrics from the server configuration.
+    """
+
+    metrics_config = config.get("metrics", {})
+
+    self.enabled = metrics_config.get("enabled", True)
+    self.sample_interval = max(1, metrics_config.get("sampleInterval", DEFAULT_SAMPLE_INTERVAL))
+
+  def counter(self, name, help_text):
+    """Get the counter with the given name, creating it if needed.
+    """
+
+    return self.register(name, lambda: Counter(name, help_text))
+
+  def gauge(self, name, help_text, value_function):
+    """Create a gauge whose value is read from the given function.
+
+       A gauge registered again under the same name reads from the newest
+       function.
+    """
+
+    return self.register_function(Gauge(name, help_text, value_function))
+
+  def counter_function(self, name, help_text, value_function):
+    """Create a counter whose value is read from the given function, for
+       counts a component already keeps.
+    """
+
+    return self.register_function(Gauge(name, help_text, value_function, "counter"))
+
+  def register_function(self, metric):
+    with self.lock:
+      self.metrics[metric.name] = metric
+
+      return metric
+
+  def histogram(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS):
+    """Get the histogram with the given name, creating it if needed.
+    """
+
+    return self.register(name, lambda: Histogram(name, help_text, buckets))
+
+  def register(self, name, factory):
+    with self.lock:
+      metric = self.metrics.get(name)
+      if metric is None:
+        metric = factory()
+        self.metrics[name] = metric
+
+      return metric
+
+  def render_prometheus(self):
+    """Render all metrics in the Prometheus text exposition format.
+    """
+
+    lines = []
+    with self.lock:
+      metrics = list(self.metrics.values())
+
+    for metric in metrics:
+      lines.append("# HELP {} {}".format(metric.name, metric.help_text))
+      lines.append("# TYPE {} {}".format(metric.name, metric.metric_type))
+      metric.render(lines)
+
+    return "\n".join(lines) + "\n"
+
+# The metrics registry for the server.
+registry = MetricsRegistry()
@@ -0,0 +1,594 @@
+#
+# An embedded store of sensor channel measurements in column files.
+#
+# The store is a directory with a partition subdirectory for each UTC day.
+# Each series, a sensor channel and the sensed entity it measured, has a file
+# in every partition it has points in. Files are only appended to, a block at
+# a time. A block is a header with the number of points, how the timestamps
+# and values are encoded and the first and last timestamp, then the columns:
+#
+#   - the timestamps, in milliseconds, as the first timestamp in the header
+#     and the deltas from the one before for the rest, in the smallest
+#     integer type they all fit in
+#   - the values, as one value if they are all the same. Otherwise, if they
+#     all have a few decimal places, scaled up to integers and stored as the
+#     first integer and the deltas from the one before for the rest, again
+#     in the smallest integer type they fit in. Failing that, as 32 bit
+#     floats if they all fit exactly or as 64 bit floats
+#
+# Sensor values usually have a fixed number of decimal places and change
+# little from one measurement to the next, so most are stored in a byte. This
+# gets much of the compression of XOR encoding the floats while every column
+# is still an array that decodes in one call.
+#
+# Files are memory mapped for reads, and blocks wholly outside the time range
+# of a read are skipped using their headers. Blocks are written at every
+# flush, so once a day is over its files are compacted into big blocks.
+#
+# The series are listed in a catalog file in the store directory, one JSON
+# list of series ID, sensor ID, channel ID and sensed ID per line.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import calendar
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import time
+import traceback
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from threading import Lock
+
+# The number of points, the timestamp delta type code, the value encoding,
+# the value type code, the value scale, the first and the last timestamp.
+BLOCK_HEADER = struct.Struct('<IBBBBqq')
+
+# A value stored once for every point in its block.
+CONSTANT_VALUE = struct.Struct('<d')
+
+# The first value of a decimal block, times 10 to the power of the scale.
+FIRST_DECIMAL_VALUE = struct.Struct('<q')
+
+VALUE_ENCODING_CONSTANT = 0
+VALUE_ENCODING_DECIMAL = 1
+VALUE_ENCODING_FLOAT = 2
+
+# The most decimal places tried for decimal encoding, and the largest value
+# that can be decimal encoded. Scaled up, and as deltas, values stay well
+# within 64 bit integers.
+MAX_DECIMAL_SCALE = 4
+MAX_DECIMAL_VALUE = 2 ** 48
+
+# The integer types tried for delta columns, smallest first.
+UNSIGNED_TYPE_CODES = ['B', 'H', 'I']
+SIGNED_TYPE_CODES = ['b', 'h', 'i']
+
+# The most points in a block. Compacted files are split into blocks this big,
+# so reads of part of a day can still skip most of it.
+BLOCK_POINTS = 4096
+
+# The time covered by a partition, in milliseconds.
+PARTITION_SIZE = 24 * 60 * 60 * 1000
+
+# The earliest and latest timestamps that can be stored, for reading
+# everything.
+FIRST_TIMESTAMP = -2 ** 63
+LAST_TIMESTAMP = 2 ** 63 - 1
+
+CATALOG_FILE_NAME = "series"
+COMPACTED_FILE_NAME = "compacted"
+SERIES_FILE_SUFFIX = ".col"
+
+# The block columns are little endian.
+SWAP_BYTES = sys.byteorder != 'little'
+
+def partition_name(partition):
+  return time.strftime("%Y%m%d", time.gmtime(partition * PARTITION_SIZE / 1000))
+
+def parse_partition_name(name):
+  """Get the partition of a partition directory, or None if the name isn't
+     one.
+  """
+
+  try:
+    return calendar.timegm(time.strptime(name, "%Y%m%d")) * 1000 // PARTITION_SIZE
+  except ValueError:
+    return None
+
+def series_file_name(series_id):
+  return "{}{}".format(series_id, SERIES_FILE_SUFFIX)
+
+def integer_type_code(integers):
+  """The type code of the smallest array type that holds every integer.
+  """
+
+  smallest = min(integers, default=0)
+  largest = max(integers, default=0)
+  for type_code in UNSIGNED_TYPE_CODES if smallest >= 0 else SIGNED_TYPE_CODES:
+    bits = array(type_code).itemsize * 8
+    if smallest >= 0 and largest < 1 << bits:
+      return type_code
+    if smallest < 0 and -(1 << (bits - 1)) <= smallest and largest < 1 << (bits - 1):
+      return type_code
+
+  return 'q'
+
+def delta_array(integers):
+  """The deltas of integers from the one before, after the first, in the
+     smallest array type that holds them.
+  """
+
+  deltas = [integers[index] - integers[index - 1] for index in range(1, len(integers))]
+  deltas = array(integer_type_code(deltas), deltas)
+  if SWAP_BYTES:
+    deltas.byteswap()
+
+  return deltas
+
+def decimal_scale(values):
+  """The fewest decimal places every value has, or None if that is more than
+     MAX_DECIMAL_SCALE or the values are too big to scale up.
+  """
+
+  if not all(-MAX_DECIMAL_VALUE < value < MAX_DECIMAL_VALUE for value in values):
+    return None
+
+  for scale in range(MAX_DECIMAL_SCALE + 1):
+    factor = 10 ** scale
+    if all(round(value * factor) / factor == value for value in values):
+      return scale
+
+  return None
+
+def encode_block(timestamps, values):
+  """Encode points, in time order, as a block.
+  """
+
+  deltas = delta_array(timestamps)
+
+  value_type_code = 'd'
+  scale = 0
+  if values.count(values[0]) == len(values):
+    value_encoding = VALUE_ENCODING_CONSTANT
+    encoded_values = CONSTANT_VALUE.pack(values[0])
+  else:
+    scale = decimal_scale(values)
+    if scale is not None:
+      value_encoding = VALUE_ENCODING_DECIMAL
+      factor = 10 ** scale
+      scaled = [round(value * factor) for value in values]
+      value_deltas = delta_array(scaled)
+      value_type_code = value_deltas.typecode
+      encoded_values = FIRST_DECIMAL_VALUE.pack(scaled[0]) + value_deltas.tobytes()
+    else:
+      value_encoding = VALUE_ENCODING_FLOAT
+      scale = 0
+      encoded_values = array('f', values)
+      if encoded_values.tolist() != values:
+        encoded_values = array('d', values)
+      value_type_code = encoded_values.typecode
+
+      if SWAP_BYTES:
+        encoded_values.byteswap()
+      encoded_values = encoded_values.tobytes()
+
+  header = BLOCK_HEADER.pack(len(timestamps), ord(deltas.typecode), value_encoding, ord(value_type_code), scale, timestamps[0], timestamps[-1])
+
+  return header + deltas.tobytes() + encoded_values
+
+def block_size(count, delta_type_code, value_encoding, value_type_code):
+  """The size of a block, header included.
+  """
+
+  size = BLOCK_HEADER.size + (count - 1) * array(chr(delta_type_code)).itemsize
+  if value_encoding == VALUE_ENCODING_CONSTANT:
+    return size + CONSTANT_VALUE.size
+  if value_encoding == VALUE_ENCODING_DECIMAL:
+    return size + FIRST_DECIMAL_VALUE.size + (count - 1) * array(chr(value_type_code)).itemsize
+
+  return size + count * array(chr(value_type_code)).itemsize
+
+def read_array(buffer, offset, type_code, count):
+  """Read an array from a buffer. Returns the array and the offset after it.
+  """
+
+  column = array(chr(type_code))
+  end = offset + count * column.itemsize
+  column.frombytes(buffer[offset:end])
+  if SWAP_BYTES:
+    column.byteswap()
+
+  return column, end
+
+def decode_block(buffer, offset):
+  """Decode the block at an offset in a buffer.
+
+     Returns the lists of timestamps and values.
+  """
+
+  count, delta_type_code, value_encoding, value_type_code, scale, first_timestamp, last_timestamp = BLOCK_HEADER.unpack_from(buffer, offset)
+
+  deltas, offset = read_array(buffer, offset + BLOCK_HEADER.size, delta_type_code, count - 1)
+  timestamps = list(accumulate(deltas, initial=first_timestamp))
+
+  if value_encoding == VALUE_ENCODING_CONSTANT:
+    return timestamps, [CONSTANT_VALUE.unpack_from(buffer, offset)[0]] * count
+
+  if value_encoding == VALUE_ENCODING_DECIMAL:
+    first_value = FIRST_DECIMAL_VALUE.unpack_from(buffer, offset)[0]
+    value_deltas, offset = read_array(buffer, offset + FIRST_DECIMAL_VALUE.size, value_type_code, count - 1)
+    factor = 10 ** scale
+
+    return timestamps, [value / factor for value in accumulate(value_deltas, initial=first_value)]
+
+  values, offset = read_array(buffer, offset, value_type_code, count)
+
+  return timestamps, values.tolist()
+
+def read_series_file(path, start_time, end_time):
+  """Read the points of a series file with start_time <= time < end_time.
+
+     Blocks are in time order within themselves but not between each other.
+     Returns the lists of timestamps and values, in time order.
+  """
+
+  try:
+    fp = open(path, 'rb')
+  except FileNotFoundError:
+    return [], []
+
+  with fp:
+    size = os.fstat(fp.fileno()).st_size
+    if size == 0:
+      return [], []
+
+    timestamps = []
+    values = []
+    in_order = True
+    with mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ) as buffer:
+      offset = 0
+      while offset + BLOCK_HEADER.size <= size:
+        count, delta_type_code, value_encoding, value_type_code, scale, first_timestamp, last_timestamp = BLOCK_HEADER.unpack_from(buffer, offset)
+        next_offset = offset + block_size(count, delta_type_code, value_encoding, value_type_code)
+
+        # A block still being written.
+        if next_offset > size:
+          break
+
+        if last_timestamp >= start_time and first_timestamp < end_time:
+          block_timestamps, block_values = decode_block(buffer, offset)
+
+          low = 0 if first_timestamp >= start_time else bisect_left(block_timestamps, start_time)
+          high = count if last_timestamp < end_time else bisect_left(block_timestamps, end_time)
+
+          if timestamps and block_timestamps[low] < timestamps[-1]:
+            in_order = False
+          timestamps.extend(block_timestamps[low:high])
+          values.extend(block_values[low:high])
+
+        offset = next_offset
+
+  if not in_order:
+    order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+    timestamps = [timestamps[index] for index in order]
+    values = [values[index] for index in order]
+
+  return timestamps, values
+
+def valid_size(path):
+  """The size of the complete blocks at the start of a series file.
+  """
+
+  size = os.path.getsize(path)
+  offset = 0
+  with open(path, 'rb') as fp:
+    while True:
+      header = fp.read(BLOCK_HEADER.size)
+      if len(header) < BLOCK_HEADER.size:
+        return offset
+
+      count, delta_type_code, value_encoding, value_type_code, scale, first_timestamp, last_timestamp = BLOCK_HEADER.unpack(header)
+      next_offset = offset + block_size(count, delta_type_code, value_encoding, value_type_code)
+      if next_offset > size:
+        return offset
+
+      offset = next_offset
+      fp.seek(offset)
+
+def sort_points(timestamps, values):
+  """Put points in time order, if they aren't already.
+  """
+
+  for index in range(1, len(timestamps)):
+    if timestamps[index] < timestamps[index - 1]:
+      order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+
+      return [timestamps[index] for index in order], [values[index] for index in order]
+
+  return timestamps, values
+
+def split_by_partition(timestamps, values):
+  """Split points, in time order, into the partitions they belong in.
+
+     Yields the partition and its timestamps and values.
+  """
+
+  start = 0
+  while start < len(timestamps):
+    partition = timestamps[start] // PARTITION_SIZE
+    end = len(timestamps)
+    if timestamps[-1] // PARTITION_SIZE != partition:
+      end = bisect_left(timestamps, (partition + 1) * PARTITION_SIZE, start)
+
+    yield partition, timestamps[start:end], values[start:end]
+    start = end
+
+class ColumnStore:
+  """The store's files, and the measurements waiting to be written to them.
+
+     Appending only adds to lists in memory, which are written to the files
+     as new blocks at each flush. Reads include points not flushed yet.
+     Flushes, compaction and retention must only be done by one thread at a
+     time, reads can be done from any thread.
+  """
+
+  def __init__(self, directory, retention_days=0):
+    self.directory = directory
+
+    # Partitions more than this many days old are deleted, 0 to keep
+    # everything.
+    self.retention_days = retention_days
+
+    # The IDs of the series, by (sensor ID, channel ID, sensed ID), and
+    # the IDs and sensed IDs of the series of each (sensor ID, channel ID).
+    self.series_ids = {}
+    self.channel_series = {}
+
+    # The partitions with a directory, oldest first.
+    self.partitions = []
+
+    # Lists of timestamps and values appended to each series since the last
+    # flush, by (sensor ID, channel ID, sensed ID).
+    self.pending = {}
+    self.lock = Lock()
+
+    # Held while a flush moves points from pending to the files, so a read
+    # sees every point in one or the other, never both.
+    self.flush_lock = Lock()
+
+    # The series files that have been checked for a partly written block
+    # since the store was opened.
+    self.checked_files = set()
+
+    # The latest partition compaction and retention were done for.
+    self.maintained_partition = None
+
+    self.points_written = 0
+    self.points_dropped = 0
+    self.write_failures = 0
+
+  def open(self):
+    """Read the catalog and the partitions of the store.
+    """
+
+    os.makedirs(self.directory, exist_ok=True)
+
+    catalog_path = os.path.join(self.directory, CATALOG_FILE_NAME)
+    if os.path.exists(catalog_path):
+      with open(catalog_path, encoding='utf-8') as fp:
+        for line in fp:
+          try:
+            series_id, sensor_id, channel_id, sensed_id = json.loads(line)
+          except ValueError:
+            # The last line may have been partly written.
+            continue
+
+          self.add_series(series_id, sensor_id, channel_id, sensed_id)
+
+    self.partitions = sorted(partition for partition in map(parse_partition_name, os.listdir(self.directory)) if partition is not None)
+
+  def add_series(self, series_id, sensor_id, channel_id, sensed_id):
+    self.series_ids[(sensor_id, channel_id, sensed_id)] = series_id
+    self.channel_series.setdefault((sensor_id, channel_id), []).append((series_id, sensed_id))
+
+  def append(self, sensor_id, channel_id, sensed_id, timestamp, value):
+    """Add a point to be written at the next flush. The timestamp is in
+       milliseconds.
+    """
+
+    with self.lock:
+      points = self.pending.get((sensor_id, channel_id, sensed_id))
+      if points is None:
+        points = self.pending[(sensor_id, channel_id, sensed_id)] = ([], [])
+      points[0].append(timestamp)
+      points[1].append(value)
+
+  def append_many(self, sensor_id, channel_id, sensed_id, timestamps, values):
+    """Add points of a series to be written at the next flush.
+    """
+
+    with self.lock:
+      points = self.pending.get((sensor_id, channel_id, sensed_id))
+      if points is None:
+        points = self.pending[(sensor_id, channel_id, sensed_id)] = ([], [])
+      points[0].extend(timestamps)
+      points[1].extend(values)
+
+  def pending_count(self):
+    with self.lock:
+      return sum(len(timestamps) for timestamps, values in self.pending.values())
+
+  def flush(self):
+    """Write every point appended since the last flush as new blocks.
+
+       Points that can't be written are dropped.
+    """
+
+    with self.flush_lock:
+      with self.lock:
+        flushing = self.pending
+        self.pending = {}
+
+      for (sensor_id, channel_id, sensed_id), (timestamps, values) in flushing.items():
+        try:
+          series_id = self.series_ids.get((sensor_id, channel_id, sensed_id))
+          if series_id is None:
+            series_id = self.create_series(sensor_id, channel_id, sensed_id)
+
+          timestamps, values = sort_points(timestamps, values)
+          for partition, partition_timestamps, partition_values in split_by_partition(timestamps, values):
+            self.write_points(partition, series_id, partition_timestamps, partition_values)
+        except OSError:
+          self.write_failures += 1
+          self.points_dropped += len(timestamps)
+          print(traceback.format_exc())
+
+  def create_series(self, sensor_id, channel_id, sensed_id):
+    """Give a new series an ID and add it to the catalog.
+    """
+
+    series_id = len(self.series_ids)
+    with open(os.path.join(self.directory, CATALOG_FILE_NAME), 'a', encoding='utf-8') as fp:
+      fp.write(json.dumps([series_id, sensor_id, channel_id, sensed_id]) + "\n")
+      fp.flush()
+      os.fsync(fp.fileno())
+
+    with self.lock:
+      self.add_series(series_id, sensor_id, channel_id, sensed_id)
+
+    return series_id
+
+  def write_points(self, partition, series_id, timestamps, values):
+    """Append points, in time order and all in one partition, to a series
+       file.
+    """
+
+    partition_directory = os.path.join(self.directory, partition_name(partition))
+    if partition not in self.partitions:
+      os.makedirs(partition_directory, exist_ok=True)
+      with self.lock:
+        self.partitions = sorted(self.partitions + [partition])
+
+    path = os.path.join(partition_directory, series_file_name(series_id))
+    with open(path, 'ab') as fp:
+      # Cut off a block that was being written when the server stopped.
+      if path not in self.checked_files:
+        size = valid_size(path)
+        if size < fp.tell():
+          fp.truncate(size)
+        self.checked_files.add(path)
+
+      for start in range(0, len(timestamps), BLOCK_POINTS):
+        fp.write(encode_block(timestamps[start:start + BLOCK_POINTS], values[start:start + BLOCK_POINTS]))
+
+    # Points written late to a day already compacted.
+    if partition != self.maintained_partition:
+      try:
+        os.remove(os.path.join(partition_directory, COMPACTED_FILE_NAME))
+      except FileNotFoundError:
+        pass
+
+    self.points_written += len(timestamps)
+
+  def maintain(self, current_time):
+    """Compact the partitions of days that are over and delete those past
+       the retention time.
+
+       Only does anything once the day has changed since it was last called.
+       The time is in milliseconds since the epoch.
+    """
+
+    current_partition = current_time // PARTITION_SIZE
+    if current_partition == self.maintained_partition:
+      return
+
+    if self.retention_days > 0:
+      for partition in [partition for partition in self.partitions if partition <= current_partition - self.retention_days]:
+        with self.lock:
+          self.partitions = [kept for kept in self.partitions if kept != partition]
+        shutil.rmtree(os.path.join(self.directory, partition_name(partition)), ignore_errors=True)
+
+    for partition in self.partitions:
+      if partition < current_partition:
+        self.compact_partition(partition)
+
+    self.maintained_partition = current_partition
+
+  def compact_partition(self, partition):
+    """Rewrite the series files of a partition as blocks of BLOCK_POINTS
+       points.
+
+       Readers that already have a file open keep reading the old one.
+    """
+
+    partition_directory = os.path.join(self.directory, partition_name(partition))
+    compacted_path = os.path.join(partition_directory, COMPACTED_FILE_NAME)
+    if os.path.exists(compacted_path):
+      return
+
+    for name in os.listdir(partition_directory):
+      if not name.endswith(SERIES_FILE_SUFFIX):
+        continue
+
+      path = os.path.join(partition_directory, name)
+      timestamps, values = read_series_file(path, FIRST_TIMESTAMP, LAST_TIMESTAMP)
+
+      compacting_path = path + ".tmp"
+      with open(compacting_path, 'wb') as fp:
+        for start in range(0, len(timestamps), BLOCK_POINTS):
+          fp.write(encode_block(timestamps[start:start + BLOCK_POINTS], values[start:start + BLOCK_POINTS]))
+        fp.flush()
+        os.fsync(fp.fileno())
+      os.replace(compacting_path, path)
+
+    open(compacted_path, 'w').close()
+
+  def iter_rows(self, sensor_id, channel_id, start_time, end_time):
+    """Read the points of a sensor channel with start_time <= time <
+       end_time, a partition at a time.
+
+       Yields a list of (timestamp, sensed ID, value) rows, in time order,
+       for each partition with points in the range. Times are in
+       milliseconds since the epoch.
+    """
+
+    with self.lock:
+      partitions = set(partition for partition in self.partitions
+                       if partition * PARTITION_SIZE < end_time and (partition + 1) * PARTITION_SIZE > start_time)
+
+      # Points not flushed yet can be in partitions with no directory yet.
+      for (point_sensor_id, point_channel_id, sensed_id), (timestamps, values) in self.pending.items():
+        if point_sensor_id == sensor_id and point_channel_id == channel_id:
+          partitions.update(timestamp // PARTITION_SIZE for timestamp in timestamps if start_time <= timestamp < end_time)
+
+    for partition in sorted(partitions):
+      partition_start = max(start_time, partition * PARTITION_SIZE)
+      partition_end = min(end_time, (partition + 1) * PARTITION_SIZE)
+      partition_directory = os.path.join(self.directory, partition_name(partition))
+
+      rows = []
+      with self.flush_lock:
+        # The series are read again for each partition, as a flush since the
+        # last one can have created one with the points that were pending.
+        with self.lock:
+          series = list(self.channel_series.get((sensor_id, channel_id), []))
+          for (point_sensor_id, point_channel_id, sensed_id), (timestamps, values) in self.pending.items():
+            if point_sensor_id == sensor_id and point_channel_id == channel_id:
+              rows.extend((timestamp, sensed_id, value) for timestamp, value in zip(timestamps, values) if partition_start <= timestamp < partition_end)
+
+        for series_id, sensed_id in series:
+          timestamps, values = read_series_file(os.path.join(partition_directory, series_file_name(series_id)), partition_start, partition_end)
+          rows.extend(zip(timestamps, [sensed_id] * len(timestamps), values))
+
+      if rows:
+        # Each series is in order, so this is a merge of sorted runs.
+        rows.sort(key=lambda row: row[0])
+        yield rows
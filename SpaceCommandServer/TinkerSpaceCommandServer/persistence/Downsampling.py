@@ -0,0 +1,61 @@
+#
+# Downsampling of measurement series for display.
+#
+
+#
+# Written by Keith Hughes
+#
+
+def largest_triangle_three_buckets(times, values, threshold):
+  """Pick the points of a series that best keep its visual shape.
+
+     This is the Largest Triangle Three Buckets algorithm. The first and last
+     points are always kept. The points in between are split into
+     threshold - 2 buckets and from each bucket the point is kept that makes
+     the largest triangle with the point kept from the previous bucket and
+     the average of the next bucket. Peaks and troughs survive, unlike with
+     averaging.
+
+     times must be numbers in increasing order. Returns the indices of the
+     points to keep, in order.
+  """
+
+  count = len(times)
+  if threshold >= count:
+    return list(range(count))
+
+  if threshold < 3:
+    return [0, count - 1][:max(threshold, 0)]
+
+  bucket_size = (count - 2) / (threshold - 2)
+
+  indices = [0]
+  selected = 0
+  for bucket in range(threshold - 2):
+    # The average point of the next bucket. For the last bucket this is the
+    # last point of the series.
+    next_start = int((bucket + 1) * bucket_size) + 1
+    next_end = min(int((bucket + 2) * bucket_size) + 1, count)
+    next_count = next_end - next_start
+    average_time = sum(times[next_start:next_end]) / next_count
+    average_value = sum(values[next_start:next_end]) / next_count
+
+    selected_time = times[selected]
+    selected_value = values[selected]
+
+    largest_area = -1.0
+    largest_index = None
+    for index in range(int(bucket * bucket_size) + 1, int((bucket + 1) * bucket_size) + 1):
+      # Twice the triangle area, which is just as good for comparing.
+      area = abs((selected_time - average_time) * (values[index] - selected_value) -
+                 (selected_time - times[index]) * (average_value - selected_value))
+      if area > largest_area:
+        largest_area = area
+        largest_index = index
+
+    indices.append(largest_index)
+    selected = largest_index
+
+  indices.append(count - 1)
+
+  return indices
@@ -6,18 +6,125 @@
 # Written by Keith Hughes
 #
 
+from abc import ABC, abstractmethod
 import traceback
 import datetime
+import os
+import queue
+import time
+import asyncio
+from threading import Lock, Thread
 from rx import Observer
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
 from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.events.StandardEvents import SensorChannelMeasurementBatchEvent
+from TinkerSpaceCommandServer.persistence.Downsampling import largest_triangle_three_buckets
+from TinkerSpaceCommandServer.persistence.PointValues import PointsRejectedError, finite_points, is_finite_value
+from TinkerSpaceCommandServer.persistence.InfluxQuery import InfluxQuery, quote_identifier, run_queries, run_query
+from TinkerSpaceCommandServer.persistence.QueryCache import QueryCache, round_up_bucket_width, AGGREGATED_ROW_TIME, AGGREGATED_ROW_MEAN, AGGREGATED_ROW_MIN, AGGREGATED_ROW_MAX, AGGREGATED_ROW_LAST
+from TinkerSpaceCommandServer.persistence.Rollups import ROLLUP_KIND_CHANNEL, ROLLUP_KIND_LOCATION, ROLLUP_TIERS, RollupAccumulator, RollupFlushThread, RollupObserver, combine_rollup_rows, select_tier
+from TinkerSpaceCommandServer.persistence.WriteAheadLog import WalShipperThread, WalSyncThread, WriteAheadLog
+from TinkerSpaceCommandServer.metrics import Metrics
+
+def escape_line_protocol_key(key):
+  """Escape a measurement name, tag key or tag value for the InfluxDB line
+     protocol.
+  """
+
+  return key.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def parse_query_date_time(date_time):
+  """Parse a date time given to a query, in Constants.QUERY_DATE_TIME_FORMAT,
+     into milliseconds since the epoch.
+  """
+
+  return int(datetime.datetime.timestamp(datetime.datetime.strptime(date_time, Constants.QUERY_DATE_TIME_FORMAT)) * 1000)
+
+def add_points(batch, points):
+  """Add a write queue item, a single point or a list of points, to a batch.
+  """
+
+  if type(points) is list:
+    batch.extend(points)
+  else:
+    batch.append(points)
+
+def count_points(points):
+  """Count the points of a write queue item.
+  """
+
+  if type(points) is list:
+    return len(points)
+
+  return 1
+
+class WriteQueue:
+  """The queue of line protocol points waiting to be written.
+
+     Items are single points or lists of points from measurement batches,
+     but the queue is limited by the number of points, not items, so its
+     memory use is bounded however the points come in.
+  """
+
+  def __init__(self, max_points):
+    self.queue = queue.Queue()
+    self.max_points = max_points
+
+    # The number of points in the queue.
+    self.points = 0
+    self.lock = Lock()
+
+  def put_nowait(self, points):
+    """Queue an item. Raises queue.Full if its points don't fit.
+    """
+
+    count = count_points(points)
+    with self.lock:
+      if self.points + count > self.max_points:
+        raise queue.Full()
+      self.points += count
+
+    self.queue.put_nowait(points)
+
+  def get(self, timeout=None):
+    return self.took(self.queue.get(timeout=timeout))
+
+  def get_nowait(self):
+    return self.took(self.queue.get_nowait())
+
+  def took(self, points):
+    with self.lock:
+      self.points -= count_points(points)
+
+    return points
+
+  def empty(self):
+    return self.queue.empty()
+
+  def qsize(self):
+    """Get the number of points in the queue.
+    """
+
+    return self.points
+
+# The position in an aggregated row of the value for each aggregate.
+AGGREGATE_ROW_INDEXES = {
+  Constants.QUERY_AGGREGATE_MEAN: AGGREGATED_ROW_MEAN,
+  Constants.QUERY_AGGREGATE_MIN: AGGREGATED_ROW_MIN,
+  Constants.QUERY_AGGREGATE_MAX: AGGREGATED_ROW_MAX,
+  Constants.QUERY_AGGREGATE_LAST: AGGREGATED_ROW_LAST
+}
 
 class EventPersistenceObserver(Observer):
   def __init__(self, persistence):
     self.persistence = persistence
 
   def on_next(self, measurement_event):
-    self.persistence.persist_measurement(measurement_event)
+    if isinstance(measurement_event, SensorChannelMeasurementBatchEvent):
+      self.persistence.enqueue_measurement_batch(measurement_event)
+    else:
+      self.persistence.enqueue_measurement(measurement_event)
 
   def on_completed(self):
     print("Event persistence subject Done!")
@@ -25,92 +132,586 @@ class EventPersistenceObserver(Observer):
   def on_error(self, error):
     print("Event persistence subject Error Occurred: {0}".format(error))
     
-class InfluxEventPersistence:
+class InfluxWriterThread(Thread):
+  """The writer thread takes line protocol points off of the write queue and
+     sends them to InfluxDB in batches.
+
+     Each item on the write queue is either a single point or a list of
+     points from a measurement batch.
+
+     A batch is sent when it is full or when its oldest point has waited
+     longer than the flush interval.
+  """
+
+  def __init__(self, persistence):
+    Thread.__init__(self)
+    self.persistence = persistence
+    self.running = True
+
+  def run(self):
+    write_queue = self.persistence.write_queue
+    batch_size = self.persistence.write_batch_size
+    flush_interval = self.persistence.write_flush_interval
+
+    batch = []
+    batch_start_time = None
+
+    # Everything queued before this time has been taken off the queue.
+    drained_time = None
+    while self.running or not write_queue.empty():
+      if batch:
+        timeout = max(0, flush_interval - (time.time() - batch_start_time))
+      else:
+        timeout = flush_interval
+
+      try:
+        get_time = time.time()
+        points = write_queue.get(timeout=timeout)
+        if not batch:
+          batch_start_time = time.time()
+        add_points(batch, points)
+
+        # Grab whatever else is already waiting, up to a full batch.
+        while len(batch) < batch_size:
+          get_time = time.time()
+          add_points(batch, write_queue.get_nowait())
+      except queue.Empty:
+        drained_time = get_time
+
+      if batch and (len(batch) >= batch_size or
+                    time.time() - batch_start_time >= flush_interval or
+                    not self.running):
+        # A measurement batch item can take the batch past its size.
+        for start in range(0, len(batch), batch_size):
+          self.persistence.write_batch(batch[start:start + batch_size])
+        batch = []
+        batch_start_time = None
+
+      if not batch and drained_time is not None:
+        self.persistence.written_time = drained_time
+
+  def stop(self):
+    self.running = False
+
+class EventPersistence(ABC):
+  """The base of the persistence backends.
+
+     A backend stores the measurements its persistence observer is given and
+     answers range queries on sensor channels. Backends provide start, stop,
+     run_async, the enqueue functions, query_channel_rows and
+     iter_channel_rows. The queries used by the web app, with downsampling
+     and the query cache, are built on the last two here.
+
+     Backends also store the rows of the rollups, with write_rollup_rows,
+     load_rollup_rows, query_rollup_rows and get_rollups_start_time. Their
+     start and stop start and stop the rollups.
+  """
+
+  # Whether each ingest shard persists the measurements of its own sensors.
+  # If not, the server process persists them as the shards send them in.
+  persist_in_shards = True
+
   def __init__(self, config):
     self.persistence_observer = EventPersistenceObserver(self)
 
-    influxdb_config = config["persistence"]["influxdb"]
+    # Query results by sensor channel and time bucket, or None if the backend
+    # is quick enough to query every time.
+    self.query_cache = None
 
-    server_host = influxdb_config["server"]["host"]
-    server_port = influxdb_config["server"]["port"]
-    server_username = influxdb_config["server"]["username"]
-    server_password = influxdb_config["server"]["password"]
+    self.metrics = Metrics.registry
 
-    sensor_tablename = influxdb_config["sensors"]["databaseName"]
-    
-    self.persistence_client = InfluxDBClient(server_host, server_port, server_username, server_password, sensor_tablename)
+    rollup_config = config["persistence"].get("rollups", {})
 
-  def attach_sensor_processor(self, sensor_processor):
-    sensor_processor.register_sensor_update_observer(self.persistence_observer)
+    # How often, in seconds, changed rollup buckets are persisted.
+    self.rollup_flush_interval = rollup_config.get("flushInterval", Constants.ROLLUP_FLUSH_INTERVAL)
+
+    # The open rollup buckets, or None if rollups are turned off.
+    self.rollups = None
+    self.rollup_observer = None
+    self.rollup_flush_thread = None
+
+    # Buckets from this time on, in milliseconds, have rollups. Queries
+    # before it use the raw measurements. None until the buckets still open
+    # from before a restart have been read back.
+    self.rollups_start_time = None
 
+    # When the rollups started taking measurements, in milliseconds.
+    self.rollups_open_time = None
+
+    if rollup_config.get("enabled", Constants.ROLLUPS_ENABLED):
+      self.rollups = RollupAccumulator(int(rollup_config.get("gracePeriod", Constants.ROLLUP_GRACE_PERIOD) * 1000), Constants.ROLLUP_MAX_UNWRITTEN_ROWS)
+      self.rollup_observer = RollupObserver(self.rollups)
+
+      self.rollup_flush_time = self.metrics.histogram("tinkerspace_rollup_flush_seconds", "Time to persist the changed rollup buckets.")
+      self.metrics.counter_function("tinkerspace_rollup_late_points_total", "Measurements too late for their rollup buckets.", lambda: self.rollups.late_points)
+      self.metrics.counter_function("tinkerspace_rollup_rows_dropped_total", "Rollup rows dropped because they could not be persisted.", lambda: self.rollups.rows_dropped)
+
+  @abstractmethod
   def start(self):
-    pass
+    raise NotImplementedError()
 
+  @abstractmethod
   def stop(self):
-    pass
+    raise NotImplementedError()
+
+  @abstractmethod
+  async def run_async(self):
+    raise NotImplementedError()
+
+  @abstractmethod
+  def enqueue_measurement(self, measurement_event):
+    """Store a measurement. This must never block.
+    """
+    raise NotImplementedError()
+
+  @abstractmethod
+  def enqueue_measurement_batch(self, batch_event):
+    """Store the measurements of a batch. This must never block.
+    """
+    raise NotImplementedError()
+
+  @abstractmethod
+  def query_channel_rows(self, sensor_id, channel, bucket_width, start_time, end_time):
+    """Get the rows of a sensor channel with start_time <= time < end_time,
+       in time order.
+
+       Raw rows, for a bucket_width of None, are (timestamp, sensed ID,
+       value). Otherwise the rows are aggregated into time buckets
+       bucket_width wide, aligned to the epoch, as lists of bucket
+       timestamp, sensed ID, count, mean, min, max and last value. Times are
+       in milliseconds since the epoch.
+    """
+    raise NotImplementedError()
+
+  @abstractmethod
+  def iter_channel_rows(self, sensor_id, channel, start_time, end_time):
+    """Get the raw rows of a sensor channel with start_time <= time <
+       end_time, as a series of lists of rows in time order.
+
+       Times are in milliseconds since the epoch.
+    """
+    raise NotImplementedError()
+
+  def query_channels_rows(self, fetches, bucket_width):
+    """Get the rows for a list of (sensor ID, channel ID, start, end)
+       fetches, as for query_channel_rows, with a list of rows for each.
+
+       Backends that can send several queries at once override this.
+    """
+    return [self.query_channel_rows(sensor_id, channel, bucket_width, start_time, end_time) for sensor_id, channel, start_time, end_time in fetches]
+
+  @abstractmethod
+  def write_rollup_rows(self, tier_index, rows):
+    """Write rollup rows of a tier, given as (kind, key, row) with rows of
+       bucket start, count, mean, minimum, maximum and last value. A row
+       replaces any written before for the same bucket.
+
+       Returns True if the rows were written.
+    """
+    raise NotImplementedError()
+
+  @abstractmethod
+  def load_rollup_rows(self, tier_index, start_time):
+    """Get the rows of every rollup of a tier with buckets starting at or
+       after start_time, as (kind, key, row) like write_rollup_rows.
+    """
+    raise NotImplementedError()
+
+  @abstractmethod
+  def query_rollup_rows(self, tier_index, kind, query_key, start_time, end_time):
+    """Get the persisted rows of a tier for a rollup query with start_time
+       <= bucket start < end_time, in time order.
+
+       The rows are lists of bucket time, sensed ID, count, mean, min, max
+       and last value.
+    """
+    raise NotImplementedError()
+
+  @abstractmethod
+  def get_rollups_start_time(self):
+    """Get the start of the first minute bucket ever persisted, or None if
+       there are none.
+    """
+    raise NotImplementedError()
+
+  @abstractmethod
+  def query_location_rows(self, sensed_id, channels, bucket_width, start_time, end_time):
+    """Get the rows of the measurements of a location from the given
+       (sensor ID, channel ID) channels, with start_time <= time < end_time,
+       aggregated together into time buckets bucket_width wide.
+
+       The rows are the same as the aggregated rows of query_channel_rows,
+       with the sensed ID of the location.
+    """
+    raise NotImplementedError()
+
+  def attach_sensor_processor(self, sensor_processor):
+    sensor_processor.register_sensor_update_observer(self.persistence_observer)
+
+    if self.rollup_observer is not None:
+      sensor_processor.register_sensor_update_observer(self.rollup_observer)
+
+  def start_rollups(self):
+    """Reopen the rollup buckets still open from before a restart, then
+       start persisting the rollups.
+
+       If the buckets can't be read back, for example because the backend
+       is down, each flush tries again, and nothing is persisted until they
+       have been. Otherwise their persisted rows would be replaced by rows
+       of just the measurements since the restart.
+    """
+
+    if self.rollups is None:
+      return
+
+    self.rollups_open_time = int(time.time() * 1000)
+    self.rollups.open(self.rollups_open_time)
+
+    self.seed_rollups()
+
+    self.rollup_flush_thread = RollupFlushThread(self, self.rollup_flush_interval)
+    self.rollup_flush_thread.start()
+
+  def seed_rollups(self):
+    """Read back the rollup buckets that were still open when the rollups
+       started, if that has not been done yet.
+
+       Returns True once they have been.
+    """
+
+    if self.rollups_start_time is not None:
+      return True
 
-  def persist_measurement(self, measurement_event):
     try:
-      json_body = [
-        {
-          "measurement": Constants.INFLUXDB_MEASUREMENT_NAME_SENSORS,
-          "tags": {
-            Constants.INFLUXDB_TAG_NAME_SENSED: measurement_event.sensed_active_model.sensed_entity_description.external_id,
-            Constants.INFLUXDB_TAG_NAME_SENSOR: measurement_event.sensor_active_model.sensor_entity_description.external_id,
-            Constants.INFLUXDB_TAG_NAME_CHANNEL: measurement_event.active_channel.channel_id
-          },
-          "time": datetime.datetime.fromtimestamp(measurement_event.time_received).isoformat() + 'Z',
-          "fields": self.create_measurement_fields(measurement_event)
-        }
-      ]
-
-      self.persistence_client.write_points(json_body)
+      rollups_start_time = self.get_rollups_start_time()
+
+      # Seeding a bucket again does nothing, so a failure part way through
+      # is just tried again.
+      for tier_index in range(len(ROLLUP_TIERS)):
+        for kind, key, row in self.load_rollup_rows(tier_index, self.rollups.open_bucket_start(tier_index, self.rollups_open_time)):
+          self.rollups.seed(tier_index, kind, key, row)
     except:
+      print("Could not read back the open rollup buckets, rollups are not persisted until they are")
       print(traceback.format_exc())
 
-  def create_measurement_fields(self, measurement_event):
-    """Add in the measurement value into the message to influx.
+      return False
+
+    # Nothing earlier was rolled up.
+    self.rollups_start_time = self.rollups_open_time if rollups_start_time is None else rollups_start_time
+
+    return True
+
+  def stop_rollups(self):
+    """Close and persist every rollup bucket.
     """
-    
-    fields = {
-      "continuous_value": float(measurement_event.value)
-    }
 
-    return fields
+    if self.rollup_flush_thread is None:
+      return
 
-  def get_channel_measurements(self, channel, startDateTime, endDateTime):
-    startTimestamp = datetime.datetime.timestamp(datetime.datetime.strptime(startDateTime, "%Y-%m-%dT%H:%M:%S%Z"))
-    endTimestamp = datetime.datetime.timestamp(datetime.datetime.strptime(endDateTime, "%Y-%m-%dT%H:%M:%S%Z"))
+    self.rollup_flush_thread.stop()
+    self.rollup_flush_thread.join()
+    self.rollup_flush_thread = None
+
+    self.flush_rollups(None)
+
+  def flush_rollups(self, current_time):
+    """Persist the rollup buckets that have changed, closing those past
+       their grace period. The time is in milliseconds, and None closes
+       every bucket.
+
+       Rows that can't be written are kept for the next flush. Nothing is
+       persisted, or closed, until the buckets open before the rollups
+       started have been read back.
+    """
+
+    if not self.seed_rollups():
+      return
+
+    start = time.perf_counter()
+    for tier_index, rows in enumerate(self.rollups.take_changes(current_time)):
+      if rows and not self.write_rollup_rows(tier_index, rows):
+        self.rollups.keep_unwritten(tier_index, rows)
+    self.rollup_flush_time.observe(time.perf_counter() - start)
+
+  def get_sensor_channel_measurements(self, sensor_id, channel, startDateTime, endDateTime, resolution=None, max_points=None, aggregate=None):
+    """Get the measurements of a sensor channel in a time range.
+
+       With no resolution, max_points or aggregate every stored point is
+       returned. Otherwise the points are aggregated into time buckets,
+       resolution seconds wide or wide enough that there are no more than
+       max_points of them, whichever is wider. aggregate is one of
+       Constants.QUERY_AGGREGATES and defaults to mean.
+
+       If only max_points is given, the buckets are downsampled with the
+       Largest Triangle Three Buckets algorithm instead, which keeps the
+       peaks and troughs of the series.
+    """
+    return self.get_sensor_channels_measurements(sensor_id, [channel], startDateTime, endDateTime, resolution, max_points, aggregate)[0]
+
+  def get_sensor_channels_measurements(self, sensor_id, channels, startDateTime, endDateTime, resolution=None, max_points=None, aggregate=None):
+    """Get the measurements of several channels of a sensor in a time range,
+       as for get_sensor_channel_measurements.
+
+       Whatever is not in the query cache is fetched for all of the channels
+       together. Gives a result for each channel, in order.
+    """
+    start_time = parse_query_date_time(startDateTime)
+    end_time = parse_query_date_time(endDateTime)
+
+    channel_keys = [(sensor_id, channel) for channel in channels]
+
+    if resolution is not None or max_points is not None or aggregate is not None:
+      return self.get_downsampled_measurements(
+        lambda bucket_width, start, end: self.get_channels_rows(channel_keys, bucket_width, start, end),
+        start_time, end_time, resolution, max_points, aggregate)
+
+    return [self.create_channel_measurement_result(rows, 2, "%Y-%m-%dT%H:%M:%S.{:03d}Z")
+            for rows in self.get_channels_rows(channel_keys, None, start_time, end_time)]
+
+  def iter_sensor_channel_measurements(self, sensor_id, channel, startDateTime, endDateTime):
+    """Get every stored point of a sensor channel in a time range, a chunk
+       at a time.
+
+       This is for exports too large to hold in memory. Each chunk is a list
+       of (timestamp in milliseconds, sensed ID, value) rows. The query cache
+       is not used, so an export doesn't push everything else out of it.
+    """
+    return self.iter_channel_rows(sensor_id, channel, parse_query_date_time(startDateTime), parse_query_date_time(endDateTime))
+
+  def get_location_measurements(self, sensed_id, measurement_type, channels, startDateTime, endDateTime, resolution=None, max_points=None, aggregate=None):
+    """Get the measurements of a measurement type at a location, over all of
+       the channels measuring it, aggregated into time buckets.
+
+       channels are the (sensor ID, channel ID) pairs of the channels. The
+       rest is as for get_sensor_channel_measurements, except that there are
+       always buckets, QUERY_LOCATION_MAX_POINTS of them if nothing else is
+       asked for.
+    """
+    if resolution is None and max_points is None:
+      max_points = Constants.QUERY_LOCATION_MAX_POINTS
+      if aggregate is None:
+        aggregate = Constants.QUERY_AGGREGATE_MEAN
+
+    ret = self.get_downsampled_measurements(
+      lambda bucket_width, start, end: [self.get_location_rows(sensed_id, measurement_type, channels, bucket_width, start, end)],
+      parse_query_date_time(startDateTime), parse_query_date_time(endDateTime), resolution, max_points, aggregate)[0]
+    ret['measurementType'] = measurement_type
+
+    return ret
+
+  def get_downsampled_measurements(self, get_rows, start_time, end_time, resolution, max_points, aggregate):
+    """Get measurements aggregated into time buckets, from get_rows given
+       the bucket width and the start and end times. get_rows gives a list
+       of rows for each series, and there is a result for each.
+
+       The times are in milliseconds since the epoch.
+    """
+    # Only downsample visually if all that was asked for was a limit on the
+    # number of points.
+    use_lttb = resolution is None and aggregate is None and max_points is not None
+
+    if aggregate is None:
+      aggregate = Constants.QUERY_AGGREGATE_MEAN
+    elif aggregate not in Constants.QUERY_AGGREGATES:
+      raise ValueError("Unknown aggregate {}".format(aggregate))
+
+    bucket_count = max_points
+    if use_lttb:
+      bucket_count = max_points * Constants.QUERY_LTTB_OVERSAMPLING
+
+    # Time buckets are given in whole milliseconds.
+    bucket_width = 0 if resolution is None else resolution * 1000
+    if bucket_count is not None:
+      bucket_width = max(bucket_width, (end_time - start_time) / bucket_count)
+    bucket_width = round_up_bucket_width(bucket_width)
+
+    value_index = AGGREGATE_ROW_INDEXES[aggregate]
+
+    results = []
+    for rows in get_rows(bucket_width, start_time, end_time):
+      if use_lttb:
+        indices = largest_triangle_three_buckets([row[AGGREGATED_ROW_TIME] for row in rows], [row[value_index] for row in rows], max_points)
+        rows = [rows[index] for index in indices]
+
+      ret = self.create_channel_measurement_result(rows, value_index, "%Y-%m-%dT%H:%M:%SZ")
+      ret['resolution'] = bucket_width / 1000.0
+      ret['aggregate'] = aggregate
+      results.append(ret)
+
+    return results
+
+  def get_channel_rows(self, sensor_id, channel, bucket_width, start_time, end_time):
+    """Get the rows for a sensor channel with start_time <= time < end_time,
+       using the query cache, if the backend has one, for whatever it has.
+
+       bucket_width is the aggregation bucket width or None for raw rows.
+       Times are in milliseconds since the epoch.
+    """
+    return self.get_channels_rows([(sensor_id, channel)], bucket_width, start_time, end_time)[0]
+
+  def get_channels_rows(self, channels, bucket_width, start_time, end_time):
+    """Get the rows for several (sensor ID, channel ID) channels, as for
+       get_channel_rows, with a list of rows for each channel.
 
-    startTimestamp = startTimestamp * 1000000000
-    endTimestamp = endTimestamp * 1000000000
-        
-    query = "select * from sensors where channel = '{0}' and time >= {1:.0f} and time < {2:.0f}".format(channel, startTimestamp, endTimestamp)
+       Everything missing from the query cache is fetched at once.
+    """
+    if self.query_cache is None:
+      return self.fetch_channels_rows([(sensor_id, channel, start_time, end_time) for sensor_id, channel in channels], bucket_width)
+
+    bucket_size = self.query_cache.get_bucket_size(bucket_width)
+
+    # Only buckets whose measurements were all written before they are
+    # fetched are complete.
+    written_time = self.get_written_time(int(time.time() * 1000))
+
+    bucket_starts = range(start_time - start_time % bucket_size, end_time, bucket_size)
+
+    # The fetches, as (sensor ID, channel ID, start, end), for each run of
+    # missing buckets of each channel, and the channel of each.
+    fetches = []
+    fetch_channel_indexes = []
+    channels_rows_by_bucket = []
+    for channel_index, (sensor_id, channel) in enumerate(channels):
+      rows_by_bucket = {}
+      missing = []
+      for bucket_start in bucket_starts:
+        rows = self.query_cache.get((sensor_id, channel, bucket_width, bucket_start))
+        if rows is None:
+          missing.append(bucket_start)
+        else:
+          rows_by_bucket[bucket_start] = rows
+      channels_rows_by_bucket.append(rows_by_bucket)
+
+      run_start = 0
+      while run_start < len(missing):
+        run_end = run_start + 1
+        while run_end < len(missing) and missing[run_end] == missing[run_end - 1] + bucket_size:
+          run_end += 1
+
+        fetches.append((sensor_id, channel, missing[run_start], missing[run_end - 1] + bucket_size))
+        fetch_channel_indexes.append(channel_index)
+
+        run_start = run_end
+
+    if fetches:
+      for fetch_channel_index, (sensor_id, channel, fetch_start, fetch_end), fetched in zip(fetch_channel_indexes, fetches, self.fetch_channels_rows(fetches, bucket_width)):
+        rows_by_bucket = channels_rows_by_bucket[fetch_channel_index]
+        for bucket_start, rows in self.query_cache.split_rows(fetched, fetch_start, fetch_end, bucket_size):
+          self.query_cache.put((sensor_id, channel, bucket_width, bucket_start), bucket_start + bucket_size, rows, written_time)
+          rows_by_bucket[bucket_start] = rows
+
+    # Only the first and last cache buckets can stick out of the range. An
+    # aggregated row is in the range if any of its bucket is.
+    first_time = start_time if bucket_width is None else start_time - bucket_width + 1
+    channels_rows = []
+    for rows_by_bucket in channels_rows_by_bucket:
+      rows = []
+      for bucket_start in bucket_starts:
+        rows.extend(row for row in rows_by_bucket[bucket_start] if first_time <= row[0] < end_time)
+      channels_rows.append(rows)
+
+    return channels_rows
+
+  def get_written_time(self, current_time):
+    """Get the time that every measurement received before has been
+       written by, for the query cache. Times are in milliseconds since the
+       epoch.
+
+       Backends that write in the background override this.
+    """
+
+    return current_time
+
+  def fetch_channels_rows(self, fetches, bucket_width):
+    """Get the rows for a list of (sensor ID, channel ID, start, end)
+       fetches, as for fetch_channel_rows, with a list of rows for each.
+
+       Fetches the rollups cannot answer go to the backend together.
+    """
+
+    tier_index = None if self.rollups is None or bucket_width is None else select_tier(bucket_width)
+    if tier_index is None:
+      return self.query_channels_rows(fetches, bucket_width)
+
+    return [self.fetch_channel_rows(sensor_id, channel, bucket_width, start_time, end_time) for sensor_id, channel, start_time, end_time in fetches]
+
+  def fetch_channel_rows(self, sensor_id, channel, bucket_width, start_time, end_time):
+    """Get the rows for a sensor channel from the rollups, if there is a
+       tier for the bucket width, or else from the backend.
+
+       The arguments and rows are the same as for query_channel_rows.
+    """
+
+    return self.fetch_rollup_rows(ROLLUP_KIND_CHANNEL, (sensor_id, channel), bucket_width, start_time, end_time,
+                                  lambda start, end: self.query_channel_rows(sensor_id, channel, bucket_width, start, end))
+
+  def get_location_rows(self, sensed_id, measurement_type, channels, bucket_width, start_time, end_time):
+    """Get the aggregated rows for a measurement type at a location, from the
+       location rollups if there is a tier for the bucket width, or else from
+       the backend.
 
+       Times are in milliseconds since the epoch.
+    """
+
+    return self.fetch_rollup_rows(ROLLUP_KIND_LOCATION, (sensed_id, measurement_type), bucket_width, start_time, end_time,
+                                  lambda start, end: self.query_location_rows(sensed_id, channels, bucket_width, start, end))
+
+  def fetch_rollup_rows(self, kind, query_key, bucket_width, start_time, end_time, query_raw_rows):
+    """Get aggregated rows for a rollup query from the coarsest rollup tier
+       that fits the bucket width.
+
+       Buckets from before the rollups started come from query_raw_rows,
+       given a start and end time, as do all of them if there are no rollups
+       or no tier fits.
+    """
+
+    tier_index = None if self.rollups is None or bucket_width is None else select_tier(bucket_width)
+    if tier_index is None or self.rollups_start_time is None:
+      return query_raw_rows(start_time, end_time)
+
+    # Buckets from the first one starting after the first rollup bucket are
+    # complete in the rollups. The first rollup bucket may only have part of
+    # its minute.
+    rollups_start = self.rollups_start_time - self.rollups_start_time % bucket_width + bucket_width
+
+    rows = []
+    if start_time < rollups_start:
+      rows = query_raw_rows(start_time, min(end_time, rollups_start))
+      start_time = rollups_start
+      if start_time >= end_time:
+        return rows
+
+    # Buckets that are open, or failed to be written, are newer in memory.
+    tier_rows = self.rollups.get_rows(tier_index, kind, query_key, start_time, end_time)
+    persisted_rows = [row for row in self.query_rollup_rows(tier_index, kind, query_key, start_time, end_time)
+                      if (row[0], row[1]) not in tier_rows]
+    tier_rows = persisted_rows + list(tier_rows.values())
+    tier_rows.sort(key=lambda row: row[0])
+
+    return rows + combine_rollup_rows(tier_rows, bucket_width)
+
+  def create_channel_measurement_result(self, rows, value_index, date_time_format):
+    """Create the query result for sensor channel rows.
+    """
     date_time_array = []
     date_array = []
     time_array = []
     value_array = []
-    sensor_array = []
     sensed_array = []
-    results = self.persistence_client.query(query)
-    points = results.get_points('sensors', None)
-    for point in points:
-      date_time = point['time']
-      date_time_split = date_time.split('T')
-      date_array.append(date_time_split[0])
-      time_array.append(date_time_split[1].split('.')[0])
-      date_time_array.append(date_time)
-      sensor_array.append(point['sensor'])
-      sensed_array.append(point['sensed'])
-      value_array.append(point['continuous_value'])
+    for row in rows:
+      timestamp = row[0]
+      date_time = datetime.datetime.utcfromtimestamp(timestamp / 1000.0)
+      date_time_array.append(date_time.strftime(date_time_format.format(timestamp % 1000)))
+      date_array.append(date_time.strftime("%Y-%m-%d"))
+      time_array.append(date_time.strftime("%H:%M:%S"))
+      sensed_array.append(row[1])
+      value_array.append(row[value_index])
 
     ret = {
       'data': {
         'dateTime': date_time_array,
-        'time': time_array,
         'date': date_array,
-        'sensor': sensor_array,
+        'time': time_array,
         'sensed': sensed_array,
         'value': value_array
       }
@@ -118,65 +719,676 @@ class InfluxEventPersistence:
 
     return ret
 
-  def get_sensor_channel_measurements(self, sensor_id, channel, startDateTime, endDateTime):
-    startTimestamp = datetime.datetime.timestamp(datetime.datetime.strptime(startDateTime, "%Y-%m-%dT%H:%M:%S%Z"))
-    endTimestamp = datetime.datetime.timestamp(datetime.datetime.strptime(endDateTime, "%Y-%m-%dT%H:%M:%S%Z"))
+class InfluxEventPersistence(EventPersistence):
+  def __init__(self, config):
+    EventPersistence.__init__(self, config)
+
+    influxdb_config = config["persistence"]["influxdb"]
 
-    startTimestamp = startTimestamp * 1000000000
-    endTimestamp = endTimestamp * 1000000000
-        
-    query = "select * from sensors where sensor = '{0}' and channel = '{1}' and time >= {2:.0f} and time < {3:.0f}".format(sensor_id, channel, startTimestamp, endTimestamp)
+    server_host = influxdb_config["server"]["host"]
+    server_port = influxdb_config["server"]["port"]
+    server_username = influxdb_config["server"]["username"]
+    server_password = influxdb_config["server"]["password"]
+
+    sensor_tablename = influxdb_config["sensors"]["databaseName"]
+    
+    self.persistence_client = InfluxDBClient(server_host, server_port, server_username, server_password, sensor_tablename)
+
+    writer_config = influxdb_config.get("writer", {})
+
+    # The maximum number of points sent to InfluxDB in one request.
+    self.write_batch_size = writer_config.get("batchSize", Constants.INFLUXDB_WRITE_BATCH_SIZE)
+
+    # The longest time, in seconds, a point waits before its batch is sent.
+    self.write_flush_interval = writer_config.get("flushInterval", Constants.INFLUXDB_WRITE_FLUSH_INTERVAL)
+
+    # How many times a failed batch is retried, and the delay in seconds
+    # between tries.
+    self.write_max_retries = writer_config.get("maxRetries", Constants.INFLUXDB_WRITE_MAX_RETRIES)
+    self.write_retry_delay = writer_config.get("retryDelay", Constants.INFLUXDB_WRITE_RETRY_DELAY)
+
+    # Points waiting to be written, already in line protocol.
+    self.write_queue = WriteQueue(writer_config.get("queueSize", Constants.INFLUXDB_WRITE_QUEUE_SIZE))
+
+    self.points_written = 0
+    self.points_dropped = 0
+    self.points_rejected = 0
+    self.write_failures = 0
+
+    self.writer_thread = None
+
+    # Set while the writer runs on an event loop rather than a thread. The
+    # event can only be set from the loop, so other threads go through the
+    # writer loop.
+    self.batch_ready = None
+    self.writer_loop = None
+
+    # If a write-ahead log directory is configured, measurements go through
+    # the log on disk rather than the write queue, so they survive InfluxDB
+    # being down and server restarts.
+    wal_config = influxdb_config.get("wal", {})
+    self.wal_directory = wal_config.get("directory")
+    self.wal_segment_size = wal_config.get("segmentSize", Constants.WAL_SEGMENT_SIZE)
+    self.wal_max_size = wal_config.get("maxSize", Constants.WAL_MAX_SIZE)
+    self.wal_sync_interval = wal_config.get("syncInterval", Constants.WAL_SYNC_INTERVAL)
+    self.wal_replay_batch_size = wal_config.get("replayBatchSize", Constants.WAL_REPLAY_BATCH_SIZE)
+    self.wal_max_retry_delay = wal_config.get("maxRetryDelay", Constants.WAL_MAX_RETRY_DELAY)
+
+    # Ingest shards each have their own log in a subdirectory. The server
+    # process ships the logs of shards that no longer run.
+    self.wal_shard = None
+    self.wal_shard_count = 0
+
+    self.wal = None
+    self.wal_threads = []
+
+    # Every point queued before this time, in seconds since the epoch, has
+    # been written to InfluxDB or dropped. None until the writer has emptied
+    # the queue or caught up with the write-ahead log.
+    self.written_time = None
+
+    # Set when ingest shards write the measurements, so this process can't
+    # tell how far they have got.
+    self.written_by_shards = False
+
+    # How long in milliseconds after a measurement is received before it is
+    # certain to be written, for when the writer's progress isn't known.
+    self.write_settle_time = int((self.write_flush_interval + self.write_max_retries * self.write_retry_delay + Constants.QUERY_CACHE_INGEST_LAG) * 1000)
+
+    # Query results by sensor channel and time bucket, so repeated queries
+    # of closed buckets don't go to InfluxDB.
+    query_cache_config = influxdb_config.get("queryCache", {})
+    self.query_cache = QueryCache(
+      query_cache_config.get("size", Constants.QUERY_CACHE_SIZE),
+      int(query_cache_config.get("bucketSize", Constants.QUERY_CACHE_BUCKET_SIZE) * 1000),
+      Constants.QUERY_CACHE_AGGREGATED_BUCKET_ROWS)
+
+    self.metrics.counter_function("tinkerspace_query_cache_hits_total", "Query cache buckets found in the cache.", lambda: self.query_cache.hits)
+    self.metrics.counter_function("tinkerspace_query_cache_misses_total", "Query cache buckets fetched from InfluxDB.", lambda: self.query_cache.misses)
+    self.write_time = self.metrics.histogram("tinkerspace_influxdb_write_seconds", "Time to write a batch of points to InfluxDB, including retries.")
+    self.metrics.gauge("tinkerspace_influxdb_write_queue_depth", "Points waiting to be written to InfluxDB.", self.write_queue.qsize)
+    self.metrics.counter_function("tinkerspace_influxdb_points_written_total", "Points written to InfluxDB.", lambda: self.points_written)
+    self.metrics.counter_function("tinkerspace_influxdb_points_dropped_total", "Points dropped because of a full queue or failed writes.", lambda: self.points_dropped)
+    self.metrics.counter_function("tinkerspace_influxdb_points_rejected_total", "Points not written because their value is NaN or infinite, or InfluxDB refused them.", lambda: self.points_rejected)
+    self.metrics.counter_function("tinkerspace_influxdb_write_failures_total", "Failed InfluxDB write requests.", lambda: self.write_failures)
+    if self.wal_directory is not None:
+      self.metrics.gauge("tinkerspace_wal_bytes", "Bytes in the write-ahead log segments.", lambda: self.wal.size() if self.wal is not None else 0)
+      self.metrics.gauge("tinkerspace_wal_pending_points", "Measurements waiting for the next write-ahead log sync.", lambda: self.wal.pending_count() if self.wal is not None else 0)
+      self.metrics.counter_function("tinkerspace_wal_points_total", "Measurements written to the write-ahead log.", lambda: self.wal.points_appended if self.wal is not None else 0)
+      self.metrics.counter_function("tinkerspace_wal_sync_failures_total", "Write-ahead log syncs that failed, dropping their measurements.", lambda: self.wal.sync_failures if self.wal is not None else 0)
+      self.metrics.counter_function("tinkerspace_wal_evicted_bytes_total", "Bytes of write-ahead log segments dropped to stay under the size limit.", lambda: self.wal.bytes_evicted if self.wal is not None else 0)
+
+  def start(self):
+    self.start_rollups()
+
+    if self.wal_directory is not None:
+      self.start_wal()
+      return
+
+    self.writer_thread = InfluxWriterThread(self)
+    self.writer_thread.start()
+
+  def stop(self):
+    self.stop_rollups()
+
+    if self.wal is not None:
+      self.stop_wal()
+      return
+
+    # The writer thread flushes anything left in the queue before it exits.
+    if self.writer_thread is not None:
+      self.writer_thread.stop()
+      self.writer_thread.join()
+      self.writer_thread = None
+
+  def start_wal(self):
+    """Open the write-ahead log and start syncing it and shipping it to
+       InfluxDB.
+    """
+
+    directory = self.wal_directory
+    if self.wal_shard is not None:
+      directory = os.path.join(directory, "shard-{}".format(self.wal_shard))
+
+    self.wal = WriteAheadLog(directory, self.wal_segment_size, self.wal_max_size)
+    self.wal.open()
+
+    self.wal_threads = [WalSyncThread(self.wal, self.wal_sync_interval), self.create_wal_shipper(self.wal)]
+
+    # Ship what is left in the logs of shards that are no longer run.
+    if self.wal_shard is None and os.path.isdir(self.wal_directory):
+      for name in sorted(os.listdir(self.wal_directory)):
+        if name.startswith("shard-") and int(name[len("shard-"):]) >= self.wal_shard_count:
+          shard_wal = WriteAheadLog(os.path.join(self.wal_directory, name), self.wal_segment_size, self.wal_max_size)
+          shard_wal.open(writable=False)
+          self.wal_threads.append(self.create_wal_shipper(shard_wal, True))
+
+    for thread in self.wal_threads:
+      thread.start()
+
+  def create_wal_shipper(self, wal, drain_and_remove=False):
+    return WalShipperThread(wal, self, self.wal_replay_batch_size, self.write_retry_delay, self.wal_max_retry_delay, drain_and_remove)
+
+  def stop_wal(self):
+    """Sync the write-ahead log a last time and ship what InfluxDB will
+       take. Anything left is shipped on the next start.
+    """
+
+    sync_thread = self.wal_threads[0]
+    sync_thread.stop()
+    sync_thread.join()
+    self.wal.close()
+
+    for thread in self.wal_threads[1:]:
+      thread.stop()
+    for thread in self.wal_threads[1:]:
+      thread.join()
+
+    self.wal = None
+    self.wal_threads = []
+
+  async def run_async(self):
+    """Write queued points to InfluxDB from the event loop until cancelled.
+
+       The InfluxDB client is blocking, so each batch is written from the
+       loop's default executor. Remaining points are flushed on cancel.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    # Persisting the rollups is blocking too, and keeps its own thread.
+    await loop.run_in_executor(None, self.start_rollups)
+    try:
+      await self.run_writer_async(loop)
+    finally:
+      await loop.run_in_executor(None, self.stop_rollups)
+
+  async def run_writer_async(self, loop):
+    """Write measurements to InfluxDB from the event loop until cancelled.
+    """
+
+    if self.wal_directory is not None:
+      # Syncing and shipping the log are blocking, so they keep their own
+      # threads.
+      await loop.run_in_executor(None, self.start_wal)
+      try:
+        await loop.create_future()
+      finally:
+        await loop.run_in_executor(None, self.stop_wal)
+
+    self.writer_loop = loop
+    self.batch_ready = asyncio.Event()
+
+    try:
+      while True:
+        try:
+          await asyncio.wait_for(self.batch_ready.wait(), self.write_flush_interval)
+        except asyncio.TimeoutError:
+          pass
+        self.batch_ready.clear()
+
+        drained_time = time.time()
+        for batch in self.drain_write_queue():
+          await loop.run_in_executor(None, self.write_batch, batch)
+        self.written_time = drained_time
+    finally:
+      self.batch_ready = None
+
+      for batch in self.drain_write_queue():
+        await loop.run_in_executor(None, self.write_batch, batch)
+
+  def drain_write_queue(self):
+    """Take everything currently in the write queue, split into batches.
+    """
+
+    batches = []
+    batch = []
+    try:
+      while True:
+        add_points(batch, self.write_queue.get_nowait())
+        while len(batch) >= self.write_batch_size:
+          batches.append(batch[:self.write_batch_size])
+          batch = batch[self.write_batch_size:]
+    except queue.Empty:
+      pass
+
+    if batch:
+      batches.append(batch)
+
+    return batches
+
+  def enqueue_measurement(self, measurement_event):
+    """Queue a measurement to be written by the writer thread.
+
+       This never blocks. If the queue is full the point is dropped. Values
+       that are NaN or infinite are left out, as InfluxDB can't store them.
+    """
+
+    if not is_finite_value(measurement_event.value):
+      self.points_rejected += 1
+      return
+
+    wal = self.wal
+    if wal is not None:
+      try:
+        wal.append(self.create_series_key(measurement_event), int(measurement_event.time_received * 1000000), float(measurement_event.value))
+      except:
+        print(traceback.format_exc())
+
+      return
+
+    try:
+      self.write_queue.put_nowait(self.create_measurement_line(measurement_event))
+
+      self.wake_async_writer()
+    except queue.Full:
+      self.points_dropped += 1
+      print("InfluxDB write queue full, dropping measurement")
+    except:
+      print(traceback.format_exc())
+
+  def write_batch(self, batch):
+    """Write a batch of line protocol points to InfluxDB in a single request.
+
+       A failed write is retried up to the configured number of times before
+       the batch is dropped. A batch InfluxDB refuses is dropped straight
+       away, as it would be refused again.
+    """
+
+    start = time.perf_counter()
+    for attempt in range(self.write_max_retries + 1):
+      try:
+        written = self.write_points(batch)
+      except PointsRejectedError:
+        print("Dropping batch of {} points InfluxDB refused".format(len(batch)))
+        self.points_rejected += len(batch)
+        self.write_time.observe(time.perf_counter() - start)
+
+        return False
+
+      if written:
+        self.write_time.observe(time.perf_counter() - start)
+
+        return True
+
+      # Don't hold up a shutdown waiting for InfluxDB to come back.
+      if attempt < self.write_max_retries and self.is_writer_running():
+        time.sleep(self.write_retry_delay)
+
+    print("Dropping batch of {} points after {} retries".format(len(batch), self.write_max_retries))
+    self.points_dropped += len(batch)
+    self.write_time.observe(time.perf_counter() - start)
+
+    return False
+
+  def get_written_time(self, current_time):
+    written_time = self.written_time
+    if written_time is None or self.written_by_shards:
+      return current_time - self.write_settle_time
+
+    # A measurement can wait on the ingest queue before it is queued for
+    # writing.
+    return int((written_time - Constants.QUERY_CACHE_INGEST_LAG) * 1000)
+
+  def wake_async_writer(self):
+    """When running on an event loop, wake the writer once there are
+       points for a full batch.
+
+       Measurements are queued from the ingest threads, so the event is set
+       on the writer loop.
+    """
+
+    batch_ready = self.batch_ready
+    if batch_ready is None or batch_ready.is_set() or self.write_queue.qsize() < self.write_batch_size:
+      return
+
+    try:
+      self.writer_loop.call_soon_threadsafe(batch_ready.set)
+    except RuntimeError:
+      # The loop has closed, and the remaining points were flushed.
+      pass
+
+  def is_writer_running(self):
+    """Whether the writer, on its thread or on the event loop, is running
+       and has not been asked to stop.
+    """
+
+    if self.writer_thread is not None:
+      return self.writer_thread.running
+
+    return self.batch_ready is not None
+
+  def write_points(self, batch):
+    """Try once to write a batch of line protocol points to InfluxDB.
+
+       Returns True if the batch was written, False if it could be written
+       later. Raises PointsRejectedError if InfluxDB refused the points
+       themselves.
+    """
+
+    try:
+      self.persistence_client.write_points(batch, time_precision='u', protocol='line')
+      self.points_written += len(batch)
+
+      return True
+    except InfluxDBClientError as error:
+      self.write_failures += 1
+      print(traceback.format_exc())
+
+      if 400 <= error.code < 500 and error.code not in Constants.INFLUXDB_WRITE_RETRIED_CLIENT_ERRORS:
+        raise PointsRejectedError(error.content) from error
+
+      return False
+    except:
+      self.write_failures += 1
+      print(traceback.format_exc())
+
+      return False
+
+  def enqueue_measurement_batch(self, batch_event):
+    """Queue all the measurements of a batch to be written by the writer
+       thread, as a single write queue item.
+
+       This never blocks. If the queue hasn't room for all of its points the
+       batch is dropped. Values that are NaN or infinite are left out.
+    """
+
+    times_received, values = finite_points(batch_event.times_received, batch_event.values)
+    if len(values) < len(batch_event.values):
+      self.points_rejected += len(batch_event.values) - len(values)
+      if not values:
+        return
+
+    wal = self.wal
+    if wal is not None:
+      try:
+        wal.append_many(self.create_series_key(batch_event),
+                        [int(time_received * 1000000) for time_received in times_received],
+                        [float(value) for value in values])
+      except:
+        print(traceback.format_exc())
+
+      return
+
+    try:
+      self.write_queue.put_nowait(self.create_measurement_batch_lines(batch_event, times_received, values))
+
+      self.wake_async_writer()
+    except queue.Full:
+      self.points_dropped += len(values)
+      print("InfluxDB write queue full, dropping measurement batch")
+    except:
+      print(traceback.format_exc())
+
+  def create_series_key(self, measurement_event):
+    """Create the InfluxDB line protocol measurement name and tags for a
+       measurement.
+    """
+
+    return "{0},{1}={2},{3}={4},{5}={6}".format(
+      Constants.INFLUXDB_MEASUREMENT_NAME_SENSORS,
+      Constants.INFLUXDB_TAG_NAME_CHANNEL, escape_line_protocol_key(measurement_event.active_channel.channel_id),
+      Constants.INFLUXDB_TAG_NAME_SENSED, escape_line_protocol_key(measurement_event.sensed_active_model.sensed_entity_description.external_id),
+      Constants.INFLUXDB_TAG_NAME_SENSOR, escape_line_protocol_key(measurement_event.sensor_active_model.sensor_entity_description.external_id))
+
+  def create_measurement_line(self, measurement_event):
+    """Create the InfluxDB line protocol point for a measurement.
+    """
+
+    return self.create_line(self.create_series_key(measurement_event), int(measurement_event.time_received * 1000000), measurement_event.value)
+
+  def create_line(self, series_key, timestamp, value):
+    """Create an InfluxDB line protocol point, timestamp in microseconds.
+    """
+
+    return "{0} {1} {2}".format(series_key, self.create_measurement_fields(value), timestamp)
+
+  def create_measurement_batch_lines(self, batch_event, times_received, values):
+    """Create the InfluxDB line protocol points for the measurements of a
+       batch with the given times and values.
+    """
+
+    series_key = self.create_series_key(batch_event)
+
+    return ["{0} {1} {2}".format(series_key, self.create_measurement_fields(value), int(time_received * 1000000))
+            for time_received, value in zip(times_received, values)]
+
+  def create_measurement_fields(self, value):
+    """Add in the measurement value into the line protocol fields.
+    """
+    
+    return "continuous_value={0!r}".format(float(value))
+
+  def create_rollup_line(self, tier_index, kind, key, row):
+    """Create the InfluxDB line protocol point for a rollup row.
+
+       Each tier and kind of rollup is its own measurement, timestamped with
+       the bucket start.
+    """
+
+    tier_name = ROLLUP_TIERS[tier_index].name
+    if kind == ROLLUP_KIND_CHANNEL:
+      sensor_id, channel_id, sensed_id = key
+      series_key = "{0},{1}={2},{3}={4},{5}={6}".format(
+        Constants.INFLUXDB_MEASUREMENT_NAME_SENSOR_ROLLUPS.format(tier_name),
+        Constants.INFLUXDB_TAG_NAME_CHANNEL, escape_line_protocol_key(channel_id),
+        Constants.INFLUXDB_TAG_NAME_SENSED, escape_line_protocol_key(sensed_id),
+        Constants.INFLUXDB_TAG_NAME_SENSOR, escape_line_protocol_key(sensor_id))
+    else:
+      sensed_id, measurement_type = key
+      series_key = "{0},{1}={2},{3}={4}".format(
+        Constants.INFLUXDB_MEASUREMENT_NAME_LOCATION_ROLLUPS.format(tier_name),
+        Constants.INFLUXDB_TAG_NAME_MEASUREMENT_TYPE, escape_line_protocol_key(measurement_type),
+        Constants.INFLUXDB_TAG_NAME_SENSED, escape_line_protocol_key(sensed_id))
+
+    bucket_start, count, mean, minimum, maximum, last = row
+
+    return "{0} count={1}i,mean={2!r},min={3!r},max={4!r},last={5!r} {6}".format(
+      series_key, count, float(mean), float(minimum), float(maximum), float(last), bucket_start * 1000)
+
+  def write_rollup_rows(self, tier_index, rows):
+    """Write rollup rows to InfluxDB, a batch at a time.
+
+       A point with the same series and time as an earlier one replaces it.
+       Nothing is retried here, the rows are written again at the next
+       rollup flush.
+    """
+
+    lines = [self.create_rollup_line(tier_index, kind, key, row) for kind, key, row in rows]
+    for start in range(0, len(lines), self.write_batch_size):
+      batch = lines[start:start + self.write_batch_size]
+      try:
+        if not self.write_points(batch):
+          return False
+      except PointsRejectedError:
+        # Writing them again would fail again.
+        print("Dropping {} rollup rows InfluxDB refused".format(len(batch)))
+        self.rollups.rows_dropped += len(batch)
+
+    return True
+
+  def get_rollup_measurement(self, tier_index, kind):
+    """Get the InfluxDB measurement of the rollups of a tier and kind.
+    """
+
+    if kind == ROLLUP_KIND_CHANNEL:
+      return Constants.INFLUXDB_MEASUREMENT_NAME_SENSOR_ROLLUPS.format(ROLLUP_TIERS[tier_index].name)
+
+    return Constants.INFLUXDB_MEASUREMENT_NAME_LOCATION_ROLLUPS.format(ROLLUP_TIERS[tier_index].name)
+
+  def load_rollup_rows(self, tier_index, start_time):
+    # Both kinds are read with one request.
+    measurements = [(kind, self.get_rollup_measurement(tier_index, kind)) for kind in [ROLLUP_KIND_CHANNEL, ROLLUP_KIND_LOCATION]]
+    results = run_queries(self.persistence_client, [InfluxQuery(measurement).where_time(start_time) for kind, measurement in measurements])
+
+    rows = []
+    for (kind, measurement), result_set in zip(measurements, results):
+      for point in result_set.get_points(measurement, None):
+        if kind == ROLLUP_KIND_CHANNEL:
+          key = (point[Constants.INFLUXDB_TAG_NAME_SENSOR], point[Constants.INFLUXDB_TAG_NAME_CHANNEL], point[Constants.INFLUXDB_TAG_NAME_SENSED])
+        else:
+          key = (point[Constants.INFLUXDB_TAG_NAME_SENSED], point[Constants.INFLUXDB_TAG_NAME_MEASUREMENT_TYPE])
+        rows.append((kind, key, (point['time'], point['count'], point['mean'], point['min'], point['max'], point['last'])))
+
+    return rows
+
+  def query_rollup_rows(self, tier_index, kind, query_key, start_time, end_time):
+    measurement = self.get_rollup_measurement(tier_index, kind)
+
+    query = InfluxQuery(measurement, ['"count"', '"mean"', '"min"', '"max"', '"last"', quote_identifier(Constants.INFLUXDB_TAG_NAME_SENSED)])
+    if kind == ROLLUP_KIND_CHANNEL:
+      query.where_tag(Constants.INFLUXDB_TAG_NAME_SENSOR, query_key[0]).where_tag(Constants.INFLUXDB_TAG_NAME_CHANNEL, query_key[1])
+    else:
+      query.where_tag(Constants.INFLUXDB_TAG_NAME_SENSED, query_key[0]).where_tag(Constants.INFLUXDB_TAG_NAME_MEASUREMENT_TYPE, query_key[1])
+    query.where_time(start_time, end_time)
+
+    results = run_query(self.persistence_client, query)
+
+    return [[point['time'], point[Constants.INFLUXDB_TAG_NAME_SENSED], point['count'], point['mean'], point['min'], point['max'], point['last']]
+            for point in results.get_points(measurement, None)]
+
+  def get_rollups_start_time(self):
+    # The location rollups start with the channel ones and are fewer series.
+    measurement = self.get_rollup_measurement(0, ROLLUP_KIND_LOCATION)
+
+    results = run_query(self.persistence_client, InfluxQuery(measurement, ['first("count")']))
+    points = list(results.get_points(measurement, None))
+
+    return points[0]['time'] if points else None
+
+  def get_channel_measurements(self, channel, startDateTime, endDateTime):
+    return self.get_tagged_measurements(Constants.INFLUXDB_TAG_NAME_CHANNEL, channel, startDateTime, endDateTime)
+
+  def get_tagged_measurements(self, tag_name, tag_value, startDateTime, endDateTime):
+    """Get every stored point with a given value of a tag in a time range,
+       from all the series that have it.
+    """
+    query = InfluxQuery(Constants.INFLUXDB_MEASUREMENT_NAME_SENSORS, ['"continuous_value"', '"sensor"', '"sensed"', '"channel"'])
+    query.where_tag(tag_name, tag_value).where_time(parse_query_date_time(startDateTime), parse_query_date_time(endDateTime))
 
     date_time_array = []
     date_array = []
     time_array = []
     value_array = []
+    sensor_array = []
     sensed_array = []
-    results = self.persistence_client.query(query)
-    points = results.get_points('sensors', None)
-    for point in points:
-      date_time = point['time']
-      date_time_split = date_time.split('T')
-      date_time_array.append(date_time)
-      date_array.append(date_time_split[0])
-      time_array.append(date_time_split[1].split('.')[0])
-      sensed_array.append(point['sensed'])
+    channel_array = []
+    results = run_query(self.persistence_client, query)
+    for point in results.get_points(Constants.INFLUXDB_MEASUREMENT_NAME_SENSORS, None):
+      timestamp = point['time']
+      date_time = datetime.datetime.utcfromtimestamp(timestamp / 1000.0)
+      date_time_array.append(date_time.strftime("%Y-%m-%dT%H:%M:%S.{:03d}Z".format(timestamp % 1000)))
+      date_array.append(date_time.strftime("%Y-%m-%d"))
+      time_array.append(date_time.strftime("%H:%M:%S"))
+      sensor_array.append(point[Constants.INFLUXDB_TAG_NAME_SENSOR])
+      sensed_array.append(point[Constants.INFLUXDB_TAG_NAME_SENSED])
+      channel_array.append(point[Constants.INFLUXDB_TAG_NAME_CHANNEL])
       value_array.append(point['continuous_value'])
 
     ret = {
       'data': {
         'dateTime': date_time_array,
-        'date': date_array,
         'time': time_array,
+        'date': date_array,
+        'sensor': sensor_array,
         'sensed': sensed_array,
+        'channel': channel_array,
         'value': value_array
       }
     }
 
     return ret
 
-  def get_sensor_measurements(self, sensor, startDateTime, endDateTime):
-    startTimestamp = datetime.datetime.timestamp(datetime.datetime.strptime(startDateTime, "%Y-%m-%dT%H:%M:%S%Z"))
-    endTimestamp = datetime.datetime.timestamp(datetime.datetime.strptime(endDateTime, "%Y-%m-%dT%H:%M:%S%Z"))
+  def create_channel_query(self, sensor_id, channel, bucket_width, start_time, end_time):
+    """Create the query for the rows of a sensor channel, raw for a
+       bucket_width of None, otherwise aggregated for each sensed item.
+    """
 
-    startTimestamp = startTimestamp * 1000000000
-    endTimestamp = endTimestamp * 1000000000
-        
-    query = "select * from sensors where sensor = '{0}' and time >= {1:.0f} and time < {2:.0f}".format(sensor, startTimestamp, endTimestamp)
+    query = InfluxQuery(Constants.INFLUXDB_MEASUREMENT_NAME_SENSORS)
+    if bucket_width is None:
+      query.columns = ['"continuous_value"', quote_identifier(Constants.INFLUXDB_TAG_NAME_SENSED)]
+    else:
+      query.select_aggregates("continuous_value")
 
-    results = self.persistence_client.query(query)
-    print(results)
+    query.where_tag(Constants.INFLUXDB_TAG_NAME_SENSOR, sensor_id).where_tag(Constants.INFLUXDB_TAG_NAME_CHANNEL, channel).where_time(start_time, end_time)
 
-  def get_sensed_measurements(self, sensed, startDateTime, endDateTime):
-    startTimestamp = datetime.datetime.timestamp(datetime.datetime.strptime(startDateTime, "%Y-%m-%dT%H:%M:%S%Z"))
-    endTimestamp = datetime.datetime.timestamp(datetime.datetime.strptime(endDateTime, "%Y-%m-%dT%H:%M:%S%Z"))
+    if bucket_width is not None:
+      query.group_by_time(bucket_width, Constants.INFLUXDB_TAG_NAME_SENSED)
 
-    startTimestamp = startTimestamp * 1000000000
-    endTimestamp = endTimestamp * 1000000000
-        
-    query = "select * from sensors where sensed = '{0}' and time >= {1:.0f} and time < {2:.0f}".format(sensed, startTimestamp, endTimestamp)
+    return query
 
-    results = self.persistence_client.query(query)
-    print(results)
-    
-    
+  def iter_channel_rows(self, sensor_id, channel, start_time, end_time):
+    """Get the raw rows of a sensor channel in a time range from InfluxDB,
+       a chunk at a time.
+
+       InfluxDB sends the points in chunks and each is given as it arrives.
+       Times are in milliseconds since the epoch.
+    """
+    results = run_query(self.persistence_client, self.create_channel_query(sensor_id, channel, None, start_time, end_time),
+                        chunked=True, chunk_size=Constants.QUERY_STREAM_CHUNK_SIZE)
+
+    # Older InfluxDB clients merge the chunks into a single result set.
+    if hasattr(results, 'get_points'):
+      results = [results]
+
+    for result_set in results:
+      rows = self.get_channel_result_rows(result_set, None)
+      if rows:
+        yield rows
+
+  def query_channel_rows(self, sensor_id, channel, bucket_width, start_time, end_time):
+    """Query InfluxDB for the rows of a sensor channel, in time order.
+
+       Times are in milliseconds since the epoch.
+    """
+    return self.get_channel_result_rows(run_query(self.persistence_client, self.create_channel_query(sensor_id, channel, bucket_width, start_time, end_time)), bucket_width)
+
+  def query_channels_rows(self, fetches, bucket_width):
+    """Query InfluxDB for the rows of several sensor channels with a single
+       request of a statement for each.
+    """
+    queries = [self.create_channel_query(sensor_id, channel, bucket_width, start_time, end_time) for sensor_id, channel, start_time, end_time in fetches]
+
+    return [self.get_channel_result_rows(result_set, bucket_width) for result_set in run_queries(self.persistence_client, queries)]
+
+  def get_channel_result_rows(self, result_set, bucket_width):
+    """Get the rows from the result of a channel query.
+    """
+    if bucket_width is None:
+      return [(point['time'], point[Constants.INFLUXDB_TAG_NAME_SENSED], point['continuous_value'])
+              for point in result_set.get_points(Constants.INFLUXDB_MEASUREMENT_NAME_SENSORS, None)]
+
+    rows = []
+    for (measurement, tags), points in result_set.items():
+      sensed = tags[Constants.INFLUXDB_TAG_NAME_SENSED]
+      rows.extend([point['time'], sensed, point['count'], point['mean'], point['min'], point['max'], point['last']] for point in points)
+
+    # Each sensed item is its own series, so mix them back into time order.
+    rows.sort(key=lambda row: row[AGGREGATED_ROW_TIME])
+
+    return rows
+
+  def query_location_rows(self, sensed_id, channels, bucket_width, start_time, end_time):
+    """Query InfluxDB for the measurements of a location from several
+       channels, aggregated together by a single query.
+
+       Times are in milliseconds since the epoch.
+    """
+    if not channels:
+      return []
+
+    query = InfluxQuery(Constants.INFLUXDB_MEASUREMENT_NAME_SENSORS).select_aggregates("continuous_value")
+    query.where_tag(Constants.INFLUXDB_TAG_NAME_SENSED, sensed_id)
+    query.where_any_tags([Constants.INFLUXDB_TAG_NAME_SENSOR, Constants.INFLUXDB_TAG_NAME_CHANNEL], channels)
+    query.where_time(start_time, end_time).group_by_time(bucket_width)
+
+    results = run_query(self.persistence_client, query)
+
+    return [[point['time'], sensed_id, point['count'], point['mean'], point['min'], point['max'], point['last']]
+            for point in results.get_points(Constants.INFLUXDB_MEASUREMENT_NAME_SENSORS, None)]
+
+  def get_sensor_measurements(self, sensor, startDateTime, endDateTime):
+    return self.get_tagged_measurements(Constants.INFLUXDB_TAG_NAME_SENSOR, sensor, startDateTime, endDateTime)
+
+  def get_sensed_measurements(self, sensed, startDateTime, endDateTime):
+    return self.get_tagged_measurements(Constants.INFLUXDB_TAG_NAME_SENSED, sensed, startDateTime, endDateTime)
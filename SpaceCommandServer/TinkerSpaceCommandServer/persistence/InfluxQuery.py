@@ -0,0 +1,151 @@
+#
+# Building InfluxQL queries with bound parameters.
+#
+# Tag values and times are never formatted into the text of a query, they
+# are sent as bound parameters, so nothing a web client gives can change
+# what a query does. Measurement, field and tag names only ever come from
+# the server code and are quoted as identifiers.
+#
+
+#
+# Written by Keith Hughes
+#
+
+def quote_identifier(name):
+  """Quote a measurement, field or tag name for InfluxQL.
+  """
+
+  return '"{}"'.format(name.replace('\\', '\\\\').replace('"', '\\"'))
+
+class InfluxQuery:
+  """A select statement on one measurement.
+
+     The where conditions are ANDed together. Times are in milliseconds
+     since the epoch.
+  """
+
+  def __init__(self, measurement, columns=None):
+    self.measurement = measurement
+
+    # The InfluxQL expressions selected, or None for every column.
+    self.columns = columns
+
+    # The where conditions, as templates with a {} for each of their
+    # parameters, and the parameters.
+    self.conditions = []
+
+    self.group_by = []
+    self.fill = None
+
+  def select_aggregates(self, field):
+    """Select the count, mean, min, max and last of a field, named for the
+       aggregate.
+    """
+
+    quoted_field = quote_identifier(field)
+    self.columns = ["{0}({1}) as {2}".format(aggregate, quoted_field, quote_identifier(aggregate)) for aggregate in ["count", "mean", "min", "max", "last"]]
+
+    return self
+
+  def where_tag(self, tag_name, value):
+    """Only select points whose tag has a value.
+    """
+
+    self.conditions.append(("{} = {{}}".format(quote_identifier(tag_name)), [value]))
+
+    return self
+
+  def where_any_tags(self, tag_names, tag_values):
+    """Only select points whose tags have one of a list of combinations of
+       values, each a tuple with a value for each of the tag names.
+    """
+
+    template = " and ".join("{} = {{}}".format(quote_identifier(tag_name)) for tag_name in tag_names)
+    self.conditions.append(("(" + " or ".join("({})".format(template) for values in tag_values) + ")",
+                            [value for values in tag_values for value in values]))
+
+    return self
+
+  def where_time(self, start_time, end_time=None):
+    """Only select points with start_time <= time < end_time. There is no
+       end if end_time is None.
+    """
+
+    # Bound times are nanoseconds.
+    self.conditions.append(("time >= {}", [int(start_time) * 1000000]))
+    if end_time is not None:
+      self.conditions.append(("time < {}", [int(end_time) * 1000000]))
+
+    return self
+
+  def group_by_time(self, bucket_width, *tag_names):
+    """Aggregate into time buckets bucket_width milliseconds wide, and
+       series for each value of the tags. Empty buckets are left out.
+    """
+
+    self.group_by = ["time({}ms)".format(int(bucket_width))] + [quote_identifier(tag_name) for tag_name in tag_names]
+    self.fill = "none"
+
+    return self
+
+  def render(self, parameter_prefix="p"):
+    """Get the text of the statement and a map of its bound parameters.
+
+       The parameter names start with the prefix, so statements with
+       different prefixes can be sent together.
+    """
+
+    parameters = {}
+
+    def bind(value):
+      name = "{}{}".format(parameter_prefix, len(parameters))
+      parameters[name] = value
+
+      return "$" + name
+
+    statement = "select {0} from {1}".format(", ".join(self.columns) if self.columns else "*", quote_identifier(self.measurement))
+
+    if self.conditions:
+      statement += " where " + " and ".join(template.format(*[bind(value) for value in values]) for template, values in self.conditions)
+
+    if self.group_by:
+      statement += " group by " + ", ".join(self.group_by)
+
+    if self.fill is not None:
+      statement += " fill({})".format(self.fill)
+
+    return statement, parameters
+
+def run_query(client, query, **kwargs):
+  """Run a query, with results in milliseconds since the epoch.
+
+     Extra keyword arguments are given to the client's query, so the result
+     is whatever the client gives for them.
+  """
+
+  statement, parameters = query.render()
+
+  return client.query(statement, bind_params=parameters, epoch='ms', **kwargs)
+
+def run_queries(client, queries, **kwargs):
+  """Run queries as a single request, with results in milliseconds since the
+     epoch.
+
+     Gives a result set for each query, in order. Extra keyword arguments
+     are given to the client's query.
+  """
+
+  statements = []
+  parameters = {}
+  for index, query in enumerate(queries):
+    statement, statement_parameters = query.render("q{}_".format(index))
+    statements.append(statement)
+    parameters.update(statement_parameters)
+
+  results = client.query("; ".join(statements), bind_params=parameters, epoch='ms', **kwargs)
+
+  # The client only gives a list when there is more than one statement.
+  if isinstance(results, list):
+    return results
+
+  return [results]
@@ -0,0 +1,228 @@
+#
+# Event persistence to an embedded column store, for deployments without an
+# InfluxDB server.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import asyncio
+import heapq
+import os
+import time
+import traceback
+from itertools import chain
+from threading import Event, Thread
+
+from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.persistence.ColumnStore import ColumnStore
+from TinkerSpaceCommandServer.persistence.EventPersistence import EventPersistence
+from TinkerSpaceCommandServer.persistence.QueryCache import AGGREGATED_ROW_TIME
+from TinkerSpaceCommandServer.persistence.RollupStore import RollupStore
+
+def aggregate_rows(rows, bucket_width):
+  """Aggregate raw rows, in time order, into time buckets bucket_width wide
+     for each sensed entity. rows can be any iterable.
+
+     Gives aggregated rows in time order, the way InfluxDB groups by time and
+     tag.
+  """
+
+  buckets = {}
+  for timestamp, sensed_id, value in rows:
+    bucket_start = timestamp - timestamp % bucket_width
+    row = buckets.get((bucket_start, sensed_id))
+    if row is None:
+      buckets[(bucket_start, sensed_id)] = [bucket_start, sensed_id, 1, value, value, value, value]
+    else:
+      row[2] += 1
+      row[3] += value
+      if value < row[4]:
+        row[4] = value
+      if value > row[5]:
+        row[5] = value
+      row[6] = value
+
+  aggregated = list(buckets.values())
+  for row in aggregated:
+    row[3] /= row[2]
+  aggregated.sort(key=lambda row: row[AGGREGATED_ROW_TIME])
+
+  return aggregated
+
+class ColumnStoreFlushThread(Thread):
+  """Flushes the column store every flush interval, and compacts and expires
+     its partitions when the day changes.
+  """
+
+  def __init__(self, persistence):
+    Thread.__init__(self)
+    self.persistence = persistence
+    self.stopped = Event()
+
+  def run(self):
+    # The store is flushed a last time when the persistence stops.
+    while not self.stopped.wait(self.persistence.flush_interval):
+      self.persistence.flush()
+
+  def stop(self):
+    self.stopped.set()
+
+class LocalEventPersistence(EventPersistence):
+  """Persists measurements to column files on the local disk.
+
+     Queries read the files directly, memory mapped, so there is no query
+     cache.
+  """
+
+  # Every shard writing the same files would corrupt them, so the server
+  # process persists the measurements the shards send it.
+  persist_in_shards = False
+
+  def __init__(self, config):
+    EventPersistence.__init__(self, config)
+
+    local_config = config["persistence"].get("local", {})
+
+    # The directory of the store.
+    self.store_directory = local_config.get("directory", Constants.LOCAL_STORE_DIRECTORY)
+
+    # How often new measurements are written to the files. A crash loses at
+    # most this much.
+    self.flush_interval = local_config.get("flushInterval", Constants.LOCAL_STORE_FLUSH_INTERVAL)
+
+    self.store = ColumnStore(self.store_directory, local_config.get("retentionDays", Constants.LOCAL_STORE_RETENTION_DAYS))
+
+    # Rollups are kept in their own directory of the store, and are kept
+    # past the retention of the measurements.
+    self.rollup_store = RollupStore(os.path.join(self.store_directory, "rollups"))
+
+    self.flush_thread = None
+
+    self.write_time = self.metrics.histogram("tinkerspace_local_store_flush_seconds", "Time to flush new measurements to the local store.")
+    self.metrics.gauge("tinkerspace_local_store_pending_points", "Measurements waiting for the next local store flush.", self.store.pending_count)
+    self.metrics.counter_function("tinkerspace_local_store_points_written_total", "Points written to the local store.", lambda: self.store.points_written)
+    self.metrics.counter_function("tinkerspace_local_store_points_dropped_total", "Points dropped because they could not be written to the local store.", lambda: self.store.points_dropped)
+    self.metrics.counter_function("tinkerspace_local_store_write_failures_total", "Failed local store writes.", lambda: self.store.write_failures)
+
+  def start(self):
+    self.open_store()
+    self.start_rollups()
+
+    self.flush_thread = ColumnStoreFlushThread(self)
+    self.flush_thread.start()
+
+  def stop(self):
+    self.stop_rollups()
+
+    if self.flush_thread is not None:
+      self.flush_thread.stop()
+      self.flush_thread.join()
+      self.flush_thread = None
+
+    self.flush()
+
+  def open_store(self):
+    self.store.open()
+    self.store.maintain(int(time.time() * 1000))
+    self.rollup_store.open()
+
+  def flush(self):
+    """Write the new measurements to the store, then compact and expire its
+       partitions if the day has changed.
+    """
+
+    start = time.perf_counter()
+    try:
+      self.store.flush()
+      self.store.maintain(int(time.time() * 1000))
+    except:
+      print(traceback.format_exc())
+    self.write_time.observe(time.perf_counter() - start)
+
+  async def run_async(self):
+    """Flush the store from the event loop until cancelled.
+
+       File writes block, so each flush runs on the loop's default executor.
+       Remaining points are flushed on cancel.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    await loop.run_in_executor(None, self.open_store)
+
+    # Persisting the rollups keeps its own thread.
+    await loop.run_in_executor(None, self.start_rollups)
+    try:
+      while True:
+        await asyncio.sleep(self.flush_interval)
+        await loop.run_in_executor(None, self.flush)
+    finally:
+      await loop.run_in_executor(None, self.stop_rollups)
+      await loop.run_in_executor(None, self.flush)
+
+  def enqueue_measurement(self, measurement_event):
+    """Add a measurement to be written at the next flush.
+    """
+
+    try:
+      self.store.append(measurement_event.sensor_active_model.sensor_entity_description.external_id,
+                        measurement_event.active_channel.channel_id,
+                        measurement_event.sensed_active_model.sensed_entity_description.external_id,
+                        int(measurement_event.time_received * 1000),
+                        float(measurement_event.value))
+    except:
+      print(traceback.format_exc())
+
+  def enqueue_measurement_batch(self, batch_event):
+    """Add the measurements of a batch to be written at the next flush.
+    """
+
+    try:
+      self.store.append_many(batch_event.sensor_active_model.sensor_entity_description.external_id,
+                             batch_event.active_channel.channel_id,
+                             batch_event.sensed_active_model.sensed_entity_description.external_id,
+                             [int(time_received * 1000) for time_received in batch_event.times_received],
+                             [float(value) for value in batch_event.values])
+    except:
+      print(traceback.format_exc())
+
+  def query_channel_rows(self, sensor_id, channel, bucket_width, start_time, end_time):
+    partition_rows = self.store.iter_rows(sensor_id, channel, start_time, end_time)
+    if bucket_width is None:
+      return list(chain.from_iterable(partition_rows))
+
+    # Only one partition of raw rows is in memory at a time.
+    return aggregate_rows(chain.from_iterable(partition_rows), bucket_width)
+
+  def query_location_rows(self, sensed_id, channels, bucket_width, start_time, end_time):
+    # Each channel is read a partition at a time and merged into time order,
+    # so the last value of a bucket is the last over all of them.
+    channel_rows = [chain.from_iterable(self.store.iter_rows(sensor_id, channel, start_time, end_time)) for sensor_id, channel in channels]
+
+    return aggregate_rows((row for row in heapq.merge(*channel_rows, key=lambda row: row[0]) if row[1] == sensed_id), bucket_width)
+
+  def iter_channel_rows(self, sensor_id, channel, start_time, end_time):
+    for rows in self.store.iter_rows(sensor_id, channel, start_time, end_time):
+      for start in range(0, len(rows), Constants.QUERY_STREAM_CHUNK_SIZE):
+        yield rows[start:start + Constants.QUERY_STREAM_CHUNK_SIZE]
+
+  def write_rollup_rows(self, tier_index, rows):
+    try:
+      self.rollup_store.write_rows(tier_index, rows)
+
+      return True
+    except OSError:
+      print(traceback.format_exc())
+
+      return False
+
+  def load_rollup_rows(self, tier_index, start_time):
+    return self.rollup_store.read_open_rows(tier_index, start_time)
+
+  def query_rollup_rows(self, tier_index, kind, query_key, start_time, end_time):
+    return self.rollup_store.read_rows(tier_index, kind, query_key, start_time, end_time)
+
+  def get_rollups_start_time(self):
+    return self.rollup_store.get_first_bucket_start(0)
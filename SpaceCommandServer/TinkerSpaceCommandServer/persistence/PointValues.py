@@ -0,0 +1,41 @@
+#
+# Checks of measurement values before they are persisted, and the error for
+# points InfluxDB refuses.
+#
+# Sensors can send NaN or infinity, and the JSON fallback, MessagePack and
+# CBOR codecs all decode them. InfluxDB line protocol has no way to write
+# them, and one in a batch gets the whole batch rejected.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import math
+
+class PointsRejectedError(Exception):
+  """InfluxDB refused a batch because of the points in it, so writing the
+     same points again would fail again.
+  """
+
+def is_finite_value(value):
+  """Is a measurement value a number that can be persisted?
+  """
+
+  try:
+    return math.isfinite(float(value))
+  except (TypeError, ValueError):
+    return False
+
+def finite_points(times, values):
+  """Leave out the points of a series whose values can't be persisted.
+
+     Returns the times and values that are left.
+  """
+
+  if all(is_finite_value(value) for value in values):
+    return times, values
+
+  points = [(point_time, value) for point_time, value in zip(times, values) if is_finite_value(value)]
+
+  return [point_time for point_time, value in points], [value for point_time, value in points]
@@ -0,0 +1,173 @@
+#
+# A cache of measurement query results, split into aligned time buckets.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+
+# The positions of the fields in an aggregated row.
+AGGREGATED_ROW_TIME = 0
+AGGREGATED_ROW_SENSED = 1
+AGGREGATED_ROW_COUNT = 2
+AGGREGATED_ROW_MEAN = 3
+AGGREGATED_ROW_MIN = 4
+AGGREGATED_ROW_MAX = 5
+AGGREGATED_ROW_LAST = 6
+
+# The bucket widths from a second to a day, in milliseconds. Each is a whole
+# number of the minutes, hours or days they are near, so they line up with
+# clock times and the rollup tiers.
+CLOCK_BUCKET_WIDTHS = [
+  1000, 2 * 1000, 5 * 1000, 10 * 1000, 15 * 1000, 30 * 1000,
+  60 * 1000, 2 * 60 * 1000, 5 * 60 * 1000, 10 * 60 * 1000, 15 * 60 * 1000, 30 * 60 * 1000,
+  60 * 60 * 1000, 2 * 60 * 60 * 1000, 3 * 60 * 60 * 1000, 6 * 60 * 60 * 1000, 12 * 60 * 60 * 1000,
+  24 * 60 * 60 * 1000
+]
+
+def round_up_to_steps(value):
+  """Round a value up to 1, 2 or 5 times a power of ten.
+  """
+
+  step = 1
+  while True:
+    for multiple in [1, 2, 5]:
+      if step * multiple >= value:
+        return step * multiple
+    step *= 10
+
+def round_up_bucket_width(bucket_width):
+  """Round an aggregation bucket width, in milliseconds, up to a width that
+     lines up with clock times.
+
+     Widths under a second are 1, 2 or 5 times a power of ten milliseconds,
+     widths over a day are 1, 2 or 5 times a power of ten days, and those in
+     between are from CLOCK_BUCKET_WIDTHS.
+
+     Charts of slightly different time ranges then use the same bucket width
+     and so can share cache entries, and wide buckets can be made from
+     rollups.
+  """
+
+  if bucket_width <= CLOCK_BUCKET_WIDTHS[0]:
+    return round_up_to_steps(bucket_width)
+
+  for width in CLOCK_BUCKET_WIDTHS:
+    if width >= bucket_width:
+      return width
+
+  day = CLOCK_BUCKET_WIDTHS[-1]
+
+  return round_up_to_steps(-(-bucket_width // day)) * day
+
+class QueryCacheEntry:
+  """The rows of one sensor channel in one cache bucket.
+
+     Raw rows are (timestamp, sensed ID, value) tuples. Aggregated rows are
+     lists of bucket timestamp, sensed ID, count, mean, min, max and last
+     value, so a single entry serves every aggregate. Timestamps are in
+     milliseconds and rows are kept in time order.
+  """
+
+  __slots__ = ('bucket_width', 'rows')
+
+  def __init__(self, bucket_width, rows):
+    # The aggregation bucket width in milliseconds, or None for raw rows.
+    self.bucket_width = bucket_width
+
+    self.rows = rows
+
+class QueryCache:
+  """A size bounded LRU cache of query rows for sensor channels.
+
+     Entries are keyed by sensor ID, channel ID, aggregation bucket width
+     (None for raw rows) and the start of an aligned cache bucket, all times
+     in milliseconds. Only buckets whose measurements have all been written
+     are cached, as they never change after that. The bucket containing now
+     is always fetched again.
+  """
+
+  def __init__(self, size, raw_bucket_size, aggregated_bucket_rows):
+    # The maximum number of entries. A size of 0 turns the cache off.
+    self.size = size
+
+    # The length in milliseconds of a cache bucket of raw rows.
+    self.raw_bucket_size = raw_bucket_size
+
+    # The number of aggregation buckets in a cache bucket of aggregated rows.
+    self.aggregated_bucket_rows = aggregated_bucket_rows
+
+    self.entries = OrderedDict()
+
+    self.lock = Lock()
+
+    self.hits = 0
+    self.misses = 0
+
+  def get_bucket_size(self, bucket_width):
+    """Get the length in milliseconds of the cache buckets for rows with the
+       given aggregation bucket width.
+    """
+
+    if bucket_width is None:
+      return self.raw_bucket_size
+
+    return bucket_width * self.aggregated_bucket_rows
+
+  def get(self, key):
+    """Get a copy of the rows for a key, or None if they have to be fetched.
+    """
+
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.misses += 1
+
+        return None
+
+      self.entries.move_to_end(key)
+      self.hits += 1
+
+      if entry.bucket_width is None:
+        return list(entry.rows)
+      else:
+        return [list(row) for row in entry.rows]
+
+  def put(self, key, end, rows, written_time):
+    """Cache the rows fetched for a key, if everything measured before the
+       end of its bucket had been written when they were fetched.
+
+       written_time is the time every measurement before it had been
+       written by. Times are in milliseconds.
+    """
+
+    if self.size <= 0 or end > written_time:
+      return
+
+    with self.lock:
+      self.entries[key] = QueryCacheEntry(key[2], rows)
+      self.entries.move_to_end(key)
+
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+  def split_rows(self, rows, bucket_start, bucket_end, bucket_size):
+    """Split time ordered rows fetched for a range of cache buckets into the
+       rows of each bucket.
+
+       Returns a list of (bucket start, rows) pairs.
+    """
+
+    times = [row[0] for row in rows]
+
+    buckets = []
+    for start in range(bucket_start, bucket_end, bucket_size):
+      low = bisect_left(times, start)
+      high = bisect_left(times, start + bucket_size)
+      buckets.append((start, rows[low:high]))
+
+    return buckets
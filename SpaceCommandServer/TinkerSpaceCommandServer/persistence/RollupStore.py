@@ -0,0 +1,240 @@
+#
+# Rollup rows in files on the local disk, for the local persistence backend.
+#
+# Each rollup tier has a directory with a file for each rollup, of fixed size
+# records in bucket order. Writing a bucket again overwrites its record, so
+# a read can binary search the records for the start of its range. Rollups
+# are listed in a catalog file in each tier directory, one JSON list of
+# rollup ID, kind and key per line.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import json
+import mmap
+import os
+import struct
+from threading import Lock
+
+from TinkerSpaceCommandServer.persistence.Rollups import ROLLUP_TIERS, rollup_query_matches, rollup_sensed_id
+
+# Bucket start, count, mean, minimum, maximum and last value.
+ROLLUP_RECORD = struct.Struct('<qIdddd')
+
+# Just the bucket start of a record.
+ROLLUP_RECORD_START = struct.Struct('<q')
+
+CATALOG_FILE_NAME = "series"
+ROLLUP_FILE_SUFFIX = ".rol"
+
+def find_record(buffer, record_count, bucket_start):
+  """Find the index of the first record whose bucket starts at or after
+     bucket_start.
+  """
+
+  low = 0
+  high = record_count
+  while low < high:
+    middle = (low + high) // 2
+    if ROLLUP_RECORD_START.unpack_from(buffer, middle * ROLLUP_RECORD.size)[0] < bucket_start:
+      low = middle + 1
+    else:
+      high = middle
+
+  return low
+
+class RollupStore:
+  """The rollup files of a local store.
+
+     Writes must only be done from one thread at a time, reads can be done
+     from any thread.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+
+    # The IDs of the rollups of each tier, by (kind, key).
+    self.rollup_ids = [{} for tier in ROLLUP_TIERS]
+
+    self.lock = Lock()
+
+  def open(self):
+    """Read the catalogs of the tiers.
+    """
+
+    for tier_index, tier in enumerate(ROLLUP_TIERS):
+      tier_directory = os.path.join(self.directory, tier.name)
+      os.makedirs(tier_directory, exist_ok=True)
+
+      catalog_path = os.path.join(tier_directory, CATALOG_FILE_NAME)
+      if not os.path.exists(catalog_path):
+        continue
+
+      with open(catalog_path, encoding='utf-8') as fp:
+        for line in fp:
+          try:
+            rollup_id, kind, key = json.loads(line)
+          except ValueError:
+            # The last line may have been partly written.
+            continue
+
+          self.rollup_ids[tier_index][(kind, tuple(key))] = rollup_id
+
+  def get_path(self, tier_index, rollup_id):
+    return os.path.join(self.directory, ROLLUP_TIERS[tier_index].name, "{}{}".format(rollup_id, ROLLUP_FILE_SUFFIX))
+
+  def create_rollup(self, tier_index, kind, key):
+    """Give a new rollup an ID and add it to the catalog of its tier.
+    """
+
+    rollup_ids = self.rollup_ids[tier_index]
+    rollup_id = len(rollup_ids)
+    with open(os.path.join(self.directory, ROLLUP_TIERS[tier_index].name, CATALOG_FILE_NAME), 'a', encoding='utf-8') as fp:
+      fp.write(json.dumps([rollup_id, kind, list(key)]) + "\n")
+      fp.flush()
+      os.fsync(fp.fileno())
+
+    with self.lock:
+      rollup_ids[(kind, key)] = rollup_id
+
+    return rollup_id
+
+  def write_rows(self, tier_index, rows):
+    """Write rollup rows, given as (kind, key, row) with rows of bucket
+       start, count, mean, minimum, maximum and last value.
+
+       The rows of a rollup must be in bucket order.
+    """
+
+    rows_by_rollup = {}
+    for kind, key, row in rows:
+      rows_by_rollup.setdefault((kind, key), []).append(row)
+
+    for (kind, key), rollup_rows in rows_by_rollup.items():
+      rollup_id = self.rollup_ids[tier_index].get((kind, key))
+      if rollup_id is None:
+        rollup_id = self.create_rollup(tier_index, kind, key)
+
+      # Not opened for appending, which would write everything at the end.
+      with open(os.open(self.get_path(tier_index, rollup_id), os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as fp:
+        for row in rollup_rows:
+          self.write_row(fp, row)
+
+  def write_row(self, fp, row):
+    """Write a row to a rollup file, overwriting the record for the same
+       bucket if there is one.
+    """
+
+    record = ROLLUP_RECORD.pack(*row)
+
+    # A record that was only partly written is cut off.
+    size = fp.seek(0, os.SEEK_END)
+    size -= size % ROLLUP_RECORD.size
+    fp.truncate(size)
+
+    # Almost always the bucket is the last one or a new one.
+    index = size // ROLLUP_RECORD.size
+    while index > 0:
+      fp.seek((index - 1) * ROLLUP_RECORD.size)
+      if ROLLUP_RECORD_START.unpack(fp.read(ROLLUP_RECORD_START.size))[0] < row[0]:
+        break
+      index -= 1
+
+    offset = index * ROLLUP_RECORD.size
+    fp.seek(offset)
+    if offset < size and ROLLUP_RECORD_START.unpack(fp.read(ROLLUP_RECORD_START.size))[0] == row[0]:
+      fp.seek(offset)
+      fp.write(record)
+    else:
+      # A new bucket, before any later ones.
+      later_records = fp.read()
+      fp.seek(offset)
+      fp.write(record + later_records)
+    fp.flush()
+
+  def read_rows(self, tier_index, kind, query_key, start_time, end_time):
+    """Read the rows of a tier for a query with start_time <= bucket start <
+       end_time.
+
+       Gives a list of rows of bucket time, sensed ID, count, mean, min, max
+       and last value, in time order.
+    """
+
+    with self.lock:
+      rollups = [(key, rollup_id) for (rollup_kind, key), rollup_id in self.rollup_ids[tier_index].items()
+                 if rollup_kind == kind and rollup_query_matches(kind, key, query_key)]
+
+    rows = []
+    for key, rollup_id in rollups:
+      sensed_id = rollup_sensed_id(kind, key)
+      try:
+        fp = open(self.get_path(tier_index, rollup_id), 'rb')
+      except FileNotFoundError:
+        continue
+
+      with fp:
+        record_count = os.fstat(fp.fileno()).st_size // ROLLUP_RECORD.size
+        if not record_count:
+          continue
+
+        with mmap.mmap(fp.fileno(), record_count * ROLLUP_RECORD.size, access=mmap.ACCESS_READ) as buffer:
+          first = find_record(buffer, record_count, start_time)
+          last = find_record(buffer, record_count, end_time)
+          rows.extend([bucket_start, sensed_id, count, mean, minimum, maximum, last_value]
+                      for bucket_start, count, mean, minimum, maximum, last_value
+                      in ROLLUP_RECORD.iter_unpack(buffer[first * ROLLUP_RECORD.size:last * ROLLUP_RECORD.size]))
+
+    rows.sort(key=lambda row: row[0])
+
+    return rows
+
+  def read_open_rows(self, tier_index, start_time):
+    """Read the rows of every rollup of a tier with buckets starting at or
+       after start_time.
+
+       Gives a list of (kind, key, row) with rows of bucket start, count,
+       mean, minimum, maximum and last value.
+    """
+
+    with self.lock:
+      rollups = list(self.rollup_ids[tier_index].items())
+
+    rows = []
+    for (kind, key), rollup_id in rollups:
+      try:
+        with open(self.get_path(tier_index, rollup_id), 'rb') as fp:
+          data = fp.read()
+      except FileNotFoundError:
+        continue
+
+      data = data[:len(data) - len(data) % ROLLUP_RECORD.size]
+      for record in ROLLUP_RECORD.iter_unpack(data):
+        if record[0] >= start_time:
+          rows.append((kind, key, record))
+
+    return rows
+
+  def get_first_bucket_start(self, tier_index):
+    """Get the earliest bucket start of any rollup of a tier, or None if
+       nothing has been written.
+    """
+
+    with self.lock:
+      rollup_ids = list(self.rollup_ids[tier_index].values())
+
+    first = None
+    for rollup_id in rollup_ids:
+      try:
+        with open(self.get_path(tier_index, rollup_id), 'rb') as fp:
+          data = fp.read(ROLLUP_RECORD_START.size)
+      except FileNotFoundError:
+        continue
+
+      if len(data) == ROLLUP_RECORD_START.size:
+        bucket_start = ROLLUP_RECORD_START.unpack(data)[0]
+        if first is None or bucket_start < first:
+          first = bucket_start
+
+    return first
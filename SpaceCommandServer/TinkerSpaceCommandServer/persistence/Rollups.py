@@ -0,0 +1,477 @@
+#
+# Rollups of measurements into minute, hour and day aggregates, for charts of
+# long time ranges.
+#
+# Rollups are kept for every sensor channel, keyed by sensor ID, channel ID
+# and sensed ID, and for every sensed location and measurement type, over all
+# of the sensor channels measuring it. Each rollup row is the count, mean,
+# minimum, maximum and last value of the measurements in its time bucket.
+#
+# Measurements only update the minute buckets. Once a bucket is a grace
+# period past its end it is closed and added to the hour bucket it is in, and
+# hours are added to days the same way. Measurements for closed buckets are
+# only counted. Open buckets are written to the persistence backend at every
+# flush, so a crash loses at most a flush interval. A later write of the same
+# bucket replaces an earlier one, and open buckets are read back when the
+# server starts.
+#
+# The row written for a bucket includes what is in the open buckets of the
+# tiers below it, so an hour is complete as persisted even though its minutes
+# are only added to it as they close. A minute read back after a restart is
+# already in its hour, and only what it gets after the restart is added.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import time
+import traceback
+from threading import Event, Lock, Thread
+from rx import Observer
+
+from TinkerSpaceCommandServer.events.StandardEvents import SensorChannelMeasurementBatchEvent
+from TinkerSpaceCommandServer.persistence.PointValues import is_finite_value
+
+ROLLUP_KIND_CHANNEL = "channel"
+ROLLUP_KIND_LOCATION = "location"
+
+ROLLUP_KINDS = [ROLLUP_KIND_CHANNEL, ROLLUP_KIND_LOCATION]
+
+class RollupTier:
+  """A rollup tier, the name it is persisted under and the width of its
+     buckets in milliseconds.
+  """
+
+  __slots__ = ('name', 'width')
+
+  def __init__(self, name, width):
+    self.name = name
+    self.width = width
+
+# The tiers, finest first.
+ROLLUP_TIERS = [
+  RollupTier("1m", 60 * 1000),
+  RollupTier("1h", 60 * 60 * 1000),
+  RollupTier("1d", 24 * 60 * 60 * 1000)
+]
+
+def select_tier(bucket_width):
+  """Get the index of the coarsest tier whose buckets can be combined into
+     buckets bucket_width milliseconds wide, or None if there isn't one.
+  """
+
+  selected = None
+  for tier_index, tier in enumerate(ROLLUP_TIERS):
+    if bucket_width >= tier.width and bucket_width % tier.width == 0:
+      selected = tier_index
+
+  return selected
+
+def rollup_sensed_id(kind, key):
+  """Get the sensed ID from the key of a rollup.
+
+     Channel rollups are keyed by (sensor ID, channel ID, sensed ID),
+     location rollups by (sensed ID, measurement type).
+  """
+
+  return key[2] if kind == ROLLUP_KIND_CHANNEL else key[0]
+
+def rollup_query_matches(kind, key, query_key):
+  """Is the rollup with a key one that a query wants?
+
+     Channel rollups are queried by (sensor ID, channel ID) and give rows for
+     every sensed ID. Location rollups are queried by their full key.
+  """
+
+  if kind == ROLLUP_KIND_CHANNEL:
+    return key[0] == query_key[0] and key[1] == query_key[1]
+
+  return key == query_key
+
+def combine_rollup_rows(rows, bucket_width):
+  """Combine rollup rows, in time order, into aggregated rows for buckets
+     bucket_width wide, for each sensed ID.
+
+     Rows are lists of bucket time, sensed ID, count, mean, min, max and last
+     value, the same as aggregated query rows.
+  """
+
+  buckets = {}
+  for bucket_time, sensed_id, count, mean, minimum, maximum, last in rows:
+    # Rows rolled up before non-finite values were left out can have them.
+    if not is_finite_value(mean):
+      continue
+
+    bucket_start = bucket_time - bucket_time % bucket_width
+    row = buckets.get((bucket_start, sensed_id))
+    if row is None:
+      buckets[(bucket_start, sensed_id)] = [bucket_start, sensed_id, count, mean * count, minimum, maximum, last]
+    else:
+      row[2] += count
+      row[3] += mean * count
+      if minimum < row[4]:
+        row[4] = minimum
+      if maximum > row[5]:
+        row[5] = maximum
+      row[6] = last
+
+  combined = list(buckets.values())
+  for row in combined:
+    row[3] /= row[2]
+  combined.sort(key=lambda row: row[0])
+
+  return combined
+
+class RollupBucket:
+  """A bucket of a rollup that is still open.
+
+     The base is the bucket as it was persisted before the server started,
+     if it was. The rest is what has been added since, which is what gets
+     added to the bucket of the next tier up when this one closes.
+  """
+
+  __slots__ = ('start', 'count', 'total', 'minimum', 'maximum', 'last', 'last_time', 'base', 'changed')
+
+  def __init__(self, start, base=None):
+    self.start = start
+    self.count = 0
+    self.total = 0.0
+    self.minimum = None
+    self.maximum = None
+    self.last = None
+    self.last_time = None
+
+    # The persisted count, mean, minimum, maximum and last value.
+    self.base = base
+
+    # Whether the bucket has changed since it was last persisted.
+    self.changed = False
+
+  def add(self, timestamp, value):
+    if self.count:
+      if value < self.minimum:
+        self.minimum = value
+      if value > self.maximum:
+        self.maximum = value
+      if timestamp >= self.last_time:
+        self.last = value
+        self.last_time = timestamp
+    else:
+      self.minimum = self.maximum = self.last = value
+      self.last_time = timestamp
+    self.count += 1
+    self.total += value
+    self.changed = True
+
+  def add_bucket(self, bucket):
+    """Add what has been added to a bucket of the tier below.
+    """
+
+    if not bucket.count:
+      return
+
+    if self.count:
+      if bucket.minimum < self.minimum:
+        self.minimum = bucket.minimum
+      if bucket.maximum > self.maximum:
+        self.maximum = bucket.maximum
+      if bucket.last_time >= self.last_time:
+        self.last = bucket.last
+        self.last_time = bucket.last_time
+    else:
+      self.minimum = bucket.minimum
+      self.maximum = bucket.maximum
+      self.last = bucket.last
+      self.last_time = bucket.last_time
+    self.count += bucket.count
+    self.total += bucket.total
+    self.changed = True
+
+  def get_row(self):
+    """Get the bucket start, count, mean, minimum, maximum and last value,
+       with the base included.
+    """
+
+    if self.base is None:
+      return (self.start, self.count, self.total / self.count, self.minimum, self.maximum, self.last)
+
+    base_count, base_mean, base_minimum, base_maximum, base_last = self.base
+    if not self.count:
+      return (self.start, base_count, base_mean, base_minimum, base_maximum, base_last)
+
+    count = base_count + self.count
+
+    return (self.start, count, (base_mean * base_count + self.total) / count,
+            min(base_minimum, self.minimum), max(base_maximum, self.maximum), self.last)
+
+class RollupAccumulator:
+  """The open buckets of every rollup, and the rows waiting to be persisted.
+
+     Measurements can be added from any thread. Flushes must only be done
+     from one thread at a time.
+  """
+
+  def __init__(self, grace_period, max_unwritten_rows):
+    # How long after its end a bucket is closed, in milliseconds.
+    self.grace_period = grace_period
+
+    # The most rows kept for writing again when the backend fails. The
+    # oldest are dropped.
+    self.max_unwritten_rows = max_unwritten_rows
+
+    # The open buckets for each tier and kind, by rollup key then bucket
+    # start.
+    self.open_buckets = [{kind: {} for kind in ROLLUP_KINDS} for tier in ROLLUP_TIERS]
+
+    # Buckets of the finest tier starting before this are closed.
+    self.closed_before = 0
+
+    # Rows that failed to be written for each tier, as (kind, key, row).
+    self.unwritten_rows = [[] for tier in ROLLUP_TIERS]
+
+    self.lock = Lock()
+
+    self.late_points = 0
+    self.rows_dropped = 0
+
+  def open(self, current_time):
+    """Start taking measurements. Buckets that would already be closed at
+       the current time, in milliseconds, are treated as closed, so their
+       persisted rows are never replaced by rows of just the measurements
+       that arrive late.
+    """
+
+    self.closed_before = self.open_bucket_start(0, current_time)
+
+  def open_bucket_start(self, tier_index, current_time):
+    """Get the earliest start of a bucket of a tier still open at the
+       current time.
+    """
+
+    return current_time - self.grace_period - ROLLUP_TIERS[tier_index].width + 1
+
+  def add(self, sensor_id, channel_id, sensed_id, measurement_type, timestamp, value):
+    """Add a measurement. The timestamp is in milliseconds.
+    """
+
+    bucket_start = timestamp - timestamp % ROLLUP_TIERS[0].width
+    if bucket_start < self.closed_before:
+      self.late_points += 1
+      return
+
+    with self.lock:
+      open_buckets = self.open_buckets[0]
+      for kind, key in [(ROLLUP_KIND_CHANNEL, (sensor_id, channel_id, sensed_id)), (ROLLUP_KIND_LOCATION, (sensed_id, measurement_type))]:
+        buckets = open_buckets[kind].get(key)
+        if buckets is None:
+          buckets = open_buckets[kind][key] = {}
+
+        bucket = buckets.get(bucket_start)
+        if bucket is None:
+          bucket = buckets[bucket_start] = RollupBucket(bucket_start)
+          self.open_containing_buckets(0, kind, key, bucket_start)
+        bucket.add(timestamp, value)
+
+  def seed(self, tier_index, kind, key, row):
+    """Open a bucket that was persisted before the server started, with
+       its persisted row of bucket start, count, mean, minimum, maximum and
+       last value.
+    """
+
+    bucket_start = row[0]
+    with self.lock:
+      buckets = self.open_buckets[tier_index][kind].setdefault(key, {})
+      bucket = buckets.get(bucket_start)
+      if bucket is None:
+        buckets[bucket_start] = RollupBucket(bucket_start, tuple(row[1:]))
+        self.open_containing_buckets(tier_index, kind, key, bucket_start)
+      elif bucket.base is None:
+        # Opened by measurements since the start, before the row could be
+        # read back.
+        bucket.base = tuple(row[1:])
+        bucket.changed = True
+
+  def open_containing_buckets(self, tier_index, kind, key, bucket_start):
+    """Open the buckets of the tiers above a tier that a bucket is in, if
+       they aren't open, so they are persisted along with it.
+    """
+
+    for upper_tier_index in range(tier_index + 1, len(ROLLUP_TIERS)):
+      width = ROLLUP_TIERS[upper_tier_index].width
+      upper_start = bucket_start - bucket_start % width
+
+      buckets = self.open_buckets[upper_tier_index][kind].setdefault(key, {})
+      if upper_start not in buckets:
+        buckets[upper_start] = RollupBucket(upper_start)
+
+  def get_tier_row(self, tier_index, kind, key, bucket):
+    """Get the row of an open bucket, including what has been added to the
+       open buckets of the tiers below it in its time.
+
+       Returns None if there is nothing in it.
+    """
+
+    row_bucket = RollupBucket(bucket.start, bucket.base)
+    row_bucket.add_bucket(bucket)
+
+    bucket_end = bucket.start + ROLLUP_TIERS[tier_index].width
+    for lower_tier_index in range(tier_index):
+      for lower_start, lower_bucket in self.open_buckets[lower_tier_index][kind].get(key, {}).items():
+        if bucket.start <= lower_start < bucket_end:
+          row_bucket.add_bucket(lower_bucket)
+
+    if not row_bucket.count and row_bucket.base is None:
+      return None
+
+    return row_bucket.get_row()
+
+  def take_changes(self, current_time):
+    """Close the buckets past their grace period and take the rows of every
+       bucket that has changed since the last time, for each tier.
+
+       The time is in milliseconds, and None closes every bucket.
+    """
+
+    changes = []
+    with self.lock:
+      # The buckets of the tiers above a changed bucket have changed too.
+      changed_above = [set() for tier in ROLLUP_TIERS]
+      for tier_index in range(len(ROLLUP_TIERS) - 1):
+        for kind, rollups in self.open_buckets[tier_index].items():
+          for key, buckets in rollups.items():
+            for bucket_start, bucket in buckets.items():
+              if bucket.changed:
+                for upper_tier_index in range(tier_index + 1, len(ROLLUP_TIERS)):
+                  changed_above[upper_tier_index].add((kind, key, bucket_start - bucket_start % ROLLUP_TIERS[upper_tier_index].width))
+
+      for tier_index, tier in enumerate(ROLLUP_TIERS):
+        tier_changes = self.unwritten_rows[tier_index]
+        self.unwritten_rows[tier_index] = []
+
+        # Buckets starting at or before this have been over for the grace
+        # period.
+        close_time = None if current_time is None else current_time - self.grace_period - tier.width
+
+        for kind, rollups in self.open_buckets[tier_index].items():
+          for key in list(rollups):
+            buckets = rollups[key]
+            for bucket_start in sorted(buckets):
+              bucket = buckets[bucket_start]
+              if bucket.changed or (kind, key, bucket_start) in changed_above[tier_index]:
+                row = self.get_tier_row(tier_index, kind, key, bucket)
+                if row is not None:
+                  tier_changes.append((kind, key, row))
+                bucket.changed = False
+
+              if close_time is None or bucket_start <= close_time:
+                del buckets[bucket_start]
+                if tier_index + 1 < len(ROLLUP_TIERS):
+                  self.add_to_next_tier(tier_index + 1, kind, key, bucket)
+
+            if not buckets:
+              del rollups[key]
+
+        if tier_index == 0 and close_time is not None:
+          self.closed_before = max(self.closed_before, close_time + 1)
+
+        changes.append(tier_changes)
+
+    return changes
+
+  def add_to_next_tier(self, tier_index, kind, key, bucket):
+    width = ROLLUP_TIERS[tier_index].width
+    bucket_start = bucket.start - bucket.start % width
+
+    buckets = self.open_buckets[tier_index][kind].setdefault(key, {})
+    next_bucket = buckets.get(bucket_start)
+    if next_bucket is None:
+      next_bucket = buckets[bucket_start] = RollupBucket(bucket_start)
+    next_bucket.add_bucket(bucket)
+
+  def keep_unwritten(self, tier_index, rows):
+    """Keep rows that could not be written, to be written with the next
+       flush.
+    """
+
+    with self.lock:
+      unwritten_rows = rows + self.unwritten_rows[tier_index]
+      if len(unwritten_rows) > self.max_unwritten_rows:
+        self.rows_dropped += len(unwritten_rows) - self.max_unwritten_rows
+        unwritten_rows = unwritten_rows[-self.max_unwritten_rows:]
+      self.unwritten_rows[tier_index] = unwritten_rows
+
+  def get_rows(self, tier_index, kind, query_key, start_time, end_time):
+    """Get the rows of the open and unwritten buckets of a tier for a query,
+       with start_time <= bucket start < end_time.
+
+       Gives a map of (bucket start, sensed ID) to rows of bucket time,
+       sensed ID, count, mean, min, max and last value.
+    """
+
+    rows = {}
+    with self.lock:
+      for row_kind, key, row in self.unwritten_rows[tier_index]:
+        if row_kind == kind and start_time <= row[0] < end_time and rollup_query_matches(kind, key, query_key):
+          sensed_id = rollup_sensed_id(kind, key)
+          rows[(row[0], sensed_id)] = [row[0], sensed_id] + list(row[1:])
+
+      for key, buckets in self.open_buckets[tier_index][kind].items():
+        if rollup_query_matches(kind, key, query_key):
+          sensed_id = rollup_sensed_id(kind, key)
+          for bucket_start, bucket in buckets.items():
+            if start_time <= bucket_start < end_time:
+              row = self.get_tier_row(tier_index, kind, key, bucket)
+              if row is not None:
+                rows[(bucket_start, sensed_id)] = [bucket_start, sensed_id] + list(row[1:])
+
+    return rows
+
+class RollupObserver(Observer):
+  """Adds every measurement to the rollups.
+  """
+
+  def __init__(self, accumulator):
+    self.accumulator = accumulator
+
+  def on_next(self, measurement_event):
+    sensor_id = measurement_event.sensor_active_model.sensor_entity_description.external_id
+    channel_id = measurement_event.active_channel.channel_id
+    sensed_id = measurement_event.sensed_active_model.sensed_entity_description.external_id
+    measurement_type = measurement_event.active_channel.channel_description.measurement_type
+
+    # A NaN or infinity would make every aggregate of its buckets one too,
+    # and the rows could not be persisted.
+    if isinstance(measurement_event, SensorChannelMeasurementBatchEvent):
+      for time_received, value in zip(measurement_event.times_received, measurement_event.values):
+        if is_finite_value(value):
+          self.accumulator.add(sensor_id, channel_id, sensed_id, measurement_type, int(time_received * 1000), float(value))
+    elif is_finite_value(measurement_event.value):
+      self.accumulator.add(sensor_id, channel_id, sensed_id, measurement_type, int(measurement_event.time_received * 1000), float(measurement_event.value))
+
+  def on_completed(self):
+    pass
+
+  def on_error(self, error):
+    print("Rollup subject Error Occurred: {0}".format(error))
+
+class RollupFlushThread(Thread):
+  """Closes and persists rollup buckets every flush interval.
+  """
+
+  def __init__(self, persistence, flush_interval):
+    Thread.__init__(self)
+    self.persistence = persistence
+    self.flush_interval = flush_interval
+    self.stopped = Event()
+
+  def run(self):
+    # The rollups are flushed a last time when they are stopped.
+    while not self.stopped.wait(self.flush_interval):
+      try:
+        self.persistence.flush_rollups(int(time.time() * 1000))
+      except:
+        print(traceback.format_exc())
+
+  def stop(self):
+    self.stopped.set()
@@ -0,0 +1,524 @@
+#
+# A local write-ahead log of measurements waiting to be written to InfluxDB.
+#
+# Measurements are appended to segment files in a directory and shipped to
+# InfluxDB from there, so they survive database outages and server restarts.
+#
+# Each segment is a series of blocks, written together at each sync. A block is its length
+# and CRC32, then the records: series records give a series key an ID for
+# the rest of the segment, point records are a series ID, a timestamp in
+# microseconds and a value. A block that was only partly written when the
+# server stopped fails its CRC and is cut off when the log is opened again.
+#
+# How far the log has been shipped is kept in a checkpoint file. A point can
+# be shipped twice after a crash, which InfluxDB treats as the same point.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import os
+import shutil
+import struct
+import time
+import traceback
+import zlib
+from threading import Condition, Event, Lock, Thread
+
+from TinkerSpaceCommandServer.persistence.PointValues import PointsRejectedError, is_finite_value
+
+# The body length and CRC32 of the body of a block.
+BLOCK_HEADER = struct.Struct('<II')
+
+# Record type, series ID, key length, followed by the UTF-8 key.
+SERIES_RECORD = struct.Struct('<BIH')
+
+# Record type, series ID, timestamp in microseconds, value.
+POINT_RECORD = struct.Struct('<BIqd')
+
+# The most points in a block. The log is shipped a block at a time, so this
+# keeps a large sync from becoming one huge InfluxDB request.
+BLOCK_POINTS = 1000
+
+RECORD_TYPE_SERIES = 1
+RECORD_TYPE_POINT = 2
+
+# The segment, by sequence number, and the offset in it that everything
+# before has been shipped.
+CHECKPOINT = struct.Struct('<QQ')
+
+CHECKPOINT_FILE_NAME = "checkpoint"
+SEGMENT_FILE_SUFFIX = ".wal"
+
+def segment_file_name(sequence):
+  return "{:016d}{}".format(sequence, SEGMENT_FILE_SUFFIX)
+
+def read_blocks(fp, offset, end=None):
+  """Read the complete blocks of a segment from an offset.
+
+     Stops at end, if given, or at the first block that is incomplete or
+     fails its CRC. Yields the offset after each block and the block body.
+  """
+
+  fp.seek(offset)
+  while end is None or offset < end:
+    header = fp.read(BLOCK_HEADER.size)
+    if len(header) < BLOCK_HEADER.size:
+      return
+
+    length, crc = BLOCK_HEADER.unpack(header)
+    body = fp.read(length)
+    if len(body) < length or zlib.crc32(body) != crc:
+      return
+
+    offset += BLOCK_HEADER.size + length
+    yield offset, body
+
+def parse_block(body, series_keys, points=None):
+  """Parse the records of a block, adding series to series_keys and, if
+     points is given, appending (series key, timestamp, value) to it.
+  """
+
+  offset = 0
+  while offset < len(body):
+    record_type = body[offset]
+    if record_type == RECORD_TYPE_POINT:
+      if points is not None:
+        _, series_id, timestamp, value = POINT_RECORD.unpack_from(body, offset)
+        points.append((series_keys[series_id], timestamp, value))
+      offset += POINT_RECORD.size
+    elif record_type == RECORD_TYPE_SERIES:
+      _, series_id, key_length = SERIES_RECORD.unpack_from(body, offset)
+      offset += SERIES_RECORD.size
+      series_keys[series_id] = body[offset:offset + key_length].decode('utf-8')
+      offset += key_length
+    else:
+      raise ValueError("Unknown write-ahead log record type {}".format(record_type))
+
+class WriteAheadLog:
+  """The segment files of the log, and the measurements waiting to be
+     appended to them.
+
+     Appending only adds to a list in memory. The sync thread writes
+     everything appended since the last sync and fsyncs it once.
+  """
+
+  def __init__(self, directory, segment_size, max_size):
+    self.directory = directory
+
+    # A new segment is started once the current one is at least this big.
+    self.segment_size = segment_size
+
+    # The oldest segments are dropped, unshipped or not, to keep the log
+    # under this size. The current segment is always kept.
+    self.max_size = max_size
+
+    # Measurements appended since the last sync, as (series key, timestamp,
+    # value).
+    self.pending = []
+    self.pending_lock = Lock()
+
+    # The sequence numbers and sizes of the segments, oldest first. Guarded
+    # by the condition, which is notified after every sync.
+    self.segments = []
+    self.segment_sizes = {}
+    self.condition = Condition()
+
+    # The segment being written, if the log is being written, and the IDs
+    # given to series keys in it.
+    self.segment_file = None
+    self.series_ids = {}
+
+    # Everything appended before this time, in seconds since the epoch, has
+    # been synced, or dropped if the sync failed. None until the first sync.
+    self.synced_time = None
+
+    self.points_appended = 0
+    self.sync_failures = 0
+    self.segments_evicted = 0
+    self.bytes_evicted = 0
+
+  def open(self, writable=True):
+    """Open the log, cutting off any partly written block at the end of the
+       last segment. A writable log starts a new segment.
+    """
+
+    os.makedirs(self.directory, exist_ok=True)
+
+    for name in os.listdir(self.directory):
+      if name.endswith(SEGMENT_FILE_SUFFIX):
+        sequence = int(name[:-len(SEGMENT_FILE_SUFFIX)])
+        self.segments.append(sequence)
+        self.segment_sizes[sequence] = os.path.getsize(self.segment_path(sequence))
+    self.segments.sort()
+
+    if self.segments:
+      self.recover_segment(self.segments[-1])
+
+    if writable:
+      self.start_segment(self.segments[-1] + 1 if self.segments else 1)
+
+  def recover_segment(self, sequence):
+    path = self.segment_path(sequence)
+    with open(path, 'rb') as fp:
+      end = 0
+      for end, body in read_blocks(fp, 0):
+        pass
+
+    if end < self.segment_sizes[sequence]:
+      print("Cutting off {} bytes of a partly written block in write-ahead log segment {}".format(self.segment_sizes[sequence] - end, path))
+      os.truncate(path, end)
+      self.segment_sizes[sequence] = end
+
+  def segment_path(self, sequence):
+    return os.path.join(self.directory, segment_file_name(sequence))
+
+  def start_segment(self, sequence):
+    # Must be called from the sync thread, or before it starts.
+    if self.segment_file is not None:
+      self.segment_file.close()
+
+    # Unbuffered, so a failed write can't be written again later.
+    self.segment_file = open(self.segment_path(sequence), 'wb', buffering=0)
+    self.series_ids = {}
+
+    with self.condition:
+      self.segments.append(sequence)
+      self.segment_sizes[sequence] = 0
+
+  def append(self, series_key, timestamp, value):
+    """Add a measurement, timestamp in microseconds since the epoch.
+    """
+
+    with self.pending_lock:
+      self.pending.append((series_key, timestamp, value))
+
+  def append_many(self, series_key, timestamps, values):
+    """Add several measurements of a series.
+    """
+
+    with self.pending_lock:
+      self.pending.extend((series_key, timestamp, value) for timestamp, value in zip(timestamps, values))
+
+  def sync(self):
+    """Write and fsync everything appended since the last sync.
+
+       Returns the number of measurements written.
+    """
+
+    sync_time = time.time()
+    with self.pending_lock:
+      pending = self.pending
+      self.pending = []
+
+    if not pending:
+      self.synced_time = sync_time
+
+      return 0
+
+    # Series first seen in these blocks only get their IDs once they are
+    # safely written.
+    blocks = bytearray()
+    series_ids = self.series_ids
+    new_series_ids = {}
+    for start in range(0, len(pending), BLOCK_POINTS):
+      body = bytearray()
+      for series_key, timestamp, value in pending[start:start + BLOCK_POINTS]:
+        series_id = series_ids.get(series_key)
+        if series_id is None:
+          series_id = new_series_ids.get(series_key)
+          if series_id is None:
+            series_id = new_series_ids[series_key] = len(series_ids) + len(new_series_ids)
+            key = series_key.encode('utf-8')
+            body += SERIES_RECORD.pack(RECORD_TYPE_SERIES, series_id, len(key))
+            body += key
+        body += POINT_RECORD.pack(RECORD_TYPE_POINT, series_id, timestamp, value)
+
+      blocks += BLOCK_HEADER.pack(len(body), zlib.crc32(body))
+      blocks += body
+
+    sequence = self.segments[-1]
+    try:
+      if self.segment_file.write(blocks) != len(blocks):
+        raise OSError("Short write to write-ahead log segment {}".format(sequence))
+      os.fsync(self.segment_file.fileno())
+    except OSError:
+      # Cut off whatever part of the block made it, so later blocks follow
+      # straight on from the last good one.
+      self.sync_failures += 1
+      print(traceback.format_exc())
+      print("Could not write {} measurements to the write-ahead log, dropping them".format(len(pending)))
+      self.segment_file.truncate(self.segment_sizes[sequence])
+      self.segment_file.seek(self.segment_sizes[sequence])
+      self.synced_time = sync_time
+
+      return 0
+
+    series_ids.update(new_series_ids)
+    self.points_appended += len(pending)
+
+    with self.condition:
+      self.segment_sizes[sequence] = self.segment_file.tell()
+      self.synced_time = sync_time
+      self.condition.notify_all()
+
+    if self.segment_sizes[sequence] >= self.segment_size:
+      self.start_segment(sequence + 1)
+
+    self.evict_segments()
+
+    return len(pending)
+
+  def evict_segments(self):
+    """Drop the oldest segments while the log is over its maximum size.
+    """
+
+    with self.condition:
+      while len(self.segments) > 1 and sum(self.segment_sizes.values()) > self.max_size:
+        sequence = self.segments.pop(0)
+        size = self.segment_sizes.pop(sequence)
+        self.segments_evicted += 1
+        self.bytes_evicted += size
+        print("Write-ahead log over {} bytes, dropping segment {} of {} bytes".format(self.max_size, sequence, size))
+
+        try:
+          os.remove(self.segment_path(sequence))
+        except FileNotFoundError:
+          pass
+
+  def remove_segments_before(self, sequence):
+    """Remove the segments older than a sequence number, once everything in
+       them has been shipped.
+    """
+
+    with self.condition:
+      while self.segments and self.segments[0] < sequence and self.segments[0] != self.segments[-1]:
+        removed = self.segments.pop(0)
+        self.segment_sizes.pop(removed)
+
+        try:
+          os.remove(self.segment_path(removed))
+        except FileNotFoundError:
+          pass
+
+  def size(self):
+    with self.condition:
+      return sum(self.segment_sizes.values())
+
+  def pending_count(self):
+    return len(self.pending)
+
+  def close(self):
+    """Sync anything still pending and close the current segment.
+    """
+
+    if self.segment_file is not None:
+      self.sync()
+      self.segment_file.close()
+      self.segment_file = None
+
+  def read_checkpoint(self):
+    """Get the shipped position, the segment sequence number and offset.
+    """
+
+    try:
+      with open(os.path.join(self.directory, CHECKPOINT_FILE_NAME), 'rb') as fp:
+        return CHECKPOINT.unpack(fp.read(CHECKPOINT.size))
+    except (FileNotFoundError, struct.error):
+      return 0, 0
+
+  def write_checkpoint(self, sequence, offset):
+    # Replaced in one step, so a crash leaves the old or the new checkpoint.
+    path = os.path.join(self.directory, CHECKPOINT_FILE_NAME)
+    with open(path + ".tmp", 'wb') as fp:
+      fp.write(CHECKPOINT.pack(sequence, offset))
+    os.replace(path + ".tmp", path)
+
+class WalSyncThread(Thread):
+  """Syncs the write-ahead log every sync interval, so many measurements
+     share each fsync.
+  """
+
+  def __init__(self, wal, sync_interval):
+    Thread.__init__(self)
+    self.wal = wal
+    self.sync_interval = sync_interval
+    self.stopped = Event()
+
+  def run(self):
+    # The log is synced a last time when it is closed.
+    while not self.stopped.wait(self.sync_interval):
+      try:
+        self.wal.sync()
+      except:
+        print(traceback.format_exc())
+
+  def stop(self):
+    self.stopped.set()
+
+class WalReader:
+  """Reads the points of a write-ahead log from a position, a block at a
+     time.
+  """
+
+  def __init__(self, wal, sequence, offset):
+    self.wal = wal
+    self.sequence = sequence
+    self.offset = offset
+
+    self.segment_file = None
+    self.series_keys = {}
+
+  def read(self, max_points):
+    """Read whole blocks until there are at least max_points points or
+       nothing more has been synced.
+
+       Returns a list of (series key, timestamp, value). The reader's
+       position moves past them.
+    """
+
+    points = []
+    while len(points) < max_points:
+      with self.wal.condition:
+        segments = list(self.wal.segments)
+        end = self.wal.segment_sizes.get(self.sequence)
+
+      if not segments:
+        break
+
+      if self.sequence < segments[0]:
+        # Never started, or evicted before it was shipped.
+        self.move_to(segments[0])
+        continue
+
+      if self.segment_file is None:
+        if end is None:
+          break
+        self.open_segment()
+
+      read_any = False
+      for self.offset, body in read_blocks(self.segment_file, self.offset, end):
+        parse_block(body, self.series_keys, points)
+        read_any = True
+        if len(points) >= max_points:
+          break
+
+      if len(points) >= max_points or read_any:
+        continue
+
+      later = [sequence for sequence in segments if sequence > self.sequence]
+      if not later:
+        break
+      if end is not None and self.offset < end:
+        print("Skipping the unreadable end of write-ahead log segment {}".format(self.sequence))
+      self.move_to(later[0])
+
+    return points
+
+  def open_segment(self):
+    self.segment_file = open(self.wal.segment_path(self.sequence), 'rb')
+
+    # The series in the part already shipped are still needed.
+    self.series_keys = {}
+    for block_end, body in read_blocks(self.segment_file, 0, self.offset):
+      parse_block(body, self.series_keys)
+
+  def move_to(self, sequence):
+    self.close()
+    self.sequence = sequence
+    self.offset = 0
+
+  def close(self):
+    if self.segment_file is not None:
+      self.segment_file.close()
+      self.segment_file = None
+
+class WalShipperThread(Thread):
+  """Ships the points in the write-ahead log to InfluxDB.
+
+     Normally this keeps up with every sync. While InfluxDB is down the log
+     grows, and once writes work again it is drained in large batches.
+  """
+
+  def __init__(self, wal, persistence, batch_size, retry_delay, max_retry_delay, drain_and_remove=False):
+    Thread.__init__(self)
+    self.wal = wal
+    self.persistence = persistence
+    self.batch_size = batch_size
+
+    # Failed writes are tried again after retry_delay, doubling up to
+    # max_retry_delay while they keep failing.
+    self.retry_delay = retry_delay
+    self.max_retry_delay = max_retry_delay
+
+    # Stop once everything has been shipped and remove the log, for logs
+    # nothing writes to any more.
+    self.drain_and_remove = drain_and_remove
+
+    self.stopped = Event()
+
+  def run(self):
+    wal = self.wal
+    reader = WalReader(wal, *wal.read_checkpoint())
+
+    retry_delay = self.retry_delay
+    points = []
+    while True:
+      if not points:
+        synced_time = wal.synced_time
+        points = reader.read(self.batch_size)
+
+        # Caught up, so everything synced by then has been written.
+        if not points and not self.drain_and_remove:
+          self.persistence.written_time = synced_time
+
+      if not points:
+        if self.stopped.is_set() or self.drain_and_remove:
+          break
+
+        with wal.condition:
+          wal.condition.wait(1.0)
+        continue
+
+      # Logs written before non-finite values were left out at enqueue can
+      # still have them.
+      lines = [self.persistence.create_line(series_key, timestamp, value) for series_key, timestamp, value in points if is_finite_value(value)]
+      self.persistence.points_rejected += len(points) - len(lines)
+
+      try:
+        written = not lines or self.persistence.write_points(lines)
+      except PointsRejectedError as error:
+        # Trying the block again would get it refused again, and the log
+        # would never move past it. InfluxDB has still written any points
+        # in it that it accepted.
+        self.persistence.points_rejected += len(lines)
+        print("InfluxDB refused a block of the write-ahead log, skipping it: {}".format(error))
+        written = True
+
+      if written:
+        points = []
+        retry_delay = self.retry_delay
+
+        wal.write_checkpoint(reader.sequence, reader.offset)
+        wal.remove_segments_before(reader.sequence)
+      elif self.stopped.wait(retry_delay):
+        # What wasn't shipped is shipped on the next start.
+        break
+      else:
+        retry_delay = min(retry_delay * 2, self.max_retry_delay)
+
+    reader.close()
+
+    if self.drain_and_remove and not points:
+      print("Shipped the write-ahead log in {}, removing it".format(wal.directory))
+      shutil.rmtree(wal.directory, ignore_errors=True)
+
+  def stop(self):
+    """Stop once everything synced so far is shipped, or a write fails.
+    """
+
+    self.stopped.set()
+
+    with self.wal.condition:
+      self.wal.condition.notify_all()
@@ -1 +1 @@
-__all__ = ["InfluxEventPersistence"]
+__all__ = ["InfluxEventPersistence", "LocalEventPersistence"]
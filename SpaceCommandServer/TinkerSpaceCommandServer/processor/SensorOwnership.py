@@ -0,0 +1,124 @@
+#
+# Which server node owns each sensor when several nodes share the sensor
+# messages.
+#
+# With MQTT shared subscriptions the broker hands each message to just one of
+# the nodes, so every node hears from every sensor now and then, but none
+# hears everything. The offline state of a sensor is tracked by exactly one
+# node, its owner. The other nodes tell the owner when they last heard from
+# the sensor with activity messages, and the owner tells every node whether
+# the sensor is offline with status messages.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import hashlib
+
+from TinkerSpaceCommandServer import Messages
+from TinkerSpaceCommandServer.comms.MessageCodecs import json_dumps
+
+# Mixed into the hash of sensor IDs for ownership, so which node owns a
+# sensor has nothing to do with which ingest shard processes it.
+OWNERSHIP_HASH_SALT = b'sensor.owner'
+
+class SensorOwnership:
+  """The ownership rule for sensors across a cluster of server nodes.
+
+     Sensors are split between the nodes by a hash of their sensor ID, so
+     every node agrees on the owner without talking to the others. The hash
+     is not the one that splits sensors between ingest shards, otherwise
+     each node would own the sensors of just some of its shards.
+  """
+
+  def __init__(self, node_index, node_count):
+    if not 0 <= node_index < node_count:
+      raise ValueError("Cluster node index {} is not in 0 to {}".format(node_index, node_count - 1))
+
+    self.node_index = node_index
+    self.node_count = node_count
+
+    # Map of sensor IDs to the index of the node that owns them.
+    self.owners = {}
+
+  def get_owner(self, sensor_id):
+    """Get the index of the node that owns a sensor.
+    """
+
+    owner = self.owners.get(sensor_id)
+    if owner is None:
+      digest = hashlib.blake2b(sensor_id.encode('utf-8'), digest_size=8, salt=OWNERSHIP_HASH_SALT).digest()
+      owner = self.owners[sensor_id] = int.from_bytes(digest, 'big') % self.node_count
+
+    return owner
+
+  def owns_sensor(self, sensor_id):
+    return self.node_count == 1 or self.get_owner(sensor_id) == self.node_index
+
+class SensorActivityReporter:
+  """Sends the owners of the sensors this node does not own the times this
+     node last heard from them, and every node the status of the sensors
+     this node owns.
+  """
+
+  def __init__(self, sensor_ownership, entity_registry, publish, activity_topic, status_topic):
+    self.sensor_ownership = sensor_ownership
+    self.entity_registry = entity_registry
+
+    # Called with a topic and a payload to send an activity message.
+    self.publish = publish
+
+    # Each node gets the activity messages for its sensors on this topic
+    # with the node index added, e.g. .../activity/2
+    self.activity_topic = activity_topic
+
+    # Status messages for each sensor go to this topic with the sensor ID
+    # added, and are retained so nodes that start later get them.
+    self.status_topic = status_topic
+
+    # Map of sensor IDs to the (value time, heartbeat time) last reported.
+    self.reported_times = {}
+
+    # Map of sensor IDs to whether the sensor was offline when its status
+    # was last reported.
+    self.reported_offline = {}
+
+  def report(self):
+    """Report every sensor this node does not own that has been heard from
+       since the last report, and every sensor this node owns that has gone
+       offline or come back since the last report.
+    """
+
+    sensor_ownership = self.sensor_ownership
+    for sensor_id, sensor_model in self.entity_registry.sensor_entity_active_models.items():
+      owner = sensor_ownership.get_owner(sensor_id)
+      if owner == sensor_ownership.node_index:
+        self.report_status(sensor_id, sensor_model)
+        continue
+
+      times = (sensor_model.value_last_time_received, sensor_model.heartbeat_last_time_received)
+      if times == (None, None) or self.reported_times.get(sensor_id) == times:
+        continue
+
+      self.reported_times[sensor_id] = times
+      self.publish("{}/{}".format(self.activity_topic, owner), json_dumps({
+        Messages.MESSAGE_FIELD_MESSAGE_TYPE: Messages.MESSAGE_VALUE_MESSAGE_TYPE_ACTIVITY,
+        Messages.MESSAGE_FIELD_SENSOR_ID: sensor_id,
+        Messages.MESSAGE_FIELD_VALUE_TIME: times[0],
+        Messages.MESSAGE_FIELD_HEARTBEAT_TIME: times[1]
+      }))
+
+  def report_status(self, sensor_id, sensor_model):
+    offline = sensor_model.offline_signaled
+    if self.reported_offline.get(sensor_id) == offline:
+      return
+
+    self.reported_offline[sensor_id] = offline
+    self.publish("{}/{}".format(self.status_topic, sensor_id), json_dumps({
+      Messages.MESSAGE_FIELD_MESSAGE_TYPE: Messages.MESSAGE_VALUE_MESSAGE_TYPE_STATUS,
+      Messages.MESSAGE_FIELD_SENSOR_ID: sensor_id,
+      Messages.MESSAGE_FIELD_OFFLINE: offline,
+      Messages.MESSAGE_FIELD_VALUE_TIME: sensor_model.value_last_time_received,
+      Messages.MESSAGE_FIELD_HEARTBEAT_TIME: sensor_model.heartbeat_last_time_received
+    }), True)
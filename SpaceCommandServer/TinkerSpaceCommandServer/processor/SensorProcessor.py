@@ -8,16 +8,125 @@
 # Written by Keith Hughes
 #
 
-from TinkerSpaceCommandServer.events.StandardEvents import SensorChannelMeasurementEvent
+from TinkerSpaceCommandServer.events.EventBus import MeasurementEventBus
+from TinkerSpaceCommandServer.events.StandardEvents import SensorChannelMeasurementEvent, SensorChannelMeasurementBatchEvent
 from TinkerSpaceCommandServer import Messages
 from TinkerSpaceCommandServer import Constants
-from rx.subjects import Subject
-from threading import Thread
+from TinkerSpaceCommandServer.metrics import Metrics
+from threading import Condition, Thread
+import asyncio
+import heapq
+import itertools
 import time
 
+class OfflineDeadlineScheduler:
+  """Tracks when each sensor will go offline if it hears nothing more, so
+     only sensors whose deadline has passed need to be checked.
+
+     The deadlines are kept in a min-heap with at most one entry per sensor.
+     New values and heartbeats do not touch the heap, a sensor's deadline is
+     only recalculated when its entry comes to the top. If it has moved
+     later the sensor is put back with the new deadline, otherwise the
+     sensor is checked for going offline.
+  """
+
+  def __init__(self, resolution):
+    # The minimum time, in seconds, between deadline checks. Deadlines
+    # closer together than this are processed in a single pass.
+    self.resolution = resolution
+
+    # Heap of (deadline, sequence number, sensor active model). The
+    # sequence number keeps models from ever being compared.
+    self.deadlines = []
+    self.sequence = itertools.count()
+
+    self.condition = Condition()
+
+    # An optional function called when an earlier deadline than the current
+    # first one has been scheduled, for waiters that aren't on the
+    # condition.
+    self.wakeup = None
+
+    self.metrics = Metrics.registry
+    self.scan_time = self.metrics.histogram("tinkerspace_offline_scan_seconds", "Time to check the sensors whose offline deadlines have passed.")
+    self.sensors_checked = self.metrics.counter("tinkerspace_offline_sensors_checked_total", "Sensors whose offline deadlines have been checked.")
+    self.offline_transitions = self.metrics.counter("tinkerspace_sensor_offline_transitions_total", "Times a sensor has gone offline.")
+    self.metrics.gauge("tinkerspace_offline_deadlines", "Sensors with a scheduled offline deadline.", lambda: len(self.deadlines))
+
+  def schedule(self, sensor_active_model):
+    """Make sure the sensor has an entry in the deadline heap.
+
+       This is cheap if the sensor is already scheduled.
+    """
+
+    if sensor_active_model.offline_deadline_scheduled:
+      return
+
+    with self.condition:
+      self.push_deadline(sensor_active_model)
+
+  def push_deadline(self, sensor_active_model):
+    # Must be called with the condition held.
+    if sensor_active_model.offline_deadline_scheduled:
+      return
+
+    deadline = sensor_active_model.offline_deadline()
+    if deadline is None:
+      return
+
+    sensor_active_model.offline_deadline_scheduled = True
+    heapq.heappush(self.deadlines, (deadline, next(self.sequence), sensor_active_model))
+
+    if self.deadlines[0][2] is sensor_active_model:
+      self.condition.notify()
+      if self.wakeup is not None:
+        self.wakeup()
+
+  def wait_timeout(self, current_time):
+    """Get how long to wait, in seconds, before the next deadline check.
+
+       Returns None if there are no deadlines.
+    """
+
+    with self.condition:
+      if not self.deadlines:
+        return None
+
+      return max(self.deadlines[0][0] - current_time, self.resolution)
+
+  def process_expired(self, current_time):
+    """Check every sensor whose deadline has passed.
+    """
+
+    start = time.perf_counter()
+
+    expired = []
+    with self.condition:
+      while self.deadlines and self.deadlines[0][0] < current_time:
+        expired.append(heapq.heappop(self.deadlines)[2])
+
+    for sensor_active_model in expired:
+      deadline = sensor_active_model.offline_deadline()
+      if deadline is not None and deadline < current_time:
+        offline_signaled = sensor_active_model.offline_signaled
+        sensor_active_model.check_if_offline_transition(current_time)
+        if sensor_active_model.offline_signaled and not offline_signaled:
+          self.offline_transitions.inc()
+
+      # The scheduled flag is cleared before the deadline is recalculated,
+      # so an update racing with this either sees the flag cleared and
+      # schedules itself, or is seen by the recalculation.
+      with self.condition:
+        sensor_active_model.offline_deadline_scheduled = False
+        self.push_deadline(sensor_active_model)
+
+    # Scans run at most once per resolution period, so are always measured.
+    self.scan_time.observe(time.perf_counter() - start)
+    self.sensors_checked.inc(len(expired))
+
 class SensorProcessorOfflineThread(Thread):
-  """The offline thread periodically checks all sensors to see if they 
-     have gone offline.
+  """The offline thread waits for the next sensor offline deadline and checks
+     the sensors whose deadlines have passed.
   """
   
   def __init__(self, sensor_processor):
@@ -26,38 +135,122 @@ class SensorProcessorOfflineThread(Thread):
     self.running = True
 
   def run(self):
+    scheduler = self.sensor_processor.offline_deadline_scheduler
+
     while self.running:
-      # let's start by sleeping to give sensors a chance to send their first
-      # value before declaring them offline.
-      time.sleep(Constants.SENSOR_OFFLINE_CHECK_DELAY)
-
-      current_time = time.time()
-      # Check heartbeat to see if sensor has gone offline.
-      for active_sensor_model in self.sensor_processor.entity_registry.get_all_sensor_active_models():
-        offline = active_sensor_model.check_if_offline_transition(current_time)
+      with scheduler.condition:
+        if self.running:
+          scheduler.condition.wait(scheduler.wait_timeout(time.time()))
+
+      scheduler.process_expired(time.time())
       
   def stop(self):
-    self.running = False
+    scheduler = self.sensor_processor.offline_deadline_scheduler
+
+    with scheduler.condition:
+      self.running = False
+      scheduler.condition.notify()
     
 class SensorProcessor:
   """The processor that takes sensor messages apart and updates the sensor models.
   """
   
-  def __init__(self, entity_registry):
+  def __init__(self, entity_registry, offline_check_resolution=Constants.SENSOR_OFFLINE_CHECK_RESOLUTION):
     self.entity_registry = entity_registry
 
-    # An RX subject for any sensor measurement
-    self.sensor_measurement_subject = Subject()
+    # The bus measurement events are published on. It binds the handlers
+    # into every channel route so a measurement goes straight to them.
+    self.event_bus = MeasurementEventBus(entity_registry)
+
+    # Map of observers for any sensor measurement to their event bus
+    # subscription.
+    self.sensor_measurement_observers = {}
+
+    self.offline_deadline_scheduler = OfflineDeadlineScheduler(offline_check_resolution)
+    self.sensor_processor_thread = None
+
+    # Which sensors this server node tracks the offline state of, when it is
+    # one of several. None when it tracks every sensor.
+    self.sensor_ownership = None
+
+    # Counts for the metrics, only kept while metrics are enabled.
+    self.measurements_received = 0
+    self.measurement_batches_received = 0
+    self.heartbeats_received = 0
+
+    self.metrics = Metrics.registry
+    self.metrics.counter_function("tinkerspace_measurements_received_total", "Measurement messages received.", lambda: self.measurements_received)
+    self.metrics.counter_function("tinkerspace_measurement_batches_received_total", "Measurement batch messages received.", lambda: self.measurement_batches_received)
+    self.metrics.counter_function("tinkerspace_heartbeats_received_total", "Heartbeat messages received.", lambda: self.heartbeats_received)
+    self.process_measurement_time = self.metrics.histogram("tinkerspace_process_measurement_seconds", "Time to process a measurement message, including observers.")
+    self.process_measurement_batch_time = self.metrics.histogram("tinkerspace_process_measurement_batch_seconds", "Time to process a measurement batch message, including observers.")
+    self.fanout_time = self.metrics.histogram("tinkerspace_observer_fanout_seconds", "Time for all observers to handle a channel measurement event.")
+    self.unknown_sensor_messages = self.metrics.counter("tinkerspace_unknown_sensor_messages_total", "Messages for sensors or channels not in the registry.")
+    self.misrouted_cluster_messages = self.metrics.counter("tinkerspace_misrouted_cluster_messages_total", "Activity and status messages ignored because they did not come on the server node topics.")
 
   def start(self):
+    self.schedule_offline_deadlines()
+
     self.sensor_processor_thread = SensorProcessorOfflineThread(self)
     self.sensor_processor_thread.start()
     
   def stop(self):
-    self.sensor_processor_thread.stop()
+    # Not started when the sensors are processed by ingest shards.
+    if self.sensor_processor_thread is not None:
+      self.sensor_processor_thread.stop()
+
+    self.event_bus.stop()
+
+  async def run_async(self):
+    """Check sensors for going offline as their deadlines pass, on the event
+       loop until cancelled.
+    """
+
+    loop = asyncio.get_running_loop()
+    scheduler = self.offline_deadline_scheduler
+
+    deadline_changed = asyncio.Event()
+    scheduler.wakeup = lambda: loop.call_soon_threadsafe(deadline_changed.set)
+
+    self.schedule_offline_deadlines()
+
+    try:
+      while True:
+        try:
+          await asyncio.wait_for(deadline_changed.wait(), scheduler.wait_timeout(time.time()))
+        except asyncio.TimeoutError:
+          pass
+        deadline_changed.clear()
+
+        scheduler.process_expired(time.time())
+    finally:
+      scheduler.wakeup = None
+
+  def schedule_offline_deadlines(self):
+    """Attach every sensor to the offline deadline scheduler.
+    """
+
+    for active_sensor_model in self.entity_registry.get_all_sensor_active_models():
+      if not self.owns_sensor(active_sensor_model.sensor_entity_description.external_id):
+        continue
+
+      active_sensor_model.offline_deadline_scheduler = self.offline_deadline_scheduler
+      self.offline_deadline_scheduler.schedule(active_sensor_model)
+
+  def owns_sensor(self, sensor_id):
+    return self.sensor_ownership is None or self.sensor_ownership.owns_sensor(sensor_id)
 
   def register_sensor_update_observer(self, observer):
-    self.sensor_measurement_subject.subscribe(observer)
+    """Register an observer of every sensor measurement.
+
+       Use the event bus directly to only observe some sensors, locations or
+       measurement types, or to observe on another thread.
+    """
+
+    self.sensor_measurement_observers[observer] = self.event_bus.subscribe_observer(observer)
+
+  def unregister_sensor_update_observer(self, observer):
+    self.event_bus.unsubscribe(self.sensor_measurement_observers.pop(observer))
     
   def process_sensor_input(self, message, time_received):
     #print("Sensor processor got message {} at time {}".format(message, time_received))
@@ -65,47 +258,125 @@ class SensorProcessor:
     message_type = message[Messages.MESSAGE_FIELD_MESSAGE_TYPE]
 
     if message_type == Messages.MESSAGE_VALUE_MESSAGE_TYPE_MEASUREMENT:
+      if self.metrics.enabled:
+        self.measurements_received += 1
+        if not self.measurements_received % self.metrics.sample_interval:
+          start = time.perf_counter()
+          self.process_measurement(message, time_received, self.fanout_time)
+          self.process_measurement_time.observe(time.perf_counter() - start)
+          return
+
       self.process_measurement(message, time_received)
+    elif message_type == Messages.MESSAGE_VALUE_MESSAGE_TYPE_MEASUREMENT_BATCH:
+      if self.metrics.enabled:
+        self.measurement_batches_received += 1
+        if not self.measurement_batches_received % self.metrics.sample_interval:
+          start = time.perf_counter()
+          self.process_measurement_batch(message, time_received, self.fanout_time)
+          self.process_measurement_batch_time.observe(time.perf_counter() - start)
+          return
+
+      self.process_measurement_batch(message, time_received)
     elif message_type == Messages.MESSAGE_VALUE_MESSAGE_TYPE_HEARTBEAT:
+      if self.metrics.enabled:
+        self.heartbeats_received += 1
+
       self.process_heartbeat(message, time_received)
+    elif message_type == Messages.MESSAGE_VALUE_MESSAGE_TYPE_ACTIVITY or message_type == Messages.MESSAGE_VALUE_MESSAGE_TYPE_STATUS:
+      # Only server nodes send these, on their own topics.
+      if type(message) is not Messages.ClusterMessage:
+        self.misrouted_cluster_messages.inc()
+      elif message_type == Messages.MESSAGE_VALUE_MESSAGE_TYPE_ACTIVITY:
+        self.process_activity(message)
+      else:
+        self.process_status(message)
 
-  def process_measurement(self, message, time_received):
+  def process_measurement(self, message, time_received, fanout_time=None):
     """A measurement message has been received. Process it.
+
+       If fanout_time is given, it is a histogram for timing the observers.
     """
     
     # Get the sensor ID out of the message that has just come in.
     sensor_id = message[Messages.MESSAGE_FIELD_SENSOR_ID]
 
-    # Get the active model for the sensor mentioned in the message.
-    # We then have to check if the sensor ID in the message is for a known
-    # sensor.
-    sensor_active_model = self.entity_registry.get_sensor_active_model(sensor_id)
-    if sensor_active_model is not None:    
-      # The sensor ID was for a known sensor.
-      
-      # Cycle through the data portion of the message, picking up the
-      # channel ID and the data from the channel
-      for channel_id, channel_data in message[Messages.MESSAGE_FIELD_DATA].items():
-
-        # Look up the active channel model for the given channel ID.
-        # Don't assume the channel ID is actually known, but check
-        # that the active channel for the channel ID exists.
-        active_channel = sensor_active_model.get_active_channel_model(channel_id)
-        if active_channel is not None:
-          active_sensed_entity = active_channel.sensed_entity_active_model
-          measurement_type = active_channel.channel_description.measurement_type
-          value = channel_data[Messages.MESSAGE_FIELD_VALUE]
+    channel_routes = self.entity_registry.channel_routes
 
-          sensor_channel_measurement_event = SensorChannelMeasurementEvent(sensor_active_model, active_sensed_entity, active_channel, value, time_received)
-          
-          # Update the value in the active channel
-          active_channel.update_current_value(value, time_received)
+    # Cycle through the data portion of the message, picking up the
+    # channel ID and the data from the channel
+    for channel_id, channel_data in message[Messages.MESSAGE_FIELD_DATA].items():
 
-          self.sensor_measurement_subject.on_next(sensor_channel_measurement_event)
+      # The route has everything needed for the channel. Don't assume the
+      # sensor and channel IDs are actually known, but check that a route
+      # exists.
+      route = channel_routes.get((sensor_id, channel_id))
+      if route is not None:
+        # Compact messages give the value directly rather than in a map.
+        if type(channel_data) is dict:
+          value = channel_data[Messages.MESSAGE_FIELD_VALUE]
         else:
-          print("Sensor {} has unknown channel {}".format(sensor_id, channel_id))
-    else:
-      print("Measurement message for unknown sensor with sensor ID {}".format(sensor_id))
+          value = channel_data
+
+        # Update the value in the active channel
+        route.active_channel.update_current_value(value, time_received)
+
+        if route.observers:
+          sensor_channel_measurement_event = SensorChannelMeasurementEvent(route.sensor_active_model, route.sensed_active_model, route.active_channel, value, time_received)
+          if fanout_time is not None:
+            start = time.perf_counter()
+            self.event_bus.publish(route.observers, sensor_channel_measurement_event)
+            fanout_time.observe(time.perf_counter() - start)
+          else:
+            self.event_bus.publish(route.observers, sensor_channel_measurement_event)
+      elif self.entity_registry.get_sensor_active_model(sensor_id) is None:
+        self.unknown_sensor_messages.inc()
+        print("Measurement message for unknown sensor with sensor ID {}".format(sensor_id))
+        return
+      else:
+        self.unknown_sensor_messages.inc()
+        print("Sensor {} has unknown channel {}".format(sensor_id, channel_id))
+
+  def process_measurement_batch(self, message, time_received, fanout_time=None):
+    """A measurement batch message has been received. Process it.
+
+       Each channel in the data portion has a list of [time offset, value]
+       samples, oldest first. The time offsets are in milliseconds relative
+       to when the message was sent. The channel is updated once with the
+       latest sample and observers get the whole batch as a single event.
+
+       If fanout_time is given, it is a histogram for timing the observers.
+    """
+
+    sensor_id = message[Messages.MESSAGE_FIELD_SENSOR_ID]
+
+    channel_routes = self.entity_registry.channel_routes
+
+    for channel_id, samples in message[Messages.MESSAGE_FIELD_DATA].items():
+      route = channel_routes.get((sensor_id, channel_id))
+      if route is not None:
+        if not samples:
+          continue
+
+        offsets, values = zip(*samples)
+        times_received = [time_received + offset / 1000.0 for offset in offsets]
+
+        route.active_channel.update_current_values(values, times_received)
+
+        if route.observers:
+          batch_event = SensorChannelMeasurementBatchEvent(route.sensor_active_model, route.sensed_active_model, route.active_channel, values, times_received)
+          if fanout_time is not None:
+            start = time.perf_counter()
+            self.event_bus.publish(route.observers, batch_event)
+            fanout_time.observe(time.perf_counter() - start)
+          else:
+            self.event_bus.publish(route.observers, batch_event)
+      elif self.entity_registry.get_sensor_active_model(sensor_id) is None:
+        self.unknown_sensor_messages.inc()
+        print("Measurement batch message for unknown sensor with sensor ID {}".format(sensor_id))
+        return
+      else:
+        self.unknown_sensor_messages.inc()
+        print("Sensor {} has unknown channel {}".format(sensor_id, channel_id))
 
   def process_heartbeat(self, message, time_received):
     """A heartbeat message has been received. Process it.
@@ -124,4 +395,36 @@ class SensorProcessor:
       # Tell the sensor it has received a heartbeat.
       sensor_active_model.heartbeat_received(time_received)
     else:
+      self.unknown_sensor_messages.inc()
       print("Message for unknown sensor with sensor ID {}".format(sensor_id))
+
+  def process_activity(self, message):
+    """Another server node has reported when it last heard from a sensor this
+       node owns.
+    """
+
+    sensor_id = message[Messages.MESSAGE_FIELD_SENSOR_ID]
+
+    sensor_active_model = self.entity_registry.get_sensor_active_model(sensor_id)
+    if sensor_active_model is None:
+      self.unknown_sensor_messages.inc()
+      print("Activity message for unknown sensor with sensor ID {}".format(sensor_id))
+    elif self.owns_sensor(sensor_id):
+      sensor_active_model.activity_reported(message.get(Messages.MESSAGE_FIELD_VALUE_TIME),
+                                            message.get(Messages.MESSAGE_FIELD_HEARTBEAT_TIME))
+
+  def process_status(self, message):
+    """The server node that owns a sensor has reported whether it is
+       offline.
+    """
+
+    sensor_id = message[Messages.MESSAGE_FIELD_SENSOR_ID]
+
+    sensor_active_model = self.entity_registry.get_sensor_active_model(sensor_id)
+    if sensor_active_model is None:
+      self.unknown_sensor_messages.inc()
+      print("Status message for unknown sensor with sensor ID {}".format(sensor_id))
+    elif not self.owns_sensor(sensor_id):
+      sensor_active_model.status_reported(message[Messages.MESSAGE_FIELD_OFFLINE],
+                                          message.get(Messages.MESSAGE_FIELD_VALUE_TIME),
+                                          message.get(Messages.MESSAGE_FIELD_HEARTBEAT_TIME))
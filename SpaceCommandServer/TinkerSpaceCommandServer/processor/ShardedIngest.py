@@ -0,0 +1,422 @@
+#
+# Sharded ingest spreads sensor processing over several worker processes, so
+# it is not held to one CPU core by the GIL.
+#
+# Sensors are split between the shards by a hash of their sensor ID. The
+# server process reads the communication providers and routes each raw
+# message to the shard that owns its sensor over a shared memory queue. Each
+# shard decodes and processes the messages for its own slice of the sensor
+# active models, persists them, and watches its sensors for going offline.
+#
+# The shards send the changes to their sensors back to the server process
+# a few times a second, where they are applied to the full entity registry
+# the web app serves from. Location-level views there see the channels of
+# every shard.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from rx import Observer
+from threading import Thread
+import pickle
+import signal
+import struct
+import time
+import traceback
+import multiprocessing
+import zlib
+
+from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer import Messages
+from TinkerSpaceCommandServer.comms.MessageCodecs import MessageCodecs
+from TinkerSpaceCommandServer.comms.ShardQueue import ShardQueue
+from TinkerSpaceCommandServer.events.StandardEvents import SensorChannelMeasurementBatchEvent
+from TinkerSpaceCommandServer.metrics import Metrics
+
+# The time the message was received and the index of its decoder, in front
+# of the raw message in an ingest frame.
+INGEST_FRAME_HEADER = struct.Struct('<dB')
+
+def shard_for_key(partition_key, shard_count):
+  """Get the index of the shard that owns the sensor with the given
+     partition key, the sensor ID as bytes.
+  """
+
+  return zlib.crc32(partition_key) % shard_count
+
+class ShardStateCollector(Observer):
+  """Collects every measurement a shard processes, until they are sent to the
+     server process.
+  """
+
+  def __init__(self):
+    # Map of (sensor ID, channel ID) to lists of the times and values of the
+    # measurements since the last send.
+    self.pending = {}
+
+  def on_next(self, measurement_event):
+    key = (measurement_event.sensor_active_model.sensor_entity_description.external_id, measurement_event.active_channel.channel_id)
+    samples = self.pending.get(key)
+    if samples is None:
+      samples = self.pending[key] = ([], [])
+
+    if isinstance(measurement_event, SensorChannelMeasurementBatchEvent):
+      samples[0].extend(measurement_event.times_received)
+      samples[1].extend(measurement_event.values)
+    else:
+      samples[0].append(measurement_event.time_received)
+      samples[1].append(measurement_event.value)
+
+  def on_completed(self):
+    pass
+
+  def on_error(self, error):
+    print("Shard state subject Error Occurred: {0}".format(error))
+
+  def take(self):
+    pending = self.pending
+    self.pending = {}
+
+    return pending
+
+class ShardWorker:
+  """One shard, both the worker process and the server's handle on it.
+  """
+
+  def __init__(self, index, shard_count, queue_size, state_interval, context):
+    self.index = index
+    self.shard_count = shard_count
+    self.state_interval = state_interval
+
+    # Raw messages from the server process to the shard, and changes to
+    # sensors from the shard back to the server process.
+    self.ingest_queue = ShardQueue(queue_size, context)
+    self.state_queue = ShardQueue(queue_size, context)
+
+    self.stop_event = context.Event()
+    self.process = None
+
+    # The latest counts sent by the shard.
+    self.messages_processed = 0
+    self.bad_messages = 0
+
+  def owns_sensor(self, sensor_id):
+    return shard_for_key(sensor_id.encode('utf-8'), self.shard_count) == self.index
+
+  def run(self, server):
+    """The worker process.
+
+       Runs until the server sets the stop event, then processes whatever is
+       still queued before stopping.
+    """
+
+    # ^C goes to the whole process group, but the server process decides
+    # when shards stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: self.stop_event.set())
+
+    sensor_processor = server.sensor_processor
+    entity_registry = sensor_processor.entity_registry
+    entity_registry.restrict_to_sensors([sensor_id for sensor_id in entity_registry.sensor_entity_active_models if self.owns_sensor(sensor_id)])
+
+    collector = ShardStateCollector()
+    sensor_processor.register_sensor_update_observer(collector)
+
+    # Backends that can't persist from the shards are left to the server
+    # process.
+    event_persistence = server.event_persistence
+
+    # The rollups of all the shards are kept by the server process.
+    if event_persistence is not None and event_persistence.rollups is not None:
+      sensor_processor.unregister_sensor_update_observer(event_persistence.rollup_observer)
+      event_persistence.rollups = None
+
+    if event_persistence is not None and not event_persistence.persist_in_shards:
+      sensor_processor.unregister_sensor_update_observer(event_persistence.persistence_observer)
+      event_persistence = None
+
+    sensor_processor.start()
+    if event_persistence is not None:
+      event_persistence.wal_shard = self.index
+      event_persistence.start()
+
+    decoders = MessageCodecs().get_decoders()
+
+    # Map of sensor IDs to the version of the sensor last sent.
+    sent_versions = {}
+
+    next_send_time = time.time() + self.state_interval
+    while True:
+      # Anything queued before the stop is still processed.
+      stopping = self.stop_event.is_set()
+
+      for frame in self.ingest_queue.get_frames(max(0, next_send_time - time.time())):
+        try:
+          time_received, decoder_index = INGEST_FRAME_HEADER.unpack_from(frame, 0)
+          message = decoders[decoder_index](frame[INGEST_FRAME_HEADER.size:])
+          sensor_processor.process_sensor_input(message, time_received)
+        except:
+          self.bad_messages += 1
+          print(traceback.format_exc())
+
+        self.messages_processed += 1
+
+      if stopping or time.time() >= next_send_time:
+        self.send_state(entity_registry, collector.take(), sent_versions)
+        next_send_time = time.time() + self.state_interval
+
+      if stopping:
+        break
+
+    sensor_processor.stop()
+    if event_persistence is not None:
+      event_persistence.stop()
+
+  def send_state(self, entity_registry, pending, sent_versions):
+    """Send the measurements since the last send and the state of every
+       sensor that has changed to the server process.
+    """
+
+    channel_updates = [(sensor_id, channel_id, times, values) for (sensor_id, channel_id), (times, values) in pending.items()]
+
+    sensor_updates = []
+    for sensor_id, sensor_model in entity_registry.sensor_entity_active_models.items():
+      if sent_versions.get(sensor_id) != sensor_model.version:
+        sent_versions[sensor_id] = sensor_model.version
+        sensor_updates.append((sensor_id, sensor_model._online, sensor_model.offline_signaled,
+                               sensor_model.value_last_time_received, sensor_model.heartbeat_last_time_received))
+
+    # Large updates are split so no one frame can outgrow the queue. The
+    # sensor states go last, after the measurements that changed them.
+    frame_channels = Constants.SHARD_STATE_FRAME_CHANNELS
+    for start in range(0, len(channel_updates), frame_channels):
+      self.send_state_frame(channel_updates[start:start + frame_channels], [])
+
+    self.send_state_frame([], sensor_updates)
+
+  def send_state_frame(self, channel_updates, sensor_updates):
+    """Send a frame of changes to the server process, split in half until
+       each part fits in the state queue.
+
+       A single channel is split by its measurements, in time order.
+    """
+
+    frame = pickle.dumps((channel_updates, sensor_updates, self.messages_processed, self.bad_messages), pickle.HIGHEST_PROTOCOL)
+    if len(frame) <= self.state_queue.max_frame_size():
+      self.state_queue.put(frame, block=True)
+      return
+
+    if len(channel_updates) + len(sensor_updates) > 1:
+      channels_half = len(channel_updates) // 2
+      sensors_half = len(sensor_updates) // 2
+      self.send_state_frame(channel_updates[:channels_half], sensor_updates[:sensors_half])
+      self.send_state_frame(channel_updates[channels_half:], sensor_updates[sensors_half:])
+    elif channel_updates and len(channel_updates[0][2]) > 1:
+      sensor_id, channel_id, times, values = channel_updates[0]
+      half = len(times) // 2
+      self.send_state_frame([(sensor_id, channel_id, times[:half], values[:half])], [])
+      self.send_state_frame([(sensor_id, channel_id, times[half:], values[half:])], [])
+    else:
+      # Raises, as nothing can make it fit.
+      self.state_queue.put(frame, block=True)
+
+class ShardStateReaderThread(Thread):
+  """Applies the changes sent by a shard to the entity registry of the server
+     process.
+  """
+
+  def __init__(self, sharded_ingest, shard):
+    Thread.__init__(self)
+    self.sharded_ingest = sharded_ingest
+    self.shard = shard
+    self.running = True
+
+  def run(self):
+    # Once stopped, keep going until the shard is done sending.
+    while self.running or self.shard.process.is_alive():
+      for frame in self.shard.state_queue.get_frames(Constants.SHARD_STATE_READ_TIMEOUT):
+        try:
+          self.sharded_ingest.apply_state(self.shard, pickle.loads(frame))
+        except:
+          print(traceback.format_exc())
+
+    for frame in self.shard.state_queue.get_frames(0):
+      self.sharded_ingest.apply_state(self.shard, pickle.loads(frame))
+
+  def stop(self):
+    self.running = False
+
+class ShardRouter:
+  """Takes the place of the ingest queue of the communication providers,
+     sending each raw message to the shard that owns its sensor.
+  """
+
+  def __init__(self, shards):
+    self.shards = shards
+
+    # Map of the decode functions of the providers' codecs to their index.
+    # The shards have the same codecs, so a decoder is sent as its index.
+    self.decoder_indexes = {}
+
+  def add_message_codecs(self, message_codecs):
+    for index, decoder in enumerate(message_codecs.get_decoders()):
+      self.decoder_indexes[decoder] = index
+
+  def start(self):
+    # The shards are started by the server.
+    pass
+
+  def stop(self):
+    pass
+
+  def put(self, partition_key, decode, payload, dt):
+    """Send a raw message to its shard.
+
+       The message is dropped if the shard's queue is full.
+
+       Returns True if the message was queued.
+    """
+
+    if partition_key is None:
+      # The sensor ID could not be found without decoding the message.
+      try:
+        partition_key = decode(payload)[Messages.MESSAGE_FIELD_SENSOR_ID].encode('utf-8')
+      except:
+        partition_key = b''
+
+    shard = self.shards[shard_for_key(partition_key, len(self.shards))]
+
+    return shard.ingest_queue.put(INGEST_FRAME_HEADER.pack(dt, self.decoder_indexes[decode]) + payload)
+
+  def depth(self):
+    """Get the number of bytes of messages waiting for the shards.
+    """
+
+    return sum(shard.ingest_queue.depth() for shard in self.shards)
+
+  def dropped_count(self):
+    return sum(shard.ingest_queue.dropped_count for shard in self.shards)
+
+class ShardedIngest:
+  """Runs the shards for a server and merges their results back into it.
+  """
+
+  def __init__(self, server, shard_count, queue_size, state_interval):
+    self.server = server
+    self.shard_count = shard_count
+
+    # The size in bytes of each of a shard's queues.
+    self.queue_size = queue_size
+
+    # How often, in seconds, shards send their changes.
+    self.state_interval = state_interval
+
+    self.shards = []
+    self.router = None
+    self.reader_threads = []
+
+    self.metrics = Metrics.registry
+    self.metrics.gauge("tinkerspace_shards", "Ingest shard processes.", lambda: len(self.shards))
+    self.metrics.counter_function("tinkerspace_shard_messages_processed_total", "Messages processed by the ingest shards.", lambda: sum(shard.messages_processed for shard in self.shards))
+    self.metrics.counter_function("tinkerspace_shard_bad_messages_total", "Messages the ingest shards could not decode or process.", lambda: sum(shard.bad_messages for shard in self.shards))
+    self.metrics.gauge("tinkerspace_shard_state_queue_bytes", "Bytes of shard changes waiting to be applied.", lambda: sum(shard.state_queue.depth() for shard in self.shards))
+
+  def start_workers(self):
+    """Fork the shard processes.
+
+       Forked processes only get the thread that forked them, so this must
+       be called before the server starts any threads. Everything the server
+       has been set up with so far, the entity registry, sensor processor and
+       persistence, is copied to each shard.
+    """
+
+    context = multiprocessing.get_context('fork')
+
+    self.shards = [ShardWorker(index, self.shard_count, self.queue_size, self.state_interval, context) for index in range(self.shard_count)]
+    for shard in self.shards:
+      shard.process = context.Process(target=shard.run, args=(self.server,), name="shard-{}".format(shard.index), daemon=True)
+      shard.process.start()
+
+    self.router = ShardRouter(self.shards)
+
+  def start(self):
+    """Start merging the shard results and route the communication
+       providers to the shards.
+    """
+
+    sensor_processor = self.server.sensor_processor
+
+    # The shards persist the measurements, the server process only queries
+    # them. Backends that can't be written from the shards are written from
+    # here.
+    event_persistence = self.server.event_persistence
+    if event_persistence is not None and event_persistence.persist_in_shards:
+      sensor_processor.unregister_sensor_update_observer(event_persistence.persistence_observer)
+      event_persistence.written_by_shards = True
+      event_persistence.wal_shard_count = self.shard_count
+
+    for provider in self.server.communicationProviders:
+      self.router.add_message_codecs(provider.message_codecs)
+      provider.ingest_queue = self.router
+
+    for shard in self.shards:
+      reader_thread = ShardStateReaderThread(self, shard)
+      reader_thread.daemon = True
+      self.reader_threads.append(reader_thread)
+      reader_thread.start()
+
+  def stop(self):
+    """Stop the shards once they have processed everything already routed to
+       them.
+    """
+
+    for shard in self.shards:
+      shard.stop_event.set()
+
+    for shard in self.shards:
+      shard.process.join(Constants.SHARD_STOP_TIMEOUT)
+      if shard.process.is_alive():
+        print("Shard {} did not stop, terminating it".format(shard.index))
+        shard.process.terminate()
+        shard.process.join()
+
+    for reader_thread in self.reader_threads:
+      reader_thread.stop()
+      reader_thread.join()
+    self.reader_threads = []
+
+    for shard in self.shards:
+      for shard_queue in [shard.ingest_queue, shard.state_queue]:
+        shard_queue.close()
+        shard_queue.unlink()
+
+  def apply_state(self, shard, state):
+    """Apply the changes sent by a shard to the entity registry.
+
+       Measurements go through the channel routes, so observers in the server
+       process, like live updates, see them just as if they had been
+       processed here.
+    """
+
+    channel_updates, sensor_updates, shard.messages_processed, shard.bad_messages = state
+
+    entity_registry = self.server.sensor_processor.entity_registry
+    channel_routes = entity_registry.channel_routes
+
+    for sensor_id, channel_id, times_received, values in channel_updates:
+      route = channel_routes.get((sensor_id, channel_id))
+      if route is None:
+        continue
+
+      route.active_channel.update_current_values(values, times_received)
+
+      if route.observers:
+        batch_event = SensorChannelMeasurementBatchEvent(route.sensor_active_model, route.sensed_active_model, route.active_channel, values, times_received)
+        self.server.sensor_processor.event_bus.publish(route.observers, batch_event)
+
+    for sensor_id, online, offline_signaled, value_last_time_received, heartbeat_last_time_received in sensor_updates:
+      sensor_model = entity_registry.get_sensor_active_model(sensor_id)
+      if sensor_model is not None:
+        sensor_model.update_status(online, offline_signaled, value_last_time_received, heartbeat_last_time_received)
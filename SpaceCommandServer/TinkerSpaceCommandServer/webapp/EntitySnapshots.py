@@ -0,0 +1,94 @@
+#
+# Cached JSON renderings of sensors and spaces for the web API.
+#
+# Written by Keith M. Hughes
+#
+
+from threading import Lock
+import json
+import time
+
+class EntitySnapshotCache:
+    """Keeps the JSON for each sensor from the last time it was rendered, and
+       only renders a sensor again when its version has changed.
+
+       Each response also gets an entity tag, so clients can ask whether
+       anything has changed without getting the whole response again.
+    """
+
+    def __init__(self, entity_registry, render_sensor_data, render_space_data):
+        self.entity_registry = entity_registry
+        self.render_sensor_data = render_sensor_data
+        self.render_space_data = render_space_data
+
+        # Versions start again from the beginning when the server restarts,
+        # so tags also carry when the cache was made.
+        self.tag_prefix = '{:x}'.format(int(time.time() * 1000))
+
+        # Map of sensor IDs to (version, JSON) for the sensor.
+        self.sensor_fragments = {}
+
+        # The JSON for the list of all sensors and the registry version it
+        # was made at.
+        self.sensors_version = None
+        self.sensors_json = None
+
+        # Spaces do not change once the registry is loaded.
+        self.spaces_json = None
+
+        self.lock = Lock()
+
+    def get_sensor(self, sensor_model):
+        """Get the JSON for a sensor and its entity tag.
+        """
+
+        with self.lock:
+            version, sensor_json = self.get_sensor_fragment(sensor_model)
+
+        # The tag is for the version the JSON was rendered at, which may be
+        # older than the sensor is now.
+        return sensor_json, self.create_tag('sensor', version)
+
+    def get_sensors(self):
+        """Get the JSON for the list of all sensors and its entity tag.
+        """
+
+        version = self.entity_registry.model_versions.latest
+        with self.lock:
+            if self.sensors_version != version:
+                fragments = [self.get_sensor_fragment(sensor_model)[1] for sensor_model in self.entity_registry.sensor_entity_active_models.values()]
+                self.sensors_json = b'[' + b', '.join(fragments) + b']'
+                self.sensors_version = version
+
+            return self.sensors_json, self.create_tag('sensors', version)
+
+    def get_spaces(self):
+        """Get the JSON for the list of all spaces and its entity tag.
+        """
+
+        with self.lock:
+            if self.spaces_json is None:
+                space_models = self.entity_registry.sensed_entity_active_models.values()
+                self.spaces_json = json.dumps([self.render_space_data(space_model) for space_model in space_models]).encode('utf-8')
+
+            return self.spaces_json, self.create_tag('spaces', 0)
+
+    def get_sensor_fragment(self, sensor_model):
+        """Get the (version, JSON) for a sensor, rendering it again if it
+           has changed. Must be called with the lock held.
+        """
+
+        sensor_id = sensor_model.sensor_entity_description.external_id
+
+        # Read the version before rendering, so a change made while rendering
+        # makes the fragment out of date rather than being missed.
+        version = sensor_model.version
+        fragment = self.sensor_fragments.get(sensor_id)
+        if fragment is None or fragment[0] != version:
+            fragment = (version, json.dumps(self.render_sensor_data(sensor_model)).encode('utf-8'))
+            self.sensor_fragments[sensor_id] = fragment
+
+        return fragment
+
+    def create_tag(self, kind, version):
+        return '{}-{}-{}'.format(self.tag_prefix, kind, version)
@@ -0,0 +1,195 @@
+#
+# Live measurement updates pushed to web clients as Server-Sent Events.
+#
+# Written by Keith M. Hughes
+#
+
+from rx import Observer
+from threading import Condition, Lock
+import time
+
+from TinkerSpaceCommandServer.comms.MessageCodecs import json_dumps
+
+class LiveUpdateClient:
+    """A connected web client and the updates waiting to be sent to it.
+
+       Only the latest value of each channel is kept, so a client that reads
+       slowly gets fewer updates rather than a growing backlog.
+    """
+
+    def __init__(self, sensor_ids=None):
+        # The sensors the client wants updates for, or None for all.
+        self.sensor_ids = sensor_ids
+
+        # Map of (sensor ID, channel ID) to the latest update for it.
+        self.pending = {}
+        self.condition = Condition()
+        self.closed = False
+
+        # When the client last took its updates.
+        self.last_taken = time.time()
+
+    def add_update(self, key, update):
+        with self.condition:
+            was_empty = not self.pending
+            self.pending[key] = update
+            if was_empty:
+                self.condition.notify()
+
+    def take_updates(self, timeout):
+        """Take the waiting updates, waiting up to timeout seconds for some.
+
+           Returns an empty list if none came in.
+        """
+
+        with self.condition:
+            if not self.pending and not self.closed:
+                self.condition.wait(timeout)
+
+            updates = list(self.pending.values())
+            self.pending = {}
+            self.last_taken = time.time()
+
+        return updates
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+class LiveUpdateHub(Observer):
+    """Takes sensor measurements from the sensor processor and hands them to
+       every connected live update client.
+    """
+
+    def __init__(self, max_rate, max_clients, keepalive_interval, client_timeout):
+        # The most batches of updates sent to a client per second.
+        self.min_send_interval = 1.0 / max_rate
+
+        self.max_clients = max_clients
+        self.keepalive_interval = keepalive_interval
+
+        # How long a client can go without taking its updates before it is
+        # considered gone.
+        self.client_timeout = client_timeout
+
+        # Replaced rather than changed, so on_next never needs the lock.
+        self.clients = ()
+        self.lock = Lock()
+
+        self.sensor_processor = None
+
+    def attach_sensor_processor(self, sensor_processor):
+        self.sensor_processor = sensor_processor
+        sensor_processor.register_sensor_update_observer(self)
+
+    def on_next(self, measurement_event):
+        clients = self.clients
+        if not clients:
+            return
+
+        sensor_id = measurement_event.sensor_active_model.sensor_entity_description.external_id
+        channel_id = measurement_event.active_channel.channel_id
+        update = {
+            'sensorId': sensor_id,
+            'channelId': channel_id,
+            'value': measurement_event.value,
+            'timestamp': int(measurement_event.time_received * 1000)
+        }
+
+        key = (sensor_id, channel_id)
+        for client in clients:
+            if client.sensor_ids is None or sensor_id in client.sensor_ids:
+                client.add_update(key, update)
+
+    def on_completed(self):
+        pass
+
+    def on_error(self, error):
+        print("Live update subject Error Occurred: {0}".format(error))
+
+    def add_client(self, sensor_ids=None):
+        """Add a new client.
+
+           Returns None if there are already too many clients.
+        """
+
+        with self.lock:
+            # Clients stuck on a dead connection never take their updates,
+            # so make room by dropping them.
+            current_time = time.time()
+            for client in self.clients:
+                if current_time - client.last_taken > self.client_timeout:
+                    client.close()
+            self.clients = tuple(client for client in self.clients if not client.closed)
+
+            if len(self.clients) >= self.max_clients:
+                return None
+
+            client = LiveUpdateClient(sensor_ids)
+            self.clients = self.clients + (client,)
+
+            return client
+
+    def remove_client(self, client):
+        client.close()
+
+        with self.lock:
+            self.clients = tuple(other for other in self.clients if other is not client)
+
+    def create_snapshot(self, sensor_ids=None):
+        """Get the current value of every channel, for a client that has just
+           connected.
+        """
+
+        updates = []
+        for sensor_model in self.sensor_processor.entity_registry.get_all_sensor_active_models():
+            sensor_id = sensor_model.sensor_entity_description.external_id
+            if sensor_ids is not None and sensor_id not in sensor_ids:
+                continue
+
+            for channel in sensor_model.get_active_channels():
+                if channel.current_value is None:
+                    continue
+
+                updates.append({
+                    'sensorId': sensor_id,
+                    'channelId': channel.channel_id,
+                    'value': channel.current_value,
+                    'timestamp': int(channel.time_last_update * 1000)
+                })
+
+        return updates
+
+    def stream_events(self, client):
+        """Generate the Server-Sent Events for a client until it goes away.
+
+           A snapshot event with every current value is sent first, then
+           update events with the channels that have changed since the last
+           one, at most max_rate times a second.
+        """
+
+        try:
+            yield self.create_event('snapshot', self.create_snapshot(client.sensor_ids))
+
+            last_sent = 0
+            while not client.closed:
+                # Wait out the rest of the send interval, letting updates
+                # coalesce in the meantime.
+                remaining = last_sent + self.min_send_interval - time.time()
+                if remaining > 0:
+                    time.sleep(remaining)
+
+                updates = client.take_updates(self.keepalive_interval)
+                if updates:
+                    last_sent = time.time()
+                    yield self.create_event('update', updates)
+                else:
+                    # A comment keeps proxies from closing the connection and
+                    # finds clients that have gone away.
+                    yield b': keepalive\n\n'
+        finally:
+            self.remove_client(client)
+
+    def create_event(self, event_type, updates):
+        return b'event: ' + event_type.encode('utf-8') + b'\ndata: ' + json_dumps(updates) + b'\n\n'
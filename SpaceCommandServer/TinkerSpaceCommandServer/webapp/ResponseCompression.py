@@ -0,0 +1,111 @@
+#
+# Compression of web app responses and precompressed static assets.
+#
+# Written by Keith M. Hughes
+#
+
+import gzip
+import mimetypes
+import os
+
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The file name suffixes of precompressed static assets for each content
+# encoding, in order of preference.
+PRECOMPRESSED_SUFFIXES = [('br', '.br'), ('gzip', '.gz')]
+
+class ResponseCompressor:
+    """Compresses responses with brotli or gzip for clients that accept them.
+
+       Brotli needs the optional brotli package, gzip is always available.
+    """
+
+    def __init__(self, minimum_size, gzip_level, brotli_quality):
+        # Responses smaller than this many bytes are sent as they are.
+        self.minimum_size = minimum_size
+
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def select_encoding(self):
+        """Get the content encoding to use for the current request, or None if
+           the client does not accept any that are available.
+        """
+
+        accept_encodings = request.accept_encodings
+        if brotli is not None and accept_encodings['br']:
+            return 'br'
+        if accept_encodings['gzip']:
+            return 'gzip'
+
+        return None
+
+    def compress_response(self, response):
+        """Compress a response if it is worth doing.
+
+           Meant as a Flask after_request function. Streamed responses are left
+           alone so every chunk still reaches the client as soon as it is made,
+           as are files, which are precompressed instead.
+        """
+
+        if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        body = response.get_data()
+        if len(body) < self.minimum_size:
+            return response
+
+        encoding = self.select_encoding()
+        if encoding is None:
+            return response
+
+        if encoding == 'br':
+            body = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            body = gzip.compress(body, compresslevel=self.gzip_level)
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+
+        # The compressed body is not byte for byte the same as the original,
+        # so the entity tag can only be a weak one.
+        tag, is_weak = response.get_etag()
+        if tag is not None and not is_weak:
+            response.set_etag(tag, weak=True)
+
+        return response
+
+    def send_static_asset(self, directory, path, max_age):
+        """Send a file from the static bundle, using a precompressed copy of it
+           if the build made one the client accepts.
+
+           The bundle's file names change whenever their contents do, so they
+           can be cached for max_age seconds and never checked again.
+        """
+
+        response = None
+
+        accept_encodings = request.accept_encodings
+        for encoding, suffix in PRECOMPRESSED_SUFFIXES:
+            if accept_encodings[encoding] and os.path.isfile(os.path.join(directory, path + suffix)):
+                mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+                response = send_from_directory(directory, path + suffix, mimetype=mimetype, max_age=max_age)
+                response.headers['Content-Encoding'] = encoding
+                break
+
+        if response is None:
+            response = send_from_directory(directory, path, max_age=max_age)
+
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+
+        return response
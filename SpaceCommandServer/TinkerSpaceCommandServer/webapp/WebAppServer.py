@@ -4,11 +4,22 @@
 # Written by Keith M. Hughes
 #
 
-from flask import Flask, Response, render_template, request, send_from_directory
+from flask import Flask, Response, render_template, request, stream_with_context
 from flask_cors import CORS
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import asyncio
 import os
 import json
 import datetime
+import time
+
+from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.comms.MessageCodecs import json_dumps
+from TinkerSpaceCommandServer.metrics import Metrics
+from TinkerSpaceCommandServer.webapp.EntitySnapshots import EntitySnapshotCache
+from TinkerSpaceCommandServer.webapp.LiveUpdates import LiveUpdateHub
+from TinkerSpaceCommandServer.webapp.ResponseCompression import ResponseCompressor
 
 class WebAppServer:
 
@@ -33,6 +44,44 @@ class WebAppServer:
         
         self.app = Flask(name, template_folder=self.template_dir, static_folder=self.static_dir)
 
+        webapp_config = server.config.get("webapp", {})
+
+        # How the web app is served.
+        server_config = webapp_config.get("server", {})
+        self.serving_mode = server_config.get("mode", Constants.WEBAPP_SERVING_MODE_DEVELOPMENT)
+        self.host = server_config.get("host", Constants.WEBAPP_HOST)
+        self.port = server_config.get("port", Constants.WEBAPP_PORT)
+        self.threads = server_config.get("threads", Constants.WEBAPP_THREADS)
+        self.connection_limit = server_config.get("connectionLimit", Constants.WEBAPP_CONNECTION_LIMIT)
+        self.keep_alive_timeout = server_config.get("keepAliveTimeout", Constants.WEBAPP_KEEP_ALIVE_TIMEOUT)
+
+        # The HTTP server and the thread it runs on, when started on its own
+        # thread.
+        self.http_server = None
+        self.server_thread = None
+
+        compression_config = webapp_config.get("compression", {})
+        self.response_compressor = ResponseCompressor(
+            compression_config.get("minimumSize", Constants.WEBAPP_COMPRESSION_MINIMUM_SIZE),
+            compression_config.get("gzipLevel", Constants.WEBAPP_COMPRESSION_GZIP_LEVEL),
+            compression_config.get("brotliQuality", Constants.WEBAPP_COMPRESSION_BROTLI_QUALITY))
+        if compression_config.get("enabled", True):
+            self.app.after_request(self.response_compressor.compress_response)
+
+        self.static_max_age = webapp_config.get("staticMaxAge", Constants.WEBAPP_STATIC_MAX_AGE)
+
+        # Pushes measurements to clients of the live endpoint.
+        live_config = webapp_config.get("liveUpdates", {})
+        self.live_update_hub = LiveUpdateHub(
+            live_config.get("maxRate", Constants.LIVE_UPDATE_MAX_RATE),
+            live_config.get("maxClients", Constants.LIVE_UPDATE_MAX_CLIENTS),
+            live_config.get("keepaliveInterval", Constants.LIVE_UPDATE_KEEPALIVE_INTERVAL),
+            live_config.get("clientTimeout", Constants.LIVE_UPDATE_CLIENT_TIMEOUT))
+
+        # The JSON for sensors and spaces, made once the sensor processor is
+        # attached.
+        self.entity_snapshots = None
+
         # Set up CORS headers on all API URLs
         CORS(self.app, resources={r"/api/*": {"origins": "*" }})
         
@@ -41,12 +90,80 @@ class WebAppServer:
         self.add_endpoint("/static/css/<path:path>","cssroot", self.cssroot_endpoint)
         self.add_endpoint("/api/v1/spaces","api_v1_spaces", self.api_v1_spaces_endpoint)
         self.add_endpoint("/api/v1/space/<string:space_id>","api_v1_space", self.api_v1_space_endpoint)
+        self.add_endpoint("/api/v1/space/<string:space_id>/values","api_v1_space_values", self.api_v1_space_values_endpoint)
         self.add_endpoint("/api/v1/sensors","api_v1_sensors", self.api_v1_sensors_endpoint)
         self.add_endpoint("/api/v1/sensor/<string:sensor_id>","api_v1_sensor", self.api_v1_sensor_endpoint)
         self.add_endpoint("/api/v1/query/sensor/<string:sensor_id>","api_v1_query_sensor", self.api_v1_query_sensor_endpoint)
+        self.add_endpoint("/api/v1/query/space/<string:space_id>","api_v1_query_space", self.api_v1_query_space_endpoint)
+        self.add_endpoint("/api/v1/history/sensor/<string:sensor_id>","api_v1_history_sensor", self.api_v1_history_sensor_endpoint)
+        self.add_endpoint("/api/v1/metrics","api_v1_metrics", self.api_v1_metrics_endpoint)
+        self.add_endpoint("/api/v1/live","api_v1_live", self.api_v1_live_endpoint)
+
+    def attach_sensor_processor(self, sensor_processor):
+        self.live_update_hub.attach_sensor_processor(sensor_processor)
+        self.entity_snapshots = EntitySnapshotCache(sensor_processor.entity_registry, self.render_sensor_data, self.render_space_data)
 
     def start(self):
-        self.app.run(host='0.0.0.0')
+        """Start serving the web app on its own thread.
+
+           The production mode needs the optional waitress package, and
+           falls back to the development server without it.
+        """
+        create_server = None
+        if self.serving_mode == Constants.WEBAPP_SERVING_MODE_PRODUCTION:
+            try:
+                from waitress.server import create_server
+            except ImportError:
+                print("The production web server needs waitress, install TinkerSpaceCommandServer[production]. Using the development server")
+
+        if create_server is not None:
+            # Waitress keeps connections alive between requests until they
+            # have been idle for the channel timeout.
+            self.http_server = create_server(
+                self.app, host=self.host, port=self.port, threads=self.threads,
+                connection_limit=self.connection_limit, channel_timeout=self.keep_alive_timeout,
+                ident='TinkerSpaceCommand')
+            target = self.http_server.run
+        else:
+            target = lambda: self.app.run(host=self.host, port=self.port, threaded=True, use_reloader=False)
+
+        self.server_thread = Thread(target=target, name='webapp', daemon=True)
+        self.server_thread.start()
+
+    def stop(self):
+        # The development server cannot be stopped, it goes when the process
+        # does.
+        if self.http_server is not None:
+            self.http_server.close()
+            self.http_server = None
+
+    async def run_async(self):
+        """Serve the web app as an ASGI application on the running event loop
+           until cancelled.
+
+           Needs the optional hypercorn and asgiref packages.
+        """
+        from asgiref.wsgi import WsgiToAsgi
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = ['{}:{}'.format(self.host, self.port)]
+        config.keep_alive_timeout = self.keep_alive_timeout
+        config.backlog = self.connection_limit
+
+        # Requests are handled by the WSGI app on the loop's default executor.
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.threads))
+
+        shutdown_event = asyncio.Event()
+        serve_task = asyncio.ensure_future(serve(WsgiToAsgi(self.app), config, shutdown_trigger=shutdown_event.wait))
+        try:
+            await asyncio.shield(serve_task)
+        except asyncio.CancelledError:
+            # Let open requests finish before giving up the loop.
+            shutdown_event.set()
+            await serve_task
+            raise
 
     def add_endpoint(self, endpoint=None, endpoint_name=None, handler=None):
         self.app.add_url_rule(endpoint, endpoint_name, handler)
@@ -55,28 +172,22 @@ class WebAppServer:
         return self.app.send_static_file('index.html')
 
     def jsroot_endpoint(self, path=None, *args):
-        print(path)
-        return send_from_directory(self.js_static_dir, path)
+        return self.response_compressor.send_static_asset(self.js_static_dir, path, self.static_max_age)
 
     def cssroot_endpoint(self, path=None, *args):
-        print(path)
-        return send_from_directory(self.css_static_dir, path)
+        return self.response_compressor.send_static_asset(self.css_static_dir, path, self.static_max_age)
 
     def api_v1_spaces_endpoint(self, *args):
-        space_models = self.server.sensor_processor.entity_registry.sensed_entity_active_models.values()
-        
-        all_space_data = []
-        for space_model in space_models:
-            all_space_data.append(self.render_space_data(space_model))
+        all_space_data, tag = self.entity_snapshots.get_spaces()
 
-        return Response(json.dumps(all_space_data), status=200, headers={'ContentType': 'application/json'})
+        return self.create_conditional_response(all_space_data, tag)
 
     def api_v1_space_endpoint(self, space_id=None, *args):
         space = self.server.sensor_processor.entity_registry.get_sensed_active_model(space_id)
         
         value = self.render_space_data(space)
 
-        return Response(json.dumps(value), status=200, headers={'ContentType': 'application/json'})
+        return Response(json.dumps(value), status=200, content_type='application/json')
 
     def render_space_data(self, space):
         space_data = {
@@ -86,22 +197,68 @@ class WebAppServer:
         }
 
         return space_data
+
+    def api_v1_space_values_endpoint(self, space_id=None, *args):
+        """Summarize the current values of every measurement type at a space,
+           over all of the sensors measuring it.
+
+           The measurementType argument limits the result to one measurement
+           type.
+        """
+        space = self.server.sensor_processor.entity_registry.get_sensed_active_model(space_id)
+        if space is None:
+            return Response(json.dumps({'error': 'Unknown space'}), status=404, content_type='application/json')
+
+        measurement_type = request.args.get('measurementType')
+        if measurement_type is None:
+            summaries = space.get_value_summaries()
+        else:
+            summary = space.get_value_summary(measurement_type)
+            if summary is None:
+                return Response(json.dumps({'error': 'No sensors measure that measurement type'}), status=404, content_type='application/json')
+            summaries = [summary]
+
+        result = {
+            'externalId': space.sensed_entity_description.external_id,
+            'values': [self.render_value_summary(summary) for summary in summaries]
+        }
+
+        return Response(json.dumps(result), status=200, content_type='application/json')
+
+    def render_value_summary(self, summary):
+        return {
+            'measurementType': summary.measurement_type,
+            'channelCount': summary.channel_count,
+            'freshChannelCount': summary.count,
+            'mean': summary.mean,
+            'min': summary.minimum,
+            'max': summary.maximum,
+            'currentValue': summary.current_value,
+            'timeLastUpdate': None if summary.time_last_update is None else int(summary.time_last_update * 1000)
+        }
     
     def api_v1_sensors_endpoint(self, *args):
-        sensor_models = self.server.sensor_processor.entity_registry.sensor_entity_active_models.values()
+        all_sensor_data, tag = self.entity_snapshots.get_sensors()
 
-        all_sensor_data = []
-        for sensor_model in sensor_models:
-            all_sensor_data.append(self.render_sensor_data(sensor_model))
-        
-        return Response(json.dumps(all_sensor_data), status=200, headers={'ContentType': 'application/json'})
+        return self.create_conditional_response(all_sensor_data, tag)
 
     def api_v1_sensor_endpoint(self, sensor_id=None, *args):
         sensor_model = self.server.sensor_processor.entity_registry.get_sensor_active_model(sensor_id)
-        
-        sensor_result = self.render_sensor_data(sensor_model)
+        if sensor_model is None:
+            return Response(json.dumps({'error': 'Unknown sensor'}), status=404, content_type='application/json')
+
+        sensor_result, tag = self.entity_snapshots.get_sensor(sensor_model)
+
+        return self.create_conditional_response(sensor_result, tag)
 
-        return Response(json.dumps(sensor_result), status=200, headers={ 'ContentType': 'application/json'})
+    def create_conditional_response(self, body, tag):
+        """Create a response with an entity tag, which is a 304 Not Modified
+           with no body if the client already has that tag.
+        """
+        response = Response(body, status=200, content_type='application/json')
+        response.set_etag(tag)
+
+        return response.make_conditional(request)
 
     def render_sensor_data(self, sensor_model):
         active_channels = []
@@ -129,13 +286,176 @@ class WebAppServer:
         return sensor_data
 
     def api_v1_query_sensor_endpoint(self, sensor_id=None, *args):
+        """Query the stored measurements for a sensor channel.
+
+           The optional resolution (seconds), maxPoints and aggregate arguments
+           have the measurements downsampled on the server.
+
+           The format argument can ask for every point to be streamed, as
+           newline delimited JSON objects with ndjson or as a JSON array with
+           jsonArray, rather than collected into a single JSON object.
+
+           The channel argument can be given more than once, to query several
+           channels of the sensor together. The result then has the result
+           for each channel, by channel ID.
+        """
         sensor = self.server.sensor_processor.entity_registry.get_sensor_active_model(sensor_id)
 
-        channel = request.args['channel']
+        channels = request.args.getlist('channel')
+        if not channels:
+            return Response(json.dumps({'error': 'channel is required'}), status=400, content_type='application/json')
+        channel = channels[0]
         startDateTime = request.args['startDateTime']
         endDateTime = request.args['endDateTime']
 
-        result = self.server.event_persistence.get_sensor_channel_measurements(sensor_id, channel, startDateTime, endDateTime)
+        resolution = request.args.get('resolution', type=float)
+        if resolution is not None and resolution <= 0:
+            return Response(json.dumps({'error': 'resolution must be positive'}), status=400, content_type='application/json')
+
+        max_points = request.args.get('maxPoints', type=int)
+        if max_points is not None and max_points <= 0:
+            return Response(json.dumps({'error': 'maxPoints must be positive'}), status=400, content_type='application/json')
+
+        aggregate = request.args.get('aggregate')
+        if aggregate is not None and aggregate not in Constants.QUERY_AGGREGATES:
+            return Response(json.dumps({'error': 'aggregate must be one of {}'.format(', '.join(Constants.QUERY_AGGREGATES))}), status=400, content_type='application/json')
+
+        query_format = request.args.get('format', Constants.QUERY_FORMAT_JSON)
+        if query_format not in Constants.QUERY_FORMATS:
+            return Response(json.dumps({'error': 'format must be one of {}'.format(', '.join(Constants.QUERY_FORMATS))}), status=400, content_type='application/json')
+
+        if query_format != Constants.QUERY_FORMAT_JSON:
+            if len(channels) > 1:
+                return Response(json.dumps({'error': 'Streamed formats give a single channel'}), status=400, content_type='application/json')
+
+            if resolution is not None or max_points is not None or aggregate is not None:
+                return Response(json.dumps({'error': 'Streamed formats give every point, so cannot be downsampled'}), status=400, content_type='application/json')
+
+            chunks = self.server.event_persistence.iter_sensor_channel_measurements(sensor_id, channel, startDateTime, endDateTime)
+            if query_format == Constants.QUERY_FORMAT_NDJSON:
+                return Response(stream_with_context(self.stream_ndjson_measurements(chunks)), status=200, content_type='application/x-ndjson')
+            else:
+                return Response(stream_with_context(self.stream_json_array_measurements(chunks)), status=200, content_type='application/json')
+
+        if len(channels) > 1:
+            results = self.server.event_persistence.get_sensor_channels_measurements(sensor_id, channels, startDateTime, endDateTime, resolution, max_points, aggregate)
+            result = {'channels': dict(zip(channels, results))}
+        else:
+            result = self.server.event_persistence.get_sensor_channel_measurements(sensor_id, channel, startDateTime, endDateTime, resolution, max_points, aggregate)
         
-        return Response(json.dumps(result), status=200, headers={ 'ContentType': 'application/json'})
+        return Response(json.dumps(result), status=200, content_type='application/json')
+
+
+    def api_v1_query_space_endpoint(self, space_id=None, *args):
+        """Query the stored measurements of a measurement type at a space,
+           aggregated over all of the sensors measuring it.
+
+           The arguments are the same as for a sensor query, with a
+           measurementType argument rather than a channel. The measurements
+           are always aggregated, and there is no streaming.
+        """
+        space = self.server.sensor_processor.entity_registry.get_sensed_active_model(space_id)
+        if space is None:
+            return Response(json.dumps({'error': 'Unknown space'}), status=404, content_type='application/json')
+
+        measurement_type = request.args['measurementType']
+        active_channels = space.get_measurement_type_channels(measurement_type)
+        if not active_channels:
+            return Response(json.dumps({'error': 'No sensors measure that measurement type'}), status=404, content_type='application/json')
+
+        startDateTime = request.args['startDateTime']
+        endDateTime = request.args['endDateTime']
+
+        resolution = request.args.get('resolution', type=float)
+        if resolution is not None and resolution <= 0:
+            return Response(json.dumps({'error': 'resolution must be positive'}), status=400, content_type='application/json')
+
+        max_points = request.args.get('maxPoints', type=int)
+        if max_points is not None and max_points <= 0:
+            return Response(json.dumps({'error': 'maxPoints must be positive'}), status=400, content_type='application/json')
+
+        aggregate = request.args.get('aggregate')
+        if aggregate is not None and aggregate not in Constants.QUERY_AGGREGATES:
+            return Response(json.dumps({'error': 'aggregate must be one of {}'.format(', '.join(Constants.QUERY_AGGREGATES))}), status=400, content_type='application/json')
+
+        channels = [(channel.sensor_entity_active_model.sensor_entity_description.external_id, channel.channel_id) for channel in active_channels]
+
+        result = self.server.event_persistence.get_location_measurements(space_id, measurement_type, channels, startDateTime, endDateTime, resolution, max_points, aggregate)
+
+        return Response(json.dumps(result), status=200, content_type='application/json')
+
+    def stream_ndjson_measurements(self, chunks):
+        """Encode chunks of measurement rows as newline delimited JSON, one
+           chunk at a time.
+        """
+        for rows in chunks:
+            yield b''.join(json_dumps({'timestamp': timestamp, 'sensed': sensed, 'value': value}) + b'\n' for timestamp, sensed, value in rows)
+
+    def stream_json_array_measurements(self, chunks):
+        """Encode chunks of measurement rows as a JSON array, one chunk at a
+           time.
+        """
+        yield b'['
+
+        separator = b''
+        for rows in chunks:
+            yield separator + b','.join(json_dumps({'timestamp': timestamp, 'sensed': sensed, 'value': value}) for timestamp, sensed, value in rows)
+            separator = b','
+
+        yield b']'
+
+    def api_v1_history_sensor_endpoint(self, sensor_id=None, *args):
+        """Get the recent measurements for a sensor channel from memory.
+
+           The channel is given by the channel argument. The seconds argument
+           limits the result to the last that many seconds.
+        """
+        sensor = self.server.sensor_processor.entity_registry.get_sensor_active_model(sensor_id)
+        if sensor is None:
+            return Response(json.dumps({'error': 'Unknown sensor'}), status=404, content_type='application/json')
+
+        channel = sensor.get_active_channel_model(request.args['channel'])
+        if channel is None:
+            return Response(json.dumps({'error': 'Unknown channel'}), status=404, content_type='application/json')
+
+        seconds = request.args.get('seconds', type=float)
+        start_time = time.time() - seconds if seconds is not None else None
+
+        timestamps, values = channel.get_history(start_time)
+
+        result = {
+            'data': {
+                'timestamp': timestamps.tolist(),
+                'value': values.tolist()
+            }
+        }
+
+        return Response(json.dumps(result), status=200, content_type='application/json')
+
+    def api_v1_metrics_endpoint(self, *args):
+        """Get the server metrics in the Prometheus text format.
+        """
+        if not Metrics.registry.enabled:
+            return Response(json.dumps({'error': 'Metrics are disabled'}), status=404, content_type='application/json')
+
+        return Response(Metrics.registry.render_prometheus(), status=200, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def api_v1_live_endpoint(self, *args):
+        """Push measurements to the client as Server-Sent Events.
+
+           Only channels that have changed are sent, no more often than the
+           configured rate. Repeating the sensor argument limits the updates
+           to those sensors.
+        """
+        sensor_ids = request.args.getlist('sensor')
+
+        client = self.live_update_hub.add_client(set(sensor_ids) if sensor_ids else None)
+        if client is None:
+            return Response(json.dumps({'error': 'Too many live clients'}), status=503, content_type='application/json')
+
+        headers = {
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
 
+        return Response(stream_with_context(self.live_update_hub.stream_events(client)), status=200, headers=headers, content_type='text/event-stream')
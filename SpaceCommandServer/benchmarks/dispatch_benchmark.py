@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+#
+# Microbenchmark for measurement dispatch in the sensor processor.
+#
+# Times SensorProcessor.process_measurement in the working tree, or in the
+# tree at --revision, against the tree at the --baseline git revision, e.g.
+# the commit before channel routes were added. Each tree is timed in its own
+# process, with the same sensors and messages.
+#
+# usage: dispatch_benchmark.py --baseline REVISION [--revision REVISION]
+#                              [--sensors 1000] [--messages 200000]
+#
+
+#
+# Written by Keith Hughes
+#
+
+import argparse
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import timeit
+
+from rx import Observer
+
+# The SpaceCommandServer directory, holding the package.
+SERVER_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class NullObserver(Observer):
+  """An observer of sensor updates that does nothing with them.
+  """
+
+  def on_next(self, value):
+    pass
+
+  def on_completed(self):
+    pass
+
+  def on_error(self, error):
+    pass
+
+def build_registry(number_sensors):
+  from TinkerSpaceCommandServer.entities import Entities
+  from TinkerSpaceCommandServer.entities.EntityRegistry import EntityRegistry
+
+  entity_registry = EntityRegistry()
+
+  channels = {
+    'temperature': Entities.SensorChannelDetail('temperature', 'Temperature', '', 'type.measurement.temperature', 'unit.measurement.temperature.fahrenheit'),
+    'humidity': Entities.SensorChannelDetail('humidity', 'Humidity', '', 'type.measurement.humidity', 'unit.measurement.humidity.relative')
+  }
+  sensor_detail = Entities.SensorDetailEntityDescription('sensor.bench.dht22', 'DHT22', '', 10, None, channels)
+  entity_registry.add_sensor_detail(sensor_detail)
+
+  location = Entities.PhysicalLocationEntityDescription('bench.location', 'Bench Location', '')
+  entity_registry.add_sensed_entity(location)
+
+  for i in range(number_sensors):
+    sensor = Entities.SensorEntityDescription('sensor.bench.{}'.format(i), 'Sensor {}'.format(i), '', sensor_detail, 10, None)
+    entity_registry.add_sensor(sensor)
+    entity_registry.register_sensor_association(sensor, list(channels.keys()), location)
+
+  entity_registry.prepare_runtime_models()
+
+  return entity_registry
+
+def measure(number_sensors, number_messages):
+  """Time the dispatch of the tree this process imports the package from.
+
+     Returns the best time per message in microseconds.
+  """
+
+  from TinkerSpaceCommandServer import Messages
+  from TinkerSpaceCommandServer.processor.SensorProcessor import SensorProcessor
+
+  entity_registry = build_registry(number_sensors)
+  sensor_processor = SensorProcessor(entity_registry)
+  sensor_processor.register_sensor_update_observer(NullObserver())
+
+  messages = [{
+    Messages.MESSAGE_FIELD_MESSAGE_TYPE: Messages.MESSAGE_VALUE_MESSAGE_TYPE_MEASUREMENT,
+    Messages.MESSAGE_FIELD_SENSOR_ID: 'sensor.bench.{}'.format(i % number_sensors),
+    Messages.MESSAGE_FIELD_DATA: {
+      'temperature': { Messages.MESSAGE_FIELD_VALUE: 70.0 + i % 10 },
+      'humidity': { Messages.MESSAGE_FIELD_VALUE: 30.0 + i % 10 }
+    }
+  } for i in range(number_messages)]
+  now = time.time()
+
+  def run():
+    for message in messages:
+      sensor_processor.process_measurement(message, now)
+
+  return min(timeit.repeat(run, number=1, repeat=5)) / number_messages * 1000000
+
+def export_revision(revision, directory):
+  """Write the SpaceCommandServer tree at a git revision into a directory.
+  """
+
+  archive = subprocess.run(['git', 'archive', revision, '.'], cwd=SERVER_DIRECTORY, check=True, stdout=subprocess.PIPE).stdout
+  with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+    tar.extractall(directory)
+
+def measure_tree(tree_directory, number_sensors, number_messages):
+  """Time the dispatch of a tree in a new process.
+  """
+
+  environment = dict(os.environ, PYTHONPATH=tree_directory)
+  output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure',
+                           '--sensors', str(number_sensors), '--messages', str(number_messages)],
+                          env=environment, check=True, stdout=subprocess.PIPE).stdout
+
+  return json.loads(output)['microsecondsPerMessage']
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark measurement dispatch in the sensor processor.')
+  parser.add_argument('--baseline', help='git revision to compare against')
+  parser.add_argument('--revision', help='git revision to time, default is the working tree')
+  parser.add_argument('--sensors', type=int, default=1000, help='number of sensors')
+  parser.add_argument('--messages', type=int, default=200000, help='number of measurement messages')
+  parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.measure:
+    print(json.dumps({'microsecondsPerMessage': measure(args.sensors, args.messages)}))
+    return
+
+  if args.baseline is None:
+    parser.error('--baseline is needed')
+
+  directory = tempfile.mkdtemp(prefix='dispatch_benchmark')
+  try:
+    baseline_directory = os.path.join(directory, 'baseline')
+    export_revision(args.baseline, baseline_directory)
+    baseline_time = measure_tree(baseline_directory, args.sensors, args.messages)
+
+    tree_directory = SERVER_DIRECTORY
+    if args.revision is not None:
+      tree_directory = os.path.join(directory, 'revision')
+      export_revision(args.revision, tree_directory)
+    tree_time = measure_tree(tree_directory, args.sensors, args.messages)
+  finally:
+    shutil.rmtree(directory)
+
+  print("Sensors: {}, messages: {}".format(args.sensors, args.messages))
+  print("Baseline {}: {:.3f} us/message".format(args.baseline, baseline_time))
+  print("{}: {:.3f} us/message".format(args.revision or "Working tree", tree_time))
+  print("Speedup: {:.2f}x".format(baseline_time / tree_time))
+
+if __name__ == '__main__':
+  main()
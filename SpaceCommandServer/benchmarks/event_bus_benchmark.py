@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+#
+# Microbenchmark for measurement event fan-out.
+#
+# Compares publishing on the measurement event bus against the Rx path it
+# replaced, where every channel value went through an Rx Subject on the
+# sensor model, one on the sensed model and one on the sensor processor, and
+# filtering was left to the observers.
+#
+# Each run has the given number of observers of every measurement, plus one
+# observer for each location that only wants that location's measurements.
+#
+# usage: event_bus_benchmark.py [sensors] [events] [observers]
+#
+
+#
+# Written by Keith Hughes
+#
+
+import sys
+import time
+import timeit
+
+from rx import Observer
+from rx.subjects import Subject
+
+from dispatch_benchmark import NullObserver, build_registry
+from TinkerSpaceCommandServer.events.EventBus import MeasurementEventBus
+from TinkerSpaceCommandServer.events.StandardEvents import SensorChannelMeasurementEvent
+
+# The locations the sensors are spread over.
+NUMBER_LOCATIONS = 8
+
+class LocationObserver(Observer):
+  """An observer that only handles measurements from one location, filtering
+     the way an Rx observer has to.
+  """
+
+  def __init__(self, sensed_id):
+    self.sensed_id = sensed_id
+    self.count = 0
+
+  def on_next(self, event):
+    if event.sensed_active_model.sensed_entity_description.external_id == self.sensed_id:
+      self.count += 1
+
+  def on_completed(self):
+    pass
+
+  def on_error(self, error):
+    pass
+
+def spread_over_locations(entity_registry):
+  # build_registry puts every sensor in one location, give them several.
+  sensed_active_model = next(iter(entity_registry.sensed_entity_active_models.values()))
+  location_models = []
+  for location in range(NUMBER_LOCATIONS):
+    location_model = type(sensed_active_model)(type(sensed_active_model.sensed_entity_description)(
+      'bench.location.{}'.format(location), 'Bench Location {}'.format(location), ''))
+    entity_registry.sensed_entity_active_models[location_model.sensed_entity_description.external_id] = location_model
+    location_models.append(location_model)
+
+  for index, route in enumerate(entity_registry.get_all_channel_routes()):
+    route.sensed_active_model = route.active_channel.sensed_entity_active_model = location_models[index % NUMBER_LOCATIONS]
+
+  return [location_model.sensed_entity_description.external_id for location_model in location_models]
+
+def main():
+  number_sensors = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  number_events = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+  number_observers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+
+  entity_registry = build_registry(number_sensors)
+  location_ids = spread_over_locations(entity_registry)
+
+  routes = list(entity_registry.get_all_channel_routes())
+  now = time.time()
+  events = [(route, SensorChannelMeasurementEvent(route.sensor_active_model, route.sensed_active_model, route.active_channel, 70.0, now))
+            for route in (routes[i % len(routes)] for i in range(number_events))]
+
+  # The Rx path, with a subject for every model and one for the processor.
+  sensor_subjects = {route.sensor_active_model: Subject() for route in routes}
+  sensed_subjects = {route.sensed_active_model: Subject() for route in routes}
+  measurement_subject = Subject()
+  for observer in range(number_observers):
+    measurement_subject.subscribe(NullObserver())
+  for location_id in location_ids:
+    measurement_subject.subscribe(LocationObserver(location_id))
+
+  # The event bus, with the location observers subscribed with a filter.
+  event_bus = MeasurementEventBus(entity_registry)
+  for observer in range(number_observers):
+    event_bus.subscribe_observer(NullObserver())
+  for location_id in location_ids:
+    event_bus.subscribe_observer(LocationObserver(location_id), sensed_ids=[location_id])
+
+  def run_rx():
+    for route, event in events:
+      sensor_subjects[route.sensor_active_model].on_next(route.active_channel)
+      sensed_subjects[route.sensed_active_model].on_next(route.active_channel)
+      measurement_subject.on_next(event)
+
+  def run_event_bus():
+    publish = event_bus.publish
+    for route, event in events:
+      if route.observers:
+        publish(route.observers, event)
+
+  rx_time = min(timeit.repeat(run_rx, number=1, repeat=5))
+  event_bus_time = min(timeit.repeat(run_event_bus, number=1, repeat=5))
+
+  print("Sensors: {}, events: {}, observers: {} + {} filtered by location".format(number_sensors, number_events, number_observers, len(location_ids)))
+  print("Rx subjects: {:.3f} us/event".format(rx_time / number_events * 1000000))
+  print("Event bus:   {:.3f} us/event".format(event_bus_time / number_events * 1000000))
+  print("Speedup:     {:.2f}x".format(rx_time / event_bus_time))
+
+if __name__ == '__main__':
+  main()
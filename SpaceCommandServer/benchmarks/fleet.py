@@ -0,0 +1,103 @@
+#
+# The generated sensor fleet the benchmarks run against.
+#
+# Only uses what the entity registry and sensor processor have always had, so
+# benchmarks comparing against an older tree can build the same fleet in it.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import os
+import tempfile
+import tracemalloc
+
+import yaml
+
+from TinkerSpaceCommandServer import Messages
+from TinkerSpaceCommandServer.entities.EntityRegistry import EntityRegistry, YamlEntityRegistryReader
+
+SENSOR_DETAIL_ID = 'sensor.benchmark.detail'
+
+def generate_fleet_descriptions(number_sensors, number_channels, number_locations, history_size=None):
+  """Generate sensor descriptions in the sensors.yaml format.
+
+     The channel histories have the default size unless history_size is
+     given.
+  """
+
+  channels = [{
+    'externalId': 'channel{}'.format(channel),
+    'name': 'Channel {}'.format(channel),
+    'description': 'Benchmark channel {}'.format(channel),
+    'measurementType': 'type.measurement.benchmark{}'.format(channel),
+    'measurementUnit': 'unit.measurement.benchmark'
+  } for channel in range(number_channels)]
+
+  sensor_detail = {
+    'externalId': SENSOR_DETAIL_ID,
+    'name': 'Benchmark sensor',
+    'description': 'A simulated sensor',
+    'sensorUpdateTimeLimit': 60,
+    'channels': channels
+  }
+  if history_size is not None:
+    sensor_detail['historySize'] = history_size
+
+  return {
+    'sensorDetails': [sensor_detail],
+    'sensors': [{
+      'externalId': 'sensor.benchmark.{}'.format(sensor),
+      'name': 'Benchmark sensor {}'.format(sensor),
+      'description': 'A simulated sensor',
+      'sensorDetail': SENSOR_DETAIL_ID,
+      'active': True
+    } for sensor in range(number_sensors)],
+    'physicalLocations': [{
+      'externalId': 'benchmark.location.{}'.format(location),
+      'name': 'Benchmark location {}'.format(location),
+      'description': 'A simulated location'
+    } for location in range(number_locations)],
+    'sensorAssociations': [{
+      'sensorId': 'sensor.benchmark.{}'.format(sensor),
+      'sensedId': 'benchmark.location.{}'.format(sensor % number_locations)
+    } for sensor in range(number_sensors)]
+  }
+
+def build_registry(number_sensors, number_channels, number_locations, history_size=None):
+  """Build an entity registry for a generated fleet.
+
+     Returns the registry and the bytes allocated building it.
+  """
+
+  descriptions = generate_fleet_descriptions(number_sensors, number_channels, number_locations, history_size)
+
+  fd, path = tempfile.mkstemp(suffix='.yaml')
+  try:
+    with os.fdopen(fd, 'w') as fp:
+      yaml.safe_dump(descriptions, fp)
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+
+    entity_registry = EntityRegistry()
+    YamlEntityRegistryReader().load_registry(path, entity_registry)
+    entity_registry.prepare_runtime_models()
+
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  finally:
+    os.remove(path)
+
+  return entity_registry, after - before
+
+def generate_messages(number_messages, number_sensors, number_channels):
+  return [{
+    Messages.MESSAGE_FIELD_MESSAGE_TYPE: Messages.MESSAGE_VALUE_MESSAGE_TYPE_MEASUREMENT,
+    Messages.MESSAGE_FIELD_SENSOR_ID: 'sensor.benchmark.{}'.format(i % number_sensors),
+    Messages.MESSAGE_FIELD_DATA: {
+      'channel{}'.format(channel): { Messages.MESSAGE_FIELD_VALUE: float(i % 100) }
+      for channel in range(number_channels)
+    }
+  } for i in range(number_messages)]
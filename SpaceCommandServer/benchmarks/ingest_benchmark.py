@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+#
+# Ingest throughput and latency benchmark with a simulated sensor fleet.
+#
+# Builds an entity registry from a generated sensor description file with N
+# sensors, M channels per sensor and K locations, then drives synthetic
+# measurement messages through the server and reports messages per second,
+# end to end latency to the measurement observers and memory per sensor.
+#
+# In direct mode messages go straight to SensorProcessor.process_sensor_input.
+# In mqtt mode they are handed to MqttCommunicationProvider.on_new_mqtt_message
+# as if they had come from a broker, so they also go through codec selection,
+# the ingest queue and the ingest workers. In sharded mode they go through
+# the same provider but are routed to --shards ingest shard processes, and the
+# latency includes the shards sending their results back.
+#
+# Results are written as JSON, one entry per fleet size. Running with and
+# without --disable-metrics shows the cost of metrics collection.
+#
+# usage: ingest_benchmark.py [--sensors 10,100,1000] [--channels 2]
+#                            [--locations 4] [--messages 100000]
+#                            [--mode direct|mqtt|sharded] [--shards 2]
+#                            [--disable-metrics]
+#                            [--output results.json]
+#
+
+#
+# Written by Keith Hughes
+#
+
+import argparse
+import json
+import sys
+import time
+import types
+
+import yaml
+from rx import Observer
+
+from fleet import build_registry, generate_messages
+from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.metrics import Metrics
+from TinkerSpaceCommandServer.processor.SensorProcessor import SensorProcessor
+
+class LatencyObserver(Observer):
+  """A measurement observer that records the time from a message being
+     received to the observer seeing it.
+  """
+
+  def __init__(self):
+    self.latencies = []
+
+  def on_next(self, measurement_event):
+    # list.append is atomic, so this is safe from several ingest workers.
+    self.latencies.append(time.time() - measurement_event.time_received)
+
+  def on_completed(self):
+    pass
+
+  def on_error(self, error):
+    pass
+
+class FakeMqttMessage:
+  """Stands in for a paho MQTT message from a broker.
+  """
+
+  def __init__(self, topic, payload):
+    self.topic = topic
+    self.payload = payload
+
+def run_direct(sensor_processor, messages):
+  start = time.perf_counter()
+  for message in messages:
+    sensor_processor.process_sensor_input(message, time.time())
+
+  return time.perf_counter() - start
+
+def run_mqtt(sensor_processor, messages, config):
+  from TinkerSpaceCommandServer.comms.MqttCommunicationProvider import MqttCommunicationProvider
+
+  provider = MqttCommunicationProvider(config)
+  provider.sensor_processor = sensor_processor
+
+  topic = config['communication']['mqtt']['sensorInputTopic']
+  codec = provider.message_codecs.json_codec
+  mqtt_messages = [FakeMqttMessage(topic, codec.encode(message)) for message in messages]
+
+  provider.ingest_queue.start()
+  try:
+    start = time.perf_counter()
+    for mqtt_message in mqtt_messages:
+      provider.on_new_mqtt_message(None, None, mqtt_message)
+
+    # Dropped messages never reach the observer, so wait for the ingest
+    # queue to account for every message instead.
+    ingest_queue = provider.ingest_queue
+    while ingest_queue.processed_count() + ingest_queue.dropped_count() < len(mqtt_messages):
+      time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+  finally:
+    provider.ingest_queue.stop()
+
+  return elapsed, provider.ingest_queue.dropped_count()
+
+def run_sharded(sensor_processor, messages, config, number_shards):
+  from TinkerSpaceCommandServer.comms.MqttCommunicationProvider import MqttCommunicationProvider
+  from TinkerSpaceCommandServer.processor.ShardedIngest import ShardedIngest
+
+  provider = MqttCommunicationProvider(config)
+
+  topic = config['communication']['mqtt']['sensorInputTopic']
+  codec = provider.message_codecs.json_codec
+  mqtt_messages = [FakeMqttMessage(topic, codec.encode(message)) for message in messages]
+
+  # Only what ShardedIngest uses of the server.
+  server = types.SimpleNamespace(sensor_processor=sensor_processor, event_persistence=None, communicationProviders=[provider])
+  sharded_ingest = ShardedIngest(server, number_shards, Constants.SHARD_QUEUE_SIZE, Constants.SHARD_STATE_INTERVAL)
+  sharded_ingest.start_workers()
+  sharded_ingest.start()
+  try:
+    start = time.perf_counter()
+    for mqtt_message in mqtt_messages:
+      provider.on_new_mqtt_message(None, None, mqtt_message)
+
+    router = sharded_ingest.router
+    while sum(shard.messages_processed for shard in sharded_ingest.shards) + router.dropped_count() < len(mqtt_messages):
+      time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+  finally:
+    sharded_ingest.stop()
+
+  return elapsed, router.dropped_count()
+
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return None
+
+  return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+def run_benchmark(number_sensors, number_channels, number_locations, number_messages, mode, config, number_shards):
+  entity_registry, registry_bytes = build_registry(number_sensors, number_channels, number_locations)
+  sensor_processor = SensorProcessor(entity_registry)
+
+  latency_observer = LatencyObserver()
+  sensor_processor.register_sensor_update_observer(latency_observer)
+
+  messages = generate_messages(number_messages, number_sensors, number_channels)
+
+  dropped = 0
+  if mode == 'mqtt':
+    elapsed, dropped = run_mqtt(sensor_processor, messages, config)
+  elif mode == 'sharded':
+    elapsed, dropped = run_sharded(sensor_processor, messages, config, number_shards)
+  else:
+    elapsed = run_direct(sensor_processor, messages)
+
+  latencies = sorted(latency_observer.latencies)
+
+  return {
+    'mode': mode,
+    'shards': number_shards if mode == 'sharded' else 0,
+    'metricsEnabled': Metrics.registry.enabled,
+    'sensors': number_sensors,
+    'channelsPerSensor': number_channels,
+    'locations': number_locations,
+    'messages': number_messages,
+    'messagesDropped': dropped,
+    'elapsedSeconds': elapsed,
+    'messagesPerSecond': number_messages / elapsed,
+    'latencyP50Microseconds': percentile(latencies, 0.50) * 1000000,
+    'latencyP99Microseconds': percentile(latencies, 0.99) * 1000000,
+    'bytesPerSensor': registry_bytes / number_sensors
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark sensor message ingest.')
+  parser.add_argument('--sensors', default='10,100,1000', help='comma separated fleet sizes to run')
+  parser.add_argument('--channels', type=int, default=2, help='channels per sensor')
+  parser.add_argument('--locations', type=int, default=4, help='number of physical locations')
+  parser.add_argument('--messages', type=int, default=100000, help='messages per run')
+  parser.add_argument('--mode', choices=['direct', 'mqtt', 'sharded'], default='direct')
+  parser.add_argument('--shards', type=int, default=2, help='ingest shard processes in sharded mode')
+  parser.add_argument('--disable-metrics', action='store_true', help='turn off metrics collection')
+  parser.add_argument('--config', help='server YAML configuration, for the MQTT ingest settings')
+  parser.add_argument('--output', help='file to write the JSON results to, default is stdout')
+  args = parser.parse_args()
+
+  config = {
+    'communication': {
+      'mqtt': {
+        'serverClientId': 'benchmark',
+        'sensorInputTopic': '/tinkermill/sensors/data',
+        'mqttMdnsServiceName': '_mqtt._tcp.local.',
+        'ingest': {
+          # Block rather than drop so every message is measured.
+          'overflowPolicy': 'block'
+        }
+      }
+    }
+  }
+  if args.config:
+    with open(args.config) as fp:
+      config = yaml.safe_load(fp)
+
+  Metrics.registry.enabled = not args.disable_metrics
+
+  results = {
+    'python': sys.version.split()[0],
+    'runs': [run_benchmark(int(sensors), args.channels, args.locations, args.messages, args.mode, config, args.shards)
+             for sensors in args.sensors.split(',')]
+  }
+
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+  main()
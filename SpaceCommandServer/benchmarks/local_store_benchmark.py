@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark for the local column store persistence backend.
+#
+# Fills a store with --days of measurements from --sensors sensors reporting
+# every --interval seconds, flushing every --flush seconds of sensor time as
+# the server would, then compacts it. The values are room temperatures to a
+# tenth of a degree that drift slowly, like real sensors.
+#
+# Reports the disk used per point, the time to write the points and the time
+# for raw and aggregated queries of one channel over an hour, a day and a
+# week.
+#
+# usage: local_store_benchmark.py [--sensors 20] [--days 7]
+#                                 [--interval 10] [--flush 5]
+#                                 [--directory DIR] [--output results.json]
+#
+
+#
+# Written by Keith Hughes
+#
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from TinkerSpaceCommandServer.metrics import Metrics
+from TinkerSpaceCommandServer.persistence.ColumnStore import PARTITION_SIZE
+from TinkerSpaceCommandServer.persistence.LocalEventPersistence import LocalEventPersistence
+
+HOUR = 60 * 60 * 1000
+
+def fill_store(persistence, number_sensors, days, interval, flush):
+  """Append and flush the measurements, ending now.
+
+     Returns the number of points and the seconds taken.
+  """
+
+  store = persistence.store
+  end_time = int(time.time() * 1000)
+  start_time = end_time - days * PARTITION_SIZE
+
+  random.seed(1)
+  temperatures = [20.0 + random.random() * 5 for sensor in range(number_sensors)]
+
+  points = 0
+  next_flush_time = start_time + flush * 1000
+  started = time.perf_counter()
+  for sample_time in range(start_time, end_time, interval * 1000):
+    for sensor in range(number_sensors):
+      temperatures[sensor] += random.choice([-0.1, 0, 0, 0, 0.1])
+      store.append('sensor.benchmark.{}'.format(sensor), 'temperature', 'location.benchmark', sample_time, round(temperatures[sensor], 1))
+      points += 1
+
+    if sample_time >= next_flush_time:
+      store.flush()
+      store.maintain(sample_time)
+      next_flush_time += flush * 1000
+  store.flush()
+  store.maintain(end_time + PARTITION_SIZE)
+
+  return points, time.perf_counter() - started
+
+def time_query(persistence, duration, bucket_width):
+  end_time = int(time.time() * 1000)
+
+  def query():
+    return persistence.query_channel_rows('sensor.benchmark.0', 'temperature', bucket_width, end_time - duration, end_time)
+
+  rows = len(query())
+  seconds = min(timeit.repeat(query, number=1, repeat=5))
+
+  return {'rows': rows, 'milliseconds': seconds * 1000}
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the local column store.')
+  parser.add_argument('--sensors', type=int, default=20, help='number of sensors')
+  parser.add_argument('--days', type=int, default=7, help='days of measurements')
+  parser.add_argument('--interval', type=int, default=10, help='seconds between measurements of a sensor')
+  parser.add_argument('--flush', type=int, default=5, help='seconds between flushes')
+  parser.add_argument('--directory', help='directory for the store, default is a temporary one')
+  parser.add_argument('--output', help='file to write the JSON results to, default is stdout')
+  args = parser.parse_args()
+
+  Metrics.registry.enabled = False
+
+  directory = args.directory or tempfile.mkdtemp(prefix='local_store_benchmark')
+  try:
+    persistence = LocalEventPersistence({'persistence': {'local': {'directory': directory}}})
+    persistence.store.open()
+
+    points, fill_seconds = fill_store(persistence, args.sensors, args.days, args.interval, args.flush)
+    disk_bytes = sum(os.path.getsize(os.path.join(path, name)) for path, directories, names in os.walk(directory) for name in names)
+
+    results = {
+      'python': sys.version.split()[0],
+      'sensors': args.sensors,
+      'days': args.days,
+      'points': points,
+      'bytesPerPoint': disk_bytes / points,
+      'writeMicrosecondsPerPoint': fill_seconds / points * 1000000,
+      'queries': {
+        'rawHour': time_query(persistence, HOUR, None),
+        'rawDay': time_query(persistence, 24 * HOUR, None),
+        'rawWeek': time_query(persistence, 7 * 24 * HOUR, None),
+        'minuteDay': time_query(persistence, 24 * HOUR, 60 * 1000),
+        'hourWeek': time_query(persistence, 7 * 24 * HOUR, HOUR)
+      },
+      'maxRssKilobytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+  finally:
+    if args.directory is None:
+      shutil.rmtree(directory)
+
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+#
+# Memory benchmark for the entity and event model at large fleet sizes.
+#
+# Builds the same generated fleet as ingest_benchmark.py and reports:
+#
+#   - bytes per sensor for the entity registry once it is built, and again
+#     after every channel has --fill measurements in its history
+#   - bytes allocated per message while processing it, including what is
+#     freed again before it is done. This is the high point of the traced
+#     memory in each message, over the memory when it started. CPython only
+#     tracks the blocks still allocated, so blocks that are freed again are
+#     only seen in these bytes, and objects reused from CPython's free lists
+#     aren't seen at all
+#   - blocks and bytes per message still allocated once the messages are
+#     processed, from tracemalloc snapshots before and after. This uses a
+#     second fleet whose histories are already full, so histories growing
+#     to their size doesn't count
+#   - blocks and bytes per message the measurement events keep allocated.
+#     The messages are processed once with an observer that drops the
+#     events and once with one that keeps them, and the difference is what
+#     the events take
+#
+# Given --baseline, the tree at that git revision is measured too, e.g. the
+# commit before the series of changes being looked at, and the two are
+# compared. Each tree is measured in its own process, with the same fleet
+# and messages.
+#
+# usage: memory_benchmark.py [--baseline REVISION] [--revision REVISION]
+#                            [--sensors 10000] [--channels 2]
+#                            [--locations 4] [--messages 100000]
+#                            [--fill 16] [--output results.json]
+#
+
+#
+# Written by Keith Hughes
+#
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from rx import Observer
+
+from dispatch_benchmark import export_revision
+from fleet import build_registry, generate_messages
+
+# The results compared between the baseline and the tree.
+COMPARED_RESULTS = ['bytesPerSensor', 'bytesPerSensorFilled', 'allocatedBytesPerMessage',
+                    'retainedBlocksPerMessage', 'retainedBytesPerMessage',
+                    'eventBlocksPerMessage', 'eventBytesPerMessage']
+
+class RetainingObserver(Observer):
+  """A measurement observer that keeps every event it is given, or none of
+     them.
+  """
+
+  def __init__(self):
+    self.events = []
+    self.retain = False
+
+  def on_next(self, measurement_event):
+    if self.retain:
+      self.events.append(measurement_event)
+
+  def on_completed(self):
+    pass
+
+  def on_error(self, error):
+    pass
+
+def fill_histories(sensor_processor, number_sensors, number_channels, fill):
+  """Give every channel fill measurements.
+
+     Returns the bytes allocated doing it.
+  """
+
+  from TinkerSpaceCommandServer import Messages
+
+  now = time.time()
+
+  tracemalloc.start()
+  before, _ = tracemalloc.get_traced_memory()
+
+  for sample in range(fill):
+    for sensor in range(number_sensors):
+      sensor_processor.process_measurement({
+        Messages.MESSAGE_FIELD_SENSOR_ID: 'sensor.benchmark.{}'.format(sensor),
+        Messages.MESSAGE_FIELD_DATA: {
+          'channel{}'.format(channel): { Messages.MESSAGE_FIELD_VALUE: float(sample) } for channel in range(number_channels)
+        }
+      }, now + sample)
+
+  after, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  return after - before
+
+def trace_messages(process, messages):
+  """Process the messages while tracing memory.
+
+     Returns the bytes allocated at the high point of each message, summed
+     over the messages, and the blocks and bytes still allocated at the end.
+  """
+
+  now = time.time()
+
+  gc.collect()
+  gc.disable()
+  try:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    allocated = 0
+    for message in messages:
+      start, _ = tracemalloc.get_traced_memory()
+      tracemalloc.reset_peak()
+
+      process(message, now)
+
+      _, peak = tracemalloc.get_traced_memory()
+      allocated += peak - start
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+  finally:
+    gc.enable()
+
+  # Leave out the snapshots themselves.
+  snapshot_filter = [tracemalloc.Filter(False, tracemalloc.__file__)]
+  differences = after.filter_traces(snapshot_filter).compare_to(before.filter_traces(snapshot_filter), 'filename')
+
+  return allocated, sum(difference.count_diff for difference in differences), sum(difference.size_diff for difference in differences)
+
+def measure_messages(sensor_processor, messages):
+  """Process the messages with an observer that drops every event, then
+     with one that keeps them.
+
+     Returns the bytes allocated per message, the blocks and bytes left
+     allocated per message, and the blocks and bytes per message the events
+     keep allocated.
+  """
+
+  observer = RetainingObserver()
+  sensor_processor.register_sensor_update_observer(observer)
+
+  # What tracing a message takes when there is nothing to process.
+  overhead, _, _ = trace_messages(lambda message, now: None, messages)
+
+  allocated, retained_blocks, retained_bytes = trace_messages(sensor_processor.process_measurement, messages)
+
+  observer.retain = True
+  _, event_blocks, event_bytes = trace_messages(sensor_processor.process_measurement, messages)
+
+  number_messages = len(messages)
+
+  return ((allocated - overhead) / number_messages,
+          retained_blocks / number_messages, retained_bytes / number_messages,
+          (event_blocks - retained_blocks) / number_messages, (event_bytes - retained_bytes) / number_messages)
+
+def measure(number_sensors, number_channels, number_locations, number_messages, fill):
+  """Measure the tree this process imports the package from.
+  """
+
+  from TinkerSpaceCommandServer.processor.SensorProcessor import SensorProcessor
+
+  try:
+    from TinkerSpaceCommandServer.metrics import Metrics
+
+    # Metrics allocate on sampled messages, leave them out of the numbers.
+    Metrics.registry.enabled = False
+  except ImportError:
+    # The tree is from before there were metrics.
+    pass
+
+  entity_registry, registry_bytes = build_registry(number_sensors, number_channels, number_locations)
+  sensor_processor = SensorProcessor(entity_registry)
+
+  fill_bytes = fill_histories(sensor_processor, number_sensors, number_channels, fill)
+
+  # Histories of fill measurements, filled twice over so that any history
+  # that grows past its size before cutting back has done so already.
+  full_registry, _ = build_registry(number_sensors, number_channels, number_locations, fill)
+  sensor_processor = SensorProcessor(full_registry)
+  fill_histories(sensor_processor, number_sensors, number_channels, 2 * fill)
+
+  messages = generate_messages(number_messages, number_sensors, number_channels)
+  allocated_bytes, retained_blocks, retained_bytes, event_blocks, event_bytes = measure_messages(sensor_processor, messages)
+
+  return {
+    'python': sys.version.split()[0],
+    'sensors': number_sensors,
+    'channelsPerSensor': number_channels,
+    'locations': number_locations,
+    'historyFill': fill,
+    'bytesPerSensor': registry_bytes / number_sensors,
+    'bytesPerSensorFilled': (registry_bytes + fill_bytes) / number_sensors,
+    'messages': number_messages,
+    'allocatedBytesPerMessage': allocated_bytes,
+    'retainedBlocksPerMessage': retained_blocks,
+    'retainedBytesPerMessage': retained_bytes,
+    'eventBlocksPerMessage': event_blocks,
+    'eventBytesPerMessage': event_bytes
+  }
+
+def measure_tree(tree_directory, args):
+  """Measure a tree in a new process.
+  """
+
+  environment = dict(os.environ, PYTHONPATH=tree_directory)
+  output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure',
+                           '--sensors', str(args.sensors), '--channels', str(args.channels),
+                           '--locations', str(args.locations), '--messages', str(args.messages),
+                           '--fill', str(args.fill)],
+                          env=environment, check=True, stdout=subprocess.PIPE).stdout
+
+  return json.loads(output)
+
+def compare(args):
+  """Measure the baseline tree and the working tree, or the tree at
+     --revision.
+  """
+
+  directory = tempfile.mkdtemp(prefix='memory_benchmark')
+  try:
+    baseline_directory = os.path.join(directory, 'baseline')
+    export_revision(args.baseline, baseline_directory)
+    baseline = measure_tree(baseline_directory, args)
+
+    tree_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if args.revision is not None:
+      tree_directory = os.path.join(directory, 'revision')
+      export_revision(args.revision, tree_directory)
+    tree = measure_tree(tree_directory, args)
+  finally:
+    shutil.rmtree(directory)
+
+  name = args.revision or 'Working tree'
+  print("Sensors: {}, messages: {}".format(args.sensors, args.messages), file=sys.stderr)
+  for result in COMPARED_RESULTS:
+    print("{}: baseline {}: {:.1f}, {}: {:.1f}".format(result, args.baseline, baseline[result], name, tree[result]), file=sys.stderr)
+
+  return {
+    'baseline': dict(baseline, revision=args.baseline),
+    'tree': dict(tree, revision=args.revision)
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark entity and event memory use.')
+  parser.add_argument('--baseline', help='git revision to compare against')
+  parser.add_argument('--revision', help='git revision to measure with --baseline, default is the working tree')
+  parser.add_argument('--sensors', type=int, default=10000, help='fleet size')
+  parser.add_argument('--channels', type=int, default=2, help='channels per sensor')
+  parser.add_argument('--locations', type=int, default=4, help='number of physical locations')
+  parser.add_argument('--messages', type=int, default=100000, help='messages to measure the per message memory with')
+  parser.add_argument('--fill', type=int, default=16, help='measurements put in every channel history')
+  parser.add_argument('--output', help='file to write the JSON results to, default is stdout')
+  parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.measure:
+    print(json.dumps(measure(args.sensors, args.channels, args.locations, args.messages, args.fill)))
+    return
+
+  if args.baseline is not None:
+    results = compare(args)
+  else:
+    results = measure(args.sensors, args.channels, args.locations, args.messages, args.fill)
+
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+  main()
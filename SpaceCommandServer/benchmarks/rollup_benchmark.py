@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark for long range queries from the rollups.
+#
+# Fills a local store and its rollups with --days of measurements from one
+# sensor reporting every --interval seconds, then times a year long chart of
+# a channel and of its location, aggregated into --points buckets, from the
+# rollups and from the raw measurements.
+#
+# usage: rollup_benchmark.py [--days 365] [--interval 60] [--points 500]
+#                            [--output results.json]
+#
+
+#
+# Written by Keith Hughes
+#
+
+import argparse
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from TinkerSpaceCommandServer.metrics import Metrics
+from TinkerSpaceCommandServer.persistence.ColumnStore import PARTITION_SIZE
+from TinkerSpaceCommandServer.persistence.LocalEventPersistence import LocalEventPersistence
+from TinkerSpaceCommandServer.persistence.QueryCache import round_up_bucket_width
+from TinkerSpaceCommandServer.persistence.Rollups import ROLLUP_KIND_LOCATION
+
+SENSOR_ID = 'sensor.benchmark'
+CHANNEL_ID = 'temperature'
+SENSED_ID = 'location.benchmark'
+
+HOUR = 60 * 60 * 1000
+
+def fill_store(persistence, start_time, end_time, interval):
+  """Append the measurements to the store and the rollups, flushing both
+     every hour of sensor time.
+
+     Returns the number of points.
+  """
+
+  store = persistence.store
+  rollups = persistence.rollups
+  rollups.open(start_time)
+  persistence.rollups_start_time = start_time
+
+  random.seed(1)
+  temperature = 20.0
+
+  points = 0
+  next_flush_time = start_time + HOUR
+  for sample_time in range(start_time, end_time, interval * 1000):
+    temperature += random.choice([-0.1, 0, 0, 0, 0.1])
+    store.append(SENSOR_ID, CHANNEL_ID, SENSED_ID, sample_time, round(temperature, 1))
+    rollups.add(SENSOR_ID, CHANNEL_ID, SENSED_ID, CHANNEL_ID, sample_time, round(temperature, 1))
+    points += 1
+
+    if sample_time >= next_flush_time:
+      store.flush()
+      store.maintain(sample_time)
+      persistence.flush_rollups(sample_time)
+      next_flush_time += HOUR
+  store.flush()
+  persistence.flush_rollups(None)
+
+  return points
+
+def time_query(query):
+  rows = len(query())
+  seconds = min(timeit.repeat(query, number=1, repeat=3))
+
+  return {'rows': rows, 'milliseconds': seconds * 1000}
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark long range queries from the rollups.')
+  parser.add_argument('--days', type=int, default=365, help='days of measurements')
+  parser.add_argument('--interval', type=int, default=60, help='seconds between measurements')
+  parser.add_argument('--points', type=int, default=500, help='buckets in a chart')
+  parser.add_argument('--output', help='file to write the JSON results to, default is stdout')
+  args = parser.parse_args()
+
+  Metrics.registry.enabled = False
+
+  directory = tempfile.mkdtemp(prefix='rollup_benchmark')
+  try:
+    persistence = LocalEventPersistence({'persistence': {'local': {'directory': directory}}})
+    persistence.open_store()
+
+    end_time = int(time.time() * 1000)
+    start_time = end_time - args.days * PARTITION_SIZE
+    points = fill_store(persistence, start_time, end_time, args.interval)
+
+    bucket_width = round_up_bucket_width((end_time - start_time) / args.points)
+
+    results = {
+      'python': sys.version.split()[0],
+      'days': args.days,
+      'points': points,
+      'bucketWidthSeconds': bucket_width / 1000,
+      'queries': {
+        'channelRaw': time_query(lambda: persistence.query_channel_rows(SENSOR_ID, CHANNEL_ID, bucket_width, start_time, end_time)),
+        'channelRollups': time_query(lambda: persistence.fetch_channel_rows(SENSOR_ID, CHANNEL_ID, bucket_width, start_time, end_time)),
+        'locationRollups': time_query(lambda: persistence.fetch_rollup_rows(ROLLUP_KIND_LOCATION, (SENSED_ID, CHANNEL_ID), bucket_width, start_time, end_time, lambda start, end: []))
+      }
+    }
+  finally:
+    shutil.rmtree(directory)
+
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+  main()
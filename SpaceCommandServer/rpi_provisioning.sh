@@ -60,4 +60,6 @@ pip3 install rx
 pip3 install flask
 pip3 install flask-cors
 pip3 install influxdb
+pip3 install waitress
+pip3 install brotli
 
@@ -120,7 +120,7 @@ setup(
     #
     # For an analysis of "install_requires" vs pip's requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['zeroconf', 'paho-mqtt', 'pyyaml', 'rx', 'flask'],  # Optional
+    install_requires=['zeroconf', 'paho-mqtt', 'pyyaml', 'rx', 'flask', 'influxdb>=5.2.3'],  # Optional
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). Users will be able to install these using the "extras"
@@ -133,6 +133,9 @@ setup(
     extras_require={  # Optional
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'async': ['hypercorn', 'asgiref', 'zeroconf>=0.32'],
+        'codecs': ['orjson', 'cbor2', 'msgpack'],
+        'production': ['waitress', 'brotli'],
     },
 
     # If there are data files included in your packages that need to be
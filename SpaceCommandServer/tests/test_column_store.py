@@ -0,0 +1,168 @@
+#
+# Tests for the embedded column store of measurements.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import os
+
+import pytest
+
+from TinkerSpaceCommandServer.persistence.ColumnStore import (BLOCK_HEADER, BLOCK_POINTS, COMPACTED_FILE_NAME, FIRST_TIMESTAMP, LAST_TIMESTAMP,
+                                                              PARTITION_SIZE, VALUE_ENCODING_CONSTANT, VALUE_ENCODING_DECIMAL,
+                                                              VALUE_ENCODING_FLOAT, ColumnStore, decode_block, encode_block,
+                                                              partition_name, read_series_file, series_file_name)
+
+# A time on 2024-03-01, in milliseconds.
+DAY_START = 19783 * PARTITION_SIZE
+
+def value_encoding(block):
+  return BLOCK_HEADER.unpack_from(block, 0)[2]
+
+@pytest.mark.parametrize('values, encoding', [
+  ([21.5] * 10, VALUE_ENCODING_CONSTANT),
+  ([21.5, 21.25, 21.75, -3.5, 0.0, 1000.125], VALUE_ENCODING_DECIMAL),
+  ([1.0, 2.0, 1e12, -1e12, 3.0], VALUE_ENCODING_DECIMAL),
+  ([0.5, 0.123456, 1.0], VALUE_ENCODING_FLOAT),
+  ([0.1 + 0.2, 1.0 / 3.0, 2.0], VALUE_ENCODING_FLOAT),
+  ([1e300, -1e300], VALUE_ENCODING_FLOAT),
+])
+def test_block_round_trip(values, encoding):
+  timestamps = [DAY_START + i * 1000 for i in range(len(values))]
+
+  block = encode_block(timestamps, values)
+
+  assert value_encoding(block) == encoding
+  assert decode_block(block, 0) == (timestamps, values)
+
+def test_block_timestamp_deltas():
+  timestamps = [DAY_START, DAY_START + 1, DAY_START + 300, DAY_START + 70000, DAY_START + 5000000000]
+  values = [float(i) for i in range(len(timestamps))]
+
+  assert decode_block(encode_block(timestamps, values), 0) == (timestamps, values)
+
+def test_small_changes_are_stored_in_bytes():
+  values = [20.0 + (i % 10) / 10.0 for i in range(100)]
+  block = encode_block([DAY_START + i * 100 for i in range(100)], values)
+
+  # A byte for each timestamp and value delta, and the first value.
+  assert len(block) == BLOCK_HEADER.size + 99 + 8 + 99
+
+@pytest.fixture
+def store(tmp_path):
+  column_store = ColumnStore(str(tmp_path / 'store'))
+  column_store.open()
+
+  return column_store
+
+def read_rows(column_store, sensor_id, channel_id, start_time=FIRST_TIMESTAMP, end_time=LAST_TIMESTAMP):
+  return [row for rows in column_store.iter_rows(sensor_id, channel_id, start_time, end_time) for row in rows]
+
+def test_points_survive_a_reopen(store):
+  store.append('sensor.a', 'temperature', 'location.a', DAY_START, 21.5)
+  store.append_many('sensor.a', 'temperature', 'location.a', [DAY_START + 1000, DAY_START + 2000], [21.75, 22.0])
+  store.append('sensor.a', 'humidity', 'location.a', DAY_START, 40.0)
+  store.flush()
+
+  reopened = ColumnStore(store.directory)
+  reopened.open()
+
+  assert read_rows(reopened, 'sensor.a', 'temperature') == [(DAY_START, 'location.a', 21.5), (DAY_START + 1000, 'location.a', 21.75),
+                                                            (DAY_START + 2000, 'location.a', 22.0)]
+  assert read_rows(reopened, 'sensor.a', 'humidity') == [(DAY_START, 'location.a', 40.0)]
+  assert read_rows(reopened, 'sensor.b', 'humidity') == []
+
+def test_pending_points_are_read(store):
+  store.append('sensor.a', 'temperature', 'location.a', DAY_START, 1.0)
+  store.flush()
+  store.append('sensor.a', 'temperature', 'location.a', DAY_START + 1000, 2.0)
+
+  assert store.pending_count() == 1
+  assert [row[2] for row in read_rows(store, 'sensor.a', 'temperature')] == [1.0, 2.0]
+
+def test_time_range(store):
+  store.append_many('sensor.a', 'temperature', 'location.a', [DAY_START + i * 1000 for i in range(10)], [float(i) for i in range(10)])
+  store.flush()
+
+  assert [row[2] for row in read_rows(store, 'sensor.a', 'temperature', DAY_START + 3000, DAY_START + 6000)] == [3.0, 4.0, 5.0]
+  assert read_rows(store, 'sensor.a', 'temperature', DAY_START + 20000, DAY_START + 30000) == []
+
+def test_series_of_several_sensed_entities_are_merged(store):
+  store.append_many('sensor.a', 'temperature', 'location.a', [DAY_START, DAY_START + 2000], [1.0, 3.0])
+  store.append_many('sensor.a', 'temperature', 'location.b', [DAY_START + 1000, DAY_START + 3000], [2.0, 4.0])
+  store.flush()
+
+  assert read_rows(store, 'sensor.a', 'temperature') == [(DAY_START, 'location.a', 1.0), (DAY_START + 1000, 'location.b', 2.0),
+                                                         (DAY_START + 2000, 'location.a', 3.0), (DAY_START + 3000, 'location.b', 4.0)]
+
+def test_points_out_of_order(store):
+  store.append_many('sensor.a', 'temperature', 'location.a', [DAY_START + 5000, DAY_START + 1000], [5.0, 1.0])
+  store.flush()
+  store.append_many('sensor.a', 'temperature', 'location.a', [DAY_START + 3000], [3.0])
+  store.flush()
+
+  assert [row[2] for row in read_rows(store, 'sensor.a', 'temperature')] == [1.0, 3.0, 5.0]
+
+def test_points_are_split_into_partitions(store):
+  timestamps = [DAY_START - 1000, DAY_START, DAY_START + PARTITION_SIZE + 1]
+  store.append_many('sensor.a', 'temperature', 'location.a', timestamps, [1.0, 2.0, 3.0])
+  store.flush()
+
+  assert store.partitions == [DAY_START // PARTITION_SIZE - 1, DAY_START // PARTITION_SIZE, DAY_START // PARTITION_SIZE + 1]
+  assert partition_name(DAY_START // PARTITION_SIZE) == '20240301'
+
+  partitions = list(store.iter_rows('sensor.a', 'temperature', FIRST_TIMESTAMP, LAST_TIMESTAMP))
+  assert [[row[0] for row in rows] for rows in partitions] == [[timestamp] for timestamp in timestamps]
+
+def test_partly_written_block_is_cut_off(store):
+  store.append_many('sensor.a', 'temperature', 'location.a', [DAY_START, DAY_START + 1000], [1.0, 2.0])
+  store.flush()
+
+  path = os.path.join(store.directory, partition_name(DAY_START // PARTITION_SIZE), series_file_name(0))
+  block = encode_block([DAY_START + 2000, DAY_START + 3000], [3.0, 4.0])
+  with open(path, 'ab') as fp:
+    fp.write(block[:len(block) - 3])
+
+  # Reads leave out the block still being written.
+  assert [row[2] for row in read_rows(store, 'sensor.a', 'temperature')] == [1.0, 2.0]
+
+  reopened = ColumnStore(store.directory)
+  reopened.open()
+  reopened.append('sensor.a', 'temperature', 'location.a', DAY_START + 5000, 5.0)
+  reopened.flush()
+
+  assert [row[2] for row in read_rows(reopened, 'sensor.a', 'temperature')] == [1.0, 2.0, 5.0]
+
+def test_compaction_keeps_every_point(store):
+  count = BLOCK_POINTS + 104
+  for start in range(0, count, 50):
+    store.append_many('sensor.a', 'temperature', 'location.a',
+                      [DAY_START + i * 10 for i in range(start, start + 50)], [float(i % 7) for i in range(start, start + 50)])
+    store.flush()
+
+  store.maintain(DAY_START + PARTITION_SIZE)
+
+  partition_directory = os.path.join(store.directory, partition_name(DAY_START // PARTITION_SIZE))
+  assert os.path.exists(os.path.join(partition_directory, COMPACTED_FILE_NAME))
+
+  timestamps, values = read_series_file(os.path.join(partition_directory, series_file_name(0)), FIRST_TIMESTAMP, LAST_TIMESTAMP)
+  assert timestamps == [DAY_START + i * 10 for i in range(count)]
+  assert values == [float(i % 7) for i in range(count)]
+
+  # Two blocks, the first of BLOCK_POINTS points.
+  with open(os.path.join(partition_directory, series_file_name(0)), 'rb') as fp:
+    assert BLOCK_HEADER.unpack(fp.read(BLOCK_HEADER.size))[0] == BLOCK_POINTS
+
+def test_retention(tmp_path):
+  column_store = ColumnStore(str(tmp_path / 'store'), retention_days=2)
+  column_store.open()
+  for day in range(4):
+    column_store.append('sensor.a', 'temperature', 'location.a', DAY_START + day * PARTITION_SIZE, float(day))
+  column_store.flush()
+
+  column_store.maintain(DAY_START + 3 * PARTITION_SIZE)
+
+  assert [row[2] for row in read_rows(column_store, 'sensor.a', 'temperature')] == [2.0, 3.0]
+  assert not os.path.exists(os.path.join(column_store.directory, partition_name(DAY_START // PARTITION_SIZE)))
@@ -0,0 +1,55 @@
+#
+# Tests for downsampling measurement series for display.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import math
+
+from TinkerSpaceCommandServer.persistence.Downsampling import largest_triangle_three_buckets
+
+def test_short_series_is_kept_whole():
+  assert largest_triangle_three_buckets([0, 1, 2], [5, 6, 7], 3) == [0, 1, 2]
+  assert largest_triangle_three_buckets([0, 1, 2], [5, 6, 7], 10) == [0, 1, 2]
+  assert largest_triangle_three_buckets([], [], 10) == []
+
+def test_tiny_thresholds():
+  times = list(range(10))
+
+  assert largest_triangle_three_buckets(times, times, 2) == [0, 9]
+  assert largest_triangle_three_buckets(times, times, 1) == [0]
+  assert largest_triangle_three_buckets(times, times, 0) == []
+
+def test_threshold_points_in_order():
+  times = list(range(1000))
+  values = [math.sin(t / 50.0) for t in times]
+
+  indices = largest_triangle_three_buckets(times, values, 100)
+
+  assert len(indices) == 100
+  assert indices[0] == 0
+  assert indices[-1] == 999
+  assert indices == sorted(set(indices))
+
+def test_one_point_per_bucket():
+  times = list(range(102))
+  values = [t % 7 for t in times]
+
+  indices = largest_triangle_three_buckets(times, values, 12)
+
+  # 100 points between the first and last, in 10 buckets of 10.
+  for bucket, index in enumerate(indices[1:-1]):
+    assert bucket * 10 + 1 <= index <= bucket * 10 + 10
+
+def test_spikes_survive():
+  times = list(range(1000))
+  values = [0.0] * 1000
+  values[123] = 100.0
+  values[777] = -100.0
+
+  indices = largest_triangle_three_buckets(times, values, 20)
+
+  assert 123 in indices
+  assert 777 in indices
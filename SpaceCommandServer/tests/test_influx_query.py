@@ -0,0 +1,91 @@
+#
+# Tests for building InfluxQL queries with bound parameters.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from TinkerSpaceCommandServer.persistence.InfluxQuery import InfluxQuery, quote_identifier, run_queries, run_query
+
+def test_quote_identifier():
+  assert quote_identifier('temperature') == '"temperature"'
+  assert quote_identifier('say "hi"') == '"say \\"hi\\""'
+  assert quote_identifier('back\\slash') == '"back\\\\slash"'
+  assert quote_identifier('a\\"; drop') == '"a\\\\\\"; drop"'
+
+def test_select_everything():
+  assert InfluxQuery('temperature').render() == ('select * from "temperature"', {})
+
+def test_tag_values_are_bound():
+  statement, parameters = InfluxQuery('temperature').where_tag('sensor', "x' or 1=1 --").where_tag('channel', '{p0}').render()
+
+  assert statement == 'select * from "temperature" where "sensor" = $p0 and "channel" = $p1'
+  assert parameters == {'p0': "x' or 1=1 --", 'p1': '{p0}'}
+
+def test_times_are_bound_in_nanoseconds():
+  statement, parameters = InfluxQuery('temperature').where_time(1500, 2500).render()
+
+  assert statement == 'select * from "temperature" where time >= $p0 and time < $p1'
+  assert parameters == {'p0': 1500000000, 'p1': 2500000000}
+
+  statement, parameters = InfluxQuery('temperature').where_time(1500.7).render()
+
+  assert statement == 'select * from "temperature" where time >= $p0'
+  assert parameters == {'p0': 1500000000}
+
+def test_any_tags():
+  query = InfluxQuery('temperature').where_any_tags(['sensor', 'channel'], [('sensor.a', 'temperature'), ('sensor.b', 'air')])
+  statement, parameters = query.render()
+
+  assert statement == ('select * from "temperature" where '
+                       '(("sensor" = $p0 and "channel" = $p1) or ("sensor" = $p2 and "channel" = $p3))')
+  assert parameters == {'p0': 'sensor.a', 'p1': 'temperature', 'p2': 'sensor.b', 'p3': 'air'}
+
+def test_aggregates_grouped_by_time():
+  query = InfluxQuery('temperature').select_aggregates('value').where_tag('sensor', 'sensor.a').where_time(0, 60000).group_by_time(1000.0, 'sensed')
+  statement, parameters = query.render()
+
+  assert statement == ('select count("value") as "count", mean("value") as "mean", min("value") as "min", '
+                       'max("value") as "max", last("value") as "last" from "temperature" '
+                       'where "sensor" = $p0 and time >= $p1 and time < $p2 group by time(1000ms), "sensed" fill(none)')
+  assert parameters == {'p0': 'sensor.a', 'p1': 0, 'p2': 60000000000}
+
+def test_parameter_prefix():
+  statement, parameters = InfluxQuery('temperature', ['"value"']).where_tag('sensor', 'sensor.a').render('q3_')
+
+  assert statement == 'select "value" from "temperature" where "sensor" = $q3_0'
+  assert parameters == {'q3_0': 'sensor.a'}
+
+class RecordingClient:
+  """Stands in for an InfluxDB client, giving back a result for a query.
+  """
+
+  def __init__(self, result):
+    self.result = result
+    self.queries = []
+
+  def query(self, statement, **kwargs):
+    self.queries.append((statement, kwargs))
+
+    return self.result
+
+def test_run_query():
+  client = RecordingClient('result')
+
+  assert run_query(client, InfluxQuery('temperature').where_tag('sensor', 'sensor.a'), chunked=True) == 'result'
+  assert client.queries == [('select * from "temperature" where "sensor" = $p0',
+                             {'bind_params': {'p0': 'sensor.a'}, 'epoch': 'ms', 'chunked': True})]
+
+def test_run_queries_sends_one_request():
+  client = RecordingClient(['first', 'second'])
+  queries = [InfluxQuery('temperature').where_tag('sensor', 'sensor.a'), InfluxQuery('humidity').where_tag('sensor', 'sensor.b')]
+
+  assert run_queries(client, queries) == ['first', 'second']
+  assert client.queries == [('select * from "temperature" where "sensor" = $q0_0; select * from "humidity" where "sensor" = $q1_0',
+                             {'bind_params': {'q0_0': 'sensor.a', 'q1_0': 'sensor.b'}, 'epoch': 'ms'})]
+
+def test_run_queries_with_one_statement():
+  client = RecordingClient('only')
+
+  assert run_queries(client, [InfluxQuery('temperature')]) == ['only']
@@ -0,0 +1,119 @@
+#
+# Tests for the partitioned ingest queue and its overflow policies.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from threading import Event, Thread
+
+import pytest
+
+from TinkerSpaceCommandServer import Constants
+from TinkerSpaceCommandServer.comms.IngestQueue import IngestPartition, IngestQueue
+
+def drain(partition):
+  messages = []
+  while partition.depth():
+    messages.append(partition.get())
+
+  return messages
+
+def test_drop_newest_keeps_the_oldest_messages():
+  partition = IngestPartition(2, Constants.INGEST_OVERFLOW_POLICY_DROP_NEWEST)
+
+  assert partition.put(1)
+  assert partition.put(2)
+  assert not partition.put(3)
+
+  assert drain(partition) == [1, 2]
+  assert partition.dropped_count == 1
+  assert partition.enqueued_count == 2
+
+def test_drop_oldest_keeps_the_newest_messages():
+  partition = IngestPartition(2, Constants.INGEST_OVERFLOW_POLICY_DROP_OLDEST)
+
+  for message in [1, 2, 3, 4]:
+    assert partition.put(message)
+
+  assert drain(partition) == [3, 4]
+  assert partition.dropped_count == 2
+
+def test_block_waits_for_room():
+  partition = IngestPartition(1, Constants.INGEST_OVERFLOW_POLICY_BLOCK)
+  partition.put(1)
+
+  put_done = Event()
+  def put_second():
+    partition.put(2)
+    put_done.set()
+
+  putter = Thread(target=put_second)
+  putter.start()
+
+  assert not put_done.wait(0.1)
+
+  assert partition.get() == 1
+  assert put_done.wait(5.0)
+  assert partition.get() == 2
+
+  putter.join()
+  assert partition.dropped_count == 0
+
+def test_block_gives_up_when_stopped():
+  partition = IngestPartition(1, Constants.INGEST_OVERFLOW_POLICY_BLOCK)
+  partition.put(1)
+
+  results = []
+  putter = Thread(target=lambda: results.append(partition.put(2)))
+  putter.start()
+  partition.stop()
+  putter.join(5.0)
+
+  assert results == [False]
+  assert partition.dropped_count == 1
+
+  # What was queued before the stop is still handed out.
+  assert partition.get() == 1
+  assert partition.get() is None
+
+def test_unknown_overflow_policy_is_rejected():
+  with pytest.raises(ValueError):
+    IngestQueue(lambda *message: None, 2, 10, "dropSome")
+
+def test_messages_with_the_same_key_are_processed_in_order():
+  processed = {}
+  def handler(key, sequence):
+    processed.setdefault(key, []).append(sequence)
+
+  ingest_queue = IngestQueue(handler, 4, 10000, Constants.INGEST_OVERFLOW_POLICY_BLOCK)
+  ingest_queue.start()
+
+  keys = [b'sensor.a', b'sensor.b', b'sensor.c', None]
+  for sequence in range(500):
+    for key in keys:
+      ingest_queue.put(key, key, sequence)
+
+  ingest_queue.stop()
+
+  assert ingest_queue.processed_count() == 2000
+  assert ingest_queue.dropped_count() == 0
+  for key in keys:
+    assert processed[key] == list(range(500))
+
+def test_handler_errors_do_not_stop_the_worker():
+  processed = []
+  def handler(value):
+    if value == 1:
+      raise ValueError("bad message")
+    processed.append(value)
+
+  ingest_queue = IngestQueue(handler, 1, 10, Constants.INGEST_OVERFLOW_POLICY_BLOCK)
+  ingest_queue.start()
+  for value in range(3):
+    ingest_queue.put(None, value)
+  ingest_queue.stop()
+
+  assert processed == [0, 2]
+  assert ingest_queue.processed_count() == 3
@@ -0,0 +1,146 @@
+#
+# Tests for the in-memory channel measurement history.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from TinkerSpaceCommandServer.entities.Entities import (PhysicalLocationEntityDescription, SensorChannelDetail, SensorEntityDescription,
+                                                        SensedEntityActiveModel, SensorActiveChannelModel, SensorEntityActiveModel)
+from TinkerSpaceCommandServer.entities.MeasurementHistory import MeasurementHistory
+
+def fill(history, count, start=0):
+  for i in range(start, start + count):
+    history.append(float(i), i)
+
+def test_empty_history():
+  history = MeasurementHistory(4)
+
+  assert len(history) == 0
+  assert list(history.get_window()[0]) == []
+  assert list(history.get_latest(2)[1]) == []
+
+def test_timestamps_are_milliseconds():
+  history = MeasurementHistory(4)
+  history.append(1.5, 10)
+
+  timestamps, values = history.get_window()
+
+  assert timestamps.typecode == 'q'
+  assert list(timestamps) == [1500]
+  assert list(values) == [10.0]
+
+def test_only_the_capacity_is_kept():
+  history = MeasurementHistory(4)
+
+  # Enough to have been cut back several times.
+  for count in range(1, 40):
+    history.append(float(count - 1), count - 1)
+
+    timestamps, values = history.get_window()
+    expected = list(range(max(0, count - 4), count))
+    assert len(history) == len(expected)
+    assert list(values) == expected
+    assert list(timestamps) == [value * 1000 for value in expected]
+
+  assert len(history.points) <= history.trim_length
+
+def test_capacity_of_one():
+  history = MeasurementHistory(1)
+  fill(history, 10)
+
+  assert list(history.get_window()[1]) == [9.0]
+
+def test_get_latest():
+  history = MeasurementHistory(8)
+  fill(history, 20)
+
+  assert list(history.get_latest(3)[1]) == [17.0, 18.0, 19.0]
+  assert list(history.get_latest(100)[1]) == list(range(12, 20))
+
+def test_window_times():
+  history = MeasurementHistory(16)
+  fill(history, 10)
+
+  # Start inclusive, end exclusive.
+  assert list(history.get_window(3, 6)[1]) == [3.0, 4.0, 5.0]
+  assert list(history.get_window(start_time=7)[1]) == [7.0, 8.0, 9.0]
+  assert list(history.get_window(end_time=2)[1]) == [0.0, 1.0]
+  assert list(history.get_window(20, 30)[1]) == []
+
+def test_history_window_limits_the_age():
+  history = MeasurementHistory(16, window=3)
+  fill(history, 10)
+
+  assert list(history.get_window()[1]) == [6.0, 7.0, 8.0, 9.0]
+
+  # An earlier start time is still limited by the window.
+  assert list(history.get_window(start_time=2)[1]) == [6.0, 7.0, 8.0, 9.0]
+  assert list(history.get_window(start_time=8)[1]) == [8.0, 9.0]
+
+def test_extend():
+  history = MeasurementHistory(8)
+  fill(history, 3)
+
+  history.extend([3.0, 4.0], [3, 4])
+
+  timestamps, values = history.get_window()
+  assert list(values) == [0.0, 1.0, 2.0, 3.0, 4.0]
+  assert list(timestamps) == [0, 1000, 2000, 3000, 4000]
+
+def test_extend_larger_than_the_capacity():
+  history = MeasurementHistory(4)
+  fill(history, 2)
+
+  history.extend([float(i) for i in range(10, 20)], list(range(10, 20)))
+
+  timestamps, values = history.get_window()
+  assert list(values) == [16.0, 17.0, 18.0, 19.0]
+  assert list(timestamps) == [16000, 17000, 18000, 19000]
+
+def test_bad_value_leaves_nothing_behind():
+  history = MeasurementHistory(4)
+  history.append(1.0, 1)
+
+  try:
+    history.append(2.0, 'on')
+  except ValueError:
+    pass
+
+  timestamps, values = history.get_window()
+  assert list(timestamps) == [1000]
+  assert list(values) == [1.0]
+
+def channel_model(history_size):
+  sensor_description = SensorEntityDescription('sensor.a', 'Sensor A', 'A test sensor', None, None, None)
+  location_description = PhysicalLocationEntityDescription('location.a', 'Location A', 'A test location')
+  channel_description = SensorChannelDetail('temperature', 'Temperature', 'Temperature', 'temperature', 'celsius')
+
+  return SensorActiveChannelModel('temperature', channel_description,
+                                  SensorEntityActiveModel(sensor_description), SensedEntityActiveModel(location_description),
+                                  history_size)
+
+def test_channel_keeps_numeric_values():
+  channel = channel_model(4)
+
+  channel.update_current_value(20.5, 1.0)
+  channel.update_current_value('on', 2.0)
+  channel.update_current_values([21.0, 21.5], [3.0, 4.0])
+
+  assert channel.current_value == 21.5
+  assert channel.time_last_update == 4.0
+  assert list(channel.get_history()[1]) == [20.5, 21.0, 21.5]
+
+def test_channel_without_history():
+  channel = channel_model(0)
+
+  channel.update_current_value(20.5, 1.0)
+  channel.update_current_values([21.0, 21.5], [3.0, 4.0])
+
+  assert channel.history is None
+  assert channel.current_value == 21.5
+
+  timestamps, values = channel.get_history()
+  assert list(timestamps) == []
+  assert list(values) == []
@@ -0,0 +1,137 @@
+#
+# Tests for the scheduler that tracks when sensors go offline.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from TinkerSpaceCommandServer.entities.Entities import SensorEntityDescription, SensorEntityActiveModel
+from TinkerSpaceCommandServer.processor.SensorProcessor import OfflineDeadlineScheduler
+
+def sensor_model(name, sensor_update_time_limit=None, sensor_heartbeat_time_limit=None, created=0.0):
+  description = SensorEntityDescription('sensor.{}'.format(name), name, 'A test sensor', None,
+                                        sensor_update_time_limit, sensor_heartbeat_time_limit)
+  sensor = SensorEntityActiveModel(description)
+  sensor._item_creation_time = created
+
+  return sensor
+
+def scheduled_sensors(scheduler):
+  return [entry[2] for entry in scheduler.deadlines]
+
+def test_deadline_from_the_last_value():
+  scheduler = OfflineDeadlineScheduler(0.1)
+  sensor = sensor_model('a', sensor_update_time_limit=10)
+  sensor.offline_deadline_scheduler = scheduler
+
+  sensor.value_update_received(None, 100.0)
+
+  assert scheduler.deadlines[0][0] == 110.0
+  assert scheduler.wait_timeout(105.0) == 5.0
+  assert scheduler.wait_timeout(109.99) == 0.1
+
+def test_no_deadline_without_time_limits():
+  scheduler = OfflineDeadlineScheduler(0.1)
+  sensor = sensor_model('a')
+
+  scheduler.schedule(sensor)
+
+  assert not sensor.offline_deadline_scheduled
+  assert scheduler.wait_timeout(0.0) is None
+
+def test_sensor_is_scheduled_once():
+  scheduler = OfflineDeadlineScheduler(0.1)
+  sensor = sensor_model('a', sensor_update_time_limit=10)
+  sensor.offline_deadline_scheduler = scheduler
+
+  for update_time in [100.0, 101.0, 102.0]:
+    sensor.value_update_received(None, update_time)
+
+  assert scheduled_sensors(scheduler) == [sensor]
+
+def test_expired_sensor_goes_offline():
+  scheduler = OfflineDeadlineScheduler(0.1)
+  sensor = sensor_model('a', sensor_update_time_limit=10)
+  sensor.offline_deadline_scheduler = scheduler
+  sensor.value_update_received(None, 100.0)
+
+  scheduler.process_expired(109.0)
+  assert not sensor.offline_signaled
+
+  scheduler.process_expired(111.0)
+  assert sensor.offline_signaled
+
+  # Nothing more to watch for until the sensor is heard from again.
+  assert not sensor.offline_deadline_scheduled
+  assert scheduler.wait_timeout(111.0) is None
+
+  sensor.value_update_received(None, 120.0)
+  assert not sensor.offline_signaled
+  assert scheduler.deadlines[0][0] == 130.0
+
+def test_later_update_moves_the_deadline():
+  scheduler = OfflineDeadlineScheduler(0.1)
+  sensor = sensor_model('a', sensor_update_time_limit=10)
+  sensor.offline_deadline_scheduler = scheduler
+  sensor.value_update_received(None, 100.0)
+
+  # The heap entry is left alone by the update, and only recalculated when
+  # it comes to the top.
+  sensor.value_update_received(None, 105.0)
+  assert scheduler.deadlines[0][0] == 110.0
+
+  scheduler.process_expired(111.0)
+
+  assert not sensor.offline_signaled
+  assert scheduled_sensors(scheduler) == [sensor]
+  assert scheduler.deadlines[0][0] == 115.0
+
+def test_only_expired_sensors_are_checked():
+  scheduler = OfflineDeadlineScheduler(0.1)
+  sensors = [sensor_model(str(limit), sensor_update_time_limit=limit) for limit in [30, 10, 20]]
+  for sensor in sensors:
+    sensor.offline_deadline_scheduler = scheduler
+    sensor.value_update_received(None, 100.0)
+
+  scheduler.process_expired(115.0)
+
+  assert [sensor.offline_signaled for sensor in sensors] == [False, True, False]
+  assert sorted(scheduled_sensors(scheduler), key=id) == sorted([sensors[0], sensors[2]], key=id)
+  assert scheduler.deadlines[0][0] == 120.0
+
+def test_heartbeat_deadline():
+  scheduler = OfflineDeadlineScheduler(0.1)
+  sensor = sensor_model('a', sensor_heartbeat_time_limit=5)
+  sensor.offline_deadline_scheduler = scheduler
+
+  sensor.heartbeat_received(100.0)
+  sensor.value_update_received(None, 102.0)
+
+  scheduler.process_expired(106.0)
+  assert not sensor.offline_signaled
+  assert scheduler.deadlines[0][0] == 107.0
+
+  scheduler.process_expired(108.0)
+  assert sensor.offline_signaled
+
+def test_online_without_a_value_uses_the_creation_time():
+  scheduler = OfflineDeadlineScheduler(0.1)
+  sensor = sensor_model('a', sensor_update_time_limit=10, created=50.0)
+  sensor.offline_deadline_scheduler = scheduler
+
+  # A heartbeat puts the sensor online before it has sent any value.
+  sensor.heartbeat_received(55.0)
+  assert scheduler.deadlines[0][0] == 60.0
+
+  scheduler.process_expired(61.0)
+  assert sensor.offline_signaled
+
+def test_never_heard_from_goes_offline():
+  scheduler = OfflineDeadlineScheduler(0.1)
+  sensor = sensor_model('a', sensor_update_time_limit=10, created=50.0)
+
+  scheduler.schedule(sensor)
+  scheduler.process_expired(61.0)
+
+  assert sensor.offline_signaled
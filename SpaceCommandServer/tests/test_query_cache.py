@@ -0,0 +1,100 @@
+#
+# Tests for the query cache and the aligned bucket widths it is keyed by.
+#
+
+#
+# Written by Keith Hughes
+#
+
+from TinkerSpaceCommandServer.persistence.QueryCache import CLOCK_BUCKET_WIDTHS, QueryCache, round_up_bucket_width
+
+SECOND = 1000
+MINUTE = 60 * SECOND
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+def test_widths_under_a_second():
+  assert round_up_bucket_width(0) == 1
+  assert round_up_bucket_width(1) == 1
+  assert round_up_bucket_width(3) == 5
+  assert round_up_bucket_width(120) == 200
+  assert round_up_bucket_width(999.5) == SECOND
+
+def test_widths_line_up_with_the_clock():
+  assert round_up_bucket_width(1001) == 2 * SECOND
+  assert round_up_bucket_width(40 * SECOND) == MINUTE
+  assert round_up_bucket_width(7 * MINUTE) == 10 * MINUTE
+  assert round_up_bucket_width(4 * HOUR) == 6 * HOUR
+  assert round_up_bucket_width(DAY) == DAY
+
+  for width in CLOCK_BUCKET_WIDTHS:
+    assert round_up_bucket_width(width) == width
+    assert DAY % width == 0
+
+def test_widths_over_a_day():
+  assert round_up_bucket_width(DAY + 1) == 2 * DAY
+  assert round_up_bucket_width(3 * DAY) == 5 * DAY
+  assert round_up_bucket_width(11 * DAY) == 20 * DAY
+
+def test_nearby_ranges_share_a_width():
+  # Charts of slightly different ranges, 300 points each.
+  widths = {round_up_bucket_width((HOUR + extra * SECOND) / 300) for extra in range(0, 60)}
+
+  assert widths == {15 * SECOND}
+
+def test_bucket_size():
+  query_cache = QueryCache(10, HOUR, 100)
+
+  assert query_cache.get_bucket_size(None) == HOUR
+  assert query_cache.get_bucket_size(MINUTE) == 100 * MINUTE
+
+def test_split_rows_into_aligned_buckets():
+  query_cache = QueryCache(10, 10, 1)
+  rows = [(time, 'location.a', time) for time in [100, 105, 109, 110, 125, 129]]
+
+  buckets = query_cache.split_rows(rows, 100, 130, 10)
+
+  assert [start for start, rows in buckets] == [100, 110, 120]
+  assert [[row[0] for row in rows] for start, rows in buckets] == [[100, 105, 109], [110], [125, 129]]
+
+def test_only_written_buckets_are_cached():
+  query_cache = QueryCache(10, 10, 1)
+
+  query_cache.put(('sensor.a', 'channel', None, 100), 110, [(100, 'location.a', 1.0)], 109)
+  assert query_cache.get(('sensor.a', 'channel', None, 100)) is None
+
+  query_cache.put(('sensor.a', 'channel', None, 100), 110, [(100, 'location.a', 1.0)], 110)
+  assert query_cache.get(('sensor.a', 'channel', None, 100)) == [(100, 'location.a', 1.0)]
+
+  assert query_cache.hits == 1
+  assert query_cache.misses == 1
+
+def test_rows_are_copied():
+  query_cache = QueryCache(10, 10, 1)
+  key = ('sensor.a', 'channel', 5, 100)
+  query_cache.put(key, 110, [[100, 'location.a', 1, 2.0, 2.0, 2.0, 2.0]], 200)
+
+  rows = query_cache.get(key)
+  rows[0][3] = 99.0
+  rows.append(None)
+
+  assert query_cache.get(key) == [[100, 'location.a', 1, 2.0, 2.0, 2.0, 2.0]]
+
+def test_least_recently_used_is_evicted():
+  query_cache = QueryCache(2, 10, 1)
+  keys = [('sensor.a', 'channel', None, start) for start in [0, 10, 20]]
+
+  query_cache.put(keys[0], 10, [], 100)
+  query_cache.put(keys[1], 20, [], 100)
+  query_cache.get(keys[0])
+  query_cache.put(keys[2], 30, [], 100)
+
+  assert query_cache.get(keys[0]) == []
+  assert query_cache.get(keys[1]) is None
+  assert query_cache.get(keys[2]) == []
+
+def test_size_zero_caches_nothing():
+  query_cache = QueryCache(0, 10, 1)
+  query_cache.put(('sensor.a', 'channel', None, 0), 10, [], 100)
+
+  assert query_cache.get(('sensor.a', 'channel', None, 0)) is None
@@ -0,0 +1,144 @@
+#
+# Tests for the minute, hour and day rollups of measurements.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import pytest
+
+from TinkerSpaceCommandServer.entities.Entities import (PhysicalLocationEntityDescription, SensorChannelDetail, SensorEntityDescription,
+                                                        SensedEntityActiveModel, SensorActiveChannelModel, SensorEntityActiveModel)
+from TinkerSpaceCommandServer.events.StandardEvents import SensorChannelMeasurementEvent, SensorChannelMeasurementBatchEvent
+from TinkerSpaceCommandServer.persistence.Rollups import (ROLLUP_KIND_CHANNEL, ROLLUP_KIND_LOCATION, RollupAccumulator, RollupObserver,
+                                                          combine_rollup_rows, select_tier)
+
+SECOND = 1000
+MINUTE = 60 * SECOND
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# The start of 2024-03-01, in milliseconds.
+T0 = 19783 * DAY
+
+CHANNEL_KEY = ('sensor.a', 'temperature', 'location.a')
+LOCATION_KEY = ('location.a', 'temperature')
+
+def test_select_tier():
+  assert select_tier(SECOND) is None
+  assert select_tier(30 * SECOND) is None
+  assert select_tier(90 * SECOND) is None
+  assert select_tier(MINUTE) == 0
+  assert select_tier(15 * MINUTE) == 0
+  assert select_tier(HOUR) == 1
+  assert select_tier(6 * HOUR) == 1
+  assert select_tier(DAY) == 2
+  assert select_tier(7 * DAY) == 2
+
+def test_combine_rollup_rows():
+  rows = [
+    [T0, 'location.a', 2, 10.0, 8.0, 12.0, 12.0],
+    [T0, 'location.b', 1, 50.0, 50.0, 50.0, 50.0],
+    [T0 + MINUTE, 'location.a', 6, 20.0, 5.0, 30.0, 25.0],
+    [T0 + 5 * MINUTE, 'location.a', 1, 7.0, 7.0, 7.0, 7.0],
+  ]
+
+  combined = combine_rollup_rows(rows, 5 * MINUTE)
+
+  assert len(combined) == 3
+  assert sorted(combined[:2], key=lambda row: row[1]) == [[T0, 'location.a', 8, 17.5, 5.0, 30.0, 25.0], [T0, 'location.b', 1, 50.0, 50.0, 50.0, 50.0]]
+  assert combined[2] == [T0 + 5 * MINUTE, 'location.a', 1, 7.0, 7.0, 7.0, 7.0]
+
+def test_combine_leaves_out_non_finite_rows():
+  rows = [
+    [T0, 'location.a', 2, 10.0, 8.0, 12.0, 12.0],
+    [T0 + MINUTE, 'location.a', 3, float('nan'), float('nan'), float('nan'), float('nan')],
+  ]
+
+  assert combine_rollup_rows(rows, HOUR) == [[T0, 'location.a', 2, 10.0, 8.0, 12.0, 12.0]]
+
+def rows_by_key(tier_changes):
+  return {(kind, key): row for kind, key, row in tier_changes}
+
+def test_minutes_roll_up_into_hours_and_days():
+  accumulator = RollupAccumulator(5 * SECOND, 100)
+  accumulator.open(T0)
+
+  accumulator.add('sensor.a', 'temperature', 'location.a', 'temperature', T0 + SECOND, 1.0)
+  accumulator.add('sensor.a', 'temperature', 'location.a', 'temperature', T0 + 2 * SECOND, 3.0)
+  accumulator.add('sensor.a', 'temperature', 'location.a', 'temperature', T0 + MINUTE + SECOND, 5.0)
+
+  minutes, hours, days = accumulator.take_changes(T0 + MINUTE + SECOND)
+
+  assert sorted(row for kind, key, row in minutes if kind == ROLLUP_KIND_CHANNEL) == [(T0, 2, 2.0, 1.0, 3.0, 3.0), (T0 + MINUTE, 1, 5.0, 5.0, 5.0, 5.0)]
+  assert rows_by_key(hours) == {
+    (ROLLUP_KIND_CHANNEL, CHANNEL_KEY): (T0, 3, 3.0, 1.0, 5.0, 5.0),
+    (ROLLUP_KIND_LOCATION, LOCATION_KEY): (T0, 3, 3.0, 1.0, 5.0, 5.0)
+  }
+  assert rows_by_key(days) == rows_by_key(hours)
+
+  # The first minute closes and goes into its hour, which is no different
+  # for it.
+  minutes, hours, days = accumulator.take_changes(T0 + 2 * MINUTE + 5 * SECOND)
+
+  assert minutes == []
+  assert rows_by_key(hours)[(ROLLUP_KIND_CHANNEL, CHANNEL_KEY)] == (T0, 3, 3.0, 1.0, 5.0, 5.0)
+  assert accumulator.get_rows(1, ROLLUP_KIND_LOCATION, LOCATION_KEY, T0, T0 + HOUR) == {
+    (T0, 'location.a'): [T0, 'location.a', 3, 3.0, 1.0, 5.0, 5.0]
+  }
+
+  # Too late for its minute.
+  accumulator.add('sensor.a', 'temperature', 'location.a', 'temperature', T0 + SECOND, 100.0)
+  assert accumulator.late_points == 1
+
+  # Closing everything leaves nothing open.
+  accumulator.take_changes(None)
+  assert accumulator.get_rows(2, ROLLUP_KIND_CHANNEL, ('sensor.a', 'temperature'), T0, T0 + DAY) == {}
+
+def test_persisted_bucket_is_added_to():
+  accumulator = RollupAccumulator(5 * SECOND, 100)
+  accumulator.open(T0)
+
+  accumulator.seed(1, ROLLUP_KIND_CHANNEL, CHANNEL_KEY, (T0, 2, 10.0, 5.0, 15.0, 15.0))
+  accumulator.add('sensor.a', 'temperature', 'location.a', 'temperature', T0 + SECOND, 20.0)
+
+  rows = accumulator.get_rows(1, ROLLUP_KIND_CHANNEL, ('sensor.a', 'temperature'), T0, T0 + HOUR)
+
+  assert rows[(T0, 'location.a')][2:] == [3, pytest.approx(40.0 / 3), 5.0, 20.0, 20.0]
+
+def test_unwritten_rows_are_kept_up_to_the_limit():
+  accumulator = RollupAccumulator(5 * SECOND, 2)
+  accumulator.open(T0)
+
+  rows = [(ROLLUP_KIND_CHANNEL, CHANNEL_KEY, (T0 + i * MINUTE, 1, float(i), float(i), float(i), float(i))) for i in range(3)]
+  accumulator.keep_unwritten(0, rows)
+
+  assert accumulator.rows_dropped == 1
+  assert accumulator.take_changes(T0)[0] == rows[1:]
+  assert accumulator.take_changes(T0)[0] == []
+
+def channel_model():
+  sensor_description = SensorEntityDescription('sensor.a', 'Sensor A', 'A test sensor', None, None, None)
+  location_description = PhysicalLocationEntityDescription('location.a', 'Location A', 'A test location')
+  channel_description = SensorChannelDetail('temperature', 'Temperature', 'Temperature', 'temperature', 'celsius')
+
+  return SensorActiveChannelModel('temperature', channel_description,
+                                  SensorEntityActiveModel(sensor_description), SensedEntityActiveModel(location_description))
+
+def test_observer_leaves_out_non_finite_values():
+  accumulator = RollupAccumulator(5 * SECOND, 100)
+  accumulator.open(T0)
+  observer = RollupObserver(accumulator)
+  channel = channel_model()
+  sensor = channel.sensor_entity_active_model
+  sensed = channel.sensed_entity_active_model
+
+  observer.on_next(SensorChannelMeasurementEvent(sensor, sensed, channel, 1.0, (T0 + SECOND) / 1000.0))
+  observer.on_next(SensorChannelMeasurementEvent(sensor, sensed, channel, float('nan'), (T0 + 2 * SECOND) / 1000.0))
+  observer.on_next(SensorChannelMeasurementBatchEvent(sensor, sensed, channel, [3, float('inf'), 'on'],
+                                                      [(T0 + 3 * SECOND) / 1000.0, (T0 + 4 * SECOND) / 1000.0, (T0 + 5 * SECOND) / 1000.0]))
+
+  rows = accumulator.get_rows(0, ROLLUP_KIND_CHANNEL, ('sensor.a', 'temperature'), T0, T0 + MINUTE)
+
+  assert rows == {(T0, 'location.a'): [T0, 'location.a', 2, 2.0, 1.0, 3.0, 3.0]}
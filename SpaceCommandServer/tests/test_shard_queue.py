@@ -0,0 +1,105 @@
+#
+# Tests for the shared memory queue between the server and the ingest shards.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import multiprocessing
+
+import pytest
+
+from TinkerSpaceCommandServer.comms.ShardQueue import FRAME_HEADER, ShardQueue
+
+@pytest.fixture
+def make_queue():
+  queues = []
+  def make(capacity):
+    shard_queue = ShardQueue(capacity, multiprocessing.get_context('fork'))
+    queues.append(shard_queue)
+
+    return shard_queue
+
+  yield make
+
+  for shard_queue in queues:
+    shard_queue.close()
+    shard_queue.unlink()
+
+def test_frames_come_out_in_order(make_queue):
+  shard_queue = make_queue(1024)
+
+  frames = [b'first', b'', b'third frame']
+  for frame in frames:
+    assert shard_queue.put(frame)
+
+  assert shard_queue.depth() == sum(FRAME_HEADER.size + len(frame) for frame in frames)
+  assert shard_queue.get_frames(0) == frames
+  assert shard_queue.depth() == 0
+  assert shard_queue.get_frames(0) == []
+
+def test_frames_wrap_around_the_ring(make_queue):
+  # A capacity that the frames don't divide, so frames and their lengths
+  # are split at every position around the ring.
+  shard_queue = make_queue(37)
+
+  for i in range(500):
+    frames = [bytes([i % 256]) * (i % 11)]
+    if i % 3 == 2:
+      frames.append(b'x' * 5)
+
+    for frame in frames:
+      assert shard_queue.put(frame)
+
+    assert shard_queue.get_frames(0) == frames
+
+def test_full_queue_drops(make_queue):
+  shard_queue = make_queue(32)
+
+  assert shard_queue.put(b'a' * 12)
+  assert shard_queue.put(b'b' * 12)
+  assert not shard_queue.put(b'c')
+  assert shard_queue.dropped_count == 1
+
+  assert shard_queue.get_frames(0) == [b'a' * 12, b'b' * 12]
+  assert shard_queue.put(b'c')
+
+def test_frame_too_big_to_ever_fit(make_queue):
+  shard_queue = make_queue(32)
+
+  assert shard_queue.max_frame_size() == 32 - FRAME_HEADER.size
+  assert shard_queue.put(b'a' * shard_queue.max_frame_size())
+  shard_queue.get_frames(0)
+
+  assert not shard_queue.put(b'a' * 29)
+  assert shard_queue.dropped_count == 1
+
+  with pytest.raises(ValueError):
+    shard_queue.put(b'a' * 29, block=True)
+
+def consume(shard_queue, count, results):
+  frames = []
+  while len(frames) < count:
+    frames.extend(shard_queue.get_frames(1.0))
+
+  results.put(frames)
+
+def test_frames_pass_between_processes(make_queue):
+  context = multiprocessing.get_context('fork')
+  shard_queue = make_queue(256)
+  results = context.Queue()
+
+  frames = [str(i).encode() * (i % 20) for i in range(2000)]
+
+  consumer = context.Process(target=consume, args=(shard_queue, len(frames), results))
+  consumer.start()
+
+  for frame in frames:
+    assert shard_queue.put(frame, block=True)
+
+  received = results.get(timeout=30)
+  consumer.join(30)
+
+  assert received == frames
+  assert shard_queue.dropped_count == 0
@@ -0,0 +1,260 @@
+#
+# Tests for the write-ahead log of measurements waiting to be written to
+# InfluxDB.
+#
+
+#
+# Written by Keith Hughes
+#
+
+import os
+import time
+
+from TinkerSpaceCommandServer.persistence.PointValues import PointsRejectedError
+from TinkerSpaceCommandServer.persistence.WriteAheadLog import BLOCK_POINTS, WalReader, WalShipperThread, WriteAheadLog
+
+def open_log(directory, segment_size=1 << 20, max_size=1 << 30, writable=True):
+  wal = WriteAheadLog(str(directory), segment_size, max_size)
+  wal.open(writable)
+
+  return wal
+
+def append_points(wal, series_key, start, count):
+  for i in range(start, start + count):
+    wal.append(series_key, i * 1000000, float(i))
+
+def read_all(wal, sequence=0, offset=0):
+  reader = WalReader(wal, sequence, offset)
+  try:
+    return reader.read(1 << 30)
+  finally:
+    reader.close()
+
+def points_of(series_key, start, count):
+  return [(series_key, i * 1000000, float(i)) for i in range(start, start + count)]
+
+def test_points_survive_a_restart(tmp_path):
+  wal = open_log(tmp_path)
+  append_points(wal, 'temperature,sensor=a', 0, 3)
+  append_points(wal, 'humidity,sensor=a', 10, 2)
+  assert wal.sync() == 5
+  wal.append_many('temperature,sensor=a', [3000000, 4000000], [3.0, 4.0])
+  wal.close()
+
+  wal = open_log(tmp_path, writable=False)
+
+  assert read_all(wal) == (points_of('temperature,sensor=a', 0, 3) + points_of('humidity,sensor=a', 10, 2) +
+                           points_of('temperature,sensor=a', 3, 2))
+
+def test_large_sync_is_split_into_blocks(tmp_path):
+  wal = open_log(tmp_path)
+  append_points(wal, 'temperature,sensor=a', 0, 2 * BLOCK_POINTS + 10)
+  wal.sync()
+
+  reader = WalReader(wal, 0, 0)
+  first = reader.read(1)
+  rest = reader.read(1 << 30)
+  reader.close()
+
+  assert first == points_of('temperature,sensor=a', 0, BLOCK_POINTS)
+  assert rest == points_of('temperature,sensor=a', BLOCK_POINTS, BLOCK_POINTS + 10)
+
+def test_partly_written_block_is_cut_off(tmp_path):
+  wal = open_log(tmp_path)
+  append_points(wal, 'temperature,sensor=a', 0, 5)
+  wal.sync()
+  good_size = wal.size()
+  append_points(wal, 'temperature,sensor=a', 5, 5)
+  wal.close()
+
+  # The server stopped part way through writing the second block.
+  path = wal.segment_path(1)
+  os.truncate(path, os.path.getsize(path) - 7)
+
+  wal = open_log(tmp_path)
+
+  assert os.path.getsize(path) == good_size
+  append_points(wal, 'temperature,sensor=a', 20, 1)
+  wal.sync()
+
+  assert read_all(wal) == points_of('temperature,sensor=a', 0, 5) + points_of('temperature,sensor=a', 20, 1)
+
+def test_block_failing_its_crc_is_cut_off(tmp_path):
+  wal = open_log(tmp_path)
+  append_points(wal, 'temperature,sensor=a', 0, 5)
+  wal.sync()
+  good_size = wal.size()
+  append_points(wal, 'temperature,sensor=a', 5, 5)
+  wal.close()
+
+  path = wal.segment_path(1)
+  with open(path, 'r+b') as fp:
+    fp.seek(-3, os.SEEK_END)
+    byte = fp.read(1)
+    fp.seek(-3, os.SEEK_END)
+    fp.write(bytes([byte[0] ^ 0xff]))
+
+  wal = open_log(tmp_path, writable=False)
+
+  assert os.path.getsize(path) == good_size
+  assert read_all(wal) == points_of('temperature,sensor=a', 0, 5)
+
+def test_reader_skips_an_unreadable_older_segment(tmp_path):
+  wal = open_log(tmp_path, segment_size=1)
+  append_points(wal, 'temperature,sensor=a', 0, 5)
+  wal.sync()
+  append_points(wal, 'temperature,sensor=a', 5, 5)
+  wal.sync()
+  wal.close()
+
+  # Only the last segment is checked when the log is opened.
+  with open(wal.segment_path(1), 'r+b') as fp:
+    fp.seek(-1, os.SEEK_END)
+    fp.write(b'\xff')
+
+  wal = open_log(tmp_path, segment_size=1, writable=False)
+
+  assert read_all(wal) == points_of('temperature,sensor=a', 5, 5)
+
+def test_checkpoint(tmp_path):
+  wal = open_log(tmp_path)
+  assert wal.read_checkpoint() == (0, 0)
+
+  append_points(wal, 'temperature,sensor=a', 0, 5)
+  wal.sync()
+
+  reader = WalReader(wal, 0, 0)
+  reader.read(1)
+  checkpoint = (reader.sequence, reader.offset)
+  wal.write_checkpoint(*checkpoint)
+  reader.close()
+
+  append_points(wal, 'temperature,sensor=a', 5, 5)
+  wal.close()
+
+  wal = open_log(tmp_path, writable=False)
+
+  assert checkpoint[0] == 1 and 0 < checkpoint[1] < wal.segment_sizes[1]
+  assert wal.read_checkpoint() == checkpoint
+
+  # The series were named in the part already shipped.
+  assert read_all(wal, *checkpoint) == points_of('temperature,sensor=a', 5, 5)
+
+def test_shipped_segments_are_removed(tmp_path):
+  wal = open_log(tmp_path, segment_size=1)
+  for start in range(0, 15, 5):
+    append_points(wal, 'temperature,sensor=a', start, 5)
+    wal.sync()
+
+  assert wal.segments == [1, 2, 3, 4]
+
+  wal.remove_segments_before(3)
+  assert wal.segments == [3, 4]
+  assert sorted(os.listdir(str(tmp_path))) == ['0000000000000003.wal', '0000000000000004.wal']
+
+  # The segment being written is always kept.
+  wal.remove_segments_before(10)
+  assert wal.segments == [4]
+
+def test_oldest_segments_are_evicted_over_the_maximum_size(tmp_path):
+  # Each sync fills a segment of 140 bytes.
+  wal = open_log(tmp_path, segment_size=1, max_size=200)
+  for start in range(0, 15, 5):
+    append_points(wal, 'temperature,sensor=a', start, 5)
+    wal.sync()
+
+  assert wal.segments == [3, 4]
+  assert wal.segments_evicted == 2
+  assert wal.bytes_evicted == 280
+
+  # A reader from before the evicted segments moves on to what is left.
+  assert read_all(wal, 1, 100) == points_of('temperature,sensor=a', 10, 5)
+
+class RecordingPersistence:
+  """Stands in for the InfluxDB persistence the shipper writes to.
+  """
+
+  def __init__(self, results):
+    # What each write does in turn, True, False or an exception to raise.
+    # Writes after the last succeed.
+    self.results = list(results)
+    self.written = []
+    self.points_rejected = 0
+    self.written_time = None
+
+  def create_line(self, series_key, timestamp, value):
+    return (series_key, timestamp, value)
+
+  def write_points(self, lines):
+    result = self.results.pop(0) if self.results else True
+    if isinstance(result, Exception):
+      raise result
+    if result:
+      self.written.extend(lines)
+
+    return result
+
+def ship(wal, persistence):
+  """Run a shipper until it has caught up with the log.
+  """
+
+  persistence.written_time = None
+
+  shipper = WalShipperThread(wal, persistence, BLOCK_POINTS, 0.001, 0.01)
+  shipper.start()
+
+  deadline = time.time() + 30
+  while persistence.written_time is None and time.time() < deadline:
+    time.sleep(0.001)
+
+  shipper.stop()
+  shipper.join(30)
+
+  assert persistence.written_time == wal.synced_time
+
+def test_shipper_writes_and_checkpoints(tmp_path):
+  wal = open_log(tmp_path)
+  append_points(wal, 'temperature,sensor=a', 0, 5)
+  wal.sync()
+
+  # InfluxDB is down for the first two tries.
+  persistence = RecordingPersistence([False, False])
+  ship(wal, persistence)
+
+  assert persistence.results == []
+  assert persistence.written == points_of('temperature,sensor=a', 0, 5)
+  assert wal.read_checkpoint() == (1, wal.segment_sizes[1])
+
+def test_shipper_leaves_out_non_finite_values(tmp_path):
+  wal = open_log(tmp_path)
+  wal.append('temperature,sensor=a', 1000000, 1.0)
+  wal.append('temperature,sensor=a', 2000000, float('nan'))
+  wal.append('temperature,sensor=a', 3000000, float('inf'))
+  wal.sync()
+
+  persistence = RecordingPersistence([])
+  ship(wal, persistence)
+
+  assert persistence.written == [('temperature,sensor=a', 1000000, 1.0)]
+  assert persistence.points_rejected == 2
+
+def test_shipper_skips_a_rejected_block(tmp_path):
+  wal = open_log(tmp_path)
+  append_points(wal, 'temperature,sensor=a', 0, 5)
+  wal.sync()
+  append_points(wal, 'temperature,sensor=a', 5, 5)
+  wal.sync()
+
+  persistence = RecordingPersistence([PointsRejectedError("field type conflict")])
+  ship(wal, persistence)
+
+  # Both syncs were shipped as one batch, which was refused.
+  assert persistence.written == []
+  assert persistence.points_rejected == 10
+  assert wal.read_checkpoint() == (1, wal.segment_sizes[1])
+
+  append_points(wal, 'temperature,sensor=a', 10, 5)
+  wal.sync()
+  ship(wal, persistence)
+
+  assert persistence.written == points_of('temperature,sensor=a', 10, 5)
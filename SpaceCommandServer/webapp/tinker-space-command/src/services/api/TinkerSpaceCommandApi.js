@@ -1,9 +1,11 @@
 import {Rxios} from 'rxios'
 
+const API_BASE_URL = 'http://ess-master1.local:5000/api/v1'
+
 const http = new Rxios({
   // all regular axios request configuration options are valid here
   // Check https://github.com/axios/axios#request-config
-  baseURL: 'http://ess-master1.local:5000/api/v1'
+  baseURL: API_BASE_URL
 })
 
 export default {
@@ -15,11 +17,15 @@ export default {
     return http.get('/sensor/' + sensorId)
   },
 
-  getSensorChannelDataQuery (sensorId, channelId, startDate, endDate) {
-    return http.get(
-      '/query/sensor/' + sensorId + '?channel=' + channelId +
+  getSensorChannelDataQuery (sensorId, channelId, startDate, endDate, maxPoints) {
+    var url = '/query/sensor/' + sensorId + '?channel=' + channelId +
       '&startDateTime=' + startDate + 'T00:00:00MST' +
-      '&endDateTime=' + endDate + 'T00:00:00MST')
+      '&endDateTime=' + endDate + 'T00:00:00MST'
+    if (maxPoints) {
+      url += '&maxPoints=' + maxPoints
+    }
+
+    return http.get(url)
   },
 
   getSpaces () {
@@ -28,5 +34,17 @@ export default {
 
   getSpace (spaceId) {
     return http.get('/space/' + spaceId)
+  },
+
+  // Get an EventSource for live measurements. A snapshot event has the
+  // current value of every channel, then update events have only the
+  // channels that changed. Leave out sensorIds to hear about every sensor.
+  getLiveUpdates (sensorIds) {
+    var url = API_BASE_URL + '/live'
+    if (sensorIds && sensorIds.length) {
+      url += '?' + sensorIds.map(sensorId => 'sensor=' + encodeURIComponent(sensorId)).join('&')
+    }
+
+    return new EventSource(url)
   }
 }
@@ -0,0 +1,104 @@
+#
+# Encoders for the messages a space node sends to the Tinker Space Command
+# server.
+#
+# The message format is described in docs/MessageFormat.md. CBOR needs the
+# cbor2 package and MessagePack needs the msgpack package.
+#
+# pip install cbor2
+# pip install msgpack
+#
+# Written by Keith M. Hughes
+#
+
+import json
+
+# The content type bytes for binary encoded messages sent on the plain sensor
+# input topic.
+CONTENT_TYPE_CBOR = 0x01
+CONTENT_TYPE_MSGPACK = 0x02
+
+ENCODING_JSON = "json"
+ENCODING_CBOR = "cbor"
+ENCODING_MSGPACK = "msgpack"
+
+def create_measurement_message(sensor_id, values, compact=False):
+  """Create a measurement message.
+
+     values is a map of channel IDs to the value for the channel. A compact
+     message gives the values directly rather than in a map with a value
+     field.
+  """
+
+  if compact:
+    data = dict(values)
+  else:
+    data = { channel_id: { "value": value } for channel_id, value in values.items() }
+
+  return {
+    "sensorId": sensor_id,
+    "messageType": "measurement",
+    "data": data
+  }
+
+def create_measurement_batch_message(sensor_id, samples):
+  """Create a measurement batch message.
+
+     samples is a map of channel IDs to a list of (time offset, value) pairs
+     for the channel, oldest first. The time offsets are in milliseconds
+     relative to when the message is sent.
+  """
+
+  return {
+    "sensorId": sensor_id,
+    "messageType": "measurementBatch",
+    "data": { channel_id: [[offset, value] for offset, value in channel_samples]
+              for channel_id, channel_samples in samples.items() }
+  }
+
+def create_heartbeat_message(sensor_id):
+  """Create a heartbeat message.
+  """
+
+  return {
+    "sensorId": sensor_id,
+    "messageType": "heartbeat"
+  }
+
+def encode_message(message, encoding=ENCODING_JSON, content_type_prefix=False):
+  """Encode a message for sending over MQTT.
+
+     Binary encodings sent on the plain sensor input topic need the content
+     type prefix. Ones sent on the topic for the encoding, e.g.
+     /tinkermill/sensors/data/cbor, do not.
+  """
+
+  if encoding == ENCODING_JSON:
+    return json.dumps(message, separators=(',', ':')).encode('utf-8')
+  elif encoding == ENCODING_CBOR:
+    import cbor2
+
+    payload = cbor2.dumps(message)
+    content_type = CONTENT_TYPE_CBOR
+  elif encoding == ENCODING_MSGPACK:
+    import msgpack
+
+    payload = msgpack.packb(message, use_bin_type=True)
+    content_type = CONTENT_TYPE_MSGPACK
+  else:
+    raise ValueError("Unknown message encoding {}".format(encoding))
+
+  if content_type_prefix:
+    return bytes([content_type]) + payload
+  else:
+    return payload
+
+def get_topic(sensor_input_topic, encoding=ENCODING_JSON):
+  """Get the topic to send messages with the given encoding on, without a
+     content type prefix.
+  """
+
+  if encoding == ENCODING_JSON:
+    return sensor_input_topic
+  else:
+    return "{}/{}".format(sensor_input_topic, encoding)